@@ -0,0 +1,161 @@
+import logging
+import os
+from dataclasses import dataclass
+
+from archiveExpansion import ARCHIVE_EXPANSION_ENABLED
+from archiveExpansion import is_archive
+from lazyClients import slack_client
+from replyRendering import section
+from replyRendering import truncate
+from s3Streaming import MB
+from textExtraction import find_extractor
+from tracing import span
+from transport import KeyedRateLimiter
+from transport import call_with_retries
+
+# Admission control of the files of a Slack message, decided from the `size`, `mimetype` and `filetype` Slack gives
+# before anything is downloaded. Every file is routed to a tier:
+#     fast    small images and text-like files, ingested and analyzed right away
+#     heavy   large files, archives (expanded, see archiveExpansion.py), audio and video: ingested by the heavy job
+#             queue (see jobQueue.py) and at most HEAVY_FILE_CONCURRENCY at a time per process, analyzed only when
+#             OpenAI can and they are small enough
+#     reject  too large, a rejected filetype or over the rate limits: not downloaded, explained in the thread
+# set env var ADMISSION_ENABLED to false to admit every file to the fast tier
+# set env vars ADMISSION_FAST_MAX_MB (default 25), ADMISSION_HEAVY_MAX_MB (default 2048) and
+# ADMISSION_HEAVY_ANALYSIS_MAX_MB (default 100) for the size limits of the tiers
+# set env var ADMISSION_REJECT_FILETYPES to the comma separated Slack filetypes to reject (default apk,dmg,exe,iso,msi)
+# set env vars ADMISSION_USER_FILES_PER_MINUTE, ADMISSION_USER_BURST, ADMISSION_CHANNEL_FILES_PER_MINUTE and
+# ADMISSION_CHANNEL_BURST for the token buckets per Slack user and per channel (per Lambda instance)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FAST = 'fast'
+HEAVY = 'heavy'
+REJECT = 'reject'
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_FAST_MAX_BYTES = int(float(os.environ.get('ADMISSION_FAST_MAX_MB', '25')) * MB)
+ADMISSION_HEAVY_MAX_BYTES = int(float(os.environ.get('ADMISSION_HEAVY_MAX_MB', '2048')) * MB)
+ADMISSION_HEAVY_ANALYSIS_MAX_BYTES = int(float(os.environ.get('ADMISSION_HEAVY_ANALYSIS_MAX_MB', '100')) * MB)
+ADMISSION_REJECT_FILETYPES = {t.strip() for t in os.environ.get('ADMISSION_REJECT_FILETYPES',
+                                                                'apk,dmg,exe,iso,msi').split(',') if t.strip()}
+ADMISSION_USER_FILES_PER_MINUTE = float(os.environ.get('ADMISSION_USER_FILES_PER_MINUTE', '30'))
+ADMISSION_USER_BURST = int(os.environ.get('ADMISSION_USER_BURST', '20'))
+ADMISSION_CHANNEL_FILES_PER_MINUTE = float(os.environ.get('ADMISSION_CHANNEL_FILES_PER_MINUTE', '120'))
+ADMISSION_CHANNEL_BURST = int(os.environ.get('ADMISSION_CHANNEL_BURST', '60'))
+
+# the archives expanded by archiveExpansion.py are analyzed, these are only stored
+OPAQUE_ARCHIVE_FILETYPES = {'7z', 'rar'}
+# the Slack filetypes the OpenAI assistant (file_search) can read, besides the local extractors and images
+ASSISTANT_FILETYPES = {'pdf', 'doc', 'docx', 'pptx', 'html', 'markdown', 'latex', 'rtf'}
+# all rejected: the explanation is the only reply of the Slack message
+ALL_REJECTED_TEXT = "None of the files were accepted."
+
+_user_limiter = KeyedRateLimiter(ADMISSION_USER_FILES_PER_MINUTE / 60, ADMISSION_USER_BURST)
+_channel_limiter = KeyedRateLimiter(ADMISSION_CHANNEL_FILES_PER_MINUTE / 60, ADMISSION_CHANNEL_BURST)
+
+
+@dataclass(frozen=True)
+class Admission:
+    """ The tier of a file, whether it is analyzed and why not (or why it is rejected). """
+    tier: str
+    analyze: bool = True
+    reason: str = ''
+
+
+def _mb(size):
+    return f"{size / MB:,.0f} MB"
+
+
+def is_analyzable(metadata):
+    """ Whether OpenAI can describe the file: images, text-like files and the documents of the assistant. """
+    mimetype = metadata['mimetype']
+    return (mimetype.startswith(('image/', 'text/')) or metadata['filetype'] in ASSISTANT_FILETYPES or
+            find_extractor(mimetype, metadata['name']) is not None)
+
+
+def classify(metadata):
+    """ The tier of a file from what Slack says about it, without the rate limits. """
+    if not ADMISSION_ENABLED:
+        return Admission(FAST)
+    size = int(metadata['size'])
+    mimetype = metadata['mimetype']
+    filetype = metadata['filetype']
+    if filetype in ADMISSION_REJECT_FILETYPES:
+        return Admission(REJECT, False, f"`{filetype}` files are not accepted")
+    if size > ADMISSION_HEAVY_MAX_BYTES:
+        return Admission(REJECT, False, f"it is {_mb(size)}, over the {_mb(ADMISSION_HEAVY_MAX_BYTES)} limit")
+    if is_archive(metadata):
+        return Admission(HEAVY, ARCHIVE_EXPANSION_ENABLED,
+                         '' if ARCHIVE_EXPANSION_ENABLED else "archives are stored without an analysis")
+    if filetype in OPAQUE_ARCHIVE_FILETYPES:
+        return Admission(HEAVY, False, f"`{filetype}` archives are stored without an analysis")
+    if mimetype.startswith(('video/', 'audio/')):
+        return Admission(HEAVY, False, "audio and video files are stored without an analysis")
+    if not is_analyzable(metadata):
+        return Admission(FAST if size <= ADMISSION_FAST_MAX_BYTES else HEAVY, False,
+                         f"`{filetype}` files can't be analyzed")
+    if size <= ADMISSION_FAST_MAX_BYTES:
+        return Admission(FAST)
+    if size <= ADMISSION_HEAVY_ANALYSIS_MAX_BYTES:
+        return Admission(HEAVY)
+    return Admission(HEAVY, False, f"it is {_mb(size)}, files over {_mb(ADMISSION_HEAVY_ANALYSIS_MAX_BYTES)} are "
+                                   f"stored without an analysis")
+
+
+def _rate_limited(metadata):
+    """ Takes a token of the user's and of the channel's bucket, or neither. """
+    user, channel = metadata['user'], metadata['slack_orig_channel']
+    if not _user_limiter.try_acquire(user):
+        return "you are sharing files faster than they can be processed, please try again in a minute"
+    if not _channel_limiter.try_acquire(channel):
+        _user_limiter.refund(user)
+        return "this channel is sharing files faster than they can be processed, please try again in a minute"
+    return None
+
+
+def admit(slack_metadata_records):
+    """ Decides the tier of every file of a Slack message and applies the per user and per channel rate limits to
+    the admitted ones. The admitted records are annotated with their `admission_tier` (and `analysis_skipped`) and
+    re-indexed as the files of the message. Returns the admitted records and the rejected ones with their
+    admission. """
+    admitted, rejected = list(), list()
+    for md in slack_metadata_records:
+        admission = classify(md)
+        if admission.tier != REJECT and ADMISSION_ENABLED:
+            limited = _rate_limited(md)
+            if limited:
+                admission = Admission(REJECT, False, limited)
+        if admission.tier == REJECT:
+            logger.info(f"Rejected {md['name']} ({md['size']} bytes, {md['filetype']}): {admission.reason}")
+            rejected.append((md, admission))
+            continue
+        md['admission_tier'] = admission.tier
+        if not admission.analyze:
+            md['analysis_skipped'] = admission.reason
+        admitted.append(md)
+    for index, md in enumerate(admitted):
+        md.update({'event_file_index': index, 'event_file_count': len(admitted)})
+    return admitted, rejected
+
+
+def job_tier(slack_metadata_records):
+    """ The files of a message stay together (one reply), a message with a heavy file is a heavy job. """
+    return HEAVY if any(md.get('admission_tier') == HEAVY for md in slack_metadata_records) else FAST
+
+
+def post_rejections(rejected, all_rejected):
+    """ Tells the Slack user right away which files were not accepted and why, in the thread of their message. """
+    if not rejected:
+        return
+    first, _ = rejected[0]
+    lines = "\n".join(f"`{md['name']}`: {admission.reason}" for md, admission in rejected)
+    text = ALL_REJECTED_TEXT if all_rejected else f"{len(rejected)} of the files were not accepted."
+    try:
+        with span('rejection_reply', files=len(rejected)):
+            call_with_retries('slack.chat.postMessage', slack_client().chat_postMessage,
+                              channel=first['slack_orig_channel'], thread_ts=first['slack_orig_ts'], text=text,
+                              blocks=[section(truncate(f"These files were not accepted :no_entry_sign:  \n"
+                                                       f"{lines}"))])
+    except Exception as e:
+        logger.warning(f"Could not post the rejected files in the thread {first['slack_orig_ts']}: {e}")
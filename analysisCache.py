@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Cache of the OpenAI analyses keyed by the content of the file, so re-uploads of the same file are not analyzed again.
+# set env var ANALYSIS_CACHE_BACKEND to `local`, `s3` or `none` (default `local`)
+# set env var ANALYSIS_CACHE_DIR for the `local` backend (default /tmp/file-slacker-analysis-cache)
+# set env var ANALYSIS_CACHE_TTL_SECONDS (default 30 days) and ANALYSIS_CACHE_MAX_ENTRIES (default 1000, `local` only)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_ANALYSIS_CACHE_DIR = '/tmp/file-slacker-analysis-cache'
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 1000
+S3_CACHE_FOLDER = 'cache/analysis'
+
+
+def analysis_cache_key(file_sha256, prompt, model):
+    """ The analysis depends on the file content, the prompt and the model, a change to any of them is a miss. """
+    return hashlib.sha256(f"{file_sha256}\n{model}\n{prompt}".encode('utf-8')).hexdigest()
+
+
+class AnalysisCache:
+    """ Maps an `analysis_cache_key` to the text of the analysis. """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, analysis):
+        raise NotImplementedError
+
+
+class NoAnalysisCache(AnalysisCache):
+
+    def get(self, key):
+        return None
+
+    def put(self, key, analysis):
+        pass
+
+
+class LocalAnalysisCache(AnalysisCache):
+    """ One JSON file per analysis in a local directory. Entries expire after `ttl_seconds`, and the least recently
+    used entries are evicted once there are more than `max_entries`. """
+
+    def __init__(self, directory=DEFAULT_ANALYSIS_CACHE_DIR, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if entry['created'] + self.ttl_seconds < time.time():
+            self._remove(path)
+            return None
+        # the modification time is the last use, for the LRU eviction
+        os.utime(path)
+        return entry['analysis']
+
+    def put(self, key, analysis):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': time.time(), 'analysis': analysis}, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = list()
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        entries.append((os.path.getmtime(path), path))
+                    except FileNotFoundError:
+                        continue
+            if len(entries) <= self.max_entries:
+                return
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_entries]:
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class S3AnalysisCache(AnalysisCache):
+    """ The analyses stored under `cache/analysis/` in the fileSlackerBot bucket, shared by all the Lambda
+    instances. Entries expire after `ttl_seconds`; use a bucket lifecycle rule on the prefix to remove them. """
+
+    def __init__(self, bucket, s3_client, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.bucket = bucket
+        self.s3 = s3_client
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=f"{S3_CACHE_FOLDER}/{key}.json")
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        entry = json.loads(response['Body'].read().decode('utf-8'))
+        if entry['created'] + self.ttl_seconds < time.time():
+            return None
+        return entry['analysis']
+
+    def put(self, key, analysis):
+        self.s3.put_object(Body=json.dumps({'created': time.time(), 'analysis': analysis}),
+                           Bucket=self.bucket,
+                           Key=f"{S3_CACHE_FOLDER}/{key}.json",
+                           ContentType='application/json')
+
+
+_analysis_cache = None
+
+
+def get_analysis_cache(bucket=None, s3_client=None):
+    """ Returns the analysis cache configured by the environment, created once per Lambda instance. The bucket and
+    S3 client are only used by the `s3` backend. """
+    global _analysis_cache
+    if _analysis_cache is None:
+        backend = os.environ.get('ANALYSIS_CACHE_BACKEND', 'local').lower()
+        ttl_seconds = int(os.environ.get('ANALYSIS_CACHE_TTL_SECONDS', DEFAULT_TTL_SECONDS))
+        if backend == 'local':
+            _analysis_cache = LocalAnalysisCache(
+                os.environ.get('ANALYSIS_CACHE_DIR', DEFAULT_ANALYSIS_CACHE_DIR),
+                ttl_seconds,
+                int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)))
+        elif backend == 's3':
+            _analysis_cache = S3AnalysisCache(bucket, s3_client, ttl_seconds)
+        elif backend == 'none':
+            _analysis_cache = NoAnalysisCache()
+        else:
+            raise ValueError(f"Unknown ANALYSIS_CACHE_BACKEND: {backend}")
+    return _analysis_cache
+
+
+def set_analysis_cache(analysis_cache):
+    """ Overrides the configured analysis cache. """
+    global _analysis_cache
+    _analysis_cache = analysis_cache
@@ -0,0 +1,435 @@
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime
+from datetime import timezone
+
+from s3Streaming import DEFAULT_PART_SIZE
+from s3Streaming import MB
+from s3Streaming import stream_to_s3
+from transport import is_throttle
+
+# Expansion of zip, tar (optionally gzip/bzip2/xz compressed) and gzip archives into their members, read as a stream:
+# a tar is read front to back from its S3 object, a zip is read in place with ranged GETs (its directory is at the
+# end), neither is extracted whole to memory or disk. Every member is stored under a derived prefix of the archive,
+# small members are stored and analyzed by a pool of ARCHIVE_MEMBER_CONCURRENCY threads while the archive is read on.
+# One row per member is written to `members/dt=YYYY-MM-DD/<s3_key>-members.json` (newline delimited JSON, see
+# athena/archive_members_table.sql).
+# set env var ARCHIVE_EXPANSION_ENABLED to false to store archives without an analysis
+# set env vars ARCHIVE_MAX_MEMBERS (default 2000), ARCHIVE_MAX_MEMBER_MB (default 100), ARCHIVE_MAX_TOTAL_MB (default
+# 2048) and ARCHIVE_MAX_RATIO (default 100, uncompressed to compressed bytes) to bound the expansion, a zip bomb stops
+# it at the first limit reached
+# set env var ARCHIVE_MEMBER_CONCURRENCY (default 8) for the members stored and analyzed at a time
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ARCHIVE_EXPANSION_ENABLED = os.environ.get('ARCHIVE_EXPANSION_ENABLED', 'true').lower() == 'true'
+ARCHIVE_MAX_MEMBERS = int(os.environ.get('ARCHIVE_MAX_MEMBERS', '2000'))
+ARCHIVE_MAX_MEMBER_BYTES = int(float(os.environ.get('ARCHIVE_MAX_MEMBER_MB', '100')) * MB)
+ARCHIVE_MAX_TOTAL_BYTES = int(float(os.environ.get('ARCHIVE_MAX_TOTAL_MB', '2048')) * MB)
+ARCHIVE_MAX_RATIO = float(os.environ.get('ARCHIVE_MAX_RATIO', '100'))
+ARCHIVE_MEMBER_CONCURRENCY = int(os.environ.get('ARCHIVE_MEMBER_CONCURRENCY', '8'))
+# the compression ratio is only checked past this many uncompressed bytes, small archives of text compress well
+RATIO_CHECK_MIN_BYTES = 1 * MB
+# the ranged GETs of a zip read this much at a time
+RANGE_BLOCK_SIZE = 1 * MB
+READ_CHUNK_SIZE = 1 * MB
+MEMBERS_FOLDER = 'members'
+MEMBERS_SUFFIX = '-members.json'
+ARCHIVE_FILETYPES = ('zip', 'gzip', 'tar', 'tgz')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tgz', '.gz', '.tbz2', '.txz')
+
+
+class ArchiveError(Exception):
+    """ The file is not an archive this module can read, or it is corrupt. """
+    pass
+
+
+class ArchiveLimitExceeded(ArchiveError):
+    """ The archive expands past one of the limits, e.g. a zip bomb. """
+    pass
+
+
+@dataclass
+class ArchiveExpansion:
+    """ The members of an archive: one row per stored member (with its analysis) and the skipped ones with why. """
+    kind: str
+    members: list = field(default_factory=list)
+    skipped: list = field(default_factory=list)
+    stopped: str = None
+    stats: dict = field(default_factory=dict)
+
+
+def is_archive(metadata):
+    name = metadata['name'].lower()
+    return metadata['filetype'] in ARCHIVE_FILETYPES or name.endswith(ARCHIVE_EXTENSIONS)
+
+
+class S3RangeReader(io.RawIOBase):
+    """ A seekable read-only file of an S3 object, read with ranged GETs of RANGE_BLOCK_SIZE. The last two blocks
+    are kept, reading a zip goes back and forth between a member's local header and its data. """
+
+    def __init__(self, s3, bucket, key, size, block_size=RANGE_BLOCK_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.block_size = block_size
+        self.position = 0
+        self.requests = 0
+        self._blocks = dict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def _get(self, start, end):
+        self.requests += 1
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+
+    def _block(self, index):
+        block = self._blocks.get(index)
+        if block is None:
+            start = index * self.block_size
+            block = self._get(start, min(start + self.block_size, self.size))
+            if len(self._blocks) >= 2:
+                del self._blocks[next(iter(self._blocks))]
+            self._blocks[index] = block
+        return block
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        if end - self.position > self.block_size:
+            data = self._get(self.position, end)
+        else:
+            index = self.position // self.block_size
+            offset = self.position - index * self.block_size
+            data = self._block(index)[offset:offset + end - self.position]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class _CountingReader(io.RawIOBase):
+    """ Counts the bytes read from the (compressed) archive, for the compression ratio. """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fileobj.read(len(buffer))
+        buffer[:len(data)] = data
+        self.count += len(data)
+        return len(data)
+
+
+def _detect(head):
+    """ The kind of archive from its first bytes. """
+    if head.startswith((b'PK\x03\x04', b'PK\x05\x06')):
+        return 'zip'
+    if head.startswith((b'\x1f\x8b', b'BZh', b'\xfd7zXZ')) or head[257:262] == b'ustar':
+        return 'tar'
+    raise ArchiveError("not a zip, tar or gzip archive")
+
+
+def safe_member_path(path):
+    """ The member path without its root, `.` and `..` parts, so it stays under the derived prefix. """
+    parts = [p for p in posixpath.normpath(path.replace('\\', '/')).split('/') if p not in ('', '.', '..')]
+    return '/'.join(parts)
+
+
+class _Limits:
+    """ The running totals of an expansion checked against the limits. """
+
+    def __init__(self, compressed_count=None):
+        self.members = 0
+        self.total_bytes = 0
+        self.compressed_count = compressed_count
+
+    def check_member(self, size, compressed_size=None):
+        if self.members >= ARCHIVE_MAX_MEMBERS:
+            raise ArchiveLimitExceeded(f"more than {ARCHIVE_MAX_MEMBERS} members")
+        if self.total_bytes + size > ARCHIVE_MAX_TOTAL_BYTES:
+            raise ArchiveLimitExceeded(f"more than {ARCHIVE_MAX_TOTAL_BYTES // MB} MB expanded")
+        if compressed_size is not None and size > RATIO_CHECK_MIN_BYTES and \
+                size > ARCHIVE_MAX_RATIO * max(compressed_size, 1):
+            raise ArchiveLimitExceeded(f"a member compressed more than {ARCHIVE_MAX_RATIO:.0f} times")
+
+    def read(self, fileobj, declared_size):
+        """ Yields the chunks of a member, however much it really expands to (its header may lie). """
+        read = 0
+        while True:
+            chunk = fileobj.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            read += len(chunk)
+            self.total_bytes += len(chunk)
+            if read > declared_size or read > ARCHIVE_MAX_MEMBER_BYTES:
+                raise ArchiveLimitExceeded(f"a member expands past its declared {declared_size} bytes")
+            if self.total_bytes > ARCHIVE_MAX_TOTAL_BYTES:
+                raise ArchiveLimitExceeded(f"more than {ARCHIVE_MAX_TOTAL_BYTES // MB} MB expanded")
+            if self.compressed_count is not None and self.total_bytes > RATIO_CHECK_MIN_BYTES and \
+                    self.total_bytes > ARCHIVE_MAX_RATIO * max(self.compressed_count.count, 1):
+                raise ArchiveLimitExceeded(f"the archive compressed more than {ARCHIVE_MAX_RATIO:.0f} times")
+            yield chunk
+
+
+def _zip_members(fileobj, limits):
+    """ Yields (path, size, compressed size, file object) of the regular files of a zip, without a file object for
+    the ones too large or encrypted. """
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f"corrupt zip: {e}")
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            if info.file_size > ARCHIVE_MAX_MEMBER_BYTES:
+                yield info.filename, info.file_size, info.compress_size, None
+                continue
+            limits.check_member(info.file_size, info.compress_size)
+            if info.flag_bits & 0x1:
+                yield info.filename, info.file_size, info.compress_size, None
+                continue
+            with archive.open(info) as member:
+                yield info.filename, info.file_size, info.compress_size, member
+
+
+def _tar_members(fileobj, limits):
+    """ Yields (path, size, compressed size, file object) of the regular files of a tar, read as a stream. """
+    try:
+        archive = tarfile.open(fileobj=fileobj, mode='r|*')
+    except tarfile.TarError as e:
+        raise ArchiveError(f"corrupt tar: {e}")
+    with archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            if info.size > ARCHIVE_MAX_MEMBER_BYTES:
+                yield info.name, info.size, None, None
+                continue
+            limits.check_member(info.size)
+            yield info.name, info.size, None, archive.extractfile(info)
+
+
+def _gzip_member(fileobj, name, limits):
+    """ A gzip that is not a tar holds a single file, of a size only known once it is read (None). """
+    limits.check_member(0)
+    yield name[:-3] if name.lower().endswith('.gz') else name, None, None, gzip.GzipFile(fileobj=fileobj)
+
+
+def _buffered(chunks, part_size):
+    """ Reads the chunks of a member of unknown size up to `part_size`. Returns its content when it fit, else None
+    and all of its chunks to be streamed. """
+    head, size = list(), 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size > part_size:
+            return None, itertools.chain(head, chunks)
+    return b''.join(head), None
+
+
+def member_metadata(archive_metadata, index, path, size, compressed_size, key):
+    """ The metadata of a member, shaped like the metadata of an upload so it goes through the same analysis. """
+    name = posixpath.basename(path)
+    extension = os.path.splitext(name)[1].lower()
+    return {
+        'id': f"{archive_metadata['id']}-{index:05d}",
+        'created': archive_metadata['created'],
+        'name': name,
+        'path': path,
+        'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+        'filetype': extension[1:] or 'binary',
+        'file_extension': extension or 'None',
+        'size': size,
+        'compressed_size': compressed_size,
+        's3_key': key,
+        'archive_id': archive_metadata['id'],
+        'archive_s3_key': archive_metadata['s3_key'],
+        'slack_event_id': archive_metadata.get('slack_event_id'),
+        'user': archive_metadata.get('user'),
+        'slack_orig_channel': archive_metadata.get('slack_orig_channel'),
+    }
+
+
+def expand_archive(s3, bucket, archive_metadata, key, size, body, analyze, prefix,
+                   concurrency=ARCHIVE_MEMBER_CONCURRENCY, part_size=DEFAULT_PART_SIZE):
+    """ Expands the archive stored at `key` (its content is `body` when it fit in a single part) into `prefix`, and
+    calls `analyze(member_metadata, content)` for every stored member on a pool of `concurrency` threads; `content`
+    is None for members larger than a part, they are read back from S3. Returns the `ArchiveExpansion`. A member
+    whose analysis OpenAI throttled stops the expansion and its error is raised, so the ingest of the archive is
+    retried rather than the member recorded as failed. """
+    if body is not None:
+        head = body[:512]
+    else:
+        head = s3.get_object(Bucket=bucket, Key=key, Range='bytes=0-511')['Body'].read()
+    kind = _detect(head)
+    expansion = ArchiveExpansion(kind)
+    start = time.perf_counter()
+    if kind == 'zip':
+        limits = _Limits()
+        members = _zip_members(io.BytesIO(body) if body is not None else
+                               io.BufferedReader(S3RangeReader(s3, bucket, key, size), RANGE_BLOCK_SIZE), limits)
+    else:
+        source = _open_counted(s3, bucket, key, body)
+        limits = _Limits(source)
+        members = _tar_members(io.BufferedReader(source, READ_CHUNK_SIZE), limits)
+
+    in_flight = threading.BoundedSemaphore(concurrency * 2)
+    lock = threading.Lock()
+    used_keys = set()
+    throttled = list()
+
+    def store_and_analyze(md, content):
+        try:
+            if content is not None:
+                s3.put_object(Body=content, Bucket=bucket, Key=md['s3_key'], ContentType=md['mimetype'])
+            analyze(md, content)
+        except Exception as e:
+            if is_throttle(e):
+                throttled.append(e)
+                return
+            logger.warning(f"Could not store or analyze the member {md['path']} of {archive_metadata['name']}: {e}")
+            md['status'] = f"failed: {e}"
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='archive-member') as executor:
+        try:
+            members = _members_or_gzip(members, expansion, body, s3, bucket, key, archive_metadata, limits)
+            for path, declared_size, compressed_size, fileobj in members:
+                if throttled:
+                    break
+                safe_path = safe_member_path(path)
+                too_large = declared_size is not None and declared_size > ARCHIVE_MAX_MEMBER_BYTES
+                skipped = ('no name' if not safe_path else
+                           f"over {ARCHIVE_MAX_MEMBER_BYTES // MB} MB" if too_large else
+                           'encrypted' if fileobj is None else None)
+                if skipped:
+                    expansion.skipped.append({'path': path, 'reason': skipped})
+                    continue
+                index = limits.members
+                limits.members += 1
+                member_key = f"{prefix}/{safe_path}"
+                if member_key in used_keys:
+                    member_key = f"{prefix}/{index:05d}-{safe_path}"
+                used_keys.add(member_key)
+                chunks = limits.read(fileobj, ARCHIVE_MAX_MEMBER_BYTES if declared_size is None else declared_size)
+                if declared_size is None:
+                    content, chunks = _buffered(chunks, part_size)
+                else:
+                    content = b''.join(chunks) if declared_size <= part_size else None
+                small = content is not None
+                if small:
+                    md = member_metadata(archive_metadata, index, path, len(content), compressed_size, member_key)
+                    md.update({'sha256': hashlib.sha256(content).hexdigest(), 'byte_count': len(content)})
+                else:
+                    md = member_metadata(archive_metadata, index, path, declared_size, compressed_size, member_key)
+                    streamed = stream_to_s3(s3, chunks, bucket, member_key, md['mimetype'], part_size=part_size)
+                    md.update({'size': streamed.size, 'sha256': streamed.sha256, 'byte_count': streamed.size})
+                with lock:
+                    expansion.members.append(md)
+                in_flight.acquire()
+                executor.submit(store_and_analyze, md, content if small else None)
+        except ArchiveLimitExceeded as e:
+            logger.warning(f"Stopped expanding {archive_metadata['name']}: {e}")
+            expansion.stopped = str(e)
+        except (ArchiveError, tarfile.TarError, zipfile.BadZipFile, EOFError, OSError) as e:
+            logger.warning(f"Stopped reading {archive_metadata['name']}: {e}")
+            expansion.stopped = f"unreadable: {e}"
+    if throttled:
+        raise throttled[0]
+
+    expansion.members.sort(key=lambda md: md['id'])
+    for md in expansion.members:
+        md.setdefault('status', 'analyzed' if md.get('ai_analysis') else 'stored')
+    expansion.stats = {
+        'kind': expansion.kind,
+        'members': len(expansion.members),
+        'skipped': len(expansion.skipped),
+        'expanded_bytes': sum(md['size'] for md in expansion.members),
+        'analyzed': sum(1 for md in expansion.members if md['status'] == 'analyzed'),
+        'by_filetype': _count_by(md['filetype'] for md in expansion.members),
+        'stopped': expansion.stopped,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+    return expansion
+
+
+def _members_or_gzip(members, expansion, body, s3, bucket, key, archive_metadata, limits):
+    """ The members of a zip or tar. A gzip that turns out not to be a tar is read again as a single file, the kind
+    of the expansion is then `gzip`. """
+    try:
+        yield from members
+    except ArchiveError:
+        if expansion.kind != 'tar' or limits.members:
+            raise
+        expansion.kind = 'gzip'
+        source = _open_counted(s3, bucket, key, body)
+        limits.compressed_count = source
+        try:
+            yield from _gzip_member(io.BufferedReader(source, READ_CHUNK_SIZE), archive_metadata['name'], limits)
+        except gzip.BadGzipFile as e:
+            raise ArchiveError(f"not a tar or gzip: {e}")
+
+
+def _open_counted(s3, bucket, key, body):
+    return _CountingReader(io.BytesIO(body) if body is not None else s3.get_object(Bucket=bucket, Key=key)['Body'])
+
+
+def _count_by(values):
+    counts = dict()
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return dict(sorted(counts.items(), key=lambda item: -item[1]))
+
+
+def members_s3_key(archive_metadata):
+    dt = datetime.fromtimestamp(int(float(archive_metadata['created'])), timezone.utc).strftime('%Y-%m-%d')
+    return f"{MEMBERS_FOLDER}/dt={dt}/{archive_metadata['s3_key']}{MEMBERS_SUFFIX}"
+
+
+MEMBER_ROW_FIELDS = ('id', 'archive_id', 'archive_s3_key', 'slack_event_id', 'user', 'slack_orig_channel', 'created',
+                     'path', 'name', 'mimetype', 'filetype', 'size', 'compressed_size', 'sha256', 's3_key', 'status',
+                     'analysis_skipped', 'ai_analysis', 'image_width', 'image_height')
+
+
+def upload_member_rows(s3, bucket, archive_metadata, expansion):
+    """ Writes the rows of the members for Athena as a single newline delimited JSON object. """
+    rows = "\n".join(json.dumps({f: md[f] for f in MEMBER_ROW_FIELDS if md.get(f) is not None}, default=str)
+                     for md in expansion.members)
+    key = members_s3_key(archive_metadata)
+    s3.put_object(Body=rows.encode('utf-8'), Bucket=bucket, Key=key, ContentType='application/x-ndjson')
+    return key
@@ -0,0 +1,42 @@
+-- The members of the archives expanded by fileSlacker (see archiveExpansion.py), one row per member. The rows of an
+-- archive are stored as a single NDJSON object under
+--     s3://file-slacker-bucket/members/dt=YYYY-MM-DD/<archive s3_key>-members.json
+-- and join the metadata table on `archive_s3_key` = `metadata.s3_key`. The member content itself is stored under
+-- `derived/<archive key>/<path>` (`s3_key`).
+CREATE EXTERNAL TABLE IF NOT EXISTS `file_slacker_db`.`archive_members` (
+  `id` string,
+  `archive_id` string,
+  `archive_s3_key` string,
+  `slack_event_id` string,
+  `user` string,
+  `slack_orig_channel` string,
+  `created` bigint,
+  `path` string,
+  `name` string,
+  `mimetype` string,
+  `filetype` string,
+  `size` bigint,
+  `compressed_size` bigint,
+  `sha256` string,
+  `s3_key` string,
+  `status` string,
+  `analysis_skipped` string,
+  `ai_analysis` string,
+  `image_width` int,
+  `image_height` int
+)
+PARTITIONED BY (
+  `dt` string
+)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+WITH SERDEPROPERTIES ('ignore.malformed.json' = 'true')
+LOCATION 's3://file-slacker-bucket/members/'
+TBLPROPERTIES (
+  'projection.enabled' = 'true',
+  'projection.dt.type' = 'date',
+  'projection.dt.format' = 'yyyy-MM-dd',
+  'projection.dt.range' = '2024-01-01,NOW',
+  'projection.dt.interval' = '1',
+  'projection.dt.interval.unit' = 'DAYS',
+  'storage.location.template' = 's3://file-slacker-bucket/members/dt=${dt}/'
+);
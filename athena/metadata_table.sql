@@ -0,0 +1,58 @@
+-- The fileSlackerBot metadata table. The records are stored Hive-style under
+--     s3://file-slacker-bucket/meta/dt=YYYY-MM-DD/filetype=<filetype>/
+-- as single JSON records (`<s3_key>-metadata.json`) and, once compacted by `fileStatsSlacker.compaction_handler`,
+-- as gzip'd NDJSON (`compacted-<hash>.json.gz`). Athena reads both, the compression is detected by the extension.
+-- Partition projection computes the partitions from the query predicates, no crawler or MSCK REPAIR is needed.
+-- The `filetype` column is the Slack filetype as uploaded, `filetype_partition` is the same value or `other` for a
+-- filetype missing from the projected list (see metadataLayout.SLACK_FILETYPES).
+CREATE EXTERNAL TABLE IF NOT EXISTS `file_slacker_db`.`metadata` (
+  `id` string,
+  `created` bigint,
+  `timestamp` bigint,
+  `name` string,
+  `mimetype` string,
+  `filetype` string,
+  `file_extension` string,
+  `user` string,
+  `user_team` string,
+  `size` bigint,
+  `url_private` string,
+  `user_text` string,
+  `s3_key` string,
+  `slack_orig_channel` string,
+  `slack_orig_ts` string,
+  `slack_event_id` string,
+  `event_file_index` int,
+  `event_file_count` int,
+  `sha256` string,
+  `byte_count` bigint,
+  `image_width` int,
+  `image_height` int,
+  `analyzed_image_bytes` bigint,
+  `thumbnail_s3_key` string,
+  `ai_analysis` string,
+  `ai_analysis_cached` boolean,
+  `blob_key` string,
+  `blob_duplicate` boolean,
+  `admission_tier` string,
+  `analysis_skipped` string,
+  `archive_members_s3_key` string
+)
+PARTITIONED BY (
+  `dt` string,
+  `filetype_partition` string
+)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+WITH SERDEPROPERTIES ('ignore.malformed.json' = 'true')
+LOCATION 's3://file-slacker-bucket/meta/'
+TBLPROPERTIES (
+  'projection.enabled' = 'true',
+  'projection.dt.type' = 'date',
+  'projection.dt.format' = 'yyyy-MM-dd',
+  'projection.dt.range' = '2024-01-01,NOW',
+  'projection.dt.interval' = '1',
+  'projection.dt.interval.unit' = 'DAYS',
+  'projection.filetype_partition.type' = 'enum',
+  'projection.filetype_partition.values' = 'auto,text,ai,apk,applescript,binary,bmp,boxnote,c,csharp,cpp,css,csv,clojure,coffeescript,cfm,d,dart,diff,doc,docx,dockerfile,dotx,email,eps,epub,erlang,fla,flv,fsharp,fortran,go,groovy,gdoc,gdraw,gpres,gsheet,gzip,html,haskell,haxe,heic,indd,java,javascript,jpg,json,keynote,kotlin,latex,lisp,lua,m4a,markdown,matlab,mhtml,mkv,mov,mp3,mp4,mpg,mumps,numbers,nzb,objc,ocaml,odg,odi,odp,ods,odt,ogg,ogv,pages,pascal,pdf,perl,php,pig,png,post,powershell,ppt,pptx,psd,puppet,python,qtz,r,rtf,ruby,rust,sql,sass,scala,scheme,sketch,shell,smalltalk,svg,swf,swift,tar,tiff,tsv,vb,vbscript,vcard,velocity,verilog,wav,webm,wmv,xls,xlsx,xlsb,xlsm,xltx,xml,yaml,zip,other',
+  'storage.location.template' = 's3://file-slacker-bucket/meta/dt=${dt}/filetype=${filetype_partition}/'
+);
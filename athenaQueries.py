@@ -0,0 +1,141 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from tracing import span
+
+# Runs Athena queries for fileStatsSlacker: several queries are submitted at once and polled together with jittered
+# exponential backoff until an overall deadline, results are paged through and cached for a short time by SQL text.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class AthenaQueryError(Exception):
+    pass
+
+
+class AthenaQueryExecutor:
+    """ `cache_ttl_seconds` is how long the rows of a query are reused within this Lambda instance, so a burst of
+    uploads shares a single execution, for the `cache_max_entries` most recently used queries. `reuse_max_age_minutes`
+    enables Athena's own result reuse across instances (engine v3), set it to 0 to disable. """
+
+    def __init__(self, athena, database, output_location, cache_ttl_seconds=60, reuse_max_age_minutes=1,
+                 deadline_seconds=30, initial_poll_seconds=0.25, max_poll_seconds=4, cache_max_entries=32):
+        self.athena = athena
+        self.database = database
+        self.output_location = output_location
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.reuse_max_age_minutes = reuse_max_age_minutes
+        self.deadline_seconds = deadline_seconds
+        self.initial_poll_seconds = initial_poll_seconds
+        self.max_poll_seconds = max_poll_seconds
+        self.cache_max_entries = cache_max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run_query(self, sql, use_cache=True):
+        return self.run_queries({'query': sql}, use_cache)['query']
+
+    def run_queries(self, queries, use_cache=True):
+        """ Runs the queries (a dict of name to SQL) concurrently and returns a dict of name to result rows. Raises
+        AthenaQueryError when a query fails or the deadline passes. Without `use_cache` neither the cached rows nor
+        Athena's reused results are used. """
+        results = dict()
+        pending = dict()
+        now = time.monotonic()
+        with self._lock:
+            for name, sql in queries.items():
+                cached = self._cache.get(sql) if use_cache else None
+                if cached is not None and cached[0] > now:
+                    self._cache.move_to_end(sql)
+                    logger.debug(f"Reusing the cached results of the {name} query")
+                    results[name] = cached[1]
+                else:
+                    pending[name] = sql
+        if not pending:
+            return results
+
+        with span('athena.queries', queries=len(pending), cached=len(results)):
+            return self._run_pending(pending, results, use_cache)
+
+    def _run_pending(self, pending, results, use_cache):
+        executions = dict()
+        try:
+            # started one at a time so a failing start still stops the queries started before it
+            for name, sql in pending.items():
+                executions[self._start(sql, use_cache)] = name
+            deadline = time.monotonic() + self.deadline_seconds
+            delay = self.initial_poll_seconds
+            while executions:
+                if time.monotonic() + delay > deadline:
+                    raise AthenaQueryError(f"The {', '.join(executions.values())} queries did not complete within "
+                                           f"{self.deadline_seconds} seconds")
+                # full jitter keeps concurrent Lambdas from polling in lockstep
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, self.max_poll_seconds)
+                response = self.athena.batch_get_query_execution(QueryExecutionIds=list(executions))
+                for execution in response['QueryExecutions']:
+                    execution_id = execution['QueryExecutionId']
+                    status = execution['Status']
+                    if status['State'] == 'SUCCEEDED':
+                        name = executions.pop(execution_id)
+                        results[name] = self._get_rows(execution_id)
+                        self._cache_rows(pending[name], results[name])
+                    elif status['State'] in ('FAILED', 'CANCELLED'):
+                        name = executions.pop(execution_id)
+                        raise AthenaQueryError(f"The {name} query was {status['State'].lower()}.\n"
+                                               f"{status.get('StateChangeReason', '')}")
+        finally:
+            for execution_id in executions:
+                self._stop(execution_id)
+        return results
+
+    def _cache_rows(self, sql, rows):
+        """ Caches the rows of a query, dropping the expired entries and then the least recently used ones. """
+        now = time.monotonic()
+        with self._lock:
+            self._cache[sql] = (now + self.cache_ttl_seconds, rows)
+            self._cache.move_to_end(sql)
+            for expired in [key for key, (expires, _) in self._cache.items() if expires <= now]:
+                del self._cache[expired]
+            while len(self._cache) > self.cache_max_entries:
+                self._cache.popitem(last=False)
+
+    def _start(self, sql, reuse_results):
+        request = {
+            'QueryString': sql,
+            'QueryExecutionContext': {'Database': self.database},
+            'ResultConfiguration': {'OutputLocation': self.output_location}
+        }
+        if reuse_results and self.reuse_max_age_minutes:
+            request['ResultReuseConfiguration'] = {
+                'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': self.reuse_max_age_minutes}
+            }
+        try:
+            return self.athena.start_query_execution(**request)['QueryExecutionId']
+        except self.athena.exceptions.InvalidRequestException as e:
+            if 'ResultReuseConfiguration' not in request:
+                raise
+            # result reuse needs the Athena engine version 3, carry on without it
+            logger.warning(f"Athena result reuse is not available, disabling it: {e}")
+            self.reuse_max_age_minutes = 0
+            del request['ResultReuseConfiguration']
+            return self.athena.start_query_execution(**request)['QueryExecutionId']
+
+    def _get_rows(self, execution_id):
+        rows = list()
+        request = {'QueryExecutionId': execution_id, 'MaxResults': 1000}
+        while True:
+            response = self.athena.get_query_results(**request)
+            rows.extend(response['ResultSet']['Rows'])
+            if not response.get('NextToken'):
+                return rows
+            request['NextToken'] = response['NextToken']
+
+    def _stop(self, execution_id):
+        try:
+            self.athena.stop_query_execution(QueryExecutionId=execution_id)
+        except Exception as e:
+            logger.warning(f"Could not stop the Athena query {execution_id}: {e}")
@@ -0,0 +1,517 @@
+""" Backfill: re-runs the extraction and analysis of the files already in the fileSlackerBot bucket and rewrites their
+metadata records in `meta/`, e.g. after a change of the prompts or model of fileSlacker, or with --schema-only to only
+rewrite the records in the current schema (see metadataLayout.typed_metadata).
+
+The metadata objects of the selected partitions are listed with a paginator while their records are reprocessed by
+a pool of worker threads, the OpenAI requests of all the workers share the --requests-per-minute and
+--tokens-per-minute limits (see openaiLimits.py). Progress is checkpointed to a local SQLite file, run the same
+command again to resume a backfill that stopped. Rewritten records carry the `backfill_run` id of the checkpoint, so
+fileStatsSlacker doesn't reply to them again and a resumed run skips them. Don't run a backfill at the same time as
+fileStatsSlacker.compaction_handler, both rewrite the compacted objects.
+
+    $ python backfill.py [--since 2024-01-01] [--until 2024-06-30] [--filetype pdf --filetype png] [--prefix F07]
+          [--concurrency 8] [--requests-per-minute 500] [--tokens-per-minute 200000] [--limit 100]
+          [--dry-run] [--schema-only] [--no-cache] [--checkpoint backfill-checkpoint.db]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime
+
+from analysisCache import NoAnalysisCache
+from analysisCache import set_analysis_cache
+from metadataLayout import OTHER_FILETYPE
+from metadataLayout import SLACK_FILETYPES
+from metadataLayout import is_metadata_key
+from metadataLayout import metadata_partition
+from metadataLayout import read_records
+from metadataLayout import typed_metadata
+from metadataLayout import write_compacted
+from openaiLimits import BULK
+from openaiLimits import OPENAI_REQUESTS_PER_MINUTE
+from openaiLimits import OPENAI_TOKENS_PER_MINUTE
+from openaiLimits import OpenAIRateLimiter
+from openaiLimits import get_openai_limiter
+from openaiLimits import get_token_budget_store
+from openaiLimits import openai_lane
+from openaiLimits import set_openai_limiter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_CHECKPOINT_PATH = 'backfill-checkpoint.db'
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REPORT_SECONDS = 10
+
+_DT_RE = re.compile(r'dt=(\d{4}-\d{2}-\d{2})/$')
+
+
+class BackfillError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class BackfillSelection:
+    """ The records to reprocess: created from `since` until `until` (YYYY-MM-DD, both included), of the `filetypes`
+    partitions (all of them when empty) and uploaded under an S3 key starting with `prefix`. """
+    since: str = None
+    until: str = None
+    filetypes: tuple = ()
+    prefix: str = None
+
+    def includes_day(self, dt):
+        return (self.since is None or dt >= self.since) and (self.until is None or dt <= self.until)
+
+    def includes_key(self, key):
+        """ Whether a metadata object may hold selected records, a single record is selected by its key. """
+        return not (self.prefix and is_metadata_key(key) and not key.rsplit('/', 1)[-1].startswith(self.prefix))
+
+    def matches(self, record):
+        try:
+            dt, filetype = metadata_partition(record)
+        except (KeyError, ValueError, TypeError):
+            return False
+        return self.includes_day(dt) and (not self.filetypes or filetype in self.filetypes) and \
+            (not self.prefix or f"{record.get('s3_key')}".startswith(self.prefix))
+
+
+@dataclass(frozen=True)
+class MetadataObject:
+    key: str
+    size: int
+    etag: str
+
+
+def record_key(record):
+    """ Identifies a record within a metadata object, like the deduplication of the compacted objects. """
+    return f"{record['id']}/{record.get('s3_key')}"
+
+
+def list_metadata_objects(s3, bucket, folder, selection):
+    """ Yields the metadata objects of the selected partitions, a page of the listing at a time. The records of the
+    legacy flat folder are not listed, migrate them first (see metadataLayout.migrate_legacy_metadata). """
+    paginator = s3.get_paginator('list_objects_v2')
+    for dt_page in paginator.paginate(Bucket=bucket, Prefix=f"{folder}/dt=", Delimiter='/'):
+        for dt_prefix in dt_page.get('CommonPrefixes', []):
+            match = _DT_RE.search(dt_prefix['Prefix'])
+            if not match or not selection.includes_day(match.group(1)):
+                continue
+            prefixes = [f"{dt_prefix['Prefix']}filetype={filetype}/" for filetype in selection.filetypes] or \
+                [dt_prefix['Prefix']]
+            for prefix in prefixes:
+                for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                    for obj in page.get('Contents', []):
+                        if selection.includes_key(obj['Key']):
+                            yield MetadataObject(obj['Key'], obj.get('Size', 0), obj.get('ETag'))
+
+
+def reprocess_record(record, run_id, schema_only=False, use_cache=True):
+    """ Returns a reprocessed copy of a metadata record: the file analyzed again (unless its analysis was skipped at
+    upload, or with `schema_only`) and the record in the current schema. Raises when the analysis failed, the record
+    is then left as it was. The OpenAI requests go through the bulk lane (see openaiLimits.py). """
+    import fileSlacker
+    metadata = typed_metadata(json.loads(json.dumps(record)))
+    if not schema_only and fileSlacker.ENABLE_AI_ANALYSIS and not metadata.get('analysis_skipped'):
+        # the analysis of a duplicate is otherwise reused from its blob
+        duplicate = metadata.pop('blob_duplicate', None) if not use_cache else None
+        with openai_lane(BULK):
+            fileSlacker.analyzeUploadedFile(metadata)
+        if duplicate is not None:
+            metadata['blob_duplicate'] = duplicate
+        if metadata['ai_analysis'].startswith(fileSlacker.ANALYSIS_FAILED_TEXT):
+            raise BackfillError(metadata['ai_analysis'])
+    metadata.update({'backfill_run': run_id, 'backfilled_at': int(time.time())})
+    return metadata
+
+
+class BackfillCheckpoint:
+    """ The progress of a backfill in a local SQLite file: its run id and options, the metadata objects done, and the
+    reprocessed records of the objects not rewritten yet (a compacted object is rewritten once all of its records
+    are reprocessed). """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, records INTEGER, finished REAL);
+            CREATE TABLE IF NOT EXISTS records (
+                object_key TEXT NOT NULL,
+                record_key TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                PRIMARY KEY (object_key, record_key));''')
+
+    def start(self, options):
+        """ Returns the run id of the backfill and whether it is resumed. Raises when the checkpoint belongs to a
+        backfill with other options. """
+        options = json.dumps(options, sort_keys=True)
+        with self._lock:
+            state = dict(self._db.execute('SELECT name, value FROM state').fetchall())
+            if not state:
+                run_id = uuid.uuid4().hex[:12]
+                self._db.executemany('INSERT INTO state (name, value) VALUES (?, ?)',
+                                     [('run_id', run_id), ('options', options), ('started', str(time.time()))])
+                return run_id, False
+        if state['options'] != options:
+            raise BackfillError(f"The checkpoint belongs to a backfill with other options: {state['options']}")
+        return state['run_id'], True
+
+    def done_objects(self):
+        with self._lock:
+            return {row[0] for row in self._db.execute('SELECT key FROM objects')}
+
+    def saved_records(self, object_key):
+        with self._lock:
+            rows = self._db.execute('SELECT record_key, metadata FROM records WHERE object_key = ?',
+                                    (object_key,)).fetchall()
+        return {key: json.loads(metadata) for key, metadata in rows}
+
+    def save_record(self, object_key, metadata):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO records (object_key, record_key, metadata) VALUES (?, ?, ?)',
+                             (object_key, record_key(metadata), json.dumps(metadata)))
+
+    def finish_object(self, key, records, done=True):
+        """ Forgets the saved records of a rewritten object, and marks it done unless some of its records failed
+        (the next run retries them). """
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM records WHERE object_key = ?', (key,))
+            if done:
+                self._db.execute('INSERT OR REPLACE INTO objects (key, records, finished) VALUES (?, ?, ?)',
+                                 (key, records, time.time()))
+            self._db.execute('COMMIT')
+
+
+class BackfillProgress:
+    """ The counters of a backfill. The rate and ETA are measured in bytes of the metadata objects, a compacted
+    object holds many records: every record of an object counts for its share of the bytes. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+        self.listed_objects = 0
+        self.listed_bytes = 0
+        self.listing_done = False
+        self.objects = 0
+        self.bytes = 0.0
+        self.selected = 0
+        self.submitted = 0
+        self.records = 0
+        self.resumed = 0
+        self.failed = 0
+        self.failed_objects = 0
+        self.by_filetype = dict()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def add_selected(self, records):
+        with self._lock:
+            self.selected += len(records)
+            for record in records:
+                filetype = f"{record.get('filetype')}"
+                self.by_filetype[filetype] = self.by_filetype.get(filetype, 0) + 1
+
+    def line(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.start
+            rate = self.records / elapsed if elapsed else 0.0
+            if self.listing_done and self.bytes and self.listed_bytes > self.bytes:
+                eta = time.strftime('%H:%M:%S', time.gmtime(elapsed * (self.listed_bytes - self.bytes) / self.bytes))
+            else:
+                eta = '-' if self.listing_done else 'listing'
+            percent = 100 * self.bytes / self.listed_bytes if self.listed_bytes else 0.0
+            return (f"{time.strftime('%H:%M:%S', time.gmtime(elapsed))} objects {self.objects:,}/"
+                    f"{self.listed_objects:,}{'' if self.listing_done else '+'} ({percent:.1f}%), records "
+                    f"{self.records:,} reprocessed ({rate:.1f}/s), {self.resumed:,} resumed, {self.failed:,} failed, "
+                    f"ETA {eta}")
+
+
+@dataclass
+class _ObjectWork:
+    """ The records of a metadata object being reprocessed. It is rewritten by the worker finishing its last
+    record. """
+    obj: MetadataObject
+    records: list
+    pending: int
+    complete: bool
+    changed: int = 0
+    failed: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class Backfill:
+    """ A backfill of the metadata objects of `bucket`/`folder` (see the module docstring). Without a checkpoint
+    it is a dry run, which only counts the records it would reprocess. """
+
+    def __init__(self, s3, bucket, folder, selection, checkpoint=None, concurrency=DEFAULT_CONCURRENCY,
+                 schema_only=False, use_cache=True, limit=None, report_seconds=DEFAULT_REPORT_SECONDS, out=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.folder = folder
+        self.selection = selection
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.schema_only = schema_only
+        self.use_cache = use_cache
+        self.limit = limit
+        self.report_seconds = report_seconds
+        self.out = out or sys.stdout
+        self.run_id = None
+        self.progress = BackfillProgress()
+        self._listed = queue.Queue()
+        self._stopping = threading.Event()
+        # records submitted to the pool and not done yet, so the listing streams through a bounded amount of work
+        self._slots = threading.BoundedSemaphore(2 * concurrency)
+
+    @property
+    def dry_run(self):
+        return self.checkpoint is None
+
+    def options(self):
+        """ What a resumed backfill must not change. """
+        import fileSlacker
+        prompts = (fileSlacker.IMAGE_PROMPT, fileSlacker.FILE_PROMPT, fileSlacker.ARCHIVE_PROMPT,
+                   fileSlacker.CHUNK_PROMPT, fileSlacker.ASSISTANT_INSTRUCTIONS)
+        return {'bucket': self.bucket, 'folder': self.folder, 'since': self.selection.since,
+                'until': self.selection.until, 'filetypes': sorted(self.selection.filetypes),
+                'prefix': self.selection.prefix, 'schema_only': self.schema_only, 'model': fileSlacker.ANALYSIS_MODEL,
+                'prompts': hashlib.sha256("\n".join(prompts).encode('utf-8')).hexdigest()}
+
+    def stop(self):
+        """ Stops submitting records, the ones in progress are finished and checkpointed. """
+        self._stopping.set()
+
+    def run(self):
+        """ Runs (or resumes) the backfill. Returns the progress counters. """
+        done = set()
+        if not self.dry_run:
+            self.run_id, resumed = self.checkpoint.start(self.options())
+            done = self.checkpoint.done_objects()
+            if resumed:
+                self._print(f"Resuming backfill {self.run_id}, {len(done):,} objects already done")
+        lister = threading.Thread(target=self._list, args=(done,), name='backfill-list', daemon=True)
+        lister.start()
+        reporter = threading.Thread(target=self._report, name='backfill-report', daemon=True)
+        reporter.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='backfill') as executor:
+                while not self._stopping.is_set():
+                    obj = self._listed.get()
+                    if obj is None:
+                        break
+                    try:
+                        self._submit(executor, obj)
+                    except Exception as e:
+                        logger.error(f"Could not read the metadata object {obj.key}: {e}")
+                        self.progress.add(failed_objects=1, bytes=obj.size)
+        except KeyboardInterrupt:
+            self._print("Stopping, the records in progress are checkpointed")
+            self.stop()
+            raise
+        finally:
+            self._stopping.set()
+            reporter.join()
+            self._print(self.progress.line())
+        return self.progress
+
+    def _print(self, text):
+        print(text, file=self.out, flush=True)
+
+    def _report(self):
+        while not self._stopping.wait(self.report_seconds):
+            self._print(self.progress.line())
+
+    def _list(self, done):
+        try:
+            for obj in list_metadata_objects(self.s3, self.bucket, self.folder, self.selection):
+                if self._stopping.is_set():
+                    break
+                if obj.key not in done:
+                    self.progress.add(listed_objects=1, listed_bytes=obj.size)
+                    self._listed.put(obj)
+        except Exception as e:
+            logger.error(f"Could not list the metadata objects: {e}")
+            self.stop()
+        finally:
+            self.progress.listing_done = True
+            self._listed.put(None)
+
+    def _submit(self, executor, obj):
+        records = read_records(self.s3, self.bucket, obj.key)
+        share = obj.size / max(1, len(records))
+        saved = self.checkpoint.saved_records(obj.key) if not self.dry_run else {}
+        todo, resumed = list(), 0
+        for i, record in enumerate(records):
+            if (self.run_id and record.get('backfill_run') == self.run_id) or not self.selection.matches(record):
+                continue
+            if record_key(record) in saved:
+                records[i] = saved[record_key(record)]
+                resumed += 1
+            else:
+                todo.append(i)
+        self.progress.add_selected([records[i] for i in todo])
+        self.progress.add(resumed=resumed, bytes=share * (len(records) - len(todo)))
+        if self.dry_run:
+            self.progress.add(objects=1, bytes=share * len(todo))
+            return
+        complete, limited = True, False
+        if self.limit is not None and self.progress.submitted + len(todo) >= self.limit:
+            complete = self.progress.submitted + len(todo) == self.limit
+            todo = todo[:self.limit - self.progress.submitted]
+            limited = True
+        # an object stopped midway is never finished, its records done so far are in the checkpoint
+        work = _ObjectWork(obj, records, pending=len(todo), complete=complete, changed=resumed)
+        if not todo:
+            self._finish(work)
+        for i in todo:
+            self._slots.acquire()
+            if self._stopping.is_set():
+                self._slots.release()
+                break
+            self.progress.add(submitted=1)
+            executor.submit(self._reprocess, work, i, share)
+        if limited:
+            self.stop()
+
+    def _reprocess(self, work, i, share):
+        try:
+            try:
+                metadata = reprocess_record(work.records[i], self.run_id, self.schema_only, self.use_cache)
+                self.checkpoint.save_record(work.obj.key, metadata)
+                with work.lock:
+                    work.records[i] = metadata
+                    work.changed += 1
+                self.progress.add(records=1, bytes=share)
+            except Exception as e:
+                logger.error(f"Could not reprocess {work.records[i].get('s3_key')} of {work.obj.key}: {e}")
+                with work.lock:
+                    work.failed += 1
+                self.progress.add(failed=1, bytes=share)
+            with work.lock:
+                work.pending -= 1
+                last = work.pending == 0
+            if last:
+                self._finish(work)
+        except Exception as e:
+            logger.error(f"Could not rewrite the metadata object {work.obj.key}: {e}")
+            self.progress.add(failed_objects=1)
+        finally:
+            self._slots.release()
+
+    def _finish(self, work):
+        """ Rewrites the object with its reprocessed records, once they are all done. """
+        if not work.complete:
+            return
+        if work.changed and not self._rewrite(work):
+            self.progress.add(failed_objects=1)
+            return
+        self.checkpoint.finish_object(work.obj.key, len(work.records), done=not work.failed)
+        self.progress.add(objects=1)
+
+    def _rewrite(self, work):
+        """ Writes the records of a single record object back to its key if it didn't change since it was listed.
+        A compacted object is written under a new key derived from its content and the old one deleted. Returns
+        False when the object changed or disappeared, its records are then left for the next run. """
+        from botocore.exceptions import ClientError
+        obj = work.obj
+        if is_metadata_key(obj.key):
+            try:
+                self.s3.put_object(Body=json.dumps(work.records[0]), Bucket=self.bucket, Key=obj.key,
+                                   ContentType='application/json', IfMatch=obj.etag)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                    raise
+                logger.warning(f"The metadata object {obj.key} changed since it was listed, leaving it for the next "
+                               f"run")
+                return False
+            return True
+        try:
+            etag = self.s3.head_object(Bucket=self.bucket, Key=obj.key)['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+            etag = None
+        if etag != obj.etag:
+            logger.warning(f"The compacted object {obj.key} was rewritten since it was listed (a compaction?), "
+                           f"leaving its records for the next run")
+            return False
+        key, _ = write_compacted(self.s3, self.bucket, obj.key.rsplit('/', 1)[0] + '/', work.records)
+        if key != obj.key:
+            self.s3.delete_object(Bucket=self.bucket, Key=obj.key)
+        return True
+
+
+def _day(value):
+    datetime.strptime(value, '%Y-%m-%d')
+    return value
+
+
+def main(argv=None):
+    import fileSlacker
+    from lazyClients import s3_client
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bucket', default=fileSlacker.S3_FILE_BUCKET)
+    parser.add_argument('--folder', default=fileSlacker.S3_METADATA_FOLDER)
+    parser.add_argument('--since', type=_day, help='first day of the records to reprocess, YYYY-MM-DD (UTC)')
+    parser.add_argument('--until', type=_day, help='last day of the records to reprocess, YYYY-MM-DD (UTC)')
+    parser.add_argument('--filetype', action='append', default=[],
+                        choices=sorted(set(SLACK_FILETYPES) | {OTHER_FILETYPE}), help='may be repeated')
+    parser.add_argument('--prefix', help='only the files whose S3 key starts with this prefix')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help='worker threads')
+    parser.add_argument('--requests-per-minute', type=float, default=OPENAI_REQUESTS_PER_MINUTE,
+                        help='OpenAI requests per minute of all the workers, 0 for no limit')
+    parser.add_argument('--tokens-per-minute', type=float, default=OPENAI_TOKENS_PER_MINUTE,
+                        help='OpenAI tokens per minute of all the workers, 0 for no limit')
+    parser.add_argument('--limit', type=int, help='stop after reprocessing this many records')
+    parser.add_argument('--dry-run', action='store_true', help='only count the records that would be reprocessed')
+    parser.add_argument('--schema-only', action='store_true', help='rewrite the records without analyzing again')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='analyze again even when an analysis of the same content, prompt and model exists')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH)
+    parser.add_argument('--report-seconds', type=float, default=DEFAULT_REPORT_SECONDS)
+    parser.add_argument('--verbose', action='store_true', help='log every file')
+    args = parser.parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    # with a shared OPENAI_BUDGET_BACKEND the backfill only takes what the Lambdas leave of the budget
+    set_openai_limiter(OpenAIRateLimiter(args.requests_per_minute, args.tokens_per_minute, get_token_budget_store()))
+    if args.no_cache:
+        set_analysis_cache(NoAnalysisCache())
+    backfill = Backfill(s3_client(), args.bucket, args.folder,
+                        BackfillSelection(args.since, args.until, tuple(args.filetype), args.prefix),
+                        None if args.dry_run else BackfillCheckpoint(args.checkpoint), args.concurrency,
+                        args.schema_only, not args.no_cache, args.limit, args.report_seconds)
+    try:
+        progress = backfill.run()
+    except BackfillError as e:
+        parser.exit(2, f"{e}\n")
+    if args.dry_run:
+        print(f"{progress.selected:,} records would be reprocessed: "
+              f"{', '.join(f'{n:,} {t}' for t, n in sorted(progress.by_filetype.items(), key=lambda i: -i[1]))}")
+        return 0
+    limiter = get_openai_limiter()
+    print(f"Backfill {backfill.run_id}: {progress.records:,} records reprocessed, {progress.resumed:,} resumed, "
+          f"{progress.failed:,} failed, {progress.failed_objects:,} objects left for the next run; "
+          f"{limiter.requests:,} OpenAI requests, {limiter.tokens:,} tokens, {limiter.waited_seconds:.0f}s of waits "
+          f"for the rate limits")
+    return 1 if progress.failed or progress.failed_objects else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
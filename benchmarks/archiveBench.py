@@ -0,0 +1,145 @@
+""" Benchmark of the archive expansion (see archiveExpansion.py) against the local fakes of fakeServices.py.
+
+Builds a zip and a tar.gz of many small members (csv, text, json and binary files), stores them in the S3 fake and
+expands them with the member analysis of fileSlacker for each pool size, reading them from S3 (ranged GETs for the
+zip, one streamed GET for the tar). Reports the members per second, the S3 GETs and the analyses. A zip bomb and a
+tar.gz bomb are expanded last to show the limits stop them.
+
+    $ python benchmarks/archiveBench.py [--members 1000] [--concurrency 1 4 16 64] [--openai-latency-ms 100]
+        [--s3-latency-ms 10] [--bomb-mb 64]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = 'file-slacker-bucket'
+
+
+def member_files(count, seed):
+    """ Distinct small members, so no analysis is a cache hit, in a few folders. """
+    rng = random.Random(seed)
+    files = list()
+    for i in range(count):
+        kind = ('csv', 'txt', 'json', 'bin')[i % 4]
+        folder = f"folder{i % 7}/" if i % 3 else ''
+        if kind == 'csv':
+            rows = "\n".join(f"{rng.randint(0, 10 ** 6)},{rng.random():.6f},row{j}" for j in range(80))
+            content = f"id,value,label\n{rows}\n".encode('utf-8')
+        elif kind == 'txt':
+            content = " ".join(rng.choice(('alpha', 'beta', 'gamma', 'delta', 'lambda', 'slack', 'file'))
+                               for _ in range(600)).encode('utf-8')
+        elif kind == 'json':
+            content = json.dumps({'member': i, 'values': [rng.random() for _ in range(200)]}).encode('utf-8')
+        else:
+            content = rng.randbytes(4096)
+        files.append((f"{folder}member{i:05d}.{kind}", content))
+    return files
+
+
+def build_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path, content in files:
+            archive.writestr(path, content)
+    return buffer.getvalue()
+
+
+def build_tar_gz(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for path, content in files:
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def build_bombs(megabytes):
+    """ A single member of zeros, compressed about a thousand times. """
+    zeros = bytes(megabytes * 1024 * 1024)
+    return {'bomb.zip': build_zip([('zeros.bin', zeros)]), 'bomb.tar.gz': build_tar_gz([('zeros.bin', zeros)])}
+
+
+def archive_metadata(name, size):
+    return {'id': f"F{abs(hash(name)) % 10 ** 8:08d}", 'created': int(time.time()), 'name': name, 's3_key': name,
+            'size': size, 'slack_event_id': 'Ev-bench', 'user': 'U-bench', 'slack_orig_channel': 'C-bench'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--openai-latency-ms', type=float, default=100.0)
+    parser.add_argument('--s3-latency-ms', type=float, default=10.0)
+    parser.add_argument('--bomb-mb', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='file-slacker-archive-bench-')
+    os.environ.update({'ANALYSIS_CACHE_BACKEND': 'none', 'SLACK_BOT_TOKEN': 'xoxb-bench',
+                       'OPENAI_API_KEY': 'sk-bench', 'ENDPOINT_STATS_LOGGING_ENABLED': 'false'})
+    import logging
+    logging.disable(logging.WARNING)
+
+    import fileSlacker
+    from archiveExpansion import expand_archive
+    from fakeServices import FakeOpenAI
+    from fakeServices import FakeS3
+    from fakeServices import Faults
+    from fakeServices import Ledger
+    from lazyClients import set_client
+
+    ledger = Ledger()
+    s3 = FakeS3(Faults(latency_ms=args.s3_latency_ms), ledger, os.path.join(workdir, 's3'), args.seed)
+    openai = FakeOpenAI(Faults(latency_ms=args.openai_latency_ms), ledger, args.seed)
+    set_client('s3', s3)
+    set_client('openai', openai)
+
+    files = member_files(args.members, args.seed)
+    archives = {'members.zip': build_zip(files), 'members.tar.gz': build_tar_gz(files)}
+    archives.update(build_bombs(args.bomb_mb))
+    for name, data in archives.items():
+        s3.put_object(Body=data, Bucket=BUCKET, Key=name)
+    print(f"{args.members} members of {sum(len(c) for _, c in files) / 1024:,.0f} kB: "
+          + ", ".join(f"{name} {len(data) / 1024:,.0f} kB" for name, data in archives.items()))
+
+    def expand(name, concurrency):
+        data = archives[name]
+        gets = s3.injector.counts[('GetObject', 'ok')]
+        analyses = openai.injector.counts[('chat.completions', 'ok')]
+        start = time.perf_counter()
+        expansion = expand_archive(s3, BUCKET, archive_metadata(name, len(data)), name, len(data), None,
+                                   fileSlacker.analyze_archive_member, f"derived/{name}/c{concurrency}",
+                                   concurrency=concurrency)
+        seconds = time.perf_counter() - start
+        return (expansion, seconds, s3.injector.counts[('GetObject', 'ok')] - gets,
+                openai.injector.counts[('chat.completions', 'ok')] - analyses)
+
+    print(f"\n{'archive':<16} {'pool':>5} {'members':>8} {'analyzed':>9} {'seconds':>8} {'members/s':>10} "
+          f"{'speedup':>8} {'S3 GETs':>8}")
+    for name in ('members.zip', 'members.tar.gz'):
+        first = None
+        for concurrency in args.concurrency:
+            expansion, seconds, gets, analyses = expand(name, concurrency)
+            first = first or seconds
+            print(f"{name:<16} {concurrency:>5} {len(expansion.members):>8} {analyses:>9} {seconds:>8.2f} "
+                  f"{len(expansion.members) / seconds:>10.1f} {first / seconds:>7.1f}x {gets:>8}")
+
+    print(f"\n{'archive':<16} {'expanded MB':>12} {'seconds':>8}  stopped")
+    for name in ('bomb.zip', 'bomb.tar.gz'):
+        expansion, seconds, _, _ = expand(name, max(args.concurrency))
+        print(f"{name:<16} {expansion.stats['expanded_bytes'] / 1024 / 1024:>12.1f} {seconds:>8.2f}  "
+              f"{expansion.stopped or 'NOT STOPPED'}")
+
+
+if __name__ == '__main__':
+    main()
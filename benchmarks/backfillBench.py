@@ -0,0 +1,171 @@
+""" Benchmark of the backfill (see backfill.py) against the local fakes of fakeServices.py.
+
+Stores csv and text uploads in the S3 fake with their metadata records (the older days compacted, the recent ones as
+single records) and backfills them with the analysis of fileSlacker: once per pool size, once within a requests per
+minute limit, and once stopped midway and resumed from its checkpoint. Reports the records per second and the chat
+completions, and checks that every record was rewritten once, with no record analyzed twice by a resumed backfill.
+
+    $ python benchmarks/backfillBench.py [--files 400] [--days 10] [--concurrency 1 8 32] [--openai-latency-ms 200]
+        [--s3-latency-ms 10] [--requests-per-minute 600]
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = 'file-slacker-bucket'
+FOLDER = 'meta'
+
+
+def uploads(count, days, seed, now):
+    """ Distinct csv and text files, so no analysis is a cache hit, with their metadata records. """
+    rng = random.Random(seed)
+    files = list()
+    for i in range(count):
+        filetype, mimetype = ('csv', 'text/csv') if i % 2 else ('text', 'text/plain')
+        if filetype == 'csv':
+            rows = "\n".join(f"{rng.randint(0, 10 ** 6)},{rng.random():.6f},row{j}" for j in range(50))
+            content = f"id,value,label\n{rows}\n".encode('utf-8')
+        else:
+            content = " ".join(rng.choice(('alpha', 'beta', 'gamma', 'delta', 'slack', 'file'))
+                               for _ in range(400)).encode('utf-8')
+        created = int((now - timedelta(seconds=rng.uniform(0, days * 86400))).timestamp())
+        name = f"upload{i:05d}.{'csv' if filetype == 'csv' else 'txt'}"
+        files.append((content, {
+            'id': f"F{i:08d}", 's3_key': f"F{i:08d}-{name}", 'name': name, 'filetype': filetype,
+            'mimetype': mimetype, 'file_extension': os.path.splitext(name)[1], 'size': len(content),
+            'created': created, 'user': f"U{rng.randint(1, 9)}", 'slack_orig_channel': 'C-bench',
+            'slack_orig_ts': f"{created}.000100", 'ai_analysis': 'An analysis with the previous prompt.'}))
+    return files
+
+
+def store(s3, files, compact_before):
+    from metadataLayout import metadata_partition
+    from metadataLayout import metadata_s3_key
+    from metadataLayout import partition_prefix
+    from metadataLayout import write_compacted
+    partitions = dict()
+    for content, record in files:
+        s3.put_object(Body=content, Bucket=BUCKET, Key=record['s3_key'])
+        dt, filetype = metadata_partition(record)
+        if dt < compact_before:
+            partitions.setdefault((dt, filetype), list()).append(record)
+        else:
+            s3.put_object(Body=json.dumps(record), Bucket=BUCKET, Key=metadata_s3_key(FOLDER, record))
+    for (dt, filetype), records in partitions.items():
+        write_compacted(s3, BUCKET, partition_prefix(FOLDER, dt, filetype), records)
+    return len(partitions)
+
+
+def all_records(s3):
+    from metadataLayout import read_records
+    keys = list()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=BUCKET, Prefix=f"{FOLDER}/"):
+        keys.extend(o['Key'] for o in page.get('Contents', []))
+    return [record for key in keys for record in read_records(s3, BUCKET, key)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--openai-latency-ms', type=float, default=200.0)
+    parser.add_argument('--s3-latency-ms', type=float, default=10.0)
+    parser.add_argument('--requests-per-minute', type=float, default=600.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='file-slacker-backfill-bench-')
+    os.environ.update({'ANALYSIS_CACHE_BACKEND': 'none', 'SLACK_BOT_TOKEN': 'xoxb-bench',
+                       'OPENAI_API_KEY': 'sk-bench', 'ENDPOINT_STATS_LOGGING_ENABLED': 'false'})
+    import logging
+    logging.disable(logging.WARNING)
+
+    from backfill import Backfill
+    from backfill import BackfillCheckpoint
+    from backfill import BackfillSelection
+    from fakeServices import FakeOpenAI
+    from fakeServices import FakeS3
+    from fakeServices import Faults
+    from fakeServices import Ledger
+    from lazyClients import set_client
+    from openaiLimits import OpenAIRateLimiter
+    from openaiLimits import set_openai_limiter
+
+    ledger = Ledger()
+    s3 = FakeS3(Faults(latency_ms=args.s3_latency_ms), ledger, os.path.join(workdir, 's3'), args.seed)
+    openai = FakeOpenAI(Faults(latency_ms=args.openai_latency_ms), ledger, args.seed)
+    set_client('s3', s3)
+    set_client('openai', openai)
+    now = datetime.now(timezone.utc)
+    files = uploads(args.files, args.days, args.seed, now)
+    compacted = store(s3, files, (now - timedelta(days=3)).strftime('%Y-%m-%d'))
+    print(f"{args.files} uploads, {compacted} compacted partitions and "
+          f"{sum(1 for r in all_records(s3) if r['created'] >= (now - timedelta(days=3)).timestamp())} single records")
+
+    def backfill(name, concurrency, limiter=None, stop_after=None, checkpoint=None):
+        set_openai_limiter(limiter or OpenAIRateLimiter())
+        checkpoint = checkpoint or BackfillCheckpoint(os.path.join(workdir, f"{name}.db"))
+        run = Backfill(s3, BUCKET, FOLDER, BackfillSelection(), checkpoint, concurrency, report_seconds=3600,
+                       out=io.StringIO())
+        if stop_after is not None:
+            def stop():
+                while run.progress.records < stop_after:
+                    time.sleep(0.01)
+                run.stop()
+            threading.Thread(target=stop, daemon=True).start()
+        completions = openai.injector.counts[('chat.completions', 'ok')]
+        start = time.perf_counter()
+        progress = run.run()
+        seconds = time.perf_counter() - start
+        return run, progress, seconds, openai.injector.counts[('chat.completions', 'ok')] - completions
+
+    def check(run_id):
+        records = all_records(s3)
+        keys = [f"{r['id']}/{r['s3_key']}" for r in records]
+        rewritten = sum(1 for r in records if r.get('backfill_run') == run_id)
+        ok = len(records) == args.files and len(set(keys)) == args.files and rewritten == args.files
+        return 'ok' if ok else f"FAILED: {len(records)} records, {len(set(keys))} distinct, {rewritten} rewritten"
+
+    print(f"\n{'run':<22} {'pool':>5} {'records':>8} {'resumed':>8} {'seconds':>8} {'records/s':>10} "
+          f"{'completions':>12}  check")
+    first = None
+    for concurrency in args.concurrency:
+        run, progress, seconds, completions = backfill(f"pool-{concurrency}", concurrency)
+        first = first or seconds
+        print(f"{f'pool {concurrency}':<22} {concurrency:>5} {progress.records:>8} {progress.resumed:>8} "
+              f"{seconds:>8.2f} {progress.records / seconds:>10.1f} {completions:>12}  {check(run.run_id)}")
+
+    concurrency = max(args.concurrency)
+    limiter = OpenAIRateLimiter(requests_per_minute=args.requests_per_minute)
+    run, progress, seconds, completions = backfill('rate-limited', concurrency, limiter)
+    print(f"{f'{args.requests_per_minute:.0f} requests/min':<22} {concurrency:>5} {progress.records:>8} "
+          f"{progress.resumed:>8} {seconds:>8.2f} {progress.records / seconds:>10.1f} {completions:>12}  "
+          f"{check(run.run_id)} ({completions / seconds * 60:.0f} requests/min)")
+
+    checkpoint = BackfillCheckpoint(os.path.join(workdir, 'resumed.db'))
+    run, progress, seconds, completions = backfill('resumed', concurrency, stop_after=args.files // 3,
+                                                   checkpoint=checkpoint)
+    print(f"{'stopped':<22} {concurrency:>5} {progress.records:>8} {progress.resumed:>8} {seconds:>8.2f} "
+          f"{progress.records / seconds:>10.1f} {completions:>12}")
+    stopped = completions
+    run, progress, seconds, completions = backfill('resumed', concurrency, checkpoint=checkpoint)
+    analyzed_twice = stopped + completions - args.files
+    print(f"{'resumed':<22} {concurrency:>5} {progress.records:>8} {progress.resumed:>8} {seconds:>8.2f} "
+          f"{progress.records / seconds:>10.1f} {completions:>12}  {check(run.run_id)}, "
+          f"{analyzed_twice} analyzed twice")
+
+
+if __name__ == '__main__':
+    main()
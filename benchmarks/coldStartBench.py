@@ -0,0 +1,125 @@
+""" Cold start benchmark of the Lambda modules (see lazyClients.py).
+
+Every run is a fresh interpreter started with `python -X importtime` which imports a handler module and invokes it on
+its fast paths: for fileSlacker an invalid event, a new event acknowledged onto the (in-memory) job queue and the
+Slack retry of that event, for fileStatsSlacker an S3 event outside of `meta/` and `events/`. Reports the median
+import and handler times, the heaviest imports, and fails when a fast path loaded one of the heavy dependencies or
+when the median import time is over `--max-import-ms`, so regressions are caught.
+
+    $ python benchmarks/coldStartBench.py [--runs 10] [--module fileSlacker|fileStatsSlacker] [--max-import-ms 150]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# none of these should be imported to acknowledge or ignore an event
+HEAVY_MODULES = ['boto3', 'botocore', 'openai', 'requests', 'slack_sdk', 'PIL', 'openpyxl', 'httpx']
+
+SLACK_EVENT = {
+    'event_id': 'Ev0000000001',
+    'event': {
+        'channel': 'C00000001',
+        'ts': '1718000000.000100',
+        'files': [{
+            'id': 'F00000001', 'created': 1718000000, 'timestamp': 1718000000, 'name': 'report.csv',
+            'mimetype': 'text/csv', 'filetype': 'csv', 'user': 'U00000001', 'user_team': 'T00000001', 'size': 1234,
+            'url_private': 'https://files.slack.com/files-pri/T00000001-F00000001/report.csv'
+        }]
+    }
+}
+
+FILE_SLACKER_RUN = f'''
+import time
+start = time.perf_counter()
+import fileSlacker
+imported = time.perf_counter()
+fileSlacker.lambda_handler({{'body': '{{"event": {{"type": "message"}}}}'}}, None)
+fileSlacker.lambda_handler({{'body': {json.dumps(json.dumps(SLACK_EVENT))}}}, None)
+fileSlacker.lambda_handler({{'body': {json.dumps(json.dumps(SLACK_EVENT))}}}, None)
+'''
+
+FILE_STATS_SLACKER_RUN = '''
+import time
+start = time.perf_counter()
+import fileStatsSlacker
+imported = time.perf_counter()
+fileStatsSlacker.lambda_handler(
+    {'Records': [{'s3': {'bucket': {'name': 'file-slacker-bucket'}, 'object': {'key': 'report.csv'}}}]}, None)
+'''
+
+REPORT = f'''
+import json, sys
+done = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - start) * 1000,
+    'handler_ms': (done - imported) * 1000,
+    'heavy_modules': [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+}}))
+'''
+
+
+def run_once(module, workdir):
+    script = (FILE_SLACKER_RUN if module == 'fileSlacker' else FILE_STATS_SLACKER_RUN) + REPORT
+    env = dict(os.environ, PYTHONPATH=ROOT, ASYNC_INGEST_ENABLED='true', JOB_QUEUE_BACKEND='memory',
+               IDEMPOTENCY_BACKEND='sqlite', IDEMPOTENCY_DB_PATH=os.path.join(workdir, 'idempotency.db'),
+               SLACK_BOT_TOKEN='xoxb-benchmark', OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'sk-benchmark'))
+    if os.path.exists(env['IDEMPOTENCY_DB_PATH']):
+        os.remove(env['IDEMPOTENCY_DB_PATH'])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+
+def parse_importtime(stderr):
+    """ The import time in microseconds of every top level package, the sum of the self times of its modules so the
+    nested imports aren't counted twice. """
+    imports = dict()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        imports[package] = imports.get(package, 0) + int(self_us)
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--module', default='fileSlacker', choices=['fileSlacker', 'fileStatsSlacker'])
+    parser.add_argument('--max-import-ms', type=float, help='fail when the median import time is over this')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    results, imports = list(), None
+    with tempfile.TemporaryDirectory() as workdir:
+        for _ in range(args.runs):
+            result, imports = run_once(args.module, workdir)
+            results.append(result)
+    import_ms = statistics.median(r['import_ms'] for r in results)
+    handler_ms = statistics.median(r['handler_ms'] for r in results)
+    heavy = sorted({m for r in results for m in r['heavy_modules']})
+
+    print(f"{args.module}, {args.runs} fresh interpreters")
+    print(f"  median import  {import_ms:8.1f} ms")
+    print(f"  median handler {handler_ms:8.1f} ms (fast paths)")
+    print("  heaviest imports (last run):")
+    for name, us in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"    {name:<24} {us / 1000:8.1f} ms")
+    failures = list()
+    if heavy:
+        failures.append(f"the fast paths imported {', '.join(heavy)}")
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        failures.append(f"the median import time is over {args.max_import_ms} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
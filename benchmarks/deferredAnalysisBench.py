@@ -0,0 +1,165 @@
+""" Benchmark of the deferred analyses (see deferredAnalysis.py) against the local fakes of fakeServices.py, the
+batches of the OpenAI fake included.
+
+Stores large csv and log uploads (over DEFERRED_MIN_MB, the content of the logs summarized in chunks) and small
+ones in the S3 fake. The large ones are analyzed once right away and once through the deferred tier: queued by
+`analyzeUploadedFile`, then packed into batches and collected by `fileSlacker.deferred_analysis_handler` until none
+is left. Reports the time an ingest holds the Lambda for the analysis, the OpenAI requests and tokens (the batch ones
+at half the price), the handler runs and batches, and checks that every deferred record was rewritten and followed up
+once in its thread. A second round fails some of the batch requests to exercise the retries, a file whose requests
+failed DEFERRED_MAX_ATTEMPTS times is rewritten and followed up with the error.
+
+    $ python benchmarks/deferredAnalysisBench.py [--files 20] [--small 10] [--size-mb 2] [--openai-latency-ms 200]
+        [--batch-seconds 0.5] [--batch-error-rate 0.2]
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = 'file-slacker-bucket'
+BATCH_PRICE = 0.5
+
+
+def upload(i, size, seed, now):
+    """ A csv export (even `i`) or a log dump (odd `i`) of about `size` bytes. """
+    rng = random.Random(seed * 100000 + i)
+    rows, total = list(), 0
+    region = ('north', 'south', 'east', 'west')
+    while total < size:
+        row = f"{rng.randint(0, 10 ** 6)},{rng.random():.6f},{rng.choice(region)},row{i}" if i % 2 == 0 else \
+            f"2024-05-{rng.randint(1, 28):02d} INFO worker-{rng.randint(1, 9)} handled {rng.randint(1, 500)} jobs"
+        rows.append(row)
+        total += len(row) + 1
+    if i % 2 == 0:
+        content = ("id,value,region,label\n" + "\n".join(rows) + "\n").encode('utf-8')
+        name, filetype, mimetype, extension = f"export{seed:02d}{i:04d}.csv", 'csv', 'text/csv', '.csv'
+    else:
+        content = ("\n".join(rows) + "\n").encode('utf-8')
+        name, filetype, mimetype, extension = f"worker{seed:02d}{i:04d}.log", 'text', 'text/plain', '.txt'
+    return content, {
+        'id': f"F{seed:02d}{i:06d}", 's3_key': f"F{seed:02d}{i:06d}-{name}", 'name': name, 'filetype': filetype,
+        'mimetype': mimetype, 'file_extension': extension, 'size': len(content), 'created': int(now),
+        'user': 'U-bench', 'slack_orig_channel': 'C-bench', 'slack_orig_ts': f"{int(now)}.{seed:02d}{i:04d}",
+        'slack_event_id': f"Ev{seed:02d}{i:06d}", 'event_file_index': 0, 'event_file_count': 1,
+        'sha256': hashlib.sha256(content).hexdigest(), 'ai_analysis': '_TODO_'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=20, help='large uploads, deferred')
+    parser.add_argument('--small', type=int, default=10, help='small uploads, analyzed right away')
+    parser.add_argument('--size-mb', type=float, default=2.0)
+    parser.add_argument('--openai-latency-ms', type=float, default=200.0)
+    parser.add_argument('--batch-seconds', type=float, default=0.5, help='until the fake completes a batch')
+    parser.add_argument('--batch-error-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='file-slacker-deferred-bench-')
+    os.environ.update({'ANALYSIS_CACHE_BACKEND': 'none', 'SLACK_BOT_TOKEN': 'xoxb-bench', 'OPENAI_API_KEY': 'sk-bench',
+                       'ENDPOINT_STATS_LOGGING_ENABLED': 'false', 'METADATA_QUERIES_ENABLED': 'false',
+                       'DEFERRED_ANALYSIS_ENABLED': 'true', 'DEFERRED_MIN_MB': f"{args.size_mb / 2}"})
+    import logging
+    logging.disable(logging.WARNING)
+
+    import fileSlacker
+    from deferredAnalysis import COMPLETED
+    from deferredAnalysis import FAILED
+    from deferredAnalysis import DEFERRED_FOLDER
+    from deferredAnalysis import should_defer
+    from fakeServices import FakeOpenAI
+    from fakeServices import FakeS3
+    from fakeServices import FakeSlackWebClient
+    from fakeServices import Faults
+    from fakeServices import Ledger
+    from lazyClients import set_client
+    from metadataLayout import read_records
+    from openaiLimits import get_openai_limiter
+
+    ledger = Ledger()
+    s3 = FakeS3(Faults(), ledger, os.path.join(workdir, 's3'), args.seed)
+    openai = FakeOpenAI(Faults(latency_ms=args.openai_latency_ms), ledger, args.seed)
+    slack = FakeSlackWebClient(Faults(), ledger, args.seed)
+    set_client('s3', s3)
+    set_client('openai', openai)
+    set_client('slack', slack)
+    now = time.time()
+
+    def uploads(seed):
+        files = [upload(i, int(args.size_mb * 1024 * 1024), seed, now) for i in range(args.files)] + \
+                [upload(args.files + i, 50 * 1024, seed, now) for i in range(args.small)]
+        for content, metadata in files:
+            s3.put_object(Body=content, Bucket=BUCKET, Key=metadata['s3_key'])
+        return [metadata for _, metadata in files]
+
+    def analyze(records, deferred):
+        """ The analysis part of the ingests, as `fileSlacker._ingest_file` runs it. """
+        limiter = get_openai_limiter()
+        requests, tokens = ledger.analyses, limiter.tokens
+        seconds = 0.0
+        for metadata in records:
+            start = time.perf_counter()
+            fileSlacker.analyzeUploadedFile(metadata, deferred=deferred and should_defer(metadata))
+            seconds += time.perf_counter() - start
+            fileSlacker.upload_metadata_to_s3(metadata)
+        return seconds, ledger.analyses - requests, limiter.tokens - tokens
+
+    def drain():
+        """ Runs the scheduled handler until no analysis is pending or in a batch. """
+        runs, batches, requests, tokens = 0, 0, ledger.analyses, openai.batch_tokens
+        while True:
+            counts = fileSlacker.deferred_analysis_handler({}, None)
+            runs += 1
+            batches += len(counts['submitted'])
+            left = [o for page in s3.get_paginator('list_objects_v2').paginate(Bucket=BUCKET,
+                                                                                 Prefix=f"{DEFERRED_FOLDER}/")
+                    for o in page.get('Contents', [])]
+            if not left:
+                return runs, batches, ledger.analyses - requests, openai.batch_tokens - tokens
+            time.sleep(args.batch_seconds)
+
+    def check(records):
+        deferred = [md for md in records if md.get('analysis_deferred')]
+        stored = [read_records(s3, BUCKET, fileSlacker.get_metadata_s3_key(md))[0] for md in deferred]
+        completed = sum(1 for r in stored
+                        if r['analysis_deferred'] == COMPLETED and 'batch analysis' in r['ai_analysis'])
+        failed = sum(1 for r in stored if r['analysis_deferred'] == FAILED)
+        threads = {md['slack_orig_ts'] for md in deferred}
+        follow_ups = [m for m in slack.messages if m['thread_ts'] in threads]
+        ok = completed + failed == len(deferred) == args.files and len(follow_ups) == len(threads)
+        outcome = f"{completed} completed, {failed} failed, {len(follow_ups)} follow-ups"
+        return f"ok ({outcome})" if ok else f"FAILED: {outcome} of {len(deferred)} deferred"
+
+    sync_seconds, sync_requests, sync_tokens = analyze(uploads(args.seed)[:args.files], deferred=False)
+    print(f"{args.files} csv and log uploads of {args.size_mb} MB (deferred), {args.small} of 50 KB (right away), "
+          f"OpenAI latency {args.openai_latency_ms:.0f} ms\n")
+    print(f"{'mode':<24} {'analysis s/file':>16} {'requests':>9} {'tokens':>9} {'cost':>6} {'runs':>5} "
+          f"{'batches':>8}  check")
+    print(f"{'right away':<24} {sync_seconds / args.files:>16.3f} {sync_requests:>9} {sync_tokens:>9} "
+          f"{1.0:>6.2f} {'':>5} {'':>8}")
+
+    openai.batch_seconds = args.batch_seconds
+    for name, error_rate, seed in (('deferred', 0.0, args.seed + 1),
+                                   (f"deferred, {args.batch_error_rate:.0%} errors", args.batch_error_rate,
+                                    args.seed + 2)):
+        openai.batch_error_rate = error_rate
+        records = uploads(seed)
+        seconds, requests, _ = analyze(records[:args.files], deferred=True)
+        runs, batches, batch_requests, batch_tokens = drain()
+        _, small_requests, _ = analyze(records[args.files:], deferred=True)
+        cost = batch_tokens * BATCH_PRICE / sync_tokens if sync_tokens else 0.0
+        print(f"{name:<24} {seconds / args.files:>16.3f} {requests + batch_requests:>9} {batch_tokens:>9} "
+              f"{cost:>6.2f} {runs:>5} {batches:>8}  {check(records)}, "
+              f"{small_requests} requests for the small files")
+    print(f"\n{json.dumps(openai.injector.summary())} OpenAI call outcomes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,873 @@
+""" In-process fakes of the Slack, S3, Athena and OpenAI clients for the offline load harness (see loadHarness.py).
+
+They are installed with `lazyClients.set_client` in place of the real clients, so fileSlacker and fileStatsSlacker
+run unchanged without network access. Every call goes through a `FaultInjector` adding latency, transient errors
+(5xx) and throttling (429 with Retry-After) raised as the errors of the real SDKs, so `transport.call_with_retries`
+handles them as it would in AWS. The AWS fakes retry throttles themselves like botocore's adaptive mode does, their
+`error_rate` is the rate of calls failing after these retries. S3 objects are spilled to a local directory so the
+fakes don't skew the memory measurements of the pipeline.
+"""
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import timezone
+from types import SimpleNamespace
+
+CHUNK = 1024 * 1024
+# the pace of the words of a streamed chat completion, after the latency of the call
+STREAM_CHUNK_SECONDS = 0.02
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+# the text of the only reply of a Slack message whose files were all rejected, see admission.py
+ALL_REJECTED_TEXT = "None of the files were accepted."
+
+
+@dataclass
+class Faults:
+    """ The behaviour of a fake service. Latencies are in milliseconds, rates are per call. """
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after_seconds: float = 1.0
+    # download bandwidth of the Slack files in MB/s, 0 for unlimited
+    bandwidth_mb_s: float = 0.0
+
+
+class FaultInjector:
+    """ Sleeps the latency of a call and decides its outcome: `ok`, `throttle` or `error`. Counts the outcomes per
+    operation. """
+
+    def __init__(self, service, faults, seed=0):
+        self.service = service
+        self.faults = faults
+        self.counts = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, operation):
+        with self._lock:
+            jitter = self._random.uniform(-self.faults.jitter_ms, self.faults.jitter_ms)
+            draw = self._random.random()
+        time.sleep(max(0.0, self.faults.latency_ms + jitter) / 1000)
+        if draw < self.faults.throttle_rate:
+            outcome = 'throttle'
+        elif draw < self.faults.throttle_rate + self.faults.error_rate:
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+        with self._lock:
+            self.counts[(operation, outcome)] += 1
+        return outcome
+
+    def aws_call(self, operation, client_error):
+        """ A boto3 call: throttles are retried with backoff as botocore does, an error (or running out of attempts)
+        raises a botocore ClientError. """
+        for attempt in range(AWS_MAX_ATTEMPTS):
+            outcome = self.call(operation)
+            if outcome == 'ok':
+                return
+            if outcome == 'error':
+                raise client_error('InternalError', 500, operation)
+            time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
+        raise client_error('SlowDown', 503, operation)
+
+    def summary(self):
+        with self._lock:
+            totals = Counter()
+            for (_, outcome), n in self.counts.items():
+                totals[outcome] += n
+            return dict(totals)
+
+
+def _client_error(code, status, operation, message=''):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code, 'Message': message or code},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+
+def _modeled_error(name, code, status):
+    """ An exception class like the modeled ones of boto3 clients (`client.exceptions.NoSuchKey`). """
+    from botocore.exceptions import ClientError
+
+    class ModeledError(ClientError):
+        def __init__(self, operation, message=''):
+            super().__init__({'Error': {'Code': code, 'Message': message or code},
+                              'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+    ModeledError.__name__ = name
+    return ModeledError
+
+
+class Ledger:
+    """ What the fakes saw of the pipeline, for the harness: the Slack file downloads per file id, the writes per S3
+    key, the replies with the stats per Slack thread and the first message of any kind (e.g. a progressive reply) per
+    thread, with their times. """
+
+    def __init__(self):
+        self.downloads = Counter()
+        self.downloaded_bytes = 0
+        self.s3_writes = Counter()
+        self.replies = dict()
+        self.feedback = dict()
+        self.analyses = 0
+        self._lock = threading.Lock()
+
+    def download(self, file_id):
+        with self._lock:
+            self.downloads[file_id] += 1
+
+    def downloaded(self, size):
+        with self._lock:
+            self.downloaded_bytes += size
+
+    def s3_write(self, key):
+        with self._lock:
+            self.s3_writes[key] += 1
+
+    def reply(self, thread_ts, final=True):
+        with self._lock:
+            now = time.perf_counter()
+            self.feedback.setdefault(thread_ts, now)
+            if final:
+                self.replies.setdefault(thread_ts, list()).append(now)
+
+    def analysis(self):
+        with self._lock:
+            self.analyses += 1
+
+
+# ---------------------------------------------------------------------------------------------------------- Slack
+
+
+def generate_content(kind, size, seed):
+    """ Yields `size` bytes of synthetic content of a kind of file: `csv`, `text`, `image` (a real JPEG when Pillow
+    is installed, its size is then what the encoder produced) or `binary`. The content differs per seed so the
+    analysis cache doesn't hit across files. """
+    if kind == 'image':
+        image = _jpeg(seed)
+        if image is not None:
+            yield image
+            return
+    if kind == 'csv':
+        header = b'id,name,amount,created\n'
+        rows = b''.join(f"{i},item-{seed}-{i},{i * 1.5:.2f},2024-06-{i % 28 + 1:02d}\n".encode()
+                        for i in range(2000))
+        block = header + rows
+    elif kind == 'text':
+        block = (f"Line of the synthetic text file {seed}, the quick brown fox jumps over the lazy dog.\n" * 2000)\
+            .encode()
+    else:
+        block = hashlib.sha256(str(seed).encode()).digest() * (CHUNK // 32)
+    remaining = size
+    while remaining > 0:
+        n = min(remaining, len(block))
+        yield block[:n]
+        remaining -= n
+
+
+def content_size(kind, size, seed):
+    """ The size of the content `generate_content` yields, an image is whatever the JPEG encoder produced. """
+    if kind == 'image':
+        image = _jpeg(seed)
+        if image is not None:
+            return len(image)
+    return size
+
+
+_jpeg_cache = dict()
+_jpeg_lock = threading.Lock()
+
+
+def _jpeg(seed):
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    color = tuple(hashlib.sha256(str(seed).encode()).digest()[:3])
+    with _jpeg_lock:
+        if color not in _jpeg_cache:
+            buffer = io.BytesIO()
+            Image.new('RGB', (2400, 1600), color).save(buffer, 'JPEG', quality=85)
+            _jpeg_cache[color] = buffer.getvalue()
+        return _jpeg_cache[color]
+
+
+class FakeSlackFileResponse:
+    """ The streamed response of a Slack private file URL, like `requests.Response` with `stream=True`. """
+
+    def __init__(self, status_code, chunks=(), headers=None, ledger=None, bandwidth_mb_s=0.0):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._chunks = chunks
+        self._ledger = ledger
+        self._bandwidth = bandwidth_mb_s * CHUNK
+
+    def iter_content(self, chunk_size=CHUNK):
+        buffered = b''
+        for chunk in self._chunks:
+            if self._bandwidth:
+                time.sleep(len(chunk) / self._bandwidth)
+            buffered += chunk
+            while len(buffered) >= chunk_size:
+                yield buffered[:chunk_size]
+                buffered = buffered[chunk_size:]
+            if self._ledger is not None:
+                self._ledger.downloaded(len(chunk))
+        if buffered:
+            yield buffered
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class FakeSlackFiles:
+    """ Stands in for the pooled `requests` Session downloading the Slack private file URLs. The harness registers
+    every file of the events it sends with `add_file`. """
+
+    def __init__(self, faults, ledger, seed=0):
+        self.injector = FaultInjector('slack.files', faults, seed)
+        self.ledger = ledger
+        self._files = dict()
+
+    def add_file(self, url, file_id, kind, size, content_seed=None):
+        """ `content_seed` gives several files the same content, the file id by default. """
+        self._files[url] = (file_id, kind, size, content_seed or file_id)
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        outcome = self.injector.call('files.get')
+        if outcome == 'throttle':
+            return FakeSlackFileResponse(
+                429, headers={'Retry-After': str(self.injector.faults.retry_after_seconds)})
+        if outcome == 'error':
+            return FakeSlackFileResponse(500)
+        if url not in self._files:
+            return FakeSlackFileResponse(404)
+        file_id, kind, size, content_seed = self._files[url]
+        self.ledger.download(file_id)
+        return FakeSlackFileResponse(200, generate_content(kind, size, content_seed), ledger=self.ledger,
+                                     bandwidth_mb_s=self.injector.faults.bandwidth_mb_s)
+
+
+class FakeSlackWebClient:
+    """ The `slack_sdk.WebClient` calls used by fileStatsSlacker and the progressive replies. Throttles and errors
+    raise `SlackApiError` with a 429 (and Retry-After) or 500 response. A message with the stats is a final reply,
+    as is the explanation that none of the files of a message were accepted (see admission.py). A coalesced reply
+    (see replyCoalescing.py) answers every thread listed in its message metadata. """
+
+    def __init__(self, faults, ledger, seed=0):
+        self.injector = FaultInjector('slack.api', faults, seed)
+        self.ledger = ledger
+        self.messages = list()
+        self._ts = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _raise(self, operation, outcome):
+        from slack_sdk.errors import SlackApiError
+        from slack_sdk.web.slack_response import SlackResponse
+        status, error = (429, 'ratelimited') if outcome == 'throttle' else (500, 'internal_error')
+        headers = {'Retry-After': str(self.injector.faults.retry_after_seconds)} if status == 429 else {}
+        response = SlackResponse(client=self, http_verb='POST', api_url=f'https://slack.com/api/{operation}',
+                                 req_args={}, data={'ok': False, 'error': error}, headers=headers,
+                                 status_code=status)
+        raise SlackApiError(f"The request to the Slack API failed: {error}", response)
+
+    def chat_postMessage(self, channel, text=None, blocks=None, thread_ts=None, metadata=None, **kwargs):
+        outcome = self.injector.call('chat.postMessage')
+        if outcome != 'ok':
+            self._raise('chat.postMessage', outcome)
+        with self._lock:
+            ts = f"{int(time.time())}.{next(self._ts):06d}"
+            self.messages.append({'channel': channel, 'thread_ts': thread_ts, 'ts': ts, 'text': text,
+                                  'blocks': blocks})
+        for thread in (metadata or {}).get('event_payload', {}).get('threads') or [thread_ts]:
+            self.ledger.reply(thread, final=self._is_final(text, blocks))
+        return {'ok': True, 'channel': channel, 'ts': ts}
+
+    def chat_update(self, channel, ts, text=None, blocks=None, **kwargs):
+        outcome = self.injector.call('chat.update')
+        if outcome != 'ok':
+            self._raise('chat.update', outcome)
+        with self._lock:
+            message = next((m for m in self.messages if m['ts'] == ts and m['channel'] == channel), None)
+            if message is None:
+                raise KeyError(f"message_not_found: {ts}")
+            message.update({'text': text, 'blocks': blocks})
+        self.ledger.reply(message['thread_ts'], final=self._is_final(text, blocks))
+        return {'ok': True, 'channel': channel, 'ts': ts}
+
+    @staticmethod
+    def _is_final(text, blocks):
+        if text == ALL_REJECTED_TEXT:
+            return True
+        return 'Summary of All Files' in (blocks if isinstance(blocks, str) else json.dumps(blocks or []))
+
+
+# ------------------------------------------------------------------------------------------------------------- S3
+
+
+class FakeStreamingBody:
+    """ Like botocore's StreamingBody, reading the spilled object from disk. """
+
+    def __init__(self, path, start=0, length=None):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._left = length
+
+    def read(self, amt=None):
+        if self._file.closed:
+            return b''
+        if self._left is not None:
+            amt = self._left if amt is None else min(amt, self._left)
+        data = self._file.read() if amt is None else self._file.read(amt)
+        if self._left is not None:
+            self._left -= len(data)
+        if not data or amt is None or self._left == 0:
+            self._file.close()
+        return data
+
+    def iter_chunks(self, chunk_size=CHUNK):
+        while data := self.read(chunk_size):
+            yield data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._file.close()
+
+
+class _FakeListObjectsPaginator:
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        contents, prefixes = list(), set()
+        with self.s3._lock:
+            keys = sorted(k for (b, k) in self.s3._objects if b == Bucket and k.startswith(Prefix))
+            stored = {k: self.s3._objects[(Bucket, k)] for k in keys}
+        for key in keys:
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefixes.add(Prefix + rest[:rest.index(Delimiter) + 1])
+            else:
+                contents.append({'Key': key, 'Size': stored[key]['size'], 'ETag': stored[key]['etag']})
+        for i in range(0, max(1, len(contents)), 1000):
+            yield {'Contents': contents[i:i + 1000],
+                   'CommonPrefixes': [{'Prefix': p} for p in sorted(prefixes)] if i == 0 else []}
+
+
+class FakeS3:
+    """ The S3 client calls used by fileSlacker, fileStatsSlacker and their modules, including multipart uploads
+    and conditional writes (IfMatch/IfNoneMatch). `on_write(bucket, key)` is called for every new object, the
+    harness uses it as the bucket's event notification. """
+
+    def __init__(self, faults, ledger, spill_dir, seed=0, on_write=None):
+        self.injector = FaultInjector('s3', faults, seed)
+        self.ledger = ledger
+        self.spill_dir = spill_dir
+        self.on_write = on_write
+        self.exceptions = SimpleNamespace(NoSuchKey=_modeled_error('NoSuchKey', 'NoSuchKey', 404),
+                                          NoSuchUpload=_modeled_error('NoSuchUpload', 'NoSuchUpload', 404))
+        self._objects = dict()
+        self._uploads = dict()
+        self._lock = threading.Lock()
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def _path(self):
+        return os.path.join(self.spill_dir, uuid.uuid4().hex)
+
+    def _store(self, bucket, key, path, content_type, condition=None):
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            etag = f'"{hashlib.md5(f.read(CHUNK)).hexdigest()}-{size}"'
+        with self._lock:
+            existing = self._objects.get((bucket, key))
+            if condition is not None:
+                if_match, if_none_match = condition
+                if (if_none_match == '*' and existing is not None) or \
+                        (if_match is not None and (existing is None or existing['etag'] != if_match)):
+                    os.remove(path)
+                    raise _client_error('PreconditionFailed', 412, 'PutObject')
+            self._objects[(bucket, key)] = {'path': path, 'etag': etag, 'size': size, 'content_type': content_type,
+                                            'modified': datetime.now(timezone.utc)}
+        if existing is not None:
+            os.remove(existing['path'])
+        self.ledger.s3_write(key)
+        if self.on_write is not None:
+            self.on_write(bucket, key)
+        return etag
+
+    def put_object(self, Bucket, Key, Body=b'', ContentType=None, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self.injector.aws_call('PutObject', _client_error)
+        path = self._path()
+        with open(path, 'wb') as f:
+            if isinstance(Body, str):
+                Body = Body.encode('utf-8')
+            if isinstance(Body, (bytes, bytearray)):
+                f.write(Body)
+            else:
+                shutil.copyfileobj(Body, f, CHUNK)
+        condition = (IfMatch, IfNoneMatch) if IfMatch or IfNoneMatch else None
+        return {'ETag': self._store(Bucket, Key, path, ContentType, condition)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.injector.aws_call('GetObject', _client_error)
+        with self._lock:
+            stored = self._objects.get((Bucket, Key))
+            if stored is None:
+                raise self.exceptions.NoSuchKey('GetObject', f"The specified key does not exist: {Key}")
+            start, length = 0, stored['size']
+            if Range:
+                # bytes=<first>-<last>, both inclusive
+                first, _, last = Range.removeprefix('bytes=').partition('-')
+                start = int(first)
+                length = max(0, min(int(last) if last else stored['size'] - 1, stored['size'] - 1) - start + 1)
+            body = FakeStreamingBody(stored['path'], start, length)
+        return {'Body': body, 'ETag': stored['etag'], 'ContentLength': length,
+                'ContentType': stored['content_type'], 'LastModified': stored['modified']}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.injector.aws_call('HeadObject', _client_error)
+        with self._lock:
+            stored = self._objects.get((Bucket, Key))
+        if stored is None:
+            raise _client_error('404', 404, 'HeadObject', 'Not Found')
+        return {'ETag': stored['etag'], 'ContentLength': stored['size'], 'ContentType': stored['content_type'],
+                'LastModified': stored['modified']}
+
+    def copy_object(self, Bucket, Key, CopySource, ContentType=None, **kwargs):
+        self.injector.aws_call('CopyObject', _client_error)
+        with self._lock:
+            source = self._objects.get((CopySource['Bucket'], CopySource['Key']))
+            if source is None:
+                raise self.exceptions.NoSuchKey('CopyObject', f"The specified key does not exist: {CopySource['Key']}")
+            path = self._path()
+            shutil.copyfile(source['path'], path)
+        etag = self._store(Bucket, Key, path, ContentType or source['content_type'])
+        return {'CopyObjectResult': {'ETag': etag, 'LastModified': datetime.now(timezone.utc)}}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.injector.aws_call('DeleteObject', _client_error)
+        with self._lock:
+            stored = self._objects.pop((Bucket, Key), None)
+        if stored is not None:
+            os.remove(stored['path'])
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.injector.aws_call('DeleteObjects', _client_error)
+        for o in Delete['Objects']:
+            with self._lock:
+                stored = self._objects.pop((Bucket, o['Key']), None)
+            if stored is not None:
+                os.remove(stored['path'])
+        return {'Deleted': [{'Key': o['Key']} for o in Delete['Objects']]}
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None, **kwargs):
+        self.injector.aws_call('CreateMultipartUpload', _client_error)
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {'bucket': Bucket, 'key': Key, 'content_type': ContentType, 'parts': dict()}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.injector.aws_call('UploadPart', _client_error)
+        path = self._path()
+        with open(path, 'wb') as f:
+            f.write(Body if isinstance(Body, (bytes, bytearray)) else Body.read())
+        etag = f'"{uuid.uuid4().hex}"'
+        with self._lock:
+            upload = self._uploads.get(UploadId)
+            if upload is None:
+                os.remove(path)
+                raise self.exceptions.NoSuchUpload('UploadPart')
+            upload['parts'][PartNumber] = (etag, path)
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.injector.aws_call('CompleteMultipartUpload', _client_error)
+        with self._lock:
+            upload = self._uploads.pop(UploadId, None)
+        if upload is None:
+            raise self.exceptions.NoSuchUpload('CompleteMultipartUpload')
+        path = self._path()
+        with open(path, 'wb') as f:
+            for part in MultipartUpload['Parts']:
+                etag, part_path = upload['parts'][part['PartNumber']]
+                if etag != part['ETag']:
+                    raise _client_error('InvalidPart', 400, 'CompleteMultipartUpload')
+                with open(part_path, 'rb') as p:
+                    shutil.copyfileobj(p, f, CHUNK)
+        for _, part_path in upload['parts'].values():
+            os.remove(part_path)
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': self._store(Bucket, Key, path, upload['content_type'])}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.injector.aws_call('AbortMultipartUpload', _client_error)
+        with self._lock:
+            upload = self._uploads.pop(UploadId, None)
+        for _, part_path in (upload or {'parts': {}})['parts'].values():
+            os.remove(part_path)
+        return {}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600, **kwargs):
+        return f"https://{Params['Bucket']}.s3.fake.local/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+    def get_paginator(self, operation):
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(operation)
+        return _FakeListObjectsPaginator(self)
+
+    def stored_bytes(self, bucket, prefixes=None):
+        """ The bytes of the objects stored under some prefixes, all the objects by default. """
+        with self._lock:
+            return sum(s['size'] for (b, k), s in self._objects.items()
+                       if b == bucket and (prefixes is None or k.startswith(tuple(prefixes))))
+
+    def json_objects(self, bucket, prefix):
+        """ The JSON objects stored under a prefix, for the Athena fake. """
+        with self._lock:
+            paths = [s['path'] for (b, k), s in self._objects.items()
+                     if b == bucket and k.startswith(prefix) and k.endswith('.json')]
+        records = list()
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    records.append(json.loads(f.read()))
+            except (OSError, ValueError):
+                pass
+        return records
+
+
+# --------------------------------------------------------------------------------------------------------- Athena
+
+
+def _athena_rows(header, rows):
+    return [{'Data': [{'VarCharValue': str(v)} for v in row]} for row in [header] + rows]
+
+
+class FakeAthena:
+    """ The Athena calls of athenaQueries.py. A query runs for the configured latency and answers the stats queries
+    of fileStatsSlacker from the metadata records stored in the S3 fake. """
+
+    def __init__(self, faults, s3, bucket, metadata_prefix='meta/', seed=0):
+        self.injector = FaultInjector('athena', faults, seed)
+        self.s3 = s3
+        self.bucket = bucket
+        self.metadata_prefix = metadata_prefix
+        self.exceptions = SimpleNamespace(
+            InvalidRequestException=_modeled_error('InvalidRequestException', 'InvalidRequestException', 400))
+        self._executions = dict()
+        self._lock = threading.Lock()
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self.injector.aws_call('StartQueryExecution', _client_error)
+        execution_id = uuid.uuid4().hex
+        with self._lock:
+            self._executions[execution_id] = {'sql': QueryString, 'started': time.perf_counter(), 'state': 'RUNNING'}
+        return {'QueryExecutionId': execution_id}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.injector.aws_call('BatchGetQueryExecution', _client_error)
+        runtime = self.injector.faults.latency_ms / 1000
+        executions = list()
+        with self._lock:
+            for execution_id in QueryExecutionIds:
+                execution = self._executions[execution_id]
+                if execution['state'] == 'RUNNING' and time.perf_counter() - execution['started'] >= runtime:
+                    execution['state'] = 'SUCCEEDED'
+                executions.append({'QueryExecutionId': execution_id, 'Status': {'State': execution['state']}})
+        return {'QueryExecutions': executions}
+
+    def get_query_results(self, QueryExecutionId, **kwargs):
+        self.injector.aws_call('GetQueryResults', _client_error)
+        with self._lock:
+            sql = self._executions[QueryExecutionId]['sql']
+        return {'ResultSet': {'Rows': self._answer(sql)}}
+
+    def stop_query_execution(self, QueryExecutionId):
+        with self._lock:
+            if QueryExecutionId in self._executions:
+                self._executions[QueryExecutionId]['state'] = 'CANCELLED'
+        return {}
+
+    def _answer(self, sql):
+        """ The rows of the fileStatsSlacker queries (summary, by filetype or reconciliation) over the metadata. """
+        records = [r for r in self.s3.json_objects(self.bucket, self.metadata_prefix) if 'filetype' in r]
+        by_filetype = dict()
+        for r in records:
+            by_filetype.setdefault(r['filetype'], list()).append(r)
+
+        def date(created):
+            return datetime.fromtimestamp(int(created), timezone.utc).strftime('%m/%d/%Y')
+
+        def with_text(group):
+            return sum(1 for r in group if r.get('user_text'))
+
+        def physical(group):
+            return sum(int(r['size']) for r in group if not r.get('blob_duplicate'))
+
+        if 'group by filetype' not in sql.lower():
+            sizes = [int(r['size']) for r in records] or [0]
+            created = [int(r['created']) for r in records]
+            return _athena_rows(
+                ['total #', '# of users', '# of slack channels', '# of filetype', 'min size (kB)', 'max size (kB)',
+                 'avg size (kB)', '# with text', 'first create date', 'last create date', 'logical bytes',
+                 'physical bytes'],
+                [[len(records), len({r['user'] for r in records}), len({r['slack_orig_channel'] for r in records}),
+                  len(by_filetype), round(min(sizes) / 1000, 2), round(max(sizes) / 1000, 2),
+                  round(sum(sizes) / len(sizes) / 1000, 2), with_text(records),
+                  date(min(created)) if created else '', date(max(created)) if created else '', sum(sizes),
+                  physical(records)]])
+        rows = list()
+        if '"size_sum"' in sql:
+            for filetype, group in sorted(by_filetype.items()):
+                sizes = [int(r['size']) for r in group]
+                created = [int(r['created']) for r in group]
+                rows.append([filetype, len(group), sum(sizes), physical(group), min(sizes), max(sizes), min(created),
+                             max(created), with_text(group), ','.join(sorted({r['user'] for r in group})),
+                             ','.join(sorted({r['slack_orig_channel'] for r in group}))])
+            return _athena_rows(['filetype', 'count', 'size_sum', 'physical_size_sum', 'size_min', 'size_max',
+                                 'created_min', 'created_max', 'with_text', 'users', 'channels'], rows)
+        for filetype, group in sorted(by_filetype.items(), key=lambda item: -len(item[1])):
+            sizes = [int(r['size']) for r in group]
+            created = [int(r['created']) for r in group]
+            rows.append([filetype, len(group), len({r['user'] for r in group}),
+                         len({r['slack_orig_channel'] for r in group}), round(sum(sizes) / len(sizes) / 1000, 2),
+                         with_text(group), date(min(created)), date(max(created))])
+        return _athena_rows(['filetype', '# per filetype', '# of users', '# of slack channels', 'avg size (kB)',
+                             '# with text', 'first create date', 'last create date'], rows)
+
+
+# --------------------------------------------------------------------------------------------------------- OpenAI
+
+
+def _openai_error(outcome, retry_after_seconds):
+    import httpx
+    import openai
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    if outcome == 'throttle':
+        response = httpx.Response(429, headers={'retry-after': str(retry_after_seconds)}, request=request)
+        return openai.RateLimitError('Rate limit reached', response=response, body=None)
+    return openai.InternalServerError('The server had an error', response=httpx.Response(500, request=request),
+                                      body=None)
+
+
+class FakeOpenAI:
+    """ The OpenAI client calls of fileSlacker: chat completions, the files/assistants/threads calls of the
+    file_search pipeline and the batches of the deferred analyses. The answers are canned, shaped like the SDK's
+    (`response.choices[0].message.content`, `response.usage`). A batch completes once it is retrieved
+    `batch_seconds` after its creation, a `batch_error_rate` of its requests failing. With `set_quota` the chat
+    completions are throttled (429, with Retry-After) and the runs fail with `rate_limit_exceeded` over the requests and
+    tokens per minute, like OpenAI counts them: the prompt and `max_tokens`. """
+
+    def __init__(self, faults, ledger, seed=0):
+        self.injector = FaultInjector('openai', faults, seed)
+        self.ledger = ledger
+        self._ids = itertools.count(1)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_completion))
+        self.files = SimpleNamespace(create=self._create_file, delete=self._ok('files.delete'),
+                                     retrieve=lambda file_id: SimpleNamespace(id=file_id, filename='file.txt'),
+                                     content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+        self.batch_seconds = 0.0
+        self.batch_error_rate = 0.0
+        self.batch_tokens = 0
+        self._batch_random = random.Random(seed)
+        self._batch_files = dict()
+        self._batches = dict()
+        self._batch_lock = threading.Lock()
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(list=lambda **kwargs: list(self._assistants),
+                                       create=self._create_assistant),
+            threads=SimpleNamespace(create=self._create_thread, delete=self._ok('threads.delete'),
+                                    runs=SimpleNamespace(create_and_poll=self._run),
+                                    messages=SimpleNamespace(list=self._messages)),
+            vector_stores=SimpleNamespace(delete=self._ok('vector_stores.delete')))
+        self._assistants = list()
+        self._quota = None
+        self.quota_throttles = 0
+        self.quota_tokens = 0
+
+    def set_quota(self, requests_per_minute=0, tokens_per_minute=0, burst_seconds=5.0):
+        self._quota = {'requests': [requests_per_minute / 60, requests_per_minute / 60 * burst_seconds],
+                       'tokens': [tokens_per_minute / 60, tokens_per_minute / 60 * burst_seconds],
+                       'burst_seconds': burst_seconds, 'updated': time.monotonic()}
+
+    def _check_quota(self, tokens):
+        """ Takes a request of `tokens` from the quota, or raises the 429 of OpenAI with how long until it fits. """
+        if self._quota is None:
+            return
+        with self._batch_lock:
+            now = time.monotonic()
+            elapsed, self._quota['updated'] = now - self._quota['updated'], now
+            waits = list()
+            for name, amount in (('requests', 1), ('tokens', tokens)):
+                rate, level = self._quota[name]
+                if rate:
+                    level = min(rate * self._quota['burst_seconds'], level + elapsed * rate)
+                    self._quota[name][1] = level
+                    waits.append((amount - level) / rate)
+            if max(waits, default=0.0) > 0:
+                self.quota_throttles += 1
+                throttled = True
+            else:
+                for name, amount in (('requests', 1), ('tokens', tokens)):
+                    self._quota[name][1] -= amount if self._quota[name][0] else 0
+                self.quota_tokens += tokens
+                throttled = False
+        if throttled:
+            raise _openai_error('throttle', f"{max(waits):.3f}")
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self._ids)}"
+
+    def _call(self, operation):
+        outcome = self.injector.call(operation)
+        if outcome != 'ok':
+            raise _openai_error(outcome, self.injector.faults.retry_after_seconds)
+
+    def _ok(self, operation):
+        def call(*args, **kwargs):
+            self._call(operation)
+            return SimpleNamespace(deleted=True)
+        return call
+
+    def _chat_completion(self, model, messages, max_tokens=None, stream=False, **kwargs):
+        self._call('chat.completions')
+        self._check_quota(sum(len(str(m.get('content', ''))) for m in messages) // 4 + (max_tokens or 0))
+        self.ledger.analysis()
+        content = f"A synthetic {model} analysis of the content ({sum(len(str(m)) for m in messages)} characters)."
+        if stream:
+            return self._stream(model, content)
+        prompt_tokens = sum(len(str(m)) for m in messages) // 4
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(content) // 4,
+                                total_tokens=prompt_tokens + len(content) // 4)
+        return SimpleNamespace(id=self._id('chatcmpl'), model=model, usage=usage, choices=[
+            SimpleNamespace(index=0, finish_reason='stop', message=SimpleNamespace(role='assistant', content=content))])
+
+    def _stream(self, model, content):
+        """ The chunks of a streamed completion, a word every STREAM_CHUNK_SECONDS. """
+        completion_id = self._id('chatcmpl')
+        for word in content.split(' '):
+            time.sleep(STREAM_CHUNK_SECONDS)
+            yield SimpleNamespace(id=completion_id, model=model, choices=[
+                SimpleNamespace(index=0, finish_reason=None, delta=SimpleNamespace(content=f"{word} "))])
+
+    def _create_file(self, file, purpose):
+        self._call('files.create')
+        name, data = file
+        if isinstance(data, (bytes, bytearray)):
+            data = io.BytesIO(data)
+        size = 0
+        content = bytearray()
+        while chunk := data.read(CHUNK):
+            size += len(chunk)
+            if purpose == 'batch':
+                content += chunk
+        file_id = self._id('file')
+        if purpose == 'batch':
+            self._batch_files[file_id] = bytes(content)
+        return SimpleNamespace(id=file_id, filename=name, bytes=size, purpose=purpose)
+
+    def _file_content(self, file_id):
+        self._call('files.content')
+        content = self._batch_files[file_id]
+        return SimpleNamespace(content=content, text=content.decode('utf-8'), read=lambda: content)
+
+    def _create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        self._call('batches.create')
+        lines = self._batch_files[input_file_id].decode('utf-8').splitlines()
+        batch = SimpleNamespace(id=self._id('batch'), status='validating', input_file_id=input_file_id,
+                                endpoint=endpoint, completion_window=completion_window, metadata=metadata,
+                                created_at=time.time(), output_file_id=None, error_file_id=None,
+                                request_counts=SimpleNamespace(total=len(lines), completed=0, failed=0))
+        with self._batch_lock:
+            self._batches[batch.id] = batch
+        return batch
+
+    def _retrieve_batch(self, batch_id):
+        self._call('batches.retrieve')
+        with self._batch_lock:
+            batch = self._batches[batch_id]
+            if batch.status == 'validating':
+                batch.status = 'in_progress'
+            elif batch.status == 'in_progress' and time.time() - batch.created_at >= self.batch_seconds:
+                self._run_batch(batch)
+            return batch
+
+    def _run_batch(self, batch):
+        """ Answers every request of the input file, the failed ones in the error file. """
+        output, errors = list(), list()
+        for line in self._batch_files[batch.input_file_id].decode('utf-8').splitlines():
+            request = json.loads(line)
+            if self._batch_random.random() < self.batch_error_rate:
+                errors.append({'id': self._id('batch_req'), 'custom_id': request['custom_id'], 'response': {
+                    'status_code': 500, 'body': {'error': {'message': 'The server had an error'}}}, 'error': None})
+                continue
+            body = request['body']
+            self.ledger.analysis()
+            content = f"A synthetic {body['model']} batch analysis of the content " \
+                      f"({sum(len(str(m)) for m in body['messages'])} characters)."
+            prompt_tokens = sum(len(str(m)) for m in body['messages']) // 4
+            self.batch_tokens += prompt_tokens + len(content) // 4
+            output.append({'id': self._id('batch_req'), 'custom_id': request['custom_id'], 'error': None, 'response': {
+                'status_code': 200, 'body': {
+                    'id': self._id('chatcmpl'), 'object': 'chat.completion', 'model': body['model'],
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                              'total_tokens': prompt_tokens + len(content) // 4}}}})
+        for results, attribute in ((output, 'output_file_id'), (errors, 'error_file_id')):
+            if results:
+                file_id = self._id('file')
+                self._batch_files[file_id] = "\n".join(json.dumps(r) for r in results).encode('utf-8')
+                setattr(batch, attribute, file_id)
+        batch.request_counts = SimpleNamespace(total=len(output) + len(errors), completed=len(output),
+                                               failed=len(errors))
+        batch.status = 'completed'
+
+    def _create_assistant(self, **config):
+        self._call('assistants.create')
+        assistant = SimpleNamespace(id=self._id('asst'), **config)
+        self._assistants.append(assistant)
+        return assistant
+
+    def _create_thread(self, messages):
+        self._call('threads.create')
+        return SimpleNamespace(id=self._id('thread'), tool_resources=SimpleNamespace(
+            file_search=SimpleNamespace(vector_store_ids=[self._id('vs')])))
+
+    def _run(self, thread_id, assistant_id):
+        self._call('threads.runs')
+        try:
+            self._check_quota(4000)
+        except Exception as e:
+            # a run over the limits isn't a 429, it fails with the delay in its error message
+            return SimpleNamespace(id=self._id('run'), status='failed', last_error=SimpleNamespace(
+                code='rate_limit_exceeded',
+                message=f"Rate limit reached for requests. Please try again in {e.response.headers['retry-after']}s."))
+        self.ledger.analysis()
+        return SimpleNamespace(id=self._id('run'), status='completed', last_error=None)
+
+    def _messages(self, thread_id, run_id=None):
+        self._call('threads.messages')
+        text = SimpleNamespace(value="A synthetic file_search analysis of the file.", annotations=[])
+        return [SimpleNamespace(role='assistant', content=[SimpleNamespace(type='text', text=text)])]
@@ -0,0 +1,94 @@
+""" Micro-benchmark of the image pre-processing done before the OpenAI image analysis (see imagePrep.py).
+
+Reports the decode/resize/encode time and the byte reduction per image and for the whole corpus. Without a corpus
+directory a synthetic one is generated (phone-sized JPEG photos, PNG screenshots and a transparent PNG).
+
+    $ python benchmarks/imagePrepBench.py [--corpus DIR] [--max-edge 1536] [--format JPEG|WEBP]
+"""
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from imagePrep import ImagePrepError
+from imagePrep import prepare_image
+
+
+def synthetic_corpus():
+    """ Images with enough noise and gradients that they don't compress unrealistically well. """
+    from PIL import Image
+    from PIL import ImageDraw
+    corpus = list()
+    specs = [('photo_12mp.jpg', (4032, 3024), 'JPEG'), ('photo_8mp.jpg', (3264, 2448), 'JPEG'),
+             ('screenshot.png', (2560, 1440), 'PNG'), ('logo_alpha.png', (1024, 1024), 'PNG')]
+    for name, size, image_format in specs:
+        noise = Image.effect_noise(size, 40).convert('L')
+        gradient = Image.linear_gradient('L').resize(size)
+        image = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+        draw = ImageDraw.Draw(image)
+        for i in range(0, size[0], 97):
+            draw.line([(i, 0), (size[0] - i, size[1])], fill=(255, 255, 255), width=3)
+        if name.startswith('logo'):
+            image = image.convert('RGBA')
+            image.putalpha(gradient)
+        buffer = BytesIO()
+        image.save(buffer, image_format, **({'quality': 92} if image_format == 'JPEG' else {}))
+        corpus.append((name, buffer.getvalue()))
+    return corpus
+
+
+def load_corpus(directory):
+    corpus = list()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                corpus.append((name, f.read()))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', help='directory of sample images (default: a synthetic corpus)')
+    parser.add_argument('--max-edge', type=int, default=1536)
+    parser.add_argument('--format', default='JPEG', choices=['JPEG', 'WEBP'])
+    parser.add_argument('--quality', type=int, default=80)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    print(f"{'image':<28} {'original':>12} {'prepared':>10} {'reduction':>10} {'MP':>6} {'ms':>8} {'detail':>7}")
+    total_original = total_prepared = total_pixels = 0
+    total_seconds = 0.0
+    for name, data in corpus:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            try:
+                prepared = prepare_image(BytesIO(data), max_edge=args.max_edge, image_format=args.format,
+                                         quality=args.quality)
+            except ImagePrepError as e:
+                print(f"{name:<28} skipped: {e}")
+                break
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        if best is None:
+            continue
+        megapixels = prepared.original_width * prepared.original_height / 1e6
+        total_original += len(data)
+        total_prepared += len(prepared.data)
+        total_pixels += megapixels
+        total_seconds += best
+        print(f"{name[:28]:<28} {len(data):>12,} {len(prepared.data):>10,} {1 - len(prepared.data) / len(data):>10.1%} "
+              f"{megapixels:>6.1f} {best * 1000:>8.1f} {prepared.detail:>7}")
+    if total_seconds:
+        print(f"\n{len(corpus)} images: {len(corpus) / total_seconds:.1f} images/s, "
+              f"{total_pixels / total_seconds:.1f} MP/s, {total_original:,} -> {total_prepared:,} bytes "
+              f"({1 - total_prepared / total_original:.1%} smaller)")
+
+
+if __name__ == '__main__':
+    main()
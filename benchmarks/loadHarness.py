@@ -0,0 +1,580 @@
+""" Offline end-to-end load harness of fileSlacker and fileStatsSlacker.
+
+Replays synthetic (or recorded, `--replay`) Slack `app_mention` events at a fixed rate through
+`fileSlacker.lambda_handler`, with Slack, S3, Athena and OpenAI replaced by the local fakes of fakeServices.py. The
+metadata and event manifests written to the S3 fake trigger `fileStatsSlacker.lambda_handler` as the bucket
+notification would (or batched as through SQS, `--stats-batch-size`), and with async ingest a pool of workers drains
+the in-memory job queue with `fileSlacker.worker_handler`. Slack re-sends an event that wasn't acknowledged within 3
+seconds (up to 3 times), the `retry-storm` scenario re-sends every event right away on top of that.
+
+Each scenario runs in a fresh interpreter and reports the throughput, the end-to-end latency (event sent to reply
+posted), time to first feedback (event sent to the first message in the thread, sooner than the reply with
+`--progressive`) and acknowledgement latency percentiles, the Slack API calls per event, the duplicate downloads,
+uploads and replies caused by the retries, the injected faults and the peak RSS. `--json` prints the results for a
+CI job, `--baseline` compares them with a previous `--json` output and fails on a regression.
+
+    $ python benchmarks/loadHarness.py [--scenarios baseline large-files multi-file duplicates mixed-sizes bursty
+        retry-storm] [--events N] [--rate EVENTS_PER_S] [--concurrency 20] [--replay events.jsonl] [--json]
+        [--baseline results.json] [--trace spans.log] [--progressive] [--fault openai.throttle_rate=0.2 ...]
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from urllib.parse import quote_plus
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeServices import Faults
+from spanStats import percentile
+
+KB = 1024
+BUCKET = 'file-slacker-bucket'
+# Slack considers an event not acknowledged within 3 seconds failed and retries it up to 3 times: right away,
+# after 1 minute and after 5 minutes (compressed with --time-scale)
+SLACK_ACK_TIMEOUT_SECONDS = 3.0
+SLACK_RETRY_DELAYS_SECONDS = (0, 60, 300)
+STORM_RETRY_GAP_SECONDS = 0.05
+FILE_KINDS = {
+    'csv': ('text/csv', 'csv', 'report-{}.csv'),
+    'text': ('text/plain', 'text', 'notes-{}.txt'),
+    'image': ('image/jpeg', 'jpg', 'photo-{}.jpg'),
+    'binary': ('application/pdf', 'pdf', 'document-{}.pdf'),
+    'video': ('video/mp4', 'mp4', 'clip-{}.mp4'),
+    'disk-image': ('application/x-iso9660-image', 'iso', 'disk-{}.iso'),
+}
+
+DEFAULT_FAULTS = {
+    'slack.files': Faults(latency_ms=80, jitter_ms=40, bandwidth_mb_s=100),
+    'slack.api': Faults(latency_ms=120, jitter_ms=60),
+    's3': Faults(latency_ms=25, jitter_ms=15),
+    'athena': Faults(latency_ms=1500, jitter_ms=500),
+    'openai': Faults(latency_ms=1200, jitter_ms=600),
+}
+
+SCENARIOS = {
+    'baseline': {
+        'events': 40, 'rate': 10.0, 'files': (1, 1), 'size_kb': (20, 800),
+        'kinds': ['csv', 'text', 'image', 'binary'], 'async_ingest': True, 'storm': False, 'faults': {}},
+    'large-files': {
+        'events': 3, 'rate': 1.0, 'files': (1, 1), 'size_kb': (24 * KB, 64 * KB),
+        'kinds': ['csv', 'binary'], 'async_ingest': True, 'storm': False, 'faults': {}},
+    'multi-file': {
+        'events': 15, 'rate': 5.0, 'files': (3, 10), 'size_kb': (20, 2 * KB),
+        'kinds': ['csv', 'text', 'image', 'binary'], 'async_ingest': True, 'storm': False, 'faults': {}},
+    # most files are one of a few popular contents (the same export shared in several channels), see contentStore.py
+    'duplicates': {
+        'events': 20, 'rate': 5.0, 'files': (1, 2), 'size_kb': (2 * KB, 12 * KB),
+        'kinds': ['csv', 'binary'], 'async_ingest': True, 'storm': False, 'faults': {},
+        'duplicate_rate': 0.8, 'popular_contents': 3},
+    # mostly small files with a few large videos (heavy tier) and disk images (rejected), see admission.py
+    'mixed-sizes': {
+        'events': 30, 'rate': 10.0, 'files': (1, 2), 'size_kb': (20, 800),
+        'kind_size_kb': {'video': (40 * KB, 120 * KB), 'disk-image': (200 * KB, 400 * KB)},
+        'kinds': ['csv', 'text', 'image', 'csv', 'text', 'image', 'video', 'disk-image'], 'async_ingest': True,
+        'storm': False, 'faults': {}},
+    # bulk uploads: a burst of single file messages into a couple of channels, their replies coalesced within the
+    # SQS batches of notifications, see replyCoalescing.py
+    'bursty': {
+        'events': 60, 'rate': 20.0, 'files': (1, 1), 'size_kb': (20, 200), 'channels': 2,
+        'kinds': ['csv', 'text', 'image'], 'async_ingest': True, 'storm': False, 'faults': {},
+        'stats_batch_size': 10, 'stats_batch_window_ms': 2000, 'env': {'REPLY_COALESCING_ENABLED': 'true'}},
+    # synchronous ingest acknowledges late, every event is re-sent 3 times and the APIs throttle
+    'retry-storm': {
+        'events': 30, 'rate': 15.0, 'files': (1, 3), 'size_kb': (20, 800),
+        'kinds': ['csv', 'text', 'image', 'binary'], 'async_ingest': False, 'storm': True,
+        'faults': {'openai': {'throttle_rate': 0.2, 'retry_after_seconds': 0.5},
+                   'slack.api': {'throttle_rate': 0.1, 'retry_after_seconds': 0.5},
+                   'slack.files': {'error_rate': 0.05},
+                   's3': {'throttle_rate': 0.05}}},
+}
+
+
+def scenario_faults(scenario, overrides):
+    """ The fault profile of every service: the defaults, then the scenario's, then the `--fault` overrides. """
+    faults = dict()
+    for service, default in DEFAULT_FAULTS.items():
+        fields = dict(scenario['faults'].get(service, {}))
+        fields.update(overrides.get(service, {}))
+        faults[service] = replace(default, **fields)
+    return faults
+
+
+def parse_fault_overrides(specs):
+    overrides = dict()
+    for spec in specs or []:
+        name, _, value = spec.partition('=')
+        service, _, field = name.rpartition('.')
+        if service not in DEFAULT_FAULTS or field not in Faults.__dataclass_fields__ or not value:
+            raise SystemExit(f"Invalid --fault {spec}, expected <service>.<field>=<value> with a service of "
+                             f"{', '.join(DEFAULT_FAULTS)} and a field of {', '.join(Faults.__dataclass_fields__)}")
+        overrides.setdefault(service, dict())[field] = float(value)
+    return overrides
+
+
+# ------------------------------------------------------------------------------------------------------- payloads
+
+
+def synthetic_events(scenario, count, seed):
+    """ Slack `app_mention` event bodies, each with files of the scenario's kinds and sizes. With a `duplicate_rate`
+    that share of the files has the content of one of the scenario's `popular_contents`, recorded as the
+    `harness_content_seed` of the file. """
+    from fakeServices import content_size
+    rng = random.Random(seed)
+    popular = [(rng.choice(scenario['kinds']), rng.randint(*scenario['size_kb']) * KB, f"P{seed:03d}{p:02d}")
+               for p in range(scenario.get('popular_contents', 0))]
+    events = list()
+    now = int(time.time())
+    for i in range(count):
+        files = list()
+        for j in range(rng.randint(*scenario['files'])):
+            file_id = f"F{seed:03d}{i:05d}{j:02d}"
+            if popular and rng.random() < scenario['duplicate_rate']:
+                kind, size, content_seed = rng.choice(popular)
+            else:
+                kind = rng.choice(scenario['kinds'])
+                size = rng.randint(*scenario.get('kind_size_kb', {}).get(kind, scenario['size_kb'])) * KB
+                content_seed = file_id
+            mimetype, filetype, name = FILE_KINDS[kind]
+            size = content_size(kind, size, content_seed)
+            files.append({
+                'harness_content_seed': content_seed,
+                'id': file_id, 'created': now, 'timestamp': now, 'name': name.format(file_id), 'mimetype': mimetype,
+                'filetype': filetype, 'user': f"U{rng.randint(1, 25):08d}", 'user_team': 'T00000001', 'size': size,
+                'url_private': f"https://files.slack.com/files-pri/T00000001-{file_id}/{name.format(file_id)}"
+            })
+        events.append({
+            'token': 'harness', 'team_id': 'T00000001', 'type': 'event_callback',
+            'event_id': f"Ev{seed:03d}{i:07d}", 'event_time': now,
+            'event': {
+                'type': 'app_mention', 'user': files[0]['user'],
+                'channel': f"C{rng.randint(1, scenario.get('channels', 8)):08d}",
+                'ts': f"{now}.{i:06d}", 'text': '<@U0BOT> what is in this file?',
+                'blocks': [{'type': 'rich_text', 'elements': [{'type': 'rich_text_section', 'elements': [
+                    {'type': 'user', 'user_id': 'U0BOT'}, {'type': 'text', 'text': ' what is in this file?'}]}]}],
+                'files': files
+            }
+        })
+    return events
+
+
+def replayed_events(path, count):
+    """ Recorded events, one per line as an API Gateway event (with a `body`) or a Slack event body. The recording is
+    cycled when more events are asked for, with the ids of the repeats made unique. """
+    with open(path) as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    recorded = [json.loads(r['body']) if 'body' in r else r for r in recorded]
+    recorded = [r for r in recorded if r.get('event', {}).get('files')]
+    if not recorded:
+        raise SystemExit(f"No Slack events with files in {path}")
+    events = list()
+    for i in range(count or len(recorded)):
+        event = copy.deepcopy(recorded[i % len(recorded)])
+        if i >= len(recorded):
+            cycle = i // len(recorded)
+            event['event_id'] = f"{event.get('event_id', 'Ev')}-{cycle}"
+            seconds, _, micros = event['event']['ts'].partition('.')
+            event['event']['ts'] = f"{int(seconds) + cycle}.{micros}"
+            for f in event['event']['files']:
+                f['id'] = f"{f['id']}-{cycle}"
+        events.append(event)
+    return events
+
+
+def file_kind(mimetype):
+    if mimetype.startswith('image'):
+        return 'image'
+    if mimetype == 'text/csv':
+        return 'csv'
+    if mimetype.startswith('text') or mimetype in ('application/json', 'application/x-ndjson'):
+        return 'text'
+    return 'binary'
+
+
+# ------------------------------------------------------------------------------------------------------ execution
+
+
+class Activity:
+    """ Counts the work in flight (deliveries, scheduled retries, worker drains and stats invocations). """
+
+    def __init__(self):
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def start(self):
+        with self._condition:
+            self._count += 1
+
+    def done(self):
+        with self._condition:
+            self._count -= 1
+            self._condition.notify_all()
+
+    def idle(self):
+        with self._condition:
+            return self._count == 0
+
+
+class EventState:
+
+    def __init__(self, body):
+        self.body = body
+        self.ts = body['event']['ts']
+        self.sent = None
+        self.deliveries = list()
+        self.lock = threading.Lock()
+
+
+def run_scenario(name, scenario, args):
+    """ Runs one scenario in this interpreter and returns its results. Must be called before fileSlacker and
+    fileStatsSlacker are imported, their configuration is read from the environment at import. """
+    workdir = tempfile.mkdtemp(prefix='file-slacker-harness-')
+    os.environ.update({
+        'ASYNC_INGEST_ENABLED': 'true' if scenario['async_ingest'] else 'false',
+        'JOB_QUEUE_BACKEND': 'memory',
+        'IDEMPOTENCY_BACKEND': 'sqlite',
+        'IDEMPOTENCY_DB_PATH': os.path.join(workdir, 'idempotency.db'),
+        'ANALYSIS_CACHE_BACKEND': 'local',
+        'ANALYSIS_CACHE_DIR': os.path.join(workdir, 'analysis-cache'),
+        'SLACK_BOT_TOKEN': 'xoxb-harness',
+        'OPENAI_API_KEY': 'sk-harness',
+        'ENDPOINT_STATS_LOGGING_ENABLED': 'false',
+        'PROGRESSIVE_REPLY_ENABLED': 'true' if args.progressive else 'false',
+    })
+    os.environ.update(scenario.get('env', {}))
+    os.environ.setdefault('STATS_SNAPSHOT_ENABLED', 'true')
+    batch_size = args.stats_batch_size or scenario.get('stats_batch_size', 1)
+    batch_window_ms = args.stats_batch_window_ms or scenario.get('stats_batch_window_ms', 200)
+
+    import fileSlacker
+    import fileStatsSlacker
+    from fakeServices import FakeAthena
+    from fakeServices import FakeOpenAI
+    from fakeServices import FakeS3
+    from fakeServices import FakeSlackFiles
+    from fakeServices import FakeSlackWebClient
+    from fakeServices import Ledger
+    from jobQueue import get_job_queue
+    from lazyClients import set_client
+
+    faults = scenario_faults(scenario, args.fault_overrides)
+    ledger = Ledger()
+    activity = Activity()
+    lambda_pool = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='lambda')
+    stats_pool = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='stats-lambda')
+    stats_invocations = list()
+
+    pending_notifications = list()
+    pending_lock = threading.Lock()
+
+    def s3_record(bucket, key):
+        # the keys of S3 notifications are URL encoded
+        return {'s3': {'bucket': {'name': bucket}, 'object': {'key': quote_plus(key, safe='/')}}}
+
+    def invoke_stats(records):
+        try:
+            start = time.perf_counter()
+            if batch_size > 1:
+                # delivered through an SQS queue subscribed to the bucket, one notification per message
+                event = {'Records': [{'messageId': uuid.uuid4().hex, 'eventSource': 'aws:sqs',
+                                      'body': json.dumps({'Records': [record]})} for record in records]}
+            else:
+                event = {'Records': records}
+            fileStatsSlacker.lambda_handler(event, None)
+            stats_invocations.append(time.perf_counter() - start)
+        finally:
+            for _ in records:
+                activity.done()
+
+    def flush_notifications(full_batches_only=False):
+        with pending_lock:
+            while pending_notifications and (len(pending_notifications) >= batch_size or
+                                             not full_batches_only):
+                batch = pending_notifications[:batch_size]
+                del pending_notifications[:batch_size]
+                stats_pool.submit(invoke_stats, batch)
+
+    def notify(bucket, key):
+        # the bucket notification is configured for the JSON objects of the meta/ and events/ folders
+        if key.endswith('.json') and key.startswith(('meta/', 'events/')):
+            activity.start()
+            with pending_lock:
+                pending_notifications.append(s3_record(bucket, key))
+            flush_notifications(full_batches_only=True)
+
+    def batching_window():
+        # like the batching window of an SQS event source mapping
+        while True:
+            time.sleep(batch_window_ms / 1000)
+            flush_notifications()
+
+    threading.Thread(target=batching_window, daemon=True, name='batching-window').start()
+
+    s3 = FakeS3(faults['s3'], ledger, os.path.join(workdir, 's3'), args.seed, on_write=notify)
+    slack_files = FakeSlackFiles(faults['slack.files'], ledger, args.seed)
+    slack = FakeSlackWebClient(faults['slack.api'], ledger, args.seed)
+    openai = FakeOpenAI(faults['openai'], ledger, args.seed)
+    athena = FakeAthena(faults['athena'], s3, BUCKET, seed=args.seed)
+    for client_name, client in (('s3', s3), ('http', slack_files), ('slack', slack), ('openai', openai),
+                                ('athena', athena)):
+        set_client(client_name, client)
+
+    if args.replay:
+        bodies = replayed_events(args.replay, args.events)
+    else:
+        bodies = synthetic_events(scenario, args.events or scenario['events'], args.seed)
+    states = [EventState(body) for body in bodies]
+    s3_keys = set()
+    for state in states:
+        for f in state.body['event']['files']:
+            slack_files.add_file(f['url_private'], f['id'], file_kind(f['mimetype']), int(f['size']),
+                                 f.get('harness_content_seed'))
+            s3_keys.add(f"{f['id']}-{f['name']}")
+
+    def deliver(state, attempt, scheduled):
+        try:
+            headers = {'Content-Type': 'application/json'}
+            if attempt:
+                headers.update({'X-Slack-Retry-Num': str(attempt), 'X-Slack-Retry-Reason': 'http_timeout'})
+            fileSlacker.lambda_handler({'headers': headers, 'body': json.dumps(state.body)}, None)
+            with state.lock:
+                state.deliveries.append(time.perf_counter() - scheduled)
+        finally:
+            activity.done()
+
+    def send(state, attempt):
+        """ Sends a delivery of the event, and schedules Slack's check of its acknowledgement. """
+        scheduled = time.perf_counter()
+        if attempt == 0:
+            state.sent = scheduled
+        activity.start()
+        lambda_pool.submit(deliver, state, attempt, scheduled)
+        if attempt >= len(SLACK_RETRY_DELAYS_SECONDS):
+            return
+        if scenario['storm']:
+            delay = STORM_RETRY_GAP_SECONDS
+        else:
+            delay = SLACK_ACK_TIMEOUT_SECONDS + SLACK_RETRY_DELAYS_SECONDS[attempt] * args.time_scale
+        activity.start()
+        timer = threading.Timer(delay, check_ack, (state, attempt, scheduled))
+        timer.daemon = True
+        timer.start()
+
+    def check_ack(state, attempt, scheduled):
+        try:
+            with state.lock:
+                acked = len(state.deliveries) > attempt and state.deliveries[attempt] <= SLACK_ACK_TIMEOUT_SECONDS
+            if scenario['storm'] or not acked:
+                send(state, attempt + 1)
+        finally:
+            activity.done()
+
+    stop_workers = threading.Event()
+
+    def worker():
+        job_queue = get_job_queue()
+        while not stop_workers.is_set():
+            if len(job_queue) == 0:
+                time.sleep(0.005)
+                continue
+            activity.start()
+            try:
+                fileSlacker.worker_handler({'max_jobs': 1}, None)
+            finally:
+                activity.done()
+
+    workers = [threading.Thread(target=worker, daemon=True, name=f'worker-{i}')
+               for i in range(args.concurrency if scenario['async_ingest'] else 0)]
+    for w in workers:
+        w.start()
+
+    start = time.perf_counter()
+    for i, state in enumerate(states):
+        time.sleep(max(0.0, start + i / (args.rate or scenario['rate']) - time.perf_counter()))
+        send(state, 0)
+
+    deadline = time.perf_counter() + args.drain_timeout
+    timed_out = False
+    while not (activity.idle() and len(get_job_queue()) == 0):
+        if time.perf_counter() > deadline:
+            timed_out = True
+            break
+        time.sleep(0.05)
+    stop_workers.set()
+    lambda_pool.shutdown(wait=not timed_out, cancel_futures=timed_out)
+    stats_pool.shutdown(wait=not timed_out, cancel_futures=timed_out)
+
+    return results(name, scenario, states, ledger, s3_keys, start, timed_out, stats_invocations,
+                   {'slack.files': slack_files, 'slack.api': slack, 's3': s3, 'athena': athena, 'openai': openai})
+
+
+def distribution(values):
+    values = sorted(values)
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99),
+            'max': values[-1] if values else 0.0}
+
+
+def results(name, scenario, states, ledger, s3_keys, start, timed_out, stats_invocations, fakes):
+    e2e, feedback, last_reply, replied_files = list(), list(), start, 0
+    for state in states:
+        replies = ledger.replies.get(state.ts)
+        if state.ts in ledger.feedback:
+            feedback.append((ledger.feedback[state.ts] - state.sent) * 1000)
+        if replies:
+            e2e.append((replies[0] - state.sent) * 1000)
+            last_reply = max(last_reply, replies[0])
+            replied_files += len(state.body['event']['files'])
+    acks = [d * 1000 for state in states for d in state.deliveries]
+    duration = max(last_reply - start, 1e-9)
+    files = sum(len(state.body['event']['files']) for state in states)
+    total_bytes = sum(int(f['size']) for state in states for f in state.body['event']['files'])
+    replied = len(e2e)
+    return {
+        'scenario': name,
+        'async_ingest': scenario['async_ingest'],
+        'events': len(states),
+        'files': files,
+        'mb': round(total_bytes / 1e6, 2),
+        'deliveries': sum(len(state.deliveries) for state in states),
+        'replied_events': replied,
+        'missing_replies': len(states) - replied,
+        'timed_out': timed_out,
+        'duration_s': round(duration, 3),
+        'events_per_s': round(replied / duration, 3),
+        'files_per_s': round(replied_files / duration, 3),
+        'mb_per_s': round(ledger.downloaded_bytes / 1e6 / duration, 3),
+        # the uploaded files as stored in S3, once per content with content-addressed storage
+        'stored_mb': round(fakes['s3'].stored_bytes(BUCKET, s3_keys | {'blobs/'}) / 1e6, 2),
+        'e2e_ms': {k: round(v, 1) for k, v in distribution(e2e).items()},
+        'first_feedback_ms': {k: round(v, 1) for k, v in distribution(feedback).items()},
+        'slack_api_calls_per_event': round(sum(fakes['slack.api'].injector.summary().values()) / max(len(states), 1),
+                                           2),
+        'ack_ms': {k: round(v, 1) for k, v in distribution(acks).items()},
+        'acks_over_3s': sum(1 for a in acks if a > SLACK_ACK_TIMEOUT_SECONDS * 1000),
+        'stats_invocations': len(stats_invocations),
+        'analyses': ledger.analyses,
+        'duplicates': {
+            'downloads': sum(n - 1 for n in ledger.downloads.values() if n > 1),
+            'uploads': sum(n - 1 for key, n in ledger.s3_writes.items() if key in s3_keys and n > 1),
+            'replies': sum(len(r) - 1 for r in ledger.replies.values() if len(r) > 1),
+        },
+        'faults': {service: fake.injector.summary() for service, fake in fakes.items()},
+        # ru_maxrss is in kB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# ---------------------------------------------------------------------------------------------------------- report
+
+
+def print_results(all_results):
+    print(f"{'scenario':<12} {'events':>6} {'files':>6} {'MB':>8} {'ev/s':>7} {'MB/s':>7} {'e2e p50':>8} "
+          f"{'p95':>8} {'p99':>8} {'fb p50':>7} {'fb p95':>7} {'ack p95':>8} {'>3s':>4} {'missed':>6} "
+          f"{'slack/ev':>8} {'dup dl':>6} {'dup rep':>7} {'S3 MB':>7} {'RSS MB':>7}")
+    for r in all_results:
+        print(f"{r['scenario']:<12} {r['events']:>6} {r['files']:>6} {r['mb']:>8.1f} {r['events_per_s']:>7.2f} "
+              f"{r['mb_per_s']:>7.1f} {r['e2e_ms']['p50']:>8.0f} {r['e2e_ms']['p95']:>8.0f} "
+              f"{r['e2e_ms']['p99']:>8.0f} {r['first_feedback_ms']['p50']:>7.0f} "
+              f"{r['first_feedback_ms']['p95']:>7.0f} {r['ack_ms']['p95']:>8.0f} {r['acks_over_3s']:>4} "
+              f"{r['missing_replies']:>6} {r['slack_api_calls_per_event']:>8.1f} {r['duplicates']['downloads']:>6} "
+              f"{r['duplicates']['replies']:>7} {r['stored_mb']:>7.1f} {r['peak_rss_mb']:>7.1f}")
+    print("injected faults (ok/throttle/error calls):")
+    for r in all_results:
+        faults = ', '.join(f"{service} {f.get('ok', 0)}/{f.get('throttle', 0)}/{f.get('error', 0)}"
+                           for service, f in r['faults'].items())
+        print(f"  {r['scenario']:<12} {faults}")
+
+
+def compare(all_results, baseline_path, max_regression):
+    """ The regressions against a baseline: the e2e p95 or throughput worse by more than `max_regression` percent,
+    more duplicates or more missing replies. """
+    with open(baseline_path) as f:
+        baseline = {r['scenario']: r for r in json.load(f)}
+    failures = list()
+    for r in all_results:
+        b = baseline.get(r['scenario'])
+        if b is None:
+            continue
+        limit = 1 + max_regression / 100
+        if r['e2e_ms']['p95'] > b['e2e_ms']['p95'] * limit:
+            failures.append(f"{r['scenario']}: e2e p95 {r['e2e_ms']['p95']} ms, baseline {b['e2e_ms']['p95']} ms")
+        if r['events_per_s'] * limit < b['events_per_s']:
+            failures.append(f"{r['scenario']}: {r['events_per_s']} events/s, baseline {b['events_per_s']}")
+        for kind, n in r['duplicates'].items():
+            if n > b['duplicates'].get(kind, 0):
+                failures.append(f"{r['scenario']}: {n} duplicate {kind}, baseline {b['duplicates'].get(kind, 0)}")
+        if r['missing_replies'] > b['missing_replies']:
+            failures.append(f"{r['scenario']}: {r['missing_replies']} missing replies, "
+                            f"baseline {b['missing_replies']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--events', type=int, help='events per scenario, instead of the scenario default')
+    parser.add_argument('--rate', type=float, help='events sent per second, instead of the scenario default')
+    parser.add_argument('--concurrency', type=int, default=20, help='concurrent Lambda invocations per handler')
+    parser.add_argument('--replay', help='JSONL file of recorded Slack events, instead of synthetic ones')
+    parser.add_argument('--stats-batch-size', type=int,
+                        help='S3 notifications per fileStatsSlacker invocation, delivered through SQS when over 1 '
+                             '(default 1, or the scenario\'s)')
+    parser.add_argument('--stats-batch-window-ms', type=float,
+                        help='the longest a notification waits for its batch to fill (default 200, or the scenario\'s)')
+    parser.add_argument('--fault', action='append', help='override a fault setting, e.g. openai.latency_ms=500')
+    parser.add_argument('--time-scale', type=float, default=0.05, help="compresses Slack's retry delays")
+    parser.add_argument('--drain-timeout', type=float, default=300, help='seconds to wait for the last replies')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--baseline', help='a previous --json output to compare against, fails on a regression')
+    parser.add_argument('--max-regression', type=float, default=25, help='percent, for --baseline')
+    parser.add_argument('--progressive', action='store_true', help='enable the progressive replies')
+    parser.add_argument('--trace', help='collect the timing spans (see tracing.py) of the runs into this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.fault_overrides = parse_fault_overrides(args.fault)
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, SCENARIOS[args.child], args)))
+        return
+
+    all_results, spans = list(), list()
+    child_args = [a for a in sys.argv[1:] if a != '--json']
+    for name in args.scenarios:
+        env = dict(os.environ, TRACING_ENABLED='true' if args.trace else os.environ.get('TRACING_ENABLED', 'false'))
+        run = subprocess.run([sys.executable, __file__, *child_args, '--child', name], env=env,
+                             capture_output=True, text=True)
+        if run.returncode != 0:
+            sys.stderr.write(run.stderr[-4000:])
+            raise SystemExit(f"The {name} scenario failed")
+        lines = run.stdout.strip().splitlines()
+        all_results.append(json.loads(lines[-1]))
+        spans.extend(lines[:-1])
+    if args.trace:
+        with open(args.trace, 'w') as f:
+            f.write('\n'.join(spans) + '\n')
+
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    else:
+        print_results(all_results)
+    failures = compare(all_results, args.baseline, args.max_regression) if args.baseline else list()
+    failures.extend(f"{r['scenario']}: timed out waiting for the replies" for r in all_results if r['timed_out'])
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
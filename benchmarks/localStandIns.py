@@ -0,0 +1,90 @@
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+# Minimal local stand-ins for the HTTP services used by fileSlacker, for the benchmarks. They count the bytes they
+# receive and throw them away, so they don't skew the memory measurements of the process under test.
+
+CHUNK = 1024 * 1024
+
+
+class LocalStandInHandler(BaseHTTPRequestHandler):
+    """ Serves two things:
+    * `GET /slack/<size>` streams `size` bytes of generated content, standing in for a Slack private file URL.
+    * Path-style S3 `PutObject` and the multipart upload calls under `/<bucket>/<key>`. """
+    protocol_version = 'HTTP/1.1'
+    received_bytes = 0
+    received_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        match = re.fullmatch(r'/slack/(\d+)', urlparse(self.path).path)
+        if match is None:
+            return self._respond(404)
+        size = int(match.group(1))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        block = bytes(range(256)) * (CHUNK // 256)
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, CHUNK)
+            self.wfile.write(block[:n])
+            remaining -= n
+
+    def do_PUT(self):
+        self._drain_body()
+        return self._respond(200, headers={'ETag': f'"{uuid.uuid4().hex}"'})
+
+    def do_POST(self):
+        self._drain_body()
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        if 'uploads' in query:
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    f'<Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{uuid.uuid4().hex}</UploadId>'
+                    f'</InitiateMultipartUploadResult>')
+        else:
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                    f'<Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>"{uuid.uuid4().hex}"</ETag>'
+                    f'</CompleteMultipartUploadResult>')
+        return self._respond(200, body=body.encode())
+
+    def do_DELETE(self):
+        return self._respond(204)
+
+    def _drain_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, CHUNK))
+            if not data:
+                break
+            remaining -= len(data)
+            with LocalStandInHandler.received_lock:
+                LocalStandInHandler.received_bytes += len(data)
+
+    def _respond(self, status, headers=None, body=b''):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 204:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
+def start_local_stand_in(port=0):
+    """ Starts the stand-in server on a background thread. Returns the server, `server.server_port` has the port. """
+    server = ThreadingHTTPServer(('127.0.0.1', port), LocalStandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,171 @@
+""" Benchmark of the metadata layout queried by Athena (see metadataLayout.py), on a synthetic data set.
+
+Compares the legacy layout (one stringified JSON object per upload in the flat `meta/` folder) with the partitioned
+and compacted layout (gzip'd NDJSON per `dt=`/`filetype=` partition) produced by migrating the same records. For the
+stats over all the files and over the last 7 days it reports the objects read (S3 GETs), the bytes scanned (what
+Athena bills) and the time of an equivalent local scan-and-aggregate. The objects are kept in memory.
+
+    $ python benchmarks/metadataLayoutBench.py [--records 100000] [--days 365] [--window-days 7]
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadataLayout import COMPACTED_SUFFIX
+from metadataLayout import SLACK_FILETYPES
+from metadataLayout import list_partitions
+from metadataLayout import migrate_legacy_metadata
+from metadataLayout import partition_prefix
+
+BUCKET = 'file-slacker-bucket'
+FOLDER = 'meta'
+COMMON_FILETYPES = ['png', 'jpg', 'pdf', 'csv', 'text', 'docx', 'xlsx', 'json', 'python', 'zip', 'heic', 'mp4']
+
+
+class _Body:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class _Paginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        contents, prefixes = list(), set()
+        for key in sorted(k for k in self.s3.objects if k.startswith(Prefix)):
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefixes.add(Prefix + rest[:rest.index(Delimiter) + 1])
+            else:
+                contents.append({'Key': key, 'Size': len(self.s3.objects[key])})
+        yield {'Contents': contents, 'CommonPrefixes': [{'Prefix': p} for p in sorted(prefixes)]}
+
+
+class MemoryS3:
+    """ Just enough of the S3 client for metadataLayout. """
+
+    def __init__(self):
+        self.objects = dict()
+
+    def get_paginator(self, name):
+        return _Paginator(self)
+
+    def put_object(self, Body, Bucket, Key, **kwargs):
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.encode('utf-8')
+
+    def get_object(self, Bucket, Key):
+        return {'Body': _Body(self.objects[Key])}
+
+    def delete_objects(self, Bucket, Delete):
+        for o in Delete['Objects']:
+            self.objects.pop(o['Key'], None)
+
+
+def synthetic_records(count, days):
+    """ Legacy records, every field stringified as fileSlacker used to write them. """
+    rng = random.Random(42)
+    now = int(time.time())
+    users = [f'U{i:08d}' for i in range(200)]
+    channels = [f'C{i:08d}' for i in range(40)]
+    filetypes = COMMON_FILETYPES + list(SLACK_FILETYPES[:20]) + ['made_up_type']
+    for i in range(count):
+        created = now - rng.randrange(days * 86400)
+        filetype = rng.choice(COMMON_FILETYPES) if rng.random() < 0.9 else rng.choice(filetypes)
+        s3_key = f'{created}-F{i:09d}.{filetype}'
+        yield s3_key, {
+            'id': f'F{i:09d}', 'created': f'{created}', 'timestamp': f'{created}', 'name': f'upload_{i}.{filetype}',
+            'mimetype': 'application/octet-stream', 'filetype': filetype, 'file_extension': f'.{filetype}',
+            'user': rng.choice(users), 'user_team': 'T00000001', 'size': f'{rng.randrange(100, 20_000_000)}',
+            'url_private': f'https://files.slack.com/files-pri/T00000001-F{i:09d}/upload_{i}.{filetype}',
+            'user_text': rng.choice(['', '', 'please have a look', 'the report for this week']), 's3_key': s3_key,
+            'slack_orig_channel': rng.choice(channels), 'slack_orig_ts': f'{created}.000100',
+            'ai_analysis': 'A synthetic description of the uploaded file. ' * rng.randrange(1, 6)
+        }
+
+
+def scan(s3, keys, since=0):
+    """ Reads and aggregates the objects like the stats queries, counting the records created after `since`.
+    Returns (objects, bytes, seconds, record count). """
+    start = time.perf_counter()
+    scanned, stats = 0, dict()
+    for key in keys:
+        body = s3.objects[key]
+        scanned += len(body)
+        if key.endswith(COMPACTED_SUFFIX):
+            records = [json.loads(line) for line in gzip.decompress(body).splitlines()]
+        else:
+            records = [json.loads(body)]
+        for r in records:
+            if int(r['created']) < since:
+                continue
+            s = stats.setdefault(r['filetype'], [0, 0, set()])
+            s[0] += 1
+            s[1] += int(r['size'])
+            s[2].add(r['user'])
+    return len(keys), scanned, time.perf_counter() - start, sum(s[0] for s in stats.values())
+
+
+def window_start(window_days):
+    since = datetime.now(timezone.utc) - timedelta(days=window_days)
+    return since.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def window_keys(s3, window_days, partitioned):
+    if not partitioned:
+        return list(s3.objects)
+    since = window_start(window_days).strftime('%Y-%m-%d')
+    prefixes = [partition_prefix(FOLDER, dt, ft) for dt, ft in list_partitions(s3, BUCKET, FOLDER) if dt >= since]
+    return [k for p in prefixes for k in s3.objects if k.startswith(p)]
+
+
+def report(label, result):
+    objects, scanned, seconds, records = result
+    print(f"  {label:<34} {objects:>8} objects {scanned / 1_000_000:>9.2f} MB {seconds:>7.2f}s {records:>8} records")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--window-days', type=int, default=7)
+    args = parser.parse_args()
+
+    s3 = MemoryS3()
+    for s3_key, record in synthetic_records(args.records, args.days):
+        s3.put_object(Body=json.dumps(record), Bucket=BUCKET, Key=f"{FOLDER}/{s3_key}-metadata.json")
+    print(f"{args.records} synthetic records over {args.days} days")
+    legacy_all = scan(s3, list(s3.objects))
+    since = int(window_start(args.window_days).timestamp())
+    legacy_window = scan(s3, window_keys(s3, args.window_days, False), since)
+
+    start = time.perf_counter()
+    migrate_legacy_metadata(s3, BUCKET, FOLDER)
+    print(f"migrated into {len(s3.objects)} compacted objects in {time.perf_counter() - start:.2f}s\n")
+    compacted_all = scan(s3, list(s3.objects))
+    compacted_window = scan(s3, window_keys(s3, args.window_days, True), since)
+
+    print("all files")
+    report('flat JSON', legacy_all)
+    report('partitioned gzip NDJSON', compacted_all)
+    print(f"last {args.window_days} days (the flat layout has to scan everything)")
+    report('flat JSON', legacy_window)
+    report('partitioned gzip NDJSON', compacted_window)
+    print(f"\nbytes scanned: {legacy_all[1] / compacted_all[1]:.1f}x less for all files, "
+          f"{legacy_window[1] / max(compacted_window[1], 1):.1f}x less for the window")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+""" Benchmark of the metadata queries answered from the local metadata index (see metadataIndex.py and
+metadataQueries.py) against the S3 fake of fakeServices.py.
+
+Writes synthetic metadata records to the S3 fake in the partitioned layout of metadataLayout.py (the older days
+compacted, the recent ones as single records), then reports the time of the first (cold) sync of the index, of an
+incremental sync after new uploads, and of every command of a sample answered from the index, checked against a
+plain Python scan of the records. The commands the index can't answer are shown with the source they go to.
+
+    $ python benchmarks/metadataQueryBench.py [--records 50000] [--days 90] [--new 100] [--repeat 20]
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = 'file-slacker-bucket'
+FOLDER = 'meta'
+FILETYPES = (('pdf', 'application/pdf'), ('csv', 'text/csv'), ('jpg', 'image/jpeg'), ('png', 'image/png'),
+             ('text', 'text/plain'), ('xlsx', 'application/vnd.ms-excel'), ('mp4', 'video/mp4'))
+COMMANDS = (
+    'largest 5 pdfs in <#C00000001|general> last week',
+    'count files by user this month',
+    'my newest images',
+    'how many csv files here yesterday',
+    'total size by filetype',
+    'list files named "report-1"',
+    'count files by day last 7 days',
+    'show files about "invoice" last 3 days',
+)
+
+
+def synthetic_records(count, days, seed, now):
+    rng = random.Random(seed)
+    records = list()
+    for i in range(count):
+        filetype, mimetype = rng.choice(FILETYPES)
+        created = int((now - timedelta(seconds=rng.uniform(0, days * 86400))).timestamp())
+        records.append({'id': f"F{seed:02d}{i:08d}", 's3_key': f"F{seed:02d}{i:08d}-report-{i}.{filetype}",
+                        'name': f"report-{i}.{filetype}", 'user': f"U{rng.randint(1, 40):08d}",
+                        'slack_orig_channel': f"C{rng.randint(1, 12):08d}", 'slack_orig_ts': f"{created}.000100",
+                        'filetype': filetype, 'mimetype': mimetype, 'size': rng.randint(1, 20000) * 1000,
+                        'created': created, 'ai_analysis': 'A synthetic analysis.'})
+    return records
+
+
+def write_records(s3, records, compact_before):
+    """ Single JSON objects for the recent days, one compacted object per partition for the older ones. """
+    from metadataLayout import COMPACTED_PREFIX
+    from metadataLayout import COMPACTED_SUFFIX
+    from metadataLayout import metadata_partition
+    from metadataLayout import metadata_s3_key
+    from metadataLayout import partition_prefix
+    partitions = dict()
+    for record in records:
+        dt, filetype = metadata_partition(record)
+        if dt < compact_before:
+            partitions.setdefault((dt, filetype), list()).append(record)
+        else:
+            s3.put_object(Body=json.dumps(record), Bucket=BUCKET, Key=metadata_s3_key(FOLDER, record))
+    for (dt, filetype), group in partitions.items():
+        body = gzip.compress("\n".join(json.dumps(r) for r in group).encode('utf-8'))
+        s3.put_object(Body=body, Bucket=BUCKET,
+                      Key=f"{partition_prefix(FOLDER, dt, filetype)}{COMPACTED_PREFIX}{dt}{COMPACTED_SUFFIX}")
+
+
+def scan(query, records):
+    """ The records a query selects, by a plain Python scan. """
+    def selected(r):
+        return ((not query.filetypes or r['filetype'] in query.filetypes) and
+                (not query.mimetype_prefix or r['mimetype'].startswith(query.mimetype_prefix)) and
+                (not query.channel or r['slack_orig_channel'] == query.channel) and
+                (not query.user or r['user'] == query.user) and
+                (query.since is None or r['created'] >= query.since) and
+                (query.until is None or r['created'] < query.until) and
+                (not query.name_contains or query.name_contains.lower() in r['name'].lower()))
+    return [r for r in records if selected(r)]
+
+
+def expected_total(query, records):
+    """ What the index should answer: the number of files listed or counted. """
+    from metadataQueries import LIST
+    matching = scan(query, records)
+    if query.kind == LIST:
+        return min(len(matching), query.limit)
+    if query.group_by:
+        key = {'filetype': 'filetype', 'user': 'user', 'channel': 'slack_orig_channel'}.get(query.group_by)
+        groups = dict()
+        for r in matching:
+            value = datetime.fromtimestamp(r['created'], timezone.utc).strftime('%Y-%m-%d') if key is None else r[key]
+            groups[value] = groups.get(value, 0) + 1
+        # the days come newest first, the other groups largest first (the sum of the top counts ignores the ties)
+        counts = sorted(groups.items(), reverse=True) if query.group_by == 'day' else \
+            sorted(groups.items(), key=lambda item: -item[1])
+        return sum(count for _, count in counts[:query.limit])
+    return len(matching)
+
+
+def answered_total(query, result):
+    from metadataQueries import LIST
+    if query.kind == LIST:
+        return len(result.rows)
+    if query.group_by:
+        return sum(row[1] for row in result.rows)
+    return result.rows[0][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--new', type=int, default=100, help='records uploaded before the incremental sync')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--s3-latency-ms', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='file-slacker-query-bench-')
+    os.environ['METADATA_INDEX_DB_PATH'] = os.path.join(workdir, 'index.db')
+    import logging
+    logging.disable(logging.INFO)
+    from fakeServices import FakeS3
+    from fakeServices import Faults
+    from fakeServices import Ledger
+    from metadataIndex import get_metadata_index
+    from metadataQueries import parse_command
+    from metadataQueries import run_query
+    from metadataQueries import to_sql
+
+    now = datetime.now(timezone.utc)
+    s3 = FakeS3(Faults(), Ledger(), os.path.join(workdir, 's3'), args.seed)
+    records = synthetic_records(args.records, args.days, args.seed, now)
+    write_records(s3, records, (now - timedelta(days=2)).strftime('%Y-%m-%d'))
+    s3.injector.faults.latency_ms = args.s3_latency_ms
+    index = get_metadata_index()
+
+    def timed_sync():
+        gets = s3.injector.counts[('GetObject', 'ok')]
+        start = time.perf_counter()
+        added = index.sync(s3, BUCKET, FOLDER, force=True)
+        return time.perf_counter() - start, added, s3.injector.counts[('GetObject', 'ok')] - gets
+
+    seconds, added, gets = timed_sync()
+    print(f"cold sync:        {seconds * 1000:>9,.0f} ms, {added:,} records from {gets:,} objects "
+          f"({os.path.getsize(os.environ['METADATA_INDEX_DB_PATH']) / 1024 / 1024:.1f} MB index)")
+    new_records = synthetic_records(args.new, 1, args.seed + 1, now)
+    write_records(s3, new_records, '')
+    records.extend(new_records)
+    seconds, added, gets = timed_sync()
+    print(f"incremental sync: {seconds * 1000:>9,.0f} ms, {added:,} records from {gets:,} objects")
+
+    print(f"\n{'command':<52} {'source':>7} {'p50 ms':>8} {'max ms':>8} {'rows':>5}  check")
+    failures = 0
+    for command in COMMANDS:
+        query = parse_command(f"<@U0BOT> {command}", 'U00000001', 'C00000002', now)
+        if query.about is not None:
+            print(f"{command:<52} {'athena':>7} {'':>8} {'':>8} {'':>5}  {to_sql(query, 'athena')[0][:60]}...")
+            continue
+        timings = list()
+        for _ in range(args.repeat):
+            result = run_query(query, s3, BUCKET, FOLDER)
+            timings.append(result.seconds * 1000)
+        expected = expected_total(query, records)
+        ok = answered_total(query, result) == expected
+        failures += 0 if ok else 1
+        print(f"{command:<52} {result.source:>7} {statistics.median(timings):>8.2f} {max(timings):>8.2f} "
+              f"{len(result.rows):>5}  {'ok' if ok else f'FAILED, expected {expected}'}")
+    if failures:
+        raise SystemExit(f"{failures} commands answered differently than a scan of the records")
+
+
+if __name__ == '__main__':
+    main()
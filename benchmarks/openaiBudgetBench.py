@@ -0,0 +1,141 @@
+""" Benchmark of the OpenAI token budget (see openaiLimits.py) against the OpenAI fake of fakeServices.py, with the
+requests and tokens per minute quota of an OpenAI organization.
+
+Runs `--instances` workers sharing the quota, like Lambda instances or backfill processes, for `--seconds` each round:
+every worker has interactive threads (the small files of Slack messages, a request then `--think-seconds` of pause)
+and bulk threads (heavy files and backfills, back to back). Once with the retries of `call_with_retries` alone, once
+with a budget per worker, each set to the whole quota (the env vars of every instance), and once with the budget
+shared in a SQLite file. Reports the requests and tokens per minute OpenAI accepted against the quota, its 429s, the
+requests dropped after their retries and the latency of each lane.
+
+    $ python benchmarks/openaiBudgetBench.py [--instances 4] [--interactive-threads 1] [--bulk-threads 4]
+        [--seconds 20] [--requests-per-minute 3000] [--tokens-per-minute 300000] [--openai-latency-ms 200]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the prompt characters and answer tokens of a request in each lane
+REQUESTS = {'interactive': (3200, 300), 'bulk': (12000, 500)}
+
+
+def request(lane):
+    characters, max_tokens = REQUESTS[lane]
+    return {'model': 'gpt-4o-mini', 'max_tokens': max_tokens,
+            'messages': [{'role': 'user', 'content': 'x' * characters}]}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, default=4)
+    parser.add_argument('--interactive-threads', type=int, default=1, help='per instance')
+    parser.add_argument('--bulk-threads', type=int, default=4, help='per instance')
+    parser.add_argument('--think-seconds', type=float, default=2.0, help='between the interactive requests')
+    parser.add_argument('--seconds', type=float, default=20.0, help='per round')
+    parser.add_argument('--requests-per-minute', type=float, default=3000.0)
+    parser.add_argument('--tokens-per-minute', type=float, default=300000.0)
+    parser.add_argument('--openai-latency-ms', type=float, default=200.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='file-slacker-openai-budget-bench-')
+    os.environ.update({'ENDPOINT_STATS_LOGGING_ENABLED': 'false'})
+    import logging
+    logging.disable(logging.WARNING)
+
+    from fakeServices import FakeOpenAI
+    from fakeServices import Faults
+    from fakeServices import Ledger
+    from openaiLimits import BULK
+    from openaiLimits import INTERACTIVE
+    from openaiLimits import LocalTokenBudgetStore
+    from openaiLimits import OpenAIRateLimiter
+    from openaiLimits import SqliteTokenBudgetStore
+    from openaiLimits import estimate_tokens
+    from openaiLimits import openai_lane
+    from transport import call_with_retries
+
+    ledger = Ledger()
+    openai = FakeOpenAI(Faults(latency_ms=args.openai_latency_ms), ledger, args.seed)
+
+    def round_(limiters):
+        """ Runs the workers, each with its limiter (None for the retries alone). Returns the latencies per lane, the
+        requests dropped, and the requests, tokens and 429s of OpenAI. """
+        openai.set_quota(args.requests_per_minute, args.tokens_per_minute)
+        throttles, tokens = openai.quota_throttles, openai.quota_tokens
+        completions = ledger.analyses
+        latencies = {INTERACTIVE: list(), BULK: list()}
+        dropped = {INTERACTIVE: 0, BULK: 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.seconds
+
+        def worker(limiter, lane):
+            req = request(lane)
+            with openai_lane(lane):
+                while time.monotonic() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        if limiter is None:
+                            call_with_retries('openai.chat.completions', openai.chat.completions.create, **req)
+                        else:
+                            limiter.call('openai.chat.completions', openai.chat.completions.create,
+                                         estimate_tokens(req), **req)
+                    except Exception:
+                        with lock:
+                            dropped[lane] += 1
+                    else:
+                        with lock:
+                            latencies[lane].append(time.perf_counter() - start)
+                    if lane == INTERACTIVE:
+                        time.sleep(args.think_seconds)
+
+        threads = [threading.Thread(target=worker, args=(limiter, lane))
+                   for limiter in limiters
+                   for lane, count in ((INTERACTIVE, args.interactive_threads), (BULK, args.bulk_threads))
+                   for _ in range(count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        minutes = (time.perf_counter() - start) / 60
+        accepted = ledger.analyses - completions
+        return latencies, dropped, accepted / minutes, (openai.quota_tokens - tokens) / minutes, \
+            openai.quota_throttles - throttles
+
+    def limiter(store):
+        return OpenAIRateLimiter(args.requests_per_minute, args.tokens_per_minute, store)
+
+    path = os.path.join(workdir, 'budget.db')
+    modes = (('retries only', lambda: [None] * args.instances),
+             ('budget per instance', lambda: [limiter(LocalTokenBudgetStore()) for _ in range(args.instances)]),
+             ('shared budget (sqlite)', lambda: [limiter(SqliteTokenBudgetStore(path)) for _ in range(args.instances)]))
+
+    print(f"{args.instances} instances of {args.interactive_threads} interactive and {args.bulk_threads} bulk threads, "
+          f"quota {args.requests_per_minute:.0f} requests and {args.tokens_per_minute:.0f} tokens/min, "
+          f"OpenAI latency {args.openai_latency_ms:.0f} ms, {args.seconds:.0f}s per round\n")
+    print(f"{'mode':<24} {'requests/min':>13} {'tokens/min':>11} {'quota':>6} {'429s':>6} {'dropped':>8} "
+          f"{'interactive p50/p95 s':>22} {'bulk p50/p95 s':>16}")
+    for name, limiters in modes:
+        latencies, dropped, requests, tokens, throttles = round_(limiters())
+        interactive, bulk = latencies[INTERACTIVE], latencies[BULK]
+        print(f"{name:<24} {requests:>13.0f} {tokens:>11.0f} {tokens / args.tokens_per_minute:>6.0%} "
+              f"{throttles:>6} {sum(dropped.values()):>8} "
+              f"{f'{percentile(interactive, 50):.2f} / {percentile(interactive, 95):.2f}':>22} "
+              f"{f'{percentile(bulk, 50):.2f} / {percentile(bulk, 95):.2f}':>16}")
+
+
+if __name__ == '__main__':
+    main()
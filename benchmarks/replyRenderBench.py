@@ -0,0 +1,183 @@
+""" Benchmark of the Slack reply rendering of fileStatsSlacker (see replyRendering.py) with a long tail of filetypes.
+
+Builds a synthetic stats snapshot with 10k filetypes and compares the legacy rendering (one table line per filetype
+from the Athena style rows, the sections far over Slack's 3000 character limit) with the typed rows, top-N rollup and
+fragment cache: conversion, cold render and cached render times, the payload size of the blocks and the largest
+section. It then lays out replies with long AI descriptions and checks every message against the per block and per
+message budgets. Exits with status 1 when a budget is exceeded.
+
+    $ python benchmarks/replyRenderBench.py [--filetypes 10000] [--files 20] [--description-chars 20000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from datetime import timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replyRendering import MESSAGE_BLOCK_LIMIT
+from replyRendering import REPLY_MAX_CHARS
+from replyRendering import SECTION_TEXT_LIMIT
+from replyRendering import FileReport
+from replyRendering import cached_fragment
+from replyRendering import compose_reply
+from replyRendering import render_stats_blocks
+from replyRendering import section
+from replyRendering import stats_from_athena_rows
+from replyRendering import stats_from_snapshot
+
+
+def synthetic_snapshot(filetypes, users, channels, seed=7):
+    """ A snapshot whose filetype counts follow a long tail, like the uploads of a workspace. """
+    rng = random.Random(seed)
+    now = int(time.time())
+    snapshot = {'version': 1, 'updated': now, 'filetypes': dict(), 'applied_keys': list()}
+    for i in range(filetypes):
+        count = max(1, int(5000 / (i + 1) ** 1.1))
+        sizes = [rng.randint(100, 50_000_000) for _ in range(2)]
+        created = sorted(rng.randint(now - 365 * 86400, now) for _ in range(2))
+        snapshot['filetypes'][f"type{i:05d}" if i >= 12 else ['png', 'jpg', 'pdf', 'csv', 'text', 'docx', 'xlsx',
+                                                                   'json', 'python', 'zip', 'heic', 'mp4'][i]] = {
+            'count': count,
+            'size_sum': sum(sizes) * count // 2,
+            'size_min': min(sizes),
+            'size_max': max(sizes),
+            'created_min': created[0],
+            'created_max': created[1],
+            'with_text': rng.randint(0, count),
+            'users': sorted({f"U{rng.randrange(users):05d}" for _ in range(min(count, 5))}),
+            'channels': sorted({f"C{rng.randrange(channels):04d}" for _ in range(min(count, 3))})
+        }
+    return snapshot
+
+
+def _row(*values):
+    return {'Data': [{'VarCharValue': f'{v}'} for v in values]}
+
+
+def _date(created):
+    return datetime.fromtimestamp(created, timezone.utc).strftime('%m/%d/%Y')
+
+
+def athena_rows(snapshot):
+    """ The snapshot as the rows of the summary and by filetype Athena queries. """
+    filetypes = snapshot['filetypes'].values()
+    count = sum(s['count'] for s in filetypes)
+    summary = [_row('header'), _row(
+        count, len(set().union(*(s['users'] for s in filetypes))),
+        len(set().union(*(s['channels'] for s in filetypes))), len(filetypes),
+        round(min(s['size_min'] for s in filetypes) / 1000, 2), round(max(s['size_max'] for s in filetypes) / 1000, 2),
+        round(sum(s['size_sum'] for s in filetypes) / count / 1000, 2), sum(s['with_text'] for s in filetypes),
+        _date(min(s['created_min'] for s in filetypes)), _date(max(s['created_max'] for s in filetypes)),
+        sum(s['size_sum'] for s in filetypes), sum(s['size_sum'] for s in filetypes))]
+    by_filetype = [_row('header')]
+    for filetype, s in sorted(snapshot['filetypes'].items(), key=lambda item: -item[1]['count']):
+        by_filetype.append(_row(filetype, s['count'], len(s['users']), len(s['channels']),
+                                round(s['size_sum'] / s['count'] / 1000, 2), s['with_text'],
+                                _date(s['created_min']), _date(s['created_max'])))
+    return summary, by_filetype
+
+
+def legacy_blocks(by_filetype):
+    """ The by filetype tables as rendered before replyRendering.py: every filetype, on every message. """
+    blocks = list()
+    for title, columns in (("*Counts and Average Size in kB by Filetype*", (0, 1, 4)),
+                           ("*Count of Users having uploaded files and the number channels used by Filetype*",
+                            (0, 2, 3)),
+                           ("*First and Last Upload Dates by Filetype*", (0, 6, 7))):
+        lines = [f"{title}  \n"]
+        for row in by_filetype[1:]:
+            data = row['Data']
+            lines.append(" ".join(f"`{data[c]['VarCharValue'].ljust(10)}`" for c in columns) + "  \n")
+        blocks.append(section(" ".join(lines)))
+    return blocks
+
+
+def timed(fn, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+
+def largest_section(blocks):
+    return max((len(b['text']['text']) for b in blocks if b['type'] == 'section'), default=0)
+
+
+def check_message(label, blocks, violations):
+    size = len(json.dumps(blocks))
+    largest = largest_section(blocks)
+    print(f"  {label:<28} {len(blocks):>4} blocks {size:>8} chars, largest section {largest:>5} chars")
+    if len(blocks) > MESSAGE_BLOCK_LIMIT or size > REPLY_MAX_CHARS or largest > SECTION_TEXT_LIMIT:
+        violations.append(label)
+
+
+def description(chars, seed=11):
+    rng = random.Random(seed)
+    words = ['The', 'file', 'contains', 'a', 'table', 'of', 'quarterly', 'figures', 'with', 'totals', 'per',
+             'region,', 'and', 'notes.', 'Columns', 'include', 'dates', 'amounts']
+    paragraphs = list()
+    length = 0
+    while length < chars:
+        paragraph = " ".join(rng.choice(words) for _ in range(rng.randint(40, 120)))
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:chars]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filetypes', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--files', type=int, default=20, help='files of the multi-file reply')
+    parser.add_argument('--description-chars', type=int, default=20000, help='length of the long AI descriptions')
+    parser.add_argument('--repeat', type=int, default=1000, help='cached renders timed')
+    args = parser.parse_args()
+
+    snapshot = synthetic_snapshot(args.filetypes, args.users, args.channels)
+    summary_rows, by_filetype_rows = athena_rows(snapshot)
+    print(f"{args.filetypes} filetypes, {sum(s['count'] for s in snapshot['filetypes'].values())} files\n")
+
+    legacy, legacy_ms = timed(lambda: legacy_blocks(by_filetype_rows))
+    print(f"legacy tables          {legacy_ms:>9.2f} ms per message, {len(json.dumps(legacy)):>9} chars, "
+          f"largest section {largest_section(legacy)} chars")
+    stats, snapshot_ms = timed(lambda: stats_from_snapshot(snapshot))
+    _, athena_ms = timed(lambda: stats_from_athena_rows(summary_rows, by_filetype_rows))
+    blocks, render_ms = timed(lambda: render_stats_blocks(stats))
+    key = ('stats', 'bench', snapshot['version'], snapshot['updated'])
+    cached_fragment(key, lambda: blocks)
+    _, cached_ms = timed(lambda: cached_fragment(key, lambda: render_stats_blocks(stats)), args.repeat)
+    print(f"typed rows (snapshot)  {snapshot_ms:>9.2f} ms once per stats version")
+    print(f"typed rows (Athena)    {athena_ms:>9.2f} ms once per stats version")
+    print(f"render, top-N rollup   {render_ms:>9.2f} ms once per stats version, {len(json.dumps(blocks)):>9} chars, "
+          f"largest section {largest_section(blocks)} chars")
+    print(f"render, cached         {cached_ms:>9.4f} ms per message\n")
+
+    violations = list()
+    print("replies")
+    upload = section("The file `report.csv` was successfully uploaded to AWS S3. :thumbsup:  \nThis is the "
+                     f"<https://file-slacker-bucket.s3.amazonaws.com/{'x' * 900}|S3 link> (_link is valid for 1 hour_)")
+    for label, reports in (
+            ('one file, short description', [FileReport('report.csv', [upload], description(600))]),
+            ('one file, long description', [FileReport('report.csv', [upload], description(args.description_chars))]),
+            (f'{args.files} files, long descriptions',
+             [FileReport(f'report{i}.csv', [upload], description(args.description_chars, i))
+              for i in range(args.files)])):
+        reply, follow_ups = compose_reply(reports, blocks)
+        check_message(label, reply, violations)
+        if follow_ups:
+            check_message(f"  {len(follow_ups)} follow-ups, largest", max(follow_ups, key=lambda m: len(json.dumps(m))),
+                          violations)
+    if violations:
+        print(f"\nover budget: {', '.join(violations)}")
+        sys.exit(1)
+    print("\nall messages within the budgets")
+
+
+if __name__ == '__main__':
+    main()
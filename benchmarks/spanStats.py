@@ -0,0 +1,91 @@
+""" Aggregates the timing spans written by tracing.py (TRACING_ENABLED=true) into latency percentiles per stage.
+
+Reads CloudWatch log exports or local captures of the Lambda output (files, or stdin without any), picks out the span
+lines (JSON or EMF) and prints count, p50, p95, p99 and max of the span durations per stage, optionally per handler,
+plus the sum of their numeric attributes such as the bytes transferred.
+
+    $ python benchmarks/spanStats.py [--by-handler] [--sort p95|count|total|name] [log files ...]
+"""
+import argparse
+import fileinput
+import json
+import math
+
+SUMMED_ATTRIBUTES = ('bytes', 'size', 'retries')
+
+
+def parse_spans(lines):
+    """ The span records of the log lines. CloudWatch prefixes the lines with a timestamp and request id, so the
+    JSON is parsed from its first brace. """
+    for line in lines:
+        start = line.find('{')
+        if start < 0 or '"span"' not in line:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        if isinstance(record, dict) and 'span' in record and 'duration_ms' in record:
+            yield record
+
+
+def percentile(sorted_values, p):
+    """ The nearest rank percentile of already sorted values. """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def aggregate(records, by_handler=False):
+    groups = dict()
+    for record in records:
+        name = (record.get('handler', '-'), record['span']) if by_handler else record['span']
+        group = groups.setdefault(name, {'durations': list(), 'errors': 0, **{a: 0 for a in SUMMED_ATTRIBUTES}})
+        group['durations'].append(float(record['duration_ms']))
+        group['errors'] += 1 if record.get('error') else 0
+        for attribute in SUMMED_ATTRIBUTES:
+            value = record.get(attribute)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                group[attribute] += value
+    stats = dict()
+    for name, group in groups.items():
+        durations = sorted(group['durations'])
+        stats[name] = {
+            'count': len(durations),
+            'errors': group['errors'],
+            'p50_ms': percentile(durations, 50),
+            'p95_ms': percentile(durations, 95),
+            'p99_ms': percentile(durations, 99),
+            'max_ms': durations[-1],
+            'total_ms': sum(durations),
+            **{a: group[a] for a in SUMMED_ATTRIBUTES}
+        }
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='log files, stdin when none')
+    parser.add_argument('--by-handler', action='store_true', help='group the spans per handler too')
+    parser.add_argument('--sort', default='p95', choices=['p95', 'count', 'total', 'name'])
+    parser.add_argument('--json', action='store_true', help='print the stats as JSON')
+    args = parser.parse_args()
+
+    with fileinput.input(files=args.files or ('-',)) as lines:
+        stats = aggregate(parse_spans(lines), args.by_handler)
+    if args.json:
+        print(json.dumps({' '.join(k) if isinstance(k, tuple) else k: v for k, v in stats.items()}, indent=2))
+        return
+
+    sort_keys = {'p95': lambda item: -item[1]['p95_ms'], 'count': lambda item: -item[1]['count'],
+                 'total': lambda item: -item[1]['total_ms'], 'name': lambda item: item[0]}
+    print(f"{'stage':<44} {'count':>7} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} "
+          f"{'MB':>9}")
+    for name, s in sorted(stats.items(), key=sort_keys[args.sort]):
+        label = ' '.join(name) if isinstance(name, tuple) else name
+        print(f"{label:<44} {s['count']:>7} {s['errors']:>6} {s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} "
+              f"{s['p99_ms']:>9.1f} {s['max_ms']:>9.1f} {s['bytes'] / 1e6:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" Benchmarks the Slack-to-S3 transfer against local stand-ins for Slack and S3 (see localStandIns.py).
+
+Each transfer runs in a fresh interpreter so the reported peak RSS belongs to that transfer only. The `legacy` mode
+reproduces the original approach (read the whole response, wrap it in a BytesIO and `upload_fileobj`), the
+`streaming` mode uses `s3Streaming.stream_to_s3` as `fileSlacker.upload_file_to_s3` does.
+
+    $ python benchmarks/streamingUploadBench.py --sizes-mb 1 10 100 1000 --modes legacy streaming
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+MB = 1024 * 1024
+
+
+def run_transfer(port, size, mode, part_size_mb, concurrency):
+    import boto3
+    import requests
+    from io import BytesIO
+    from botocore.config import Config
+    from s3Streaming import stream_to_s3
+
+    endpoint = f'http://127.0.0.1:{port}'
+    s3 = boto3.client('s3', 'us-east-2', endpoint_url=endpoint, aws_access_key_id='bench',
+                      aws_secret_access_key='bench', config=Config(s3={'addressing_style': 'path'}))
+    start = time.perf_counter()
+    with requests.get(f'{endpoint}/slack/{size}', stream=True) as response:
+        if mode == 'legacy':
+            content = response.content
+            s3.upload_fileobj(BytesIO(content), 'file-slacker-bucket', 'bench-object')
+        else:
+            stream_to_s3(s3, response.iter_content(chunk_size=MB), 'file-slacker-bucket', 'bench-object',
+                         'application/octet-stream', part_size=part_size_mb * MB, max_concurrency=concurrency)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes-mb', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--modes', nargs='+', default=['legacy', 'streaming'], choices=['legacy', 'streaming'])
+    parser.add_argument('--part-size-mb', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--child', nargs=3, metavar=('PORT', 'SIZE', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        port, size, mode = args.child
+        print(json.dumps(run_transfer(int(port), int(size), mode, args.part_size_mb, args.concurrency)))
+        return
+
+    from localStandIns import start_local_stand_in
+    server = start_local_stand_in()
+    print(f"{'size (MB)':>10} {'mode':>10} {'seconds':>9} {'MB/s':>9} {'peak RSS (MB)':>14}")
+    for size_mb in args.sizes_mb:
+        for mode in args.modes:
+            output = subprocess.run(
+                [sys.executable, __file__, '--part-size-mb', str(args.part_size_mb), '--concurrency',
+                 str(args.concurrency), '--child', str(server.server_port), str(size_mb * MB), mode],
+                check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{size_mb:>10} {mode:>10} {result['seconds']:>9.2f} {size_mb / result['seconds']:>9.1f} "
+                  f"{result['peak_rss_mb']:>14.1f}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
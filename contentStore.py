@@ -0,0 +1,222 @@
+import hashlib
+import itertools
+import json
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+
+from s3Streaming import DEFAULT_PART_SIZE
+from s3Streaming import DEFAULT_UPLOAD_CONCURRENCY
+from s3Streaming import MB
+from s3Streaming import stream_to_s3
+
+# Content-addressed storage of the uploaded files. The bytes of a file are stored once, under the SHA-256 computed
+# while they are streamed from Slack:
+#     blobs/<sha256[:2]>/<sha256>          the content
+#     blobs/refs/<sha256>.json             the reference record: the uploads pointing at the blob (its reference
+#                                          count), the analyses and the thumbnail to reuse for the next duplicate
+#     blobs/fingerprints/<fingerprint>     the SHA-256 of a blob by its size and first MiB
+# The metadata of every upload keeps its own `s3_key` and points at the content with `blob_key`. A duplicate is
+# recognized by its fingerprint as soon as its first MiB is downloaded, the rest is then only hashed to confirm it,
+# not uploaded again. A blob larger than a part is uploaded to a staging key and copied to its key in S3 once its
+# hash is known.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BLOBS_FOLDER = 'blobs'
+REFS_FOLDER = f'{BLOBS_FOLDER}/refs'
+FINGERPRINTS_FOLDER = f'{BLOBS_FOLDER}/fingerprints'
+STAGING_FOLDER = f'{BLOBS_FOLDER}/staging'
+FINGERPRINT_BYTES = 1 * MB
+MAX_UPDATE_ATTEMPTS = 10
+
+
+@dataclass
+class StoredBlob:
+    """ An upload stored in the content-addressed storage. `body` holds the bytes only when the file fits in a
+    single part, like `s3Streaming.StreamedObject`. """
+    key: str
+    sha256: str
+    size: int
+    duplicate: bool
+    reference: dict
+    body: bytes = None
+
+
+def blob_key(sha256):
+    return f"{BLOBS_FOLDER}/{sha256[:2]}/{sha256}"
+
+
+def reference_key(sha256):
+    return f"{REFS_FOLDER}/{sha256}.json"
+
+
+def fingerprint(size, prefix):
+    """ Identifies the probable duplicates of a file by its declared size and its first FINGERPRINT_BYTES. """
+    return hashlib.sha256(f"{size}\n".encode('utf-8') + prefix).hexdigest()
+
+
+def is_blob_key(key):
+    return key.startswith(f'{BLOBS_FOLDER}/') and not key.startswith((f'{REFS_FOLDER}/', f'{FINGERPRINTS_FOLDER}/',
+                                                                      f'{STAGING_FOLDER}/'))
+
+
+def load_reference(s3, bucket, sha256):
+    """ Returns the reference record of a blob and its ETag, or None and None for an unknown blob. """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=reference_key(sha256))
+    except s3.exceptions.NoSuchKey:
+        return None, None
+    return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+
+def update_reference(s3, bucket, sha256, update):
+    """ Applies `update(record)` to the reference record of a blob with optimistic concurrency (S3 conditional
+    writes), `record` is None for a new blob. `update` returns the record to save, or None when there is nothing to
+    change. Returns the saved record and whether it was created by this update. """
+    from botocore.exceptions import ClientError
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        record, etag = load_reference(s3, bucket, sha256)
+        updated = update(json.loads(json.dumps(record)) if record is not None else None)
+        if updated is None:
+            return record, False
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(Body=json.dumps(updated, separators=(',', ':')), Bucket=bucket, Key=reference_key(sha256),
+                          ContentType='application/json', **condition)
+            return updated, record is None
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+        logger.info(f"The reference record of {sha256} was updated concurrently, retrying ({attempt + 1})")
+        time.sleep(0.05 * (attempt + 1))
+    raise Exception(f"Could not update the reference record of {sha256} after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+def add_reference(s3, bucket, sha256, upload_key, size, content_type, fingerprint_key=None):
+    """ Counts the upload `upload_key` as a reference to the blob, idempotently. Returns the record and whether this
+    upload created the blob. """
+    def add(record):
+        if record is None:
+            record = {'sha256': sha256, 'size': size, 'content_type': content_type, 'created': int(time.time()),
+                      'fingerprint_key': fingerprint_key, 'uploads': list(), 'analyses': dict()}
+        elif upload_key in record['uploads']:
+            return None
+        record['uploads'].append(upload_key)
+        record['references'] = len(record['uploads'])
+        return record
+    return update_reference(s3, bucket, sha256, add)
+
+
+def remove_reference(s3, bucket, sha256, upload_key):
+    """ Removes an upload from the references of a blob. The blob, its fingerprint and its record are deleted with
+    the last reference. Returns the number of references left. """
+    def remove(record):
+        if record is None or upload_key not in record['uploads']:
+            return None
+        record['uploads'].remove(upload_key)
+        record['references'] = len(record['uploads'])
+        return record
+    record, _ = update_reference(s3, bucket, sha256, remove)
+    if record is None:
+        return 0
+    if not record['uploads']:
+        keys = [blob_key(sha256), reference_key(sha256)] + ([record['fingerprint_key']]
+                                                             if record.get('fingerprint_key') else [])
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys]})
+    return record['references']
+
+
+def set_reference_attributes(s3, bucket, sha256, analyses=None, **attributes):
+    """ Stores what the next duplicate of a blob can reuse: the analyses (merged, by analysis cache key) and e.g.
+    the thumbnail key. """
+    def set_attributes(record):
+        if record is None:
+            return None
+        record['analyses'].update(analyses or {})
+        record.update(attributes)
+        return record
+    update_reference(s3, bucket, sha256, set_attributes)
+
+
+def _read_prefix(chunks, size):
+    """ Reads at least `size` bytes (or the whole stream) from the chunk iterator. Returns them and the iterator. """
+    prefix = bytearray()
+    for chunk in chunks:
+        prefix += chunk
+        if len(prefix) >= size:
+            break
+    return bytes(prefix), chunks
+
+
+def _lookup_fingerprint(s3, bucket, key):
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8').strip()
+    except s3.exceptions.NoSuchKey:
+        return None
+
+
+def _confirm_duplicate(prefix, chunks, sha256, part_size):
+    """ Hashes the rest of the stream. Returns its size and content (when it fits a part) if it is the blob
+    `sha256`, None otherwise. """
+    digest = hashlib.sha256(prefix)
+    size = len(prefix)
+    body = bytearray(prefix)
+    for chunk in chunks:
+        digest.update(chunk)
+        size += len(chunk)
+        if body is not None:
+            body += chunk
+            if len(body) >= part_size:
+                body = None
+    if digest.hexdigest() != sha256:
+        return None
+    return size, bytes(body) if body is not None else None
+
+
+def store_stream(s3, bucket, open_chunks, declared_size, content_type, upload_key, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+    """ Stores the file streamed by `open_chunks()` (an iterable of byte chunks, a new download per call) once, and
+    counts the upload `upload_key` as a reference to it. A probable duplicate (same fingerprint) is only hashed. A
+    fingerprint collision, very unlikely, costs a second download. """
+    chunks = iter(open_chunks())
+    prefix, chunks = _read_prefix(chunks, FINGERPRINT_BYTES)
+    fingerprint_key = f"{FINGERPRINTS_FOLDER}/{fingerprint(declared_size, prefix)}"
+    candidate = _lookup_fingerprint(s3, bucket, fingerprint_key)
+    if candidate is not None:
+        confirmed = _confirm_duplicate(prefix, chunks, candidate, part_size)
+        if confirmed is not None:
+            size, body = confirmed
+            record, created = add_reference(s3, bucket, candidate, upload_key, size, content_type, fingerprint_key)
+            if not created:
+                logger.info(f"{upload_key} is a duplicate of the blob {candidate}, not uploaded again")
+                return StoredBlob(blob_key(candidate), candidate, size, True, record, body)
+            # the last reference to the blob was removed after its fingerprint was read, store it again
+            remove_reference(s3, bucket, candidate, upload_key)
+        else:
+            logger.warning(f"The fingerprint of {upload_key} matched the blob {candidate} without being a duplicate")
+        chunks = iter(open_chunks())
+        prefix, chunks = _read_prefix(chunks, FINGERPRINT_BYTES)
+
+    def small_object_key(sha256):
+        # the content of a small file is known before it is stored, a duplicate isn't stored again
+        record, _ = load_reference(s3, bucket, sha256)
+        return blob_key(sha256) if record is None else None
+
+    staging_key = f"{STAGING_FOLDER}/{uuid.uuid4().hex}"
+    streamed = stream_to_s3(s3, itertools.chain([prefix], chunks), bucket, staging_key, content_type,
+                            part_size=part_size, max_concurrency=max_concurrency, small_object_key=small_object_key)
+    sha256 = streamed.sha256
+    if streamed.key == staging_key:
+        try:
+            record, _ = load_reference(s3, bucket, sha256)
+            if record is None:
+                s3.copy_object(Bucket=bucket, Key=blob_key(sha256), ContentType=content_type,
+                               CopySource={'Bucket': bucket, 'Key': staging_key}, MetadataDirective='REPLACE')
+        finally:
+            s3.delete_object(Bucket=bucket, Key=staging_key)
+    record, created = add_reference(s3, bucket, sha256, upload_key, streamed.size, content_type, fingerprint_key)
+    if created:
+        s3.put_object(Body=sha256, Bucket=bucket, Key=fingerprint_key, ContentType='text/plain')
+    return StoredBlob(blob_key(sha256), sha256, streamed.size, not created, record, streamed.body)
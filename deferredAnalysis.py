@@ -0,0 +1,260 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from s3Streaming import MB
+from tracing import span
+from transport import call_with_retries
+
+# Deferred analysis of the files that can wait ("ready within the hour"). Instead of a chat completion while the Lambda
+# waits, the request is queued in S3, and the scheduled `fileSlacker.deferred_analysis_handler` packs the queue into
+# an OpenAI Batch job (at half the price of the synchronous requests), collects the finished batches, rewrites the
+# `ai_analysis` of the `meta/` record and follows up in the thread of the upload. The reply to the upload says the
+# analysis is on its way. Only the chat completion analyses are deferred (the images sent inline and the locally
+# extracted files, whose chunks are summarized by a first batch and analyzed by a second one): the Batch API has no
+# assistants, the other files are analyzed right away.
+#     deferred/pending/<item_id>.json     the queued analyses
+#     deferred/batches/<batch_id>.json    the analyses of a submitted batch, until it is collected
+# set env var DEFERRED_ANALYSIS_ENABLED to true to defer the files that are at least DEFERRED_MIN_MB (default 10), of
+# the DEFERRED_FILETYPES (comma separated Slack filetypes, default any) and from the DEFERRED_CHANNELS (comma
+# separated channel ids, default any)
+# set env var DEFERRED_MAX_ATTEMPTS (default 3) for the batches a failed request is retried in
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFERRED_ANALYSIS_ENABLED = os.environ.get('DEFERRED_ANALYSIS_ENABLED', 'false').lower() == 'true'
+DEFERRED_MIN_BYTES = int(float(os.environ.get('DEFERRED_MIN_MB', '10')) * MB)
+DEFERRED_FILETYPES = {t.strip() for t in os.environ.get('DEFERRED_FILETYPES', '').split(',') if t.strip()}
+DEFERRED_CHANNELS = {c.strip() for c in os.environ.get('DEFERRED_CHANNELS', '').split(',') if c.strip()}
+DEFERRED_MAX_ATTEMPTS = int(os.environ.get('DEFERRED_MAX_ATTEMPTS', '3'))
+DEFERRED_FOLDER = 'deferred'
+
+# the `analysis_deferred` of a metadata record
+PENDING = 'pending'
+COMPLETED = 'completed'
+FAILED = 'failed'
+DEFERRED_ANALYSIS_TEXT = "The file will be analyzed in a batch, the analysis will follow in this thread."
+
+# the limits of an OpenAI batch: requests and size of its input file
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * MB
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_COMPLETION_WINDOW = '24h'
+OPEN_BATCH_STATUSES = ('validating', 'in_progress', 'finalizing', 'cancelling')
+FINAL_CUSTOM_ID = 'final'
+
+
+def should_defer(metadata):
+    """ Whether the analysis of an upload is routed to the deferred tier, by its size, filetype and channel. """
+    return (DEFERRED_ANALYSIS_ENABLED and metadata['size'] >= DEFERRED_MIN_BYTES and
+            (not DEFERRED_FILETYPES or metadata['filetype'] in DEFERRED_FILETYPES) and
+            (not DEFERRED_CHANNELS or metadata['slack_orig_channel'] in DEFERRED_CHANNELS))
+
+
+def pending_key(item_id):
+    return f"{DEFERRED_FOLDER}/pending/{item_id}.json"
+
+
+def batch_key(batch_id):
+    return f"{DEFERRED_FOLDER}/batches/{batch_id}.json"
+
+
+def join_summaries(summaries, summary_format):
+    """ The summaries of the chunks of a file, in order, as the content of its final analysis request. """
+    return "\n\n".join(summary_format.format(index=i + 1, count=len(summaries), summary=summary)
+                       for i, summary in enumerate(summaries))
+
+
+def queue_analysis(s3, bucket, metadata, metadata_key, cache_key, final, chunks=None, summary_format=None):
+    """ Queues the chat completion request `final` analyzing an upload. With `chunks` the requests summarizing its
+    chunks are run first, the summaries formatted with `summary_format` are then appended to the content of the last
+    message of `final`. The item is named after the Slack file, so a retried ingest queues it only once. """
+    item = {
+        'item_id': metadata['id'],
+        'queued': int(time.time()),
+        'attempts': 0,
+        'metadata_key': metadata_key,
+        'metadata': {k: metadata[k] for k in ('id', 's3_key', 'name', 'filetype', 'created', 'slack_orig_channel',
+                                              'slack_orig_ts', 'sha256', 'blob_key', 'thumbnail_s3_key')
+                     if metadata.get(k) is not None},
+        'cache_key': cache_key,
+        'chunks': chunks or [],
+        'summaries': {},
+        'summary_format': summary_format,
+        'final': final,
+    }
+    s3.put_object(Body=json.dumps(item), Bucket=bucket, Key=pending_key(item['item_id']),
+                  ContentType='application/json')
+    logger.info(f"Deferred the analysis of {metadata['name']} ({len(item['chunks'])} chunks)")
+    return item
+
+
+def item_requests(item):
+    """ The (custom_id, body) of the requests an item still needs: its missing chunk summaries, or its final
+    request once every chunk is summarized. """
+    missing = [i for i in range(len(item['chunks'])) if str(i) not in item['summaries']]
+    if missing:
+        return [(f"{item['item_id']}:{i}", item['chunks'][i]) for i in missing]
+    final = json.loads(json.dumps(item['final']))
+    if item['chunks']:
+        summaries = [item['summaries'][str(i)] for i in range(len(item['chunks']))]
+        final['messages'][-1]['content'] += join_summaries(summaries, item['summary_format'])
+    return [(f"{item['item_id']}:{FINAL_CUSTOM_ID}", final)]
+
+
+def _read_json(s3, bucket, key):
+    return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+
+
+def _list_keys(s3, bucket, prefix):
+    keys = list()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(o['Key'] for o in page.get('Contents', []))
+    return keys
+
+
+def _read_items(s3, bucket, keys):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return list(executor.map(lambda key: _read_json(s3, bucket, key), keys))
+
+
+def submit_batches(s3, openai, bucket):
+    """ Packs the queued items into OpenAI batches of at most BATCH_MAX_REQUESTS requests and BATCH_MAX_BYTES. The
+    manifest of a batch is written before its items leave the queue, so a crash in between submits them again
+    rather than losing them. Returns the ids of the submitted batches. """
+    keys = _list_keys(s3, bucket, f"{DEFERRED_FOLDER}/pending/")
+    if not keys:
+        return []
+    batch_ids = list()
+    # the oldest first, popped from the end
+    items = sorted(_read_items(s3, bucket, keys), key=lambda item: item['queued'], reverse=True)
+    while items:
+        lines, packed, size = list(), list(), 0
+        while items:
+            item_lines = [json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body})
+                          for custom_id, body in item_requests(items[-1])]
+            item_size = sum(len(line) + 1 for line in item_lines)
+            if packed and (len(lines) + len(item_lines) > BATCH_MAX_REQUESTS or size + item_size > BATCH_MAX_BYTES):
+                break
+            lines.extend(item_lines)
+            packed.append(items.pop())
+            size += item_size
+        with span('deferred_batch_submit', items=len(packed), requests=len(lines), bytes=size):
+            body = "\n".join(lines).encode('utf-8')
+            input_file = call_with_retries('openai.files.create', openai.files.create,
+                                           file=('deferred-analysis.jsonl', body), purpose='batch')
+            batch = call_with_retries('openai.batches.create', lambda: openai.batches.create(
+                input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW,
+                metadata={'source': 'fileSlackerBot'}))
+            manifest = {'batch_id': batch.id, 'input_file_id': input_file.id, 'submitted': int(time.time()),
+                        'items': packed}
+            s3.put_object(Body=json.dumps(manifest), Bucket=bucket, Key=batch_key(batch.id),
+                          ContentType='application/json')
+            for item in packed:
+                s3.delete_object(Bucket=bucket, Key=pending_key(item['item_id']))
+        logger.info(f"Submitted the batch {batch.id}: {len(packed)} analyses, {len(lines)} requests")
+        batch_ids.append(batch.id)
+    return batch_ids
+
+
+def _batch_results(openai, batch):
+    """ The content or the error of every request of a finished batch, by custom_id. """
+    results = dict()
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        text = call_with_retries('openai.files.content', openai.files.content, file_id).text
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code') != 200:
+                error = result.get('error') or response.get('body', {}).get('error') or response.get('status_code')
+                results[result['custom_id']] = (None, f"{error}")
+            else:
+                results[result['custom_id']] = (response['body']['choices'][0]['message']['content'], None)
+    return results
+
+
+def _apply_results(item, results, batch_status):
+    """ Takes the results of an item's requests. Returns its analysis once its final request succeeded, else None
+    and the error of its failed requests, if any. """
+    errors = list()
+    for custom_id, _ in item_requests(item):
+        content, error = results.get(custom_id, (None, f"not run, the batch is {batch_status}"))
+        part = custom_id.rsplit(':', 1)[1]
+        if content is None:
+            errors.append(error)
+        elif part == FINAL_CUSTOM_ID:
+            return content, None
+        else:
+            item['summaries'][part] = content
+    return None, "; ".join(errors) or None
+
+
+def _cleanup_files(openai, file_ids):
+    for file_id in file_ids:
+        if not file_id:
+            continue
+        try:
+            openai.files.delete(file_id)
+        except Exception as e:
+            logger.warning(f"Could not delete the OpenAI batch file {file_id}: {e}")
+
+
+def collect_batches(s3, openai, bucket, complete):
+    """ Collects the finished batches. An item whose final request succeeded is passed to `complete(item, analysis,
+    error)`, one whose chunks are now all summarized is queued again for its final request, and one with failed
+    requests is queued again until DEFERRED_MAX_ATTEMPTS, after which it is completed with its error (`analysis` None).
+    The items whose completion raised stay in the manifest for the next run. Returns the counts by outcome. """
+    counts = {'open': 0, COMPLETED: 0, FAILED: 0, 'requeued': 0}
+    for key in _list_keys(s3, bucket, f"{DEFERRED_FOLDER}/batches/"):
+        manifest = _read_json(s3, bucket, key)
+        batch = call_with_retries('openai.batches.retrieve', openai.batches.retrieve, manifest['batch_id'])
+        if batch.status in OPEN_BATCH_STATUSES:
+            counts['open'] += 1
+            continue
+        with span('deferred_batch_collect', items=len(manifest['items']), status=batch.status):
+            results = _batch_results(openai, batch)
+            unfinished = list()
+            for item in manifest['items']:
+                analysis, error = _apply_results(item, results, batch.status)
+                if analysis is None and error is None:
+                    counts['requeued'] += 1
+                    s3.put_object(Body=json.dumps(item), Bucket=bucket, Key=pending_key(item['item_id']),
+                                  ContentType='application/json')
+                    continue
+                if analysis is None:
+                    item['attempts'] += 1
+                    if item['attempts'] < DEFERRED_MAX_ATTEMPTS:
+                        logger.warning(f"Retrying the deferred analysis of {item['metadata']['name']} "
+                                       f"(attempt {item['attempts']}): {error}")
+                        counts['requeued'] += 1
+                        s3.put_object(Body=json.dumps(item), Bucket=bucket, Key=pending_key(item['item_id']),
+                                      ContentType='application/json')
+                        continue
+                try:
+                    complete(item, analysis, error)
+                    counts[COMPLETED if analysis is not None else FAILED] += 1
+                except Exception as e:
+                    logger.error(f"Could not complete the deferred analysis of {item['metadata']['name']}: {e}")
+                    unfinished.append(item)
+            if unfinished:
+                manifest['items'] = unfinished
+                s3.put_object(Body=json.dumps(manifest), Bucket=bucket, Key=key, ContentType='application/json')
+                continue
+            s3.delete_object(Bucket=bucket, Key=key)
+            _cleanup_files(openai, (manifest['input_file_id'], batch.output_file_id, batch.error_file_id))
+        logger.info(f"Collected the batch {manifest['batch_id']} ({batch.status})")
+    return counts
+
+
+def run_deferred_analysis(s3, openai, bucket, complete):
+    """ One run of the deferred tier: the finished batches are collected first, so the items they queue again go
+    out with the new ones. Returns the counts of the collected items and the ids of the submitted batches. """
+    counts = collect_batches(s3, openai, bucket, complete)
+    counts['submitted'] = submit_batches(s3, openai, bucket)
+    return counts
@@ -1,13 +1,84 @@
+import base64
+import hashlib
 import json
 import logging
 import mimetypes
 import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from io import BytesIO
-import boto3
-import requests
-from botocore.exceptions import ClientError
-from botocore.exceptions import NoCredentialsError
-from openai import OpenAI
+from tempfile import SpooledTemporaryFile
+from admission import HEAVY
+from admission import admit
+from admission import is_analyzable
+from admission import job_tier
+from admission import post_rejections
+from analysisCache import analysis_cache_key
+from analysisCache import get_analysis_cache
+from archiveExpansion import ARCHIVE_EXPANSION_ENABLED
+from archiveExpansion import expand_archive
+from archiveExpansion import is_archive
+from archiveExpansion import upload_member_rows
+from contentStore import load_reference
+from contentStore import set_reference_attributes
+from contentStore import store_stream
+from deferredAnalysis import COMPLETED
+from deferredAnalysis import DEFERRED_ANALYSIS_TEXT
+from deferredAnalysis import FAILED
+from deferredAnalysis import PENDING
+from deferredAnalysis import join_summaries
+from deferredAnalysis import queue_analysis
+from deferredAnalysis import run_deferred_analysis
+from deferredAnalysis import should_defer
+from idempotency import event_key
+from idempotency import file_key
+from idempotency import get_idempotency_store
+from imagePrep import ImagePrepError
+from imagePrep import prepare_image
+from jobQueue import build_command_job
+from jobQueue import build_job
+from jobQueue import get_job_queue
+from lazyClients import first_call
+from lazyClients import http_session
+from lazyClients import log_startup_profile
+from lazyClients import openai_client
+from lazyClients import s3_client
+from lazyClients import slack_client
+from metadataIndex import get_metadata_index
+from metadataLayout import metadata_s3_key
+from metadataLayout import record_id
+from metadataLayout import update_record
+from metadataQueries import METADATA_QUERIES_ENABLED
+from metadataQueries import answer_command
+from metadataQueries import answers_inline
+from metadataQueries import command_from_event
+from openaiLimits import BULK
+from openaiLimits import estimate_run_tokens
+from openaiLimits import estimate_tokens
+from openaiLimits import get_openai_limiter
+from openaiLimits import message_retry_after
+from openaiLimits import openai_lane
+from openaiLimits import with_current_lane
+from progressiveReply import start_progressive_reply
+from replyRendering import section
+from replyRendering import truncate
+from s3Streaming import MB
+from s3Streaming import stream_to_s3
+from textExtraction import ExtractionError
+from textExtraction import extract
+from textExtraction import find_extractor
+from transport import HttpStatusError
+from transport import call_with_retries
+from transport import is_throttle
+from transport import log_endpoint_stats
+from tracing import lazy_json
+from tracing import set_trace_id
+from tracing import span
+from tracing import start_trace
+from tracing import with_current_trace
 
 # to retrieve the file data from the Slack private URL set the following environment variables
 # SLACK_BOT_TOKEN
@@ -17,22 +88,69 @@ from openai import OpenAI
 # OPENAI_API_KEY
 
 # set env var DEBUG_LOGGING_ENABLED to true or false
+
+# set env var CONTENT_ADDRESSED_STORAGE_ENABLED to false to store every upload under its own `s3_key` instead of
+# once per content under `blobs/` (see contentStore.py)
+
+# set env var ASYNC_INGEST_ENABLED to true to only acknowledge the Slack event in `lambda_handler` and leave the
+# transfer and analysis of the file to `worker_handler` (see jobQueue.py for configuring the queue)
+
+# set env var DEFERRED_ANALYSIS_ENABLED to true to analyze the files that can wait in OpenAI batches, submitted and
+# collected by `deferred_analysis_handler` (see deferredAnalysis.py for the routing)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 S3_FILE_BUCKET = 'file-slacker-bucket'
 S3_METADATA_FOLDER = 'meta'
+S3_EVENTS_FOLDER = 'events'
+S3_THUMBNAILS_FOLDER = 'thumbnails'
+S3_DERIVED_FOLDER = 'derived'
 
-s3 = boto3.client('s3', 'us-east-2')
-open_ai = OpenAI()
+# the S3 and OpenAI clients (and their imports) are created on first use, see lazyClients.py
 ENABLE_AI_ANALYSIS = True
+ANALYSIS_MODEL = "gpt-4o"
+IMAGE_PROMPT = "What’s in this image?"
+FILE_PROMPT = "Analyze and describe the meaning behind this file."
+ASSISTANT_NAME = "Assistant to fileSlackerBot"
+ASSISTANT_INSTRUCTIONS = """You are an expert at analyzing the text within files. Use your knowledge base to summarize the 
+        meaning of the text within the given file."""
+CHUNK_PROMPT = "Summarize this excerpt of a larger file in a few sentences, keeping any names, numbers and dates."
+ARCHIVE_PROMPT = "Describe what this archive contains and what it is for, from the descriptions of its files."
+SUMMARY_FORMAT = "Summary of excerpt {index} of {count}:\n{summary}"
+# the analysis of a file that failed starts with this text, followed by the error
+ANALYSIS_FAILED_TEXT = "The file could not be analysed."
+# text-like files are extracted locally and summarized with a single chat completion, the Assistants file_search
+# pipeline is only used when a file can't be extracted
+LOCAL_EXTRACTION_ENABLED = os.environ.get('LOCAL_EXTRACTION_ENABLED', 'true').lower() == 'true'
+EXTRACTION_TOKEN_BUDGET = int(os.environ.get('EXTRACTION_TOKEN_BUDGET', '6000'))
+# images are downsized and re-encoded before the analysis, results up to IMAGE_INLINE_MAX_BYTES are sent inline
+IMAGE_PREP_ENABLED = os.environ.get('IMAGE_PREP_ENABLED', 'true').lower() == 'true'
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', '1536'))
+IMAGE_FORMAT = os.environ.get('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', '80'))
+IMAGE_INLINE_MAX_BYTES = int(os.environ.get('IMAGE_INLINE_MAX_BYTES', f'{1024 * 1024}'))
+# the assistant is looked up or created on first use and reused across warm invocations
+_assistant = None
+_assistant_lock = threading.Lock()
+ASYNC_INGEST_ENABLED = os.environ.get('ASYNC_INGEST_ENABLED', 'false').lower() == 'true'
+# Slack files are streamed to S3 in parts, memory use is about (S3_UPLOAD_CONCURRENCY + 1) * S3_PART_SIZE
+S3_PART_SIZE = int(os.environ.get('S3_PART_SIZE_MB', '8')) * MB
+S3_UPLOAD_CONCURRENCY = int(os.environ.get('S3_UPLOAD_CONCURRENCY', '4'))
+STREAM_CHUNK_SIZE = 1 * MB
+CONTENT_ADDRESSED_STORAGE_ENABLED = os.environ.get('CONTENT_ADDRESSED_STORAGE_ENABLED', 'true').lower() == 'true'
+# the files attached to the same Slack message are ingested concurrently, up to this limit
+EVENT_FILE_CONCURRENCY = int(os.environ.get('EVENT_FILE_CONCURRENCY', '4'))
+# the heavy files (see admission.py) are ingested at most this many at a time per process, so they don't take all
+# the concurrency from the fast ones
+HEAVY_FILE_CONCURRENCY = int(os.environ.get('HEAVY_FILE_CONCURRENCY', '1'))
+_heavy_file_slots = threading.BoundedSemaphore(HEAVY_FILE_CONCURRENCY)
 
 
 def lambda_handler(event, context):
     """ The AWS Lambda Handler. This handles the events from Slack via the HTTP Gateway.
-    TODO: This method is currently doing too much. Since it's not acknowledging a
-    success within 3 seconds the Slack API is re-sending events. Should considering
-    an asynchronous call/event to another Lambda so we can return a success immediately."""
+    When ASYNC_INGEST_ENABLED is set, the event is only validated and a job is put on the job queue so that Slack
+    receives its acknowledgement well within 3 seconds. The file transfer and analysis are then done by
+    `worker_handler`. Otherwise everything is done inline, which may cause Slack to re-send the event."""
 
     # uncomment to verify the Slack Request URL from a new Slack app
     '''
@@ -43,32 +161,304 @@ def lambda_handler(event, context):
         }
     '''
 
+    start_trace('fileSlacker.lambda_handler')
     try:
-        logger.debug(f'fileSlacker.lambda_handler -- event:\n{json.dumps(event)}')
-        logger.debug(f'fileSlacker.lambda_handler -- context:\n{str(context)}')
+        logger.debug("fileSlacker.lambda_handler -- event:\n%s", lazy_json(event))
+        logger.debug("fileSlacker.lambda_handler -- context:\n%s", context)
 
-        if checkForInvalidEvent(event):
+        with span('validate'):
+            invalid = checkForInvalidEvent(event)
+        # a mention without a file may be a metadata query (see metadataQueries.py)
+        command = command_from_event(json.loads(event['body'])) if invalid else None
+        if command is not None:
+            handle_command(command)
+            return {
+                'statusCode': 200,
+            }
+        if invalid:
             # do nothing, just return success
-            logger.warning(f"Ignoring invalid received event: \n{str(event)}")
+            logger.warning("Ignoring invalid received event: \n%s", event)
             return {
                 'statusCode': 200,
             }
 
-        slack_metadata = build_slack_metadata(event)
+        slack_metadata_records = build_slack_metadata(event)
+        slack_event_id = slack_metadata_records[0]['slack_event_id']
+        set_trace_id(slack_event_id)
 
-        if checkForExistingFileInS3(slack_metadata['s3_key']):
+        # a single conditional write tells us if this is a Slack retry of an event we already have
+        idempotency = get_idempotency_store()
+        claim_key = event_key(slack_event_id)
+        with span('claim_event') as claim_span:
+            claim_token = idempotency.claim(claim_key)
+            claim_span.set(duplicate=claim_token is None)
+        if claim_token is None:
             # do nothing, just return success
-            logger.warning(f"Ignoring a most-likely Slack retry event. s3_key: {slack_metadata['s3_key']}")
+            logger.warning(f"Ignoring a Slack retry event. event_id: {slack_event_id}")
             return {
                 'statusCode': 200,
             }
 
-        file = upload_file_to_s3(slack_metadata)
-        if ENABLE_AI_ANALYSIS:
-            analyzeUploadedFile(slack_metadata, file)
-        upload_metadata_to_s3(slack_metadata)
+        try:
+            # the files too large, of a rejected type or over the rate limits are explained right away, the others
+            # are routed to the fast or heavy tier (see admission.py)
+            with span('admission', files=len(slack_metadata_records)) as admission_span:
+                admitted, rejected = admit(slack_metadata_records)
+                admission_span.set(rejected=len(rejected), tier=job_tier(admitted))
+            post_rejections(rejected, all_rejected=not admitted)
+            if admitted and ASYNC_INGEST_ENABLED:
+                tier = job_tier(admitted)
+                with span('enqueue', files=len(admitted), tier=tier):
+                    job_id = get_job_queue(tier).put(build_job(admitted, tier))
+                logger.info(f"Queued {tier} ingest job {job_id} for event_id: {slack_event_id}")
+            elif admitted:
+                ingest_event(admitted)
+            idempotency.complete(claim_key, claim_token)
+        except Exception:
+            # let the Slack retry have another go
+            idempotency.release(claim_key, claim_token)
+            raise
     except Exception as err:
         logger.error(f"An error occurred.\n{err}")
+    finally:
+        log_endpoint_stats('fileSlacker.lambda_handler')
+        log_startup_profile('fileSlacker.lambda_handler')
+    return {
+        'statusCode': 200,
+    }
+
+
+def handle_command(command):
+    """ Answers the metadata query of a mention in its thread, or queues it with ASYNC_INGEST_ENABLED or when it
+    can't be answered within Slack's 3 seconds (see `answers_inline`). The Slack event is claimed like the events with
+    files, so a Slack retry isn't answered twice. """
+    set_trace_id(command['slack_event_id'])
+    idempotency = get_idempotency_store()
+    claim_key = event_key(command['slack_event_id'])
+    with span('claim_event') as claim_span:
+        claim_token = idempotency.claim(claim_key)
+        claim_span.set(duplicate=claim_token is None)
+    if claim_token is None:
+        logger.warning(f"Ignoring a Slack retry event. event_id: {command['slack_event_id']}")
+        return
+    try:
+        if ASYNC_INGEST_ENABLED or not answers_inline(command, s3_client(), S3_FILE_BUCKET, S3_METADATA_FOLDER):
+            with span('enqueue', command=True):
+                job_id = get_job_queue().put(build_command_job(command))
+            logger.info(f"Queued command job {job_id} for event_id: {command['slack_event_id']}")
+        else:
+            with span('command'):
+                answer_command(command, s3_client(), S3_FILE_BUCKET, S3_METADATA_FOLDER)
+        idempotency.complete(claim_key, claim_token)
+    except Exception:
+        idempotency.release(claim_key, claim_token)
+        raise
+
+
+def worker_handler(event, context):
+    """ The AWS Lambda Handler for the ingest worker. When triggered by SQS, every record of the batch is a job and
+    only the failed records are reported back for a retry. Otherwise (scheduled or manual invocation, or a local
+    run) the configured job queue is drained, optionally limited by `max_jobs` in the event, the queue of the heavy
+    files with a `tier` of `heavy`. """
+    logger.debug("fileSlacker.worker_handler -- context:\n%s", context)
+    if event and 'Records' in event:
+        failures = list()
+        for record in event['Records']:
+            try:
+                process_ingest_job(json.loads(record['body']))
+            except Exception as err:
+                logger.error(f"An error occurred while processing the SQS message {record['messageId']}.\n{err}")
+                failures.append({'itemIdentifier': record['messageId']})
+        log_endpoint_stats('fileSlacker.worker_handler')
+        log_startup_profile('fileSlacker.worker_handler')
+        return {'batchItemFailures': failures}
+
+    max_jobs = (event or {}).get('max_jobs')
+    processed = drain_job_queue(get_job_queue((event or {}).get('tier')), max_jobs)
+    log_endpoint_stats('fileSlacker.worker_handler')
+    log_startup_profile('fileSlacker.worker_handler')
+    return {'processed': processed}
+
+
+def drain_job_queue(job_queue, max_jobs=None, batch_size=10):
+    """ Processes jobs until the queue is empty (or `max_jobs` have been processed). A failed job is released back to
+    the queue to be retried by a later drain. Returns the number of successfully processed jobs. """
+    processed = 0
+    attempted = 0
+    failed_job_ids = set()
+    while max_jobs is None or attempted < max_jobs:
+        limit = batch_size if max_jobs is None else min(batch_size, max_jobs - attempted)
+        queued_jobs = job_queue.get(max_jobs=limit)
+        if not queued_jobs:
+            break
+        retried = [q for q in queued_jobs if q.job['job_id'] in failed_job_ids]
+        for queued_job in queued_jobs:
+            if queued_job in retried:
+                job_queue.release(queued_job)
+                continue
+            attempted += 1
+            try:
+                process_ingest_job(queued_job.job)
+                job_queue.ack(queued_job)
+                processed += 1
+            except Exception as err:
+                logger.error(f"An error occurred while processing the job {queued_job.job['job_id']}.\n{err}")
+                failed_job_ids.add(queued_job.job['job_id'])
+                job_queue.release(queued_job)
+        if len(retried) == len(queued_jobs):
+            # only failed jobs are left, stop instead of spinning on them
+            break
+    return processed
+
+
+def deferred_analysis_handler(event, context):
+    """ The scheduled AWS Lambda Handler of the deferred analyses (see deferredAnalysis.py): collects the finished
+    OpenAI batches into the metadata records and the threads of the uploads, then submits the queued analyses as a
+    new batch. """
+    logger.debug("fileSlacker.deferred_analysis_handler -- context:\n%s", context)
+    counts = run_deferred_analysis(s3_client(), openai_client(), S3_FILE_BUCKET, complete_deferred_analysis)
+    logger.info(f"Deferred analysis: {json.dumps(counts)}")
+    log_endpoint_stats('fileSlacker.deferred_analysis_handler')
+    return counts
+
+
+def complete_deferred_analysis(item, ai_analysis, error=None):
+    """ Stores the analysis of a deferred item in its metadata record, and in the analysis cache like an analysis
+    made right away, then posts it in the thread of the upload. Without `ai_analysis` the analysis failed with
+    `error`. fileStatsSlacker doesn't reply to the rewritten record (its `analysis_deferred` is final). """
+    md = item['metadata']
+    if ai_analysis is None:
+        ai_analysis, status = f"{ANALYSIS_FAILED_TEXT}\n```{error}```", FAILED
+    else:
+        status = COMPLETED
+        if item['cache_key']:
+            get_analysis_cache(S3_FILE_BUCKET, s3_client()).put(item['cache_key'], ai_analysis)
+            if md.get('blob_key'):
+                set_reference_attributes(s3_client(), S3_FILE_BUCKET, md['sha256'], {item['cache_key']: ai_analysis},
+                                         **({'thumbnail_s3_key': md['thumbnail_s3_key']}
+                                            if md.get('thumbnail_s3_key') else {}))
+
+    def set_analysis(record):
+        record.update({'ai_analysis': ai_analysis, 'analysis_deferred': status,
+                       'analysis_deferred_seconds': int(time.time()) - item['queued']})
+        return record
+    update_record(s3_client(), S3_FILE_BUCKET, item['metadata_key'], record_id(md), set_analysis)
+    with span('deferred_analysis_reply', status=status):
+        call_with_retries('slack.chat.postMessage', slack_client().chat_postMessage,
+                          channel=md['slack_orig_channel'], thread_ts=md['slack_orig_ts'],
+                          text=f"The analysis of {md['name']}",
+                          blocks=[section(truncate(f"*The analysis of `{md['name']}`*\n{ai_analysis}"))])
+
+
+def process_ingest_job(job):
+    """ Runs the heavy part of the ingest for a job created by `lambda_handler`, or answers its metadata query. """
+    queued_seconds = time.time() - job['enqueued']
+    if 'command' in job:
+        start_trace('fileSlacker.worker_handler', job['command']['slack_event_id'])
+        with span('command_job', queued_ms=round(queued_seconds * 1000)):
+            answer_command(job['command'], s3_client(), S3_FILE_BUCKET, S3_METADATA_FOLDER)
+        return
+    logger.info(f"Processing ingest job {job['job_id']} queued {queued_seconds:.2f}s ago")
+    start_trace('fileSlacker.worker_handler', job['files'][0]['slack_event_id'])
+    with span('ingest_job', files=len(job['files']), queued_ms=round(queued_seconds * 1000)):
+        ingest_event(job['files'])
+
+
+def ingest_event(slack_metadata_records):
+    """ Ingests all the files attached to a Slack message concurrently, at most EVENT_FILE_CONCURRENCY at a time. A
+    failing file doesn't stop the others, its error is recorded for the reply. When the message had several files an
+    event manifest is written to S3 so that fileStatsSlacker replies once for all of them. Raises when every file
+    failed, or when OpenAI throttled the analysis of a file, so the event can be retried (the files already ingested
+    are then skipped). With progressive replies the progress of the files is shown in the thread
+    while they are ingested (see progressiveReply.py). """
+    results = dict()
+    throttled = list()
+    progress = start_progressive_reply(slack_metadata_records)
+    with ThreadPoolExecutor(max_workers=min(EVENT_FILE_CONCURRENCY, len(slack_metadata_records)),
+                            thread_name_prefix='ingest-file') as executor:
+        futures = {executor.submit(with_current_trace(ingest_file), md, progress): md for md in slack_metadata_records}
+        for future in as_completed(futures):
+            md = futures[future]
+            try:
+                results[md['id']] = 'processed' if future.result() else 'skipped'
+            except Exception as err:
+                logger.error(f"An error occurred while ingesting {md['name']} (s3_key = {md['s3_key']}).\n{err}")
+                results[md['id']] = f'failed: {err}'
+                if is_throttle(err):
+                    throttled.append(md['name'])
+                elif progress:
+                    progress.failed(md['id'])
+
+    if throttled:
+        raise Exception(f"OpenAI throttled the analysis of {', '.join(throttled)} of event "
+                        f"{slack_metadata_records[0]['slack_event_id']}.")
+    if all(r.startswith('failed') for r in results.values()):
+        raise Exception(f"None of the {len(results)} files of event {slack_metadata_records[0]['slack_event_id']} "
+                        f"could be ingested.")
+    if len(slack_metadata_records) > 1:
+        if progress:
+            progress.close()
+        with span('event_manifest_upload', files=len(slack_metadata_records)):
+            upload_event_manifest_to_s3(slack_metadata_records, results, progress.ts if progress else None)
+    return results
+
+
+def ingest_file(slack_metadata, progress=None):
+    """ Transfers the Slack file to S3, analyzes it and persists the metadata, which in turn triggers the
+    fileStatsSlacker reply. Returns False when the file had already been processed. The file is claimed first so the
+    same Slack file is never transferred and analyzed twice, e.g. a queue redelivery or the file being shared again in
+    another message. The `progress` of a progressive reply is told when the file is in S3 and as its analysis streams
+    in. Heavy files wait for one of the HEAVY_FILE_CONCURRENCY slots, and their OpenAI requests go through the bulk
+    lane (see openaiLimits.py). """
+    if slack_metadata.get('admission_tier') == HEAVY:
+        with span('heavy_slot_wait'):
+            _heavy_file_slots.acquire()
+        try:
+            with openai_lane(BULK):
+                return _ingest_file(slack_metadata, progress)
+        finally:
+            _heavy_file_slots.release()
+    return _ingest_file(slack_metadata, progress)
+
+
+def _ingest_file(slack_metadata, progress=None):
+    idempotency = get_idempotency_store()
+    claim_key = file_key(slack_metadata['id'])
+    claim_token = idempotency.claim(claim_key)
+    if claim_token is None:
+        logger.warning(f"Ignoring an already processed file. s3_key: {slack_metadata['s3_key']}")
+        return False
+
+    try:
+        with span('ingest_file', size=slack_metadata['size'], mimetype=slack_metadata['mimetype'],
+                  filetype=slack_metadata['filetype']):
+            with span('transfer', mimetype=slack_metadata['mimetype']) as transfer_span:
+                file = upload_file_to_s3(slack_metadata)
+                transfer_span.set(bytes=slack_metadata.get('byte_count'))
+            if progress:
+                progress.received(slack_metadata['id'])
+            if slack_metadata.get('analysis_skipped'):
+                slack_metadata.update({'ai_analysis': f"The file was not analyzed, "
+                                                      f"{slack_metadata['analysis_skipped']}.",
+                                       'ai_analysis_cached': 'false'})
+            elif ENABLE_AI_ANALYSIS:
+                with span('analysis', mimetype=slack_metadata['mimetype']) as analysis_span:
+                    analyzeUploadedFile(slack_metadata, file, progress, deferred=should_defer(slack_metadata))
+                    analysis_span.set(cache_hit=slack_metadata.get('ai_analysis_cached') == 'true')
+            if progress:
+                progress.analysis(slack_metadata['id'], slack_metadata['ai_analysis'], done=True)
+                if slack_metadata['event_file_count'] == 1:
+                    # the metadata triggers the final reply, which updates the progress message
+                    progress.close()
+                    if progress.ts:
+                        slack_metadata['slack_reply_ts'] = progress.ts
+            with span('metadata_upload'):
+                upload_metadata_to_s3(slack_metadata)
+        idempotency.complete(claim_key, claim_token)
+        return True
+    except Exception:
+        idempotency.release(claim_key, claim_token)
+        raise
 
 
 def checkForInvalidEvent(event):
@@ -80,40 +470,30 @@ def checkForInvalidEvent(event):
     return 'files' not in slack_event['event']
 
 
-def checkForExistingFileInS3(file_s3_key):
-    results = s3.list_objects(Bucket=S3_FILE_BUCKET,
-                              Prefix=file_s3_key)
-    # if 'Contents' exist, then the file exists in s3
-    logger.info(f"File Exists: {'Contents' in results}")
-    return 'Contents' in results
-
-def checkForExistingMetadataInS3(meta_s3_key):
-    results = s3.list_objects(Bucket=S3_FILE_BUCKET,
-                              Prefix=meta_s3_key)
-    # if 'Contents' exist, then the file exists in s3
-    logger.info(f"Metadata Exists: {'Contents' in results}")
-    return 'Contents' in results
-
-
 def upload_file_to_s3(metadata):
-    """ Transfers the Slack user's attached file (via the Slack private URL) to an S3 bucket."""
+    """ Streams the Slack user's attached file (via the Slack private URL) to an S3 bucket without holding the whole
+    file in memory. The SHA-256 and byte count are added to the metadata. Returns the file content only when it is
+    small enough to fit in a single part, otherwise None and the content has to be read back from S3.
+    With content-addressed storage the content is stored once under `blob_key` and a duplicate is not uploaded again,
+    `blob_duplicate` tells which. """
+    from botocore.exceptions import ClientError
+    from botocore.exceptions import NoCredentialsError
     try:
-        slack_token = os.environ["SLACK_BOT_TOKEN"]
-        slack_file_response = requests.get(
-            metadata['url_private'],
-            headers={'Content-Type': 'text', 'Authorization': f'Bearer {slack_token}'},
-            stream=True)
-        if slack_file_response.status_code == 200:
-            slack_file = slack_file_response.content
-            binary_stream = BytesIO(slack_file)
-            s3.upload_fileobj(
-                binary_stream,
+        if CONTENT_ADDRESSED_STORAGE_ENABLED:
+            return store_uploaded_blob(metadata)
+        with first_call('slack.files'):
+            slack_file_response = call_with_retries('slack.files', open_slack_file, metadata['url_private'])
+        with slack_file_response:
+            streamed = stream_to_s3(
+                s3_client(),
+                slack_file_response.iter_content(chunk_size=STREAM_CHUNK_SIZE),
                 S3_FILE_BUCKET,
                 metadata['s3_key'],
-                ExtraArgs={'ContentType': f'{metadata['mimetype']}'})
-            return slack_file
-        else:
-            raise Exception(f"Unsuccessful HTTP status while fetching Slack file: {slack_file_response.status_code}")
+                metadata['mimetype'],
+                part_size=S3_PART_SIZE,
+                max_concurrency=S3_UPLOAD_CONCURRENCY)
+        metadata.update({'sha256': streamed.sha256, 'byte_count': streamed.size})
+        return streamed.body
     except FileNotFoundError as e:
         logging.error(f"The slack file was not found at {metadata['url_private']}\n{e}")
         raise
@@ -125,35 +505,220 @@ def upload_file_to_s3(metadata):
         raise
 
 
-def analyzeUploadedFile(metadata, file):
+def store_uploaded_blob(metadata):
+    """ Stores the Slack file in the content-addressed storage. A duplicate brings along what was kept from the first
+    upload of its content: its analyses (see `analyzeUploadedFile`) and its thumbnail. """
+    def open_chunks():
+        with first_call('slack.files'):
+            response = call_with_retries('slack.files', open_slack_file, metadata['url_private'])
+        with response:
+            yield from response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+
+    stored = store_stream(s3_client(), S3_FILE_BUCKET, open_chunks, metadata['size'], metadata['mimetype'],
+                          metadata['s3_key'], part_size=S3_PART_SIZE, max_concurrency=S3_UPLOAD_CONCURRENCY)
+    metadata.update({'sha256': stored.sha256, 'byte_count': stored.size, 'blob_key': stored.key,
+                     'blob_duplicate': stored.duplicate})
+    if stored.duplicate and stored.reference.get('thumbnail_s3_key'):
+        metadata['thumbnail_s3_key'] = stored.reference['thumbnail_s3_key']
+    return stored.body
+
+
+def open_slack_file(url_private):
+    """ Starts the streamed download of a Slack file over the pooled HTTP session. An unsuccessful response is closed
+    and raised, `call_with_retries` retries it when it is transient (e.g. a 429 with its Retry-After). """
+    slack_token = os.environ["SLACK_BOT_TOKEN"]
+    response = http_session().get(
+        url_private,
+        headers={'Content-Type': 'text', 'Authorization': f'Bearer {slack_token}'},
+        stream=True,
+        timeout=(5, 60))
+    if response.status_code != 200:
+        response.close()
+        raise HttpStatusError(response.status_code,
+                              f"Unsuccessful HTTP status while fetching Slack file: {response.status_code}",
+                              response.headers)
+    return response
+
+
+def open_uploaded_file(metadata, file=None):
+    """ Returns a readable file object of the uploaded file's content. Large files are streamed back from S3 rather
+    than kept in memory since the upload. """
+    if file is not None:
+        return BytesIO(file)
+    return s3_client().get_object(Bucket=S3_FILE_BUCKET, Key=stored_object_key(metadata))['Body']
+
+
+def stored_object_key(metadata):
+    """ The S3 key of the content of an upload, its blob with content-addressed storage. """
+    return metadata.get('blob_key') or metadata['s3_key']
+
+
+def analyzeUploadedFile(metadata, file=None, progress=None, deferred=False):
     """ First grant temporary public access to the uploaded file (via a presigned URL). Then request OpenAi to
     analyze the file. Store the result in the metadata to be persisted to S3.
+    The analysis of a file with the same content, prompt and model is reused from the analysis cache, or from the
+    blob of a duplicate upload. With a progressive reply the chat completions are streamed into its `progress`
+    message. A `deferred` image or extracted file is queued for an OpenAI batch instead (see deferredAnalysis.py).
     TODO: Look into improving the requests to analyze files to OpenAI """
-    ai_analysis = "The file could not be analysed."
+    ai_analysis = ANALYSIS_FAILED_TEXT
     filename = metadata['name']
+    is_image = metadata['mimetype'].startswith('image')
+    is_expanded_archive = ARCHIVE_EXPANSION_ENABLED and is_archive(metadata)
+    cache_key = None
+    on_text = (lambda text: progress.analysis(metadata['id'], text)) if progress else None
+    if metadata.get('sha256'):
+        prompt = ARCHIVE_PROMPT if is_expanded_archive else IMAGE_PROMPT if is_image else FILE_PROMPT
+        cache_key = analysis_cache_key(metadata['sha256'], prompt, ANALYSIS_MODEL)
     try:
-        presigned_url = generate_presigned_url(S3_FILE_BUCKET, metadata['s3_key'])
-        if metadata['mimetype'].startswith('image'):
-            ai_analysis = analyze_image("What’s in this image?", presigned_url)
+        cached_analysis = None
+        if cache_key and metadata.get('blob_duplicate'):
+            reference, _ = load_reference(s3_client(), S3_FILE_BUCKET, metadata['sha256'])
+            cached_analysis = (reference or {}).get('analyses', {}).get(cache_key)
+        if cached_analysis is None and cache_key:
+            cached_analysis = get_analysis_cache(S3_FILE_BUCKET, s3_client()).get(cache_key)
+        if cached_analysis is not None:
+            logger.info(f"Reusing the cached analysis of {filename} (sha256 = {metadata['sha256']})")
+            metadata.update({'ai_analysis': cached_analysis, 'ai_analysis_cached': 'true'})
+            return
+
+        if is_expanded_archive:
+            ai_analysis = analyze_archive(metadata, file, on_text)
+        elif is_image:
+            with span('image_prep', size=metadata['size'], mimetype=metadata['mimetype']) as prep_span:
+                image_url, detail = prepare_image_for_analysis(metadata, file)
+                prep_span.set(bytes=metadata.get('analyzed_image_bytes'), detail=detail)
+            if deferred and image_url.startswith('data:'):
+                # a presigned URL would expire before the batch runs
+                defer_analysis(metadata, cache_key, image_request(IMAGE_PROMPT, image_url, detail))
+                return
+            ai_analysis = analyze_image(IMAGE_PROMPT, image_url, detail, on_text)
         else:
             # attempting to add a file extension if the filename doesn't have one
             if metadata['file_extension'] is not None and metadata['file_extension'] != 'None' and not (filename.endswith(metadata['file_extension'])):
                 filename = metadata['name'] + metadata['file_extension']
-            # total hack :)
-            if filename.endswith('.xlsx') or filename.endswith('.csv'):
-                filename += '.txt'
-            ai_analysis = analyze_file("Analyze and describe the meaning behind this file.", file, filename)
+            extraction = None
+            if LOCAL_EXTRACTION_ENABLED and find_extractor(metadata['mimetype'], filename) is not None:
+                try:
+                    with span('extraction', size=metadata['size'], mimetype=metadata['mimetype']) as extraction_span:
+                        extraction = extract(open_uploaded_file(metadata, file), metadata['mimetype'], filename,
+                                             token_budget=EXTRACTION_TOKEN_BUDGET)
+                        extraction_span.set(kind=extraction.kind, chunks=len(extraction.chunks),
+                                            truncated=extraction.truncated)
+                    metadata.update({'content_stats': extraction.stats})
+                except ExtractionError as e:
+                    logger.warning(f"Falling back to the OpenAI assistant for {filename}: {e}")
+            if extraction is not None and deferred:
+                chunks = [chunk_request(chunk, filename) for chunk in extraction.chunks]
+                content = '' if extraction.chunks else extraction.sample
+                defer_analysis(metadata, cache_key, extracted_file_request(FILE_PROMPT, extraction, filename, content),
+                               chunks)
+                return
+            if extraction is not None:
+                ai_analysis = analyze_extracted_file(FILE_PROMPT, extraction, filename, on_text)
+            else:
+                # total hack :)
+                if filename.endswith('.xlsx') or filename.endswith('.csv'):
+                    filename += '.txt'
+                ai_analysis = analyze_file(FILE_PROMPT, open_uploaded_file(metadata, file), filename, metadata['size'])
+        if cache_key:
+            get_analysis_cache(S3_FILE_BUCKET, s3_client()).put(cache_key, ai_analysis)
+        if metadata.get('blob_key'):
+            set_reference_attributes(s3_client(), S3_FILE_BUCKET, metadata['sha256'], {cache_key: ai_analysis},
+                                     **({'thumbnail_s3_key': metadata['thumbnail_s3_key']}
+                                        if metadata.get('thumbnail_s3_key') else {}))
     except Exception as e:
+        if is_throttle(e):
+            # not turned into a failed analysis, the ingest (or backfill) of the file is retried
+            raise
         logger.error(f"Error while analysing {filename} (slack name = {metadata['name']})")
         logger.exception(e)
         ai_analysis += f"\n```{str(e)}```"
-    metadata.update({'ai_analysis': ai_analysis})
+    metadata.update({'ai_analysis': ai_analysis, 'ai_analysis_cached': 'false'})
 
 
-def analyze_image(request, url):
-    """ A simple approach to analyzing image content using OpenAI."""
-    response = open_ai.chat.completions.create(
-        model="gpt-4o",
+def defer_analysis(metadata, cache_key, final, chunks=None):
+    """ Queues the analysis requests of an upload for the next OpenAI batch, its metadata says the analysis follows. """
+    with span('analysis_deferred', chunks=len(chunks or [])):
+        queue_analysis(s3_client(), S3_FILE_BUCKET, metadata, get_metadata_s3_key(metadata), cache_key, final, chunks,
+                       SUMMARY_FORMAT)
+    metadata.update({'ai_analysis': DEFERRED_ANALYSIS_TEXT, 'ai_analysis_cached': 'false',
+                     'analysis_deferred': PENDING})
+
+
+def analyze_archive(metadata, file=None, on_text=None):
+    """ Expands a zip, tar or gzip archive (see archiveExpansion.py) under the derived folder and analyzes its members
+    concurrently, each like an upload of its own. The descriptions of the members are then summarized into the
+    analysis of the archive, and one row per member is written for Athena. """
+    key = stored_object_key(metadata)
+    with span('archive_expansion', size=metadata['size']) as expansion_span:
+        expansion = expand_archive(s3_client(), S3_FILE_BUCKET, metadata, key, metadata.get('byte_count') or
+                                   metadata['size'], file, with_current_lane(analyze_archive_member),
+                                   f"{S3_DERIVED_FOLDER}/{key}",
+                                   part_size=S3_PART_SIZE)
+        expansion_span.set(members=len(expansion.members), skipped=len(expansion.skipped),
+                           stopped=expansion.stopped)
+    metadata.update({'archive_stats': expansion.stats,
+                     'archive_members_s3_key': upload_member_rows(s3_client(), S3_FILE_BUCKET, metadata, expansion)})
+    if not expansion.members:
+        return f"The archive has no files that could be read{f' ({expansion.stopped})' if expansion.stopped else ''}."
+    listing = "\n".join(f"- {md['path']} ({md['size']} bytes): "
+                        f"{md.get('ai_analysis') or md.get('analysis_skipped') or md['status']}"
+                        for md in expansion.members)
+    extraction = extract(BytesIO(listing.encode('utf-8')), 'text/plain', 'members.txt',
+                         token_budget=EXTRACTION_TOKEN_BUDGET)
+    extraction.stats = expansion.stats
+    return analyze_extracted_file(ARCHIVE_PROMPT, extraction, metadata['name'], on_text)
+
+
+def analyze_archive_member(member_metadata, content):
+    """ Analyzes a member of an archive through the image and text paths of the uploads. Archives within archives
+    are not expanded, and only the files OpenAI can read are analyzed. """
+    if is_archive(member_metadata):
+        member_metadata['analysis_skipped'] = "archives within archives are not expanded"
+    elif not is_analyzable(member_metadata):
+        member_metadata['analysis_skipped'] = f"`{member_metadata['filetype']}` files can't be analyzed"
+    elif ENABLE_AI_ANALYSIS:
+        analyzeUploadedFile(member_metadata, content)
+
+
+def prepare_image_for_analysis(metadata, file=None):
+    """ Downsizes and re-encodes the uploaded image before it is sent to OpenAI, and stores a thumbnail next to the
+    original for the fileStatsSlacker reply. Small results are sent inline as a data URL, larger ones as a derived S3
+    object. Returns the URL to analyze and the OpenAI detail level. Falls back to the original upload (detail `auto`)
+    when the image can't be decoded. """
+    if IMAGE_PREP_ENABLED:
+        try:
+            with SpooledTemporaryFile(max_size=S3_PART_SIZE) as spool:
+                shutil.copyfileobj(open_uploaded_file(metadata, file), spool, STREAM_CHUNK_SIZE)
+                spool.seek(0)
+                prepared = prepare_image(spool, max_edge=IMAGE_MAX_EDGE, image_format=IMAGE_FORMAT,
+                                         quality=IMAGE_QUALITY)
+            metadata.update({
+                'image_width': prepared.original_width,
+                'image_height': prepared.original_height,
+                'analyzed_image_bytes': len(prepared.data)
+            })
+            if prepared.thumbnail:
+                thumbnail_key = f"{S3_THUMBNAILS_FOLDER}/{stored_object_key(metadata)}{prepared.extension}"
+                s3_client().put_object(Body=prepared.thumbnail, Bucket=S3_FILE_BUCKET, Key=thumbnail_key,
+                                       ContentType=prepared.mimetype)
+                metadata.update({'thumbnail_s3_key': thumbnail_key})
+            if len(prepared.data) <= IMAGE_INLINE_MAX_BYTES:
+                data_url = f"data:{prepared.mimetype};base64,{base64.b64encode(prepared.data).decode('ascii')}"
+                return data_url, prepared.detail
+            derived_key = f"{S3_DERIVED_FOLDER}/{stored_object_key(metadata)}{prepared.extension}"
+            s3_client().put_object(Body=prepared.data, Bucket=S3_FILE_BUCKET, Key=derived_key,
+                                   ContentType=prepared.mimetype)
+            return generate_presigned_url(S3_FILE_BUCKET, derived_key), prepared.detail
+        except ImagePrepError as e:
+            logger.warning(f"Sending the original image {metadata['name']} to OpenAI: {e}")
+    return generate_presigned_url(S3_FILE_BUCKET, stored_object_key(metadata)), 'auto'
+
+
+def image_request(request, url, detail='auto'):
+    """ The chat completion request analyzing an image. """
+    return dict(
+        model=ANALYSIS_MODEL,
         messages=[
             {
                 "role": "user",
@@ -163,6 +728,7 @@ def analyze_image(request, url):
                         "type": "image_url",
                         "image_url": {
                             "url": f"{url}",
+                            "detail": detail,
                         },
                     },
                 ],
@@ -170,121 +736,314 @@ def analyze_image(request, url):
         ],
         max_tokens=300,
     )
-    logger.debug(f"Image analysis: {str(response.choices[0].message.content)}")
-    return str(response.choices[0].message.content)
-
-
-def analyze_file(request, raw_file, filename):
-    """  Analyzing the content of text-like files using OpenAI."""
-    assistant = open_ai.beta.assistants.create(
-        name="Assistant to fileSlackerBot",
-        instructions="""You are an expert at analyzing the text within files. Use your knowledge base to summarize the 
-        meaning of the text within the given file.""",
-        model="gpt-4o",
-        tools=[{"type": "file_search"}]
-    )
 
-    # Upload the user provided file to OpenAI
-    message_file = open_ai.files.create(
-        file=(filename, raw_file), purpose="assistants",
-    )
 
-    # Create a thread and attach the file to the message
-    thread = open_ai.beta.threads.create(
+def analyze_image(request, url, detail='auto', on_text=None):
+    """ A simple approach to analyzing image content using OpenAI."""
+    with first_call('openai.chat.completions'):
+        content = create_completion(on_text, **image_request(request, url, detail))
+    logger.debug(f"Image analysis: {content}")
+    return content
+
+
+def text_request(instructions, content, max_tokens):
+    return dict(
+        model=ANALYSIS_MODEL,
         messages=[
-            {
-                "role": "user",
-                "content": request,
-                # Attach the new file to the message.
-                "attachments": [
-                    {"file_id": message_file.id, "tools": [{"type": "file_search"}]}
-                ],
-            }
-        ]
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": content}
+        ],
+        max_tokens=max_tokens,
     )
 
-    # The thread now has a vector store with that file in its tool resources.
-    logger.debug(thread.tool_resources.file_search)
 
-    # Use the create and poll SDK helper to create a run and poll the status of
-    # the run until it's in a terminal state.
+def chunk_request(chunk, filename):
+    """ The chat completion request summarizing a chunk of a file too large for a single request. """
+    return text_request(CHUNK_PROMPT, f"An excerpt of the file {filename}:\n\n{chunk}", 300)
 
-    run = open_ai.beta.threads.runs.create_and_poll(
-        thread_id=thread.id, assistant_id=assistant.id
-    )
 
-    messages = list(open_ai.beta.threads.messages.list(thread_id=thread.id, run_id=run.id))
+def extracted_file_request(request, extraction, filename, content):
+    """ The chat completion request analyzing a locally extracted file: its structural stats and `content`, a sample
+    or the summaries of its chunks, last. """
+    note = " (only a sample of the content is included)" if extraction.truncated else ""
+    return text_request(
+        ASSISTANT_INSTRUCTIONS,
+        f"""{request}
 
-    message_content = messages[0].content[0].text
-    annotations = message_content.annotations
-    citations = []
-    for index, annotation in enumerate(annotations):
-        message_content.value = message_content.value.replace(annotation.text, f"[{index}]")
-        if file_citation := getattr(annotation, "file_citation", None):
-            cited_file = open_ai.files.retrieve(file_citation.file_id)
-            citations.append(f"[{index}] {cited_file.filename}")
+File name: {filename}
+Structure: {json.dumps(extraction.stats, default=str)}
+Content{note}:
+{content}""",
+        500)
 
-    response = message_content.value
-    response += "\n".join(citations)
-    return response
+
+def analyze_extracted_file(request, extraction, filename, on_text=None):
+    """ Analyzing the content of a locally extracted text-like file with a single chat completion. The structural
+    stats are sent along with a sample of the content that fits the token budget. When the content doesn't fit, the
+    chunks are first summarized concurrently and the summaries are sent instead (map-reduce). """
+    if extraction.chunks:
+        with ThreadPoolExecutor(max_workers=min(4, len(extraction.chunks)), thread_name_prefix='summarize') as executor:
+            summarize = with_current_lane(lambda chunk: complete_request(chunk_request(chunk, filename)))
+            summaries = list(executor.map(summarize, extraction.chunks))
+        content = join_summaries(summaries, SUMMARY_FORMAT)
+    else:
+        content = extraction.sample
+    return complete_request(extracted_file_request(request, extraction, filename, content), on_text)
+
+
+def complete_request(request, on_text=None):
+    with first_call('openai.chat.completions'):
+        return create_completion(on_text, **request)
+
+
+def create_completion(on_text=None, **request):
+    """ Runs a chat completion and returns its text. With `on_text` the response is streamed and `on_text` is
+    called with the text so far as it comes in. Only opening the stream is retried, a stream broken midway fails the
+    analysis. The requests wait for their turn in the OpenAI budget, if any (see openaiLimits.py). """
+    limiter = get_openai_limiter()
+    if on_text is None:
+        response = limiter.call('openai.chat.completions', openai_client().chat.completions.create,
+                                estimate_tokens(request), **request)
+        return str(response.choices[0].message.content)
+    stream = limiter.call('openai.chat.completions', openai_client().chat.completions.create,
+                          estimate_tokens(request), stream=True, **request)
+    parts = list()
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            on_text(''.join(parts))
+    return ''.join(parts)
+
+
+def get_assistant():
+    """ Returns the OpenAI assistant used to analyze files. It is created once, with a hash of its configuration in
+    its metadata, and then found again by that hash by new Lambda instances. It is reused across warm invocations. """
+    global _assistant
+    open_ai = openai_client()
+    with _assistant_lock:
+        if _assistant is not None:
+            return _assistant
+        config = {'name': ASSISTANT_NAME, 'instructions': ASSISTANT_INSTRUCTIONS, 'model': ANALYSIS_MODEL,
+                  'tools': [{"type": "file_search"}]}
+        config_hash = hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+        for assistant in open_ai.beta.assistants.list(limit=100):
+            if assistant.name == ASSISTANT_NAME and (assistant.metadata or {}).get('config_hash') == config_hash:
+                _assistant = assistant
+                break
+        else:
+            logger.info(f"Creating the OpenAI assistant {ASSISTANT_NAME} (config_hash = {config_hash})")
+            _assistant = open_ai.beta.assistants.create(**config, metadata={'config_hash': config_hash})
+        return _assistant
+
+
+def analyze_file(request, raw_file, filename, size=None):
+    """  Analyzing the content of text-like files using OpenAI. The uploaded file, the thread and its vector store
+    only serve this one request, they are deleted afterwards. The run is estimated from the `size` of the file. """
+    assistant = get_assistant()
+    open_ai = openai_client()
+
+    # Upload the user provided file to OpenAI, a retry has to start over so a stream that can't be rewound isn't retried
+    seekable = hasattr(raw_file, 'seekable') and raw_file.seekable()
+
+    def upload_file():
+        if seekable:
+            raw_file.seek(0)
+        return open_ai.files.create(file=(filename, raw_file), purpose="assistants")
+    message_file = call_with_retries('openai.files.create', upload_file, max_attempts=None if seekable else 1)
+    thread = None
+    try:
+        # Create a thread and attach the file to the message
+        thread = call_with_retries(
+            'openai.threads.create', open_ai.beta.threads.create,
+            messages=[
+                {
+                    "role": "user",
+                    "content": request,
+                    # Attach the new file to the message.
+                    "attachments": [
+                        {"file_id": message_file.id, "tools": [{"type": "file_search"}]}
+                    ],
+                }
+            ]
+        )
+
+        # The thread now has a vector store with that file in its tool resources.
+        logger.debug(thread.tool_resources.file_search)
+
+        # Use the create and poll SDK helper to create a run and poll the status of
+        # the run until it's in a terminal state.
+        run = get_openai_limiter().call(
+            'openai.threads.runs', run_assistant, estimate_run_tokens(size),
+            thread_id=thread.id, assistant_id=assistant.id
+        )
+
+        messages = list(call_with_retries('openai.threads.messages', open_ai.beta.threads.messages.list,
+                                          thread_id=thread.id, run_id=run.id))
+
+        message_content = messages[0].content[0].text
+        annotations = message_content.annotations
+        citations = []
+        for index, annotation in enumerate(annotations):
+            message_content.value = message_content.value.replace(annotation.text, f"[{index}]")
+            if file_citation := getattr(annotation, "file_citation", None):
+                # the only file in the thread is the one we uploaded, no need to look it up
+                if file_citation.file_id == message_file.id:
+                    citations.append(f"[{index}] {filename}")
+                else:
+                    cited_file = open_ai.files.retrieve(file_citation.file_id)
+                    citations.append(f"[{index}] {cited_file.filename}")
+
+        response = message_content.value
+        response += "\n".join(citations)
+        return response
+    finally:
+        cleanup_openai_objects(message_file, thread)
+
+
+def run_assistant(thread_id, assistant_id):
+    """ Runs the assistant on the thread until the run is in a terminal state. A run that failed on the rate limits
+    raises a 429, with the delay its error asks for, so the OpenAI rate limiter queues it again. Any other run that
+    didn't complete raises its error. """
+    run = openai_client().beta.threads.runs.create_and_poll(thread_id=thread_id, assistant_id=assistant_id)
+    error = getattr(run, 'last_error', None)
+    if run.status == 'failed' and getattr(error, 'code', None) == 'rate_limit_exceeded':
+        retry_after = message_retry_after(error.message)
+        raise HttpStatusError(429, f"The assistant run {run.id} was rate limited: {error.message}",
+                              {} if retry_after is None else {'Retry-After': str(retry_after)})
+    if run.status != 'completed':
+        raise Exception(f"The assistant run {run.id} ended {run.status}" +
+                        (f": {error.code} {error.message}" if error else '.'))
+    return run
+
+
+def cleanup_openai_objects(message_file, thread):
+    """ Deletes the OpenAI objects created for a single file analysis. A failure is only logged, it must not fail
+    the analysis. """
+    open_ai = openai_client()
+    try:
+        if thread is not None:
+            file_search = thread.tool_resources.file_search if thread.tool_resources else None
+            for vector_store_id in (file_search.vector_store_ids if file_search else None) or []:
+                open_ai.beta.vector_stores.delete(vector_store_id)
+            open_ai.beta.threads.delete(thread.id)
+        open_ai.files.delete(message_file.id)
+    except Exception as e:
+        logger.warning(f"Could not clean up the OpenAI objects of file {message_file.id}: {e}")
 
 
 def upload_metadata_to_s3(metadata):
     """ Uploads metadata json to a folder, meta, in the S3 bucket. This metadata has the file key and
     can be queried via Athena. """
-    logger.debug(f"fileSlacker.upload_metadata_to_s3 -- metadata: {json.dumps(metadata)}")
+    from botocore.exceptions import ClientError
+    from botocore.exceptions import NoCredentialsError
+    logger.debug("fileSlacker.upload_metadata_to_s3 -- metadata: %s", lazy_json(metadata))
     try:
         metadata_json = json.dumps(metadata)
-        metadata_s3_key = f"{S3_METADATA_FOLDER}/{metadata['s3_key']}-metadata.json"
-        # last chance check to see if metadata already exists - TODO: fix the architecture instead!
-        if not checkForExistingMetadataInS3(metadata_s3_key):
-            response = s3.put_object(
-                Body=metadata_json,
-                Bucket=S3_FILE_BUCKET,
-                Key=metadata_s3_key,
-                ContentType='application/json'
-            )
+        key = get_metadata_s3_key(metadata)
+        response = s3_client().put_object(
+            Body=metadata_json,
+            Bucket=S3_FILE_BUCKET,
+            Key=key,
+            ContentType='application/json'
+        )
     except NoCredentialsError as e:
         logging.error(f"Credentials not available\n{e}")
         raise
     except ClientError as e:
-        logging.error(f"A Client Error occurred with saving the `{metadata['filename']}` metadata to S3\n{e}")
+        logging.error(f"A Client Error occurred with saving the `{metadata['name']}` metadata to S3\n{e}")
         raise
     except Exception as e:
-        logging.error(f"An Error occurred with saving the `{metadata['filename']}` metadata to S3\n{e}")
+        logging.error(f"An Error occurred with saving the `{metadata['name']}` metadata to S3\n{e}")
+        raise
+    if METADATA_QUERIES_ENABLED:
+        # the local metadata index of this instance answers for the new file right away
+        try:
+            get_metadata_index().add([metadata], [(key, response.get('ETag'))])
+        except Exception as e:
+            logger.warning(f"Could not add the `{metadata['name']}` metadata to the local index: {e}")
+
+
+def get_metadata_s3_key(metadata):
+    """ The metadata is partitioned Hive-style by creation date and filetype (see metadataLayout.py) so Athena
+    queries can skip the partitions they don't need. """
+    return metadata_s3_key(S3_METADATA_FOLDER, metadata)
+
+
+def upload_event_manifest_to_s3(slack_metadata_records, results, reply_ts=None):
+    """ Uploads the manifest of a Slack message with several files to the events folder of the S3 bucket. This
+    triggers the single fileStatsSlacker reply for all the files of the message, which updates the progress message
+    `reply_ts` when there is one. It is kept out of the meta folder so it isn't part of the Athena metadata table. """
+    from botocore.exceptions import ClientError
+    first = slack_metadata_records[0]
+    manifest = {
+        'slack_event_id': first['slack_event_id'],
+        'slack_orig_channel': first['slack_orig_channel'],
+        'slack_orig_ts': first['slack_orig_ts'],
+        'files': [
+            {
+                'name': md['name'],
+                'metadata_key': get_metadata_s3_key(md),
+                'status': results[md['id']]
+            } for md in slack_metadata_records]
+    }
+    if reply_ts:
+        manifest['slack_reply_ts'] = reply_ts
+    try:
+        s3_client().put_object(
+            Body=json.dumps(manifest),
+            Bucket=S3_FILE_BUCKET,
+            Key=f"{S3_EVENTS_FOLDER}/{first['slack_event_id']}-event.json",
+            ContentType='application/json'
+        )
+    except ClientError as e:
+        logging.error(f"A Client Error occurred with saving the event manifest of {first['slack_event_id']} to S3\n{e}")
         raise
 
 
 def build_slack_metadata(event):
-    """ Builds the metadata json to be stored in the meta folder of the s3 bucket. """
+    """ Builds the metadata json to be stored in the meta folder of the s3 bucket. There is one metadata record
+    per file attached to the Slack message. Numeric fields are stored as JSON numbers so Athena doesn't cast them. """
     slack_json = event['body']
-    logger.debug(f"SLACK JSON:\n{slack_json}")
+    logger.debug("SLACK JSON:\n%s", slack_json)
     slack_event = json.loads(slack_json)
-    slack_event_file = slack_event['event']['files'][0]
-    s3_key = f"{slack_event_file['id']}-{slack_event_file['name']}"
-    file_extension = mimetypes.guess_extension(slack_event_file['mimetype'])
-    if file_extension is None:
-        file_extension = mimetypes.guess_extension(slack_event_file['filetype'])
-    if file_extension is None:
-        file_extension = mimetypes.guess_extension(slack_event_file['name'])
-    md = {
-        'id': f'{slack_event_file['id']}',
-        'created': f'{slack_event_file['created']}',
-        'timestamp': f'{slack_event_file['timestamp']}',
-        'name': f'{slack_event_file['name']}',
-        'mimetype': f'{slack_event_file['mimetype']}',
-        'filetype': f'{slack_event_file['filetype']}',
-        'file_extension': f'{file_extension}',
-        'user': f'{slack_event_file['user']}',
-        'user_team': f'{slack_event_file['user_team']}',
-        'size': f'{slack_event_file['size']}',
-        'url_private': f'{slack_event_file['url_private']}',
-        'user_text': '',
-        's3_key': f'{s3_key}',
-        'slack_orig_channel': f'{slack_event['event']['channel']}',
-        'slack_orig_ts': f'{slack_event['event']['ts']}',
-        'ai_analysis': '_TODO_'
-    }
+    slack_event_files = slack_event['event']['files']
+    user_text = get_user_text(slack_event)
+    records = list()
+    for index, slack_event_file in enumerate(slack_event_files):
+        s3_key = f"{slack_event_file['id']}-{slack_event_file['name']}"
+        file_extension = mimetypes.guess_extension(slack_event_file['mimetype'])
+        if file_extension is None:
+            file_extension = mimetypes.guess_extension(slack_event_file['filetype'])
+        if file_extension is None:
+            file_extension = mimetypes.guess_extension(slack_event_file['name'])
+        md = {
+            'id': f'{slack_event_file['id']}',
+            'created': int(slack_event_file['created']),
+            'timestamp': int(slack_event_file['timestamp']),
+            'name': f'{slack_event_file['name']}',
+            'mimetype': f'{slack_event_file['mimetype']}',
+            'filetype': f'{slack_event_file['filetype']}',
+            'file_extension': f'{file_extension}',
+            'user': f'{slack_event_file['user']}',
+            'user_team': f'{slack_event_file['user_team']}',
+            'size': int(slack_event_file['size']),
+            'url_private': f'{slack_event_file['url_private']}',
+            'user_text': f'{user_text}',
+            's3_key': f'{s3_key}',
+            'slack_orig_channel': f'{slack_event['event']['channel']}',
+            'slack_orig_ts': f'{slack_event['event']['ts']}',
+            'slack_event_id': f'{slack_event.get('event_id', slack_event_files[0]['id'])}',
+            'event_file_index': index,
+            'event_file_count': len(slack_event_files),
+            'ai_analysis': '_TODO_'
+        }
+        logger.debug("METADATA JSON:\n%s", lazy_json(md, indent=4))
+        records.append(md)
+    return records
+
+
+def get_user_text(slack_event):
+    """ Finds the first text entered by the user in the Slack message referencing fileSlackerBot. """
     try:
         blocks = slack_event['event']['blocks']
         for b in blocks:
@@ -293,25 +1052,24 @@ def build_slack_metadata(event):
                     if e1['type'] == 'rich_text_section':
                         for e2 in e1['elements']:
                             if e2['type'] == 'text':
-                                md.update({'user_text': f'{e2['text']}'})
-                                break
+                                return e2['text']
                         break
                 break
-    except KeyError:
-        logger.warning("No additional text was found from the user. Nothing may have been entered.", e)
-    logger.debug(f'METADATA JSON:\nf{json.dumps(md, indent=4)}')
-    return md
+    except KeyError as e:
+        logger.warning(f"No additional text was found from the user. Nothing may have been entered. {e}")
+    return ''
 
 
 def generate_presigned_url(bucket, key):
     """ Create a temporary public-accessible URL for easy access by OpenAi. The ExpiresIn attribute is
     in seconds. """
+    from botocore.exceptions import ClientError
     try:
-        url = s3.generate_presigned_url(ClientMethod='get_object',
-                                        Params={'Bucket': bucket,
-                                                'Key': key},
-                                        ExpiresIn=300
-                                        )
+        url = s3_client().generate_presigned_url(ClientMethod='get_object',
+                                                 Params={'Bucket': bucket,
+                                                         'Key': key},
+                                                 ExpiresIn=300
+                                                 )
         logger.debug("Got presigned URL: %s", url)
     except ClientError as e:
         logger.error(e)
@@ -1,12 +1,50 @@
 import json
-import boto3
-from botocore.exceptions import NoCredentialsError
-from botocore.exceptions import ClientError
 import logging
 import os
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
-import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from urllib.parse import quote
+from urllib.parse import unquote_plus
+from athenaQueries import AthenaQueryExecutor
+from deferredAnalysis import COMPLETED
+from deferredAnalysis import FAILED
+from lazyClients import athena_client
+from lazyClients import log_startup_profile
+from lazyClients import memoized_client
+from lazyClients import s3_client
+from lazyClients import slack_client
+from metadataLayout import compact_partition
+from metadataLayout import is_metadata_key
+from metadataLayout import list_partitions
+from metadataLayout import migrate_legacy_metadata
+from replyCoalescing import REPLY_COALESCING_ENABLED
+from replyCoalescing import ReplyBuffer
+from replyCoalescing import coalesce_replies
+from replyCoalescing import get_reply_buffer
+from replyCoalescing import group_key
+from replyRendering import FileReport
+from replyRendering import cached_fragment
+from replyRendering import compose_reply
+from replyRendering import render_stats_blocks
+from replyRendering import rows_version
+from replyRendering import section
+from replyRendering import stats_from_athena_rows
+from replyRendering import stats_from_snapshot
+from statsSnapshot import load_snapshot
+from statsSnapshot import save_snapshot
+from statsSnapshot import snapshot_from_reconciliation_rows
+from statsSnapshot import update_snapshot
+from tracing import lazy_json
+from tracing import span
+from tracing import start_trace
+from tracing import with_current_trace
+from transport import KeyedRateLimiter
+from transport import call_with_retries
+from transport import log_endpoint_stats
 
 # set env var DEBUG_LOGGING_ENABLED to true or false
 logger = logging.getLogger(__name__)
@@ -14,60 +52,440 @@ logger.setLevel(logging.INFO)
 # Set the following environment variables for the slack WebClient
 # SLACK_BOT_TOKEN
 # SLACK_SIGNING_SECRET
-slack = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"))
-region = 'us-east-2'
 # set AWS policies to allow this Lambda to access S3 and Athena
-s3 = boto3.client('s3', region)
-athena = boto3.client('athena', region)
+# the Slack, S3 and Athena clients (and their imports) are created on first use, see lazyClients.py
+S3_FILE_BUCKET = 'file-slacker-bucket'
+S3_METADATA_FOLDER = 'meta'
+S3_EVENTS_FOLDER = 'events'
+# set env var STATS_SNAPSHOT_ENABLED to false to compute the stats with Athena queries for every reply
+STATS_SNAPSHOT_ENABLED = os.environ.get('STATS_SNAPSHOT_ENABLED', 'true').lower() == 'true'
+
+ATHENA_DATABASE = 'file_slacker_db'
+ATHENA_OUTPUT_LOCATION = 's3://file-slacker-athena-query-result-bucket'
+# Athena results are reused for ATHENA_CACHE_TTL_SECONDS within a Lambda instance (and by Athena itself for a minute)
+ATHENA_CACHE_TTL_SECONDS = int(os.environ.get('ATHENA_CACHE_TTL_SECONDS', '60'))
+ATHENA_DEADLINE_SECONDS = int(os.environ.get('ATHENA_DEADLINE_SECONDS', '30'))
+# The metadata table is partitioned by day (see athena/metadata_table.sql), set env var ATHENA_STATS_WINDOW_DAYS to
+# only report on, and only scan, the files of the last N days. 0 reports on all the files.
+ATHENA_STATS_WINDOW_DAYS = int(os.environ.get('ATHENA_STATS_WINDOW_DAYS', '0'))
+# the partitions of the last COMPACTION_MIN_AGE_DAYS days are still being written to and are not compacted
+COMPACTION_MIN_AGE_DAYS = int(os.environ.get('COMPACTION_MIN_AGE_DAYS', '1'))
+# the metadata JSON of a batch of notifications are fetched STATS_BATCH_CONCURRENCY at a time
+STATS_BATCH_CONCURRENCY = int(os.environ.get('STATS_BATCH_CONCURRENCY', '16'))
+# Slack allows about one message per second per channel with short bursts, the replies of a batch are posted to
+# SLACK_POST_CONCURRENCY channels at a time
+SLACK_POST_CONCURRENCY = int(os.environ.get('SLACK_POST_CONCURRENCY', '8'))
+SLACK_CHANNEL_POSTS_PER_SECOND = float(os.environ.get('SLACK_CHANNEL_POSTS_PER_SECOND', '1'))
+SLACK_CHANNEL_POST_BURST = int(os.environ.get('SLACK_CHANNEL_POST_BURST', '3'))
+_channel_rate_limiter = KeyedRateLimiter(SLACK_CHANNEL_POSTS_PER_SECOND, SLACK_CHANNEL_POST_BURST)
+
+STATS_SUMMARY_SQL = '''SELECT
+   count(*) "total #",
+   count(distinct(user)) "# of users", 
+   count(distinct(slack_orig_channel)) "# of slack channels",
+   count(distinct(filetype)) "# of filetype",
+   round(min(size)/1000,2) "min size (kB)",
+   round(max(size)/1000,2) "max size (kB)",
+   round(avg(size)/1000,2) "avg size (kB)",
+   sum(case when nullif(user_text,'') is not null then 1 else 0 end) "# with text",
+   to_char(min(from_unixtime(created)), 'mm/dd/yyyy') "first create date",
+   to_char(max(from_unixtime(created)), 'mm/dd/yyyy') "last create date",
+   sum(size) "logical bytes",
+   sum(case when coalesce(blob_duplicate, false) then 0 else size end) "physical bytes"
+FROM "file_slacker_db"."metadata"
+{where};'''
+
+STATS_BY_FILETYPE_SQL = '''SELECT filetype,
+   count(*) "# per filetype",
+   count(distinct(user)) "# of users", 
+   count(distinct(slack_orig_channel)) "# of slack channels",
+   round(avg(size)/1000,2) "avg size (kB)",
+   sum(case when nullif(user_text,'') is not null then 1 else 0 end) "# with text",
+   to_char(min(from_unixtime(created)), 'mm/dd/yyyy') "first create date",
+   to_char(max(from_unixtime(created)), 'mm/dd/yyyy') "last create date"
+FROM "file_slacker_db"."metadata"
+{where}
+group by filetype
+order by 2 desc;'''
+
+RECONCILIATION_SQL = '''SELECT filetype,
+   count(*) "count",
+   sum(size) "size_sum",
+   sum(case when coalesce(blob_duplicate, false) then 0 else size end) "physical_size_sum",
+   min(size) "size_min",
+   max(size) "size_max",
+   min(created) "created_min",
+   max(created) "created_max",
+   sum(case when nullif(user_text,'') is not null then 1 else 0 end) "with_text",
+   array_join(array_agg(distinct(user)), ',') "users",
+   array_join(array_agg(distinct(slack_orig_channel)), ',') "channels"
+FROM "file_slacker_db"."metadata"
+{where}
+group by filetype;'''
 
 
 def lambda_handler(event, context):
-    """ This Lambda handler is triggered by changes in the fileSlackerBot S3 bucket. It is configured to only send
-    trigger events on JSON object in S3. We are only interested in the updates to the JSON objects in the `meta/`
-    directory. (Configuring a prefix of `meta/` on S3 trigger didn't seem to work, so we do a check in this method.)
-    We don't want to trigger off the file upload events or try to handle the upload of multiple files at once
-    as this would trigger multiple messages back to the Slack user."""
+    """ This Lambda handler is triggered by changes in the fileSlackerBot S3 bucket, directly or through an SQS queue
+    receiving the S3 notifications. It is configured to only send trigger events on JSON object in S3. We are only
+    interested in the updates to the JSON objects in the `meta/` directory. (Configuring a prefix of `meta/` on S3
+    trigger didn't seem to work, so we do a check in this method.) We don't want to trigger off the file upload
+    events. When several files were attached to the same Slack message fileSlacker also writes an event manifest to
+    the `events/` directory, and a single reply covering all of the files is sent for the manifest instead of one per
+    metadata JSON.
+    Every record of the batch is handled (see `process_records`). With SQS only the messages of the failed records
+    are reported back, so only they are retried. """
+    start_trace('fileStatsSlacker.lambda_handler')
+    records = list()
+    failed_records = list()
     try:
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key']
-        logger.debug(f'bucket: {bucket}')
-        logger.debug(f'key: {key}')
-
-        # trigger by s3 updates in the meta/ folder only
-        if key.startswith('meta/'):
-            logger.debug(f"fileStatsSlacker.lambda_handler -- event: {json.dumps(event)}")
-            post_message_to_slack_user(bucket, key)
+        logger.debug("fileStatsSlacker.lambda_handler -- event: %s", lazy_json(event))
+        records = notification_records(event)
+        failed_records = process_records(records)
     except Exception as e:
         logger.error(f"An exception occurred in the fileStatsSlacker.lambda_handler: {e}")
+        failed_records = records
+    finally:
+        log_endpoint_stats('fileStatsSlacker.lambda_handler')
+        log_startup_profile('fileStatsSlacker.lambda_handler')
+    message_ids = dict.fromkeys(r.message_id for r in failed_records if r.message_id is not None)
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in message_ids]}
+
+
+@dataclass(frozen=True)
+class NotificationRecord:
+    """ An S3 object notification. The message id is the SQS message it came in, None for a direct S3 trigger. """
+    bucket: str
+    key: str
+    message_id: str = None
+
+
+def notification_records(event):
+    """ The S3 object notifications of a Lambda event, sent by S3 or by an SQS queue subscribed to the bucket. The
+    keys of S3 notifications are URL encoded (e.g. the `=` of the metadata partitions). """
+    records = list()
+    for record in event.get('Records', []):
+        if 'body' in record:
+            try:
+                s3_records = json.loads(record['body']).get('Records', [])
+            except ValueError:
+                logger.warning(f"Ignoring the SQS message {record.get('messageId')}, it is not an S3 notification")
+                continue
+            message_id = record.get('messageId')
+        else:
+            s3_records, message_id = [record], None
+        for s3_record in s3_records:
+            if 's3' in s3_record:
+                records.append(NotificationRecord(s3_record['s3']['bucket']['name'],
+                                                  unquote_plus(s3_record['s3']['object']['key']), message_id))
+    return records
+
+
+def is_reply_key(key):
+    """ Replies are triggered by s3 updates in the meta/ and events/ folders only, not by the compacted metadata
+    objects. """
+    return (key.startswith(f'{S3_METADATA_FOLDER}/') and is_metadata_key(key)) or key.startswith(f'{S3_EVENTS_FOLDER}/')
+
+
+def process_records(records):
+    """ Replies to the uploads of a batch of notifications at about the cost of a single one: the metadata JSON (and
+    event manifests) of the batch are fetched concurrently, the stats snapshot is updated once per bucket with all of
+    them and the stats blocks are rendered once per bucket and shared by the replies. The replies are laid out within
+    Slack's size limits (see replyRendering.py), what doesn't fit is continued in the thread. They are then posted
+    SLACK_POST_CONCURRENCY channels at a time, within Slack's per channel rate limit. With reply coalescing the
+    replies are posted together with the others of their channel in the batch, or buffered across invocations with
+    REPLY_BUFFER_DB_PATH (see replyCoalescing.py). The records rewritten by a backfill are skipped. Returns the
+    failed records. """
+    objects = {(r.bucket, r.key) for r in records if is_reply_key(r.key)}
+    if not objects:
+        return []
+    failed = set()
+    # without a buffer shared across invocations the replies are coalesced within the batch
+    reply_buffer = (get_reply_buffer() or ReplyBuffer()) if REPLY_COALESCING_ENABLED else None
+
+    documents = fetch_documents(objects, failed)
+    # a record rewritten by a backfill (see backfill.py) or with a deferred analysis (see deferredAnalysis.py) was
+    # counted and replied to when its file was uploaded
+    backfilled = {obj for obj, document in documents.items()
+                  if document.get('backfill_run') or document.get('analysis_deferred') in (COMPLETED, FAILED)}
+    if backfilled:
+        logger.info(f"Ignoring {len(backfilled)} backfilled or deferred analysis metadata records")
+        objects -= backfilled
+        documents = {obj: document for obj, document in documents.items() if obj not in backfilled}
+    # the metadata of the files of the manifests, unless its notification is part of the batch too
+    manifest_files = {(bucket, f['metadata_key']) for (bucket, key), manifest in documents.items()
+                      if key.startswith(f'{S3_EVENTS_FOLDER}/') for f in manifest['files']
+                      if not f['status'].startswith('failed')}
+    documents.update(fetch_documents(manifest_files - documents.keys(), set()))
+
+    replies = list()
+    for bucket in {bucket for bucket, _ in objects}:
+        metadata_records = [(key, document) for (b, key), document in documents.items()
+                            if b == bucket and not key.startswith(f'{S3_EVENTS_FOLDER}/')]
+        # the metadata triggers of a manifest may not have been handled yet, the snapshot ignores the records
+        # already applied
+        snapshot = update_stats_snapshot(bucket, metadata_records)
+        bucket_replies = list()
+        for (b, key) in sorted(objects - failed):
+            if b != bucket:
+                continue
+            try:
+                if key.startswith(f'{S3_EVENTS_FOLDER}/'):
+                    bucket_replies.append(((bucket, key), event_reply(bucket, documents[(bucket, key)], documents)))
+                elif int(documents[(bucket, key)].get('event_file_count', 1)) > 1:
+                    logger.debug(f"Leaving the reply for {key} to its event manifest")
+                else:
+                    bucket_replies.append(((bucket, key), file_reply(bucket, key, documents[(bucket, key)])))
+            except Exception as e:
+                logger.error(f"An error occurred while building the reply to {key}: {e}")
+                failed.add((bucket, key))
+        if REPLY_COALESCING_ENABLED:
+            bucket_replies = buffer_replies(bucket, bucket_replies, documents, reply_buffer)
+        if not bucket_replies:
+            continue
+        try:
+            with span('render_blocks', replies=len(bucket_replies), snapshot=snapshot is not None):
+                stats_blocks = get_stats_blocks(bucket, snapshot)
+                for _, reply in bucket_replies:
+                    blocks, follow_ups = compose_reply(reply.pop('reports'), reply['blocks'] + stats_blocks)
+                    reply['blocks'] = json.dumps(blocks)
+                    reply['follow_ups'] = [json.dumps(follow_up) for follow_up in follow_ups]
+            replies.extend(bucket_replies)
+        except Exception as e:
+            logger.error(f"An error occurred while rendering the stats of the bucket {bucket}: {e}")
+            failed.update(obj for obj, _ in bucket_replies)
+
+    failed.update(post_replies(replies))
+    if REPLY_COALESCING_ENABLED:
+        batch_only = reply_buffer is not get_reply_buffer()
+        with span('coalesce_replies', batch_only=batch_only):
+            unposted = coalesce_replies(reply_buffer, flush_coalesced_replies, all_groups=batch_only)
+        if batch_only:
+            failed.update(tuple(object_id.split('/', 1)) for object_id in unposted)
+    return [r for r in records if (r.bucket, r.key) in failed]
+
+
+def buffer_replies(bucket, bucket_replies, documents, reply_buffer):
+    """ Buffers the (object, reply) pairs for coalescing in `reply_buffer`. Returns the pairs to post right away: the
+    updates of a progressive reply, which are no new message, and the replies that could not be buffered. """
+    immediate = list()
+    for (b, key), reply in bucket_replies:
+        if reply['progress_ts']:
+            immediate.append(((b, key), reply))
+            continue
+        document = documents[(b, key)]
+        metadata_records = ([documents[(b, f['metadata_key'])] for f in document['files']
+                             if not f['status'].startswith('failed')] if key.startswith(f'{S3_EVENTS_FOLDER}/')
+                            else [document])
+        buffered = {'channel': reply['channel'], 'thread_ts': reply['thread_ts'], 'blocks': reply['blocks'],
+                    'reports': [asdict(report) for report in reply['reports']],
+                    'users': sorted({md['user'] for md in metadata_records if md.get('user')})}
+        group = group_key(bucket, reply['channel'], reply['thread_ts'])
+        try:
+            reply_buffer.add(group, f"{b}/{key}", buffered)
+        except Exception as e:
+            logger.error(f"Could not buffer the reply to {key}, posting it right away: {e}")
+            immediate.append(((b, key), reply))
+    return immediate
+
+
+def coalesced_reply(bucket, buffered_replies):
+    """ The single reply to the uploads of a group of buffered replies: every file, the files that could not be
+    uploaded, then the stats once. It is posted in the thread the uploads share, or in the channel mentioning their
+    users. The threads it answers are listed in its message metadata. """
+    threads = list(dict.fromkeys(reply['thread_ts'] for reply in buffered_replies))
+    users = sorted({user for reply in buffered_replies for user in reply['users']})
+    reports = [FileReport(**report) for reply in buffered_replies for report in reply['reports']]
+    blocks = [block for reply in buffered_replies for block in reply['blocks']]
+    if len(threads) > 1:
+        mentions = ', '.join(f"<@{user}>" for user in users) or 'you'
+        blocks.insert(0, section(f"Replying to the {len(threads)} messages with files shared by {mentions}."))
+    stats_blocks = get_stats_blocks(bucket)
+    blocks, follow_ups = compose_reply(reports, blocks + stats_blocks)
+    return {
+        'channel': buffered_replies[0]['channel'],
+        'thread_ts': threads[0] if len(threads) == 1 else None,
+        'text': f"{len(reports)} files were successfully uploaded to AWS S3.",
+        'blocks': json.dumps(blocks),
+        'follow_ups': [json.dumps(follow_up) for follow_up in follow_ups],
+        'metadata': {'event_type': 'file_slacker_reply', 'event_payload': {'threads': threads}},
+    }
+
+
+def flush_coalesced_replies(group, buffered):
+    """ Posts the coalesced reply of the (object id, reply) pairs of a group. Returns whether it was posted. """
+    bucket = group.split('|')[0]
+    with span('flush_replies', replies=len(buffered)):
+        reply = coalesced_reply(bucket, [reply for _, reply in buffered])
+        return not post_replies([((bucket, buffered[0][0]), reply)])
+
+
+def fetch_documents(objects, failed):
+    """ Gets the JSON documents of the (bucket, key) objects concurrently. The objects that could not be read are
+    added to `failed`. """
+    if not objects:
+        return {}
+    documents = dict()
+    with span('get_metadata', records=len(objects)), \
+            ThreadPoolExecutor(max_workers=min(STATS_BATCH_CONCURRENCY, len(objects))) as executor:
+        futures = {executor.submit(with_current_trace(get_s3_metadata), bucket, key): (bucket, key)
+                   for bucket, key in objects}
+        for future, obj in futures.items():
+            try:
+                documents[obj] = future.result()
+            except Exception as e:
+                logger.error(f"Could not get {obj[1]} from the S3 bucket {obj[0]}: {e}")
+                failed.add(obj)
+    return documents
+
+
+def file_reply(bucket, key, metadata):
+    """ The reply to the Slack user that uploaded a file via fileSlackerBot to AWS S3. The originating Slack channel
+    and thread IDs are stored in the metadata. """
+    return {
+        'channel': metadata['slack_orig_channel'],
+        'thread_ts': metadata['slack_orig_ts'],
+        'text': f"The file {metadata['name']} was successfully uploaded to AWS S3.",
+        'reports': [get_file_report(bucket, metadata)],
+        'blocks': [],
+        'progress_ts': metadata.get('slack_reply_ts')
+    }
 
 
-def post_message_to_slack_user(bucket, key):
-    """ Posts a message to the slack user that uploaded a file via fileSlackerBot to AWS S3.
-    The originating Slack channel and thread IDs are stored in the metadata S3 folder.
-    Most of the analysis/reporting is done in the building of the Slack message blocks. """
-    logger.debug(f"fileStatsSlacker.post_message_to_slack_user -- bucket: {bucket}, key: {key}")
-    metadata = get_s3_metadata(bucket, key)
-    # ID of SLACK channel
-    channel_id = metadata['slack_orig_channel']
-    # Slack TS message thread
-    message_ts = metadata['slack_orig_ts']
+def event_reply(bucket, manifest, documents):
+    """ The single reply to the Slack user that uploaded several files in one message, the event manifest lists the
+    metadata JSON of every file. """
+    ingested = [f for f in manifest['files'] if not f['status'].startswith('failed')]
+    failed_files = [f for f in manifest['files'] if f['status'].startswith('failed')]
+    missing = [f['name'] for f in ingested if (bucket, f['metadata_key']) not in documents]
+    if missing:
+        raise Exception(f"Could not get the metadata of {', '.join(missing)}")
+    metadata_records = [documents[(bucket, f['metadata_key'])] for f in ingested]
+    return {
+        'channel': manifest['slack_orig_channel'],
+        'thread_ts': manifest['slack_orig_ts'],
+        'text': f"{len(metadata_records)} of {len(manifest['files'])} files were successfully uploaded to AWS S3.",
+        'reports': [get_file_report(bucket, metadata) for metadata in metadata_records],
+        'blocks': get_failed_files_blocks(failed_files),
+        'progress_ts': manifest.get('slack_reply_ts')
+    }
 
+
+def post_replies(replies):
+    """ Posts the (object, reply) pairs. The replies to the same channel are posted one after the other, paced by
+    the per channel rate limiter, and SLACK_POST_CONCURRENCY channels are posted to at a time. A reply failing after
+    the retries of `call_with_retries` doesn't stop the others. A reply to a message that already has a progressive
+    reply (see progressiveReply.py) updates that message instead. The follow-ups of a reply are posted in its thread
+    after it, they don't fail the reply once it was posted. Returns the objects of the failed replies. """
+    by_channel = dict()
+    for obj, reply in replies:
+        by_channel.setdefault(reply['channel'], list()).append((obj, reply))
+
+    def post_channel(channel_replies):
+        failures = list()
+        for obj, reply in channel_replies:
+            follow_ups = reply.pop('follow_ups', [])
+            progress_ts = reply.pop('progress_ts', None)
+            try:
+                _channel_rate_limiter.acquire(reply['channel'])
+                if progress_ts:
+                    result = call_with_retries('slack.chat.update', slack_client().chat_update,
+                                               channel=reply['channel'], ts=progress_ts, text=reply['text'],
+                                               blocks=reply['blocks'])
+                else:
+                    result = call_with_retries('slack.chat.postMessage', slack_client().chat_postMessage, **reply)
+                logger.debug(result)
+                # a reply posted in the channel is continued in its own thread
+                thread_ts = reply.get('thread_ts') or result['ts']
+            except Exception as e:
+                logger.error(f"A Slack API Error occurred while replying to {obj[1]}: {e}")
+                failures.append(obj)
+                continue
+            for blocks in follow_ups:
+                try:
+                    _channel_rate_limiter.acquire(reply['channel'])
+                    call_with_retries('slack.chat.postMessage', slack_client().chat_postMessage,
+                                      channel=reply['channel'], thread_ts=thread_ts,
+                                      text=f"{reply['text']} (continued)", blocks=blocks)
+                except Exception as e:
+                    logger.error(f"A Slack API Error occurred while continuing the reply to {obj[1]}: {e}")
+                    break
+        return failures
+
+    if not by_channel:
+        return []
+    with span('post_replies', replies=len(replies), channels=len(by_channel)), \
+            ThreadPoolExecutor(max_workers=min(SLACK_POST_CONCURRENCY, len(by_channel))) as executor:
+        return [obj for failures in executor.map(with_current_trace(post_channel), by_channel.values())
+                for obj in failures]
+
+
+def update_stats_snapshot(bucket, keyed_metadata_records):
+    """ Adds the new metadata records to the stats snapshot. Returns the updated snapshot, or None when the
+    snapshot is disabled or could not be updated (the reply then falls back to Athena). """
+    if not STATS_SNAPSHOT_ENABLED:
+        return None
     try:
-        result = slack.chat_postMessage(
-            channel=channel_id,
-            thread_ts=message_ts,
-            text=f"The file {metadata['name']} was successfully uploaded to AWS S3.",
-            blocks=get_slack_msg_blocks(bucket, key, metadata)
-        )
-        logger.debug(result)
-    except SlackApiError as e:
-        logger.error(f"A Slack API Error occurred: {e}")
+        with span('snapshot_update', records=len(keyed_metadata_records)):
+            return update_snapshot(s3_client(), bucket, keyed_metadata_records)
+    except Exception as e:
+        logger.error(f"An error occurred while updating the stats snapshot: {e}")
+        return None
+
+
+def flush_replies_handler(event, context):
+    """ This handler is meant to be run on a schedule (e.g. every minute) on the machine holding the reply buffer
+    (REPLY_BUFFER_DB_PATH, see replyCoalescing.py). It posts the coalesced replies of the groups that are due, the
+    ones left behind by invocations that didn't flush them. """
+    reply_buffer = get_reply_buffer()
+    if reply_buffer is None:
+        return {'unposted': 0}
+    unposted = coalesce_replies(reply_buffer, flush_coalesced_replies)
+    log_endpoint_stats('fileStatsSlacker.flush_replies_handler')
+    return {'unposted': len(unposted)}
+
+
+def reconcile_handler(event, context):
+    """ This Lambda handler is meant to be run on a schedule (e.g. a daily EventBridge rule). It rebuilds the stats
+    snapshot from all the metadata with an Athena query, correcting any drift of the incremental updates. The
+    snapshot is only replaced if it wasn't updated while the query ran, otherwise the query is run again. """
+    bucket = (event or {}).get('bucket', S3_FILE_BUCKET)
+    for attempt in range(3):
+        previous_snapshot, etag = load_snapshot(s3_client(), bucket)
+        snapshot = snapshot_from_reconciliation_rows(get_reconciliation_stats(), previous_snapshot)
+        if save_snapshot(s3_client(), bucket, snapshot, etag):
+            logger.info(f"Reconciled the stats snapshot, version {snapshot['version']}, "
+                        f"{len(snapshot['filetypes'])} filetypes")
+            return {'version': snapshot['version']}
+        logger.info(f"The stats snapshot was updated during the reconciliation, retrying ({attempt + 1})")
+    raise Exception("Could not reconcile the stats snapshot")
+
+
+def compaction_handler(event, context):
+    """ This Lambda handler is meant to be run on a schedule (e.g. a daily EventBridge rule). It rolls the small
+    metadata JSON objects of every partition older than COMPACTION_MIN_AGE_DAYS into a single gzip'd NDJSON object,
+    so Athena reads a few objects per day instead of one per upload. With `migrate_legacy` in the event the metadata
+    written to the flat `meta/` folder before the partitioned layout is moved into the partitions first. """
+    event = event or {}
+    bucket = event.get('bucket', S3_FILE_BUCKET)
+    migrated = migrate_legacy_metadata(s3_client(), bucket, S3_METADATA_FOLDER) if event.get('migrate_legacy') else 0
+    before = (datetime.now(timezone.utc) - timedelta(days=COMPACTION_MIN_AGE_DAYS)).strftime('%Y-%m-%d')
+    compacted = 0
+    for dt, filetype in list_partitions(s3_client(), bucket, S3_METADATA_FOLDER):
+        if dt < before:
+            try:
+                compacted += 1 if compact_partition(s3_client(), bucket, S3_METADATA_FOLDER, dt, filetype) else 0
+            except Exception as e:
+                logger.error(f"An error occurred while compacting the partition dt={dt}/filetype={filetype}: {e}")
+    logger.info(f"Compacted {compacted} metadata partitions, migrated {migrated} legacy metadata records")
+    return {'compacted_partitions': compacted, 'migrated_records': migrated}
 
 
 def get_s3_metadata(bucket, key):
     """ Fetches the JSON metadata for the uploaded file and converts it to a python data structure. """
+    from botocore.exceptions import ClientError
+    from botocore.exceptions import NoCredentialsError
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)
+        response = s3_client().get_object(Bucket=bucket, Key=key)
         m = response['Body'].read().decode('utf-8')
         logger.debug(m)
         return json.loads(m)
@@ -79,72 +497,59 @@ def get_s3_metadata(bucket, key):
         raise
 
 
-def get_slack_msg_blocks(bucket, key, metadata):
-    """ Generates a simple report of the fileSlackerBot files in S3. The formatting isn't the best. Slack doesn't
-    support all the markdown syntax. Tried to allow the reporting text to wrap and kept the simple tables narrow to be
-    more easily read on mobile devices. """
+def get_failed_files_blocks(failed_files):
+    """ The Slack message block listing the files of a message that could not be uploaded. """
+    if not failed_files:
+        return []
+    failed_lines = "\n".join(f"`{f['name']}`" for f in failed_files)
+    return [section(f"""These files could not be uploaded :thumbsdown:  
+{failed_lines}""")]
+
 
+def get_file_report(bucket, metadata):
+    """ The Slack message blocks describing one uploaded file, images show their thumbnail, and its description.
+    The description is split into sections by `compose_reply`. """
+    # a content-addressed upload is stored in its blob, the link downloads it under the name of the upload
+    link = generate_presigned_url(bucket, metadata.get('blob_key') or metadata['s3_key'], metadata['name'])
+    upload_block = section(f"""The file `{metadata['name']}` was successfully uploaded to AWS S3. :thumbsup:  
+This is the <{link}|S3 link> (_link is valid for 1 hour_)""")
+    if metadata.get('thumbnail_s3_key'):
+        upload_block["accessory"] = {
+            "type": "image",
+            "image_url": generate_presigned_url(bucket, metadata['thumbnail_s3_key']),
+            "alt_text": f"{metadata['name']} thumbnail"
+        }
+    return FileReport(metadata['name'], [upload_block], metadata.get('ai_analysis') or '')
+
+
+def get_stats_blocks(bucket, snapshot=None):
+    """ The Slack message blocks reporting on all the files in S3. The stats come from the stats snapshot (a single
+    S3 GET, unless the caller just updated it), Athena is only queried when there is no snapshot yet. The blocks are
+    cached per stats version. """
+    if snapshot is None and STATS_SNAPSHOT_ENABLED:
+        snapshot, _ = load_snapshot(s3_client(), bucket)
+    if snapshot is not None and snapshot['filetypes']:
+        return cached_fragment(('stats', bucket, snapshot['version'], snapshot['updated']),
+                               lambda: render_stats_blocks(stats_from_snapshot(snapshot)))
     # Execute AWS Athena queries to get resulting data structures that can be reported upon.
-    stats_summary_row_data = get_stats_summary()
-    stats_by_filetype = get_stats_by_filetype()
-    # Build a data structure for Slack message blocks
-    blocks = [
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"""The file `{metadata['name']}` was successfully uploaded to AWS S3. :thumbsup:  
-This is the <{generate_presigned_url(bucket, metadata['s3_key'])}|S3 link> (_link is valid for 1 hour_)"""
-            }
-        },
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"""*Description*  
-{metadata['ai_analysis']}"""
-            }
-        },
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": report_summary_stats(stats_summary_row_data)
-            }
-        },
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": report_count_avg_size_by_filetype(stats_by_filetype)
-            }
-        },
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": report_user_channel_count_by_filetype(stats_by_filetype)
-            }
-        },
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": report_earliest_latest_dates_by_filetype(stats_by_filetype)
-            }
-        }]
-    return json.dumps(blocks)
-
-
-def generate_presigned_url(bucket, key):
+    stats_summary_row_data, stats_by_filetype = get_stats_summary_and_by_filetype()
+    return cached_fragment(('stats', rows_version(stats_summary_row_data, stats_by_filetype)),
+                           lambda: render_stats_blocks(stats_from_athena_rows(stats_summary_row_data,
+                                                                              stats_by_filetype)))
+
+
+def generate_presigned_url(bucket, key, filename=None):
     """ Create a temporary public-accessible URL for easy verification by the Slack user. The ExpiresIn attribute is
-    in seconds. """
+    in seconds. A content-addressed blob is named after the upload with `filename`. """
+    from botocore.exceptions import ClientError
+    params = {'Bucket': bucket, 'Key': key}
+    if filename:
+        params['ResponseContentDisposition'] = f"inline; filename*=UTF-8''{quote(filename)}"
     try:
-        url = s3.generate_presigned_url(ClientMethod='get_object',
-                                        Params={'Bucket': bucket,
-                                                'Key': key},
-                                        ExpiresIn=3600
-                                        )
+        url = s3_client().generate_presigned_url(ClientMethod='get_object',
+                                                 Params=params,
+                                                 ExpiresIn=3600
+                                                 )
         logger.debug("Got presigned URL: %s", url)
     except ClientError as e:
         logger.error(e)
@@ -152,155 +557,46 @@ def generate_presigned_url(bucket, key):
     return url
 
 
-def get_stats_summary():
-    """ Executes an Athena query of general stats of all the files uploaded to the fileSlackerBot S3 bucket.
-    Returns a singe row data structure. """
-    sql = '''SELECT
-   count(*) "total #",
-   count(distinct(user)) "# of users", 
-   count(distinct(slack_orig_channel)) "# of slack channels",
-   count(distinct(filetype)) "# of filetype",
-   round(min(size)/1000,2) "min size (kB)",
-   round(max(size)/1000,2) "max size (kB)",
-   round(avg(size)/1000,2) "avg size (kB)",
-   sum(case when nullif(user_text,'') is not null then 1 else 0 end) "# with text",
-   to_char(min(from_unixtime(created)), 'mm/dd/yyyy') "first create date",
-   to_char(max(from_unixtime(created)), 'mm/dd/yyyy') "last create date"
-FROM "file_slacker_db"."metadata";'''
+def get_reconciliation_stats():
+    """ Executes an Athena query of the running counters kept in the stats snapshot, per filetype, with the distinct
+    users and channels as comma separated lists. Used to periodically rebuild the snapshot. """
+    return run_athena_query(RECONCILIATION_SQL.format(where=''), 'reconciliation stats', use_cache=False)
+
+
+def get_athena_executor():
+    """ The Athena query executor, created on first use and kept (with its result cache) across warm invocations. """
+    return memoized_client('athena_executor', lambda: AthenaQueryExecutor(
+        athena_client(), ATHENA_DATABASE, ATHENA_OUTPUT_LOCATION,
+        cache_ttl_seconds=ATHENA_CACHE_TTL_SECONDS,
+        deadline_seconds=ATHENA_DEADLINE_SECONDS))
+
+
+def get_stats_summary_and_by_filetype():
+    """ Executes the summary and by filetype Athena queries concurrently. Returns both row data structures. """
     try:
-        query_execution = athena.start_query_execution(
-            QueryString=sql,
-            QueryExecutionContext={
-                'Database': 'file_slacker_db'
-            },
-            ResultConfiguration={
-                'OutputLocation': 's3://file-slacker-athena-query-result-bucket'
-            }
-        )
-        execution_id = query_execution['QueryExecutionId']
+        where = stats_partition_filter()
+        rows = get_athena_executor().run_queries({'summary': STATS_SUMMARY_SQL.format(where=where),
+                                                  'by_filetype': STATS_BY_FILETYPE_SQL.format(where=where)})
     except Exception as e:
-        logging.error(f"An error occurred whiled executing the summary stats sql.\n{e}")
+        logging.error(f"An error occurred while executing the stats queries.\n{e}")
         raise
+    return rows['summary'], rows['by_filetype']
 
-    for i in range(1, 5):
-        try:
-            time.sleep(i)
-            query_details = athena.get_query_execution(QueryExecutionId=execution_id)
-            state = query_details['QueryExecution']['Status']['State']
-            if state == 'SUCCEEDED':
-                query_results = athena.get_query_results(QueryExecutionId=execution_id)
-                return query_results['ResultSet']['Rows']
-            elif state == 'FAILED':
-                raise Exception(
-                    f"The summary stats query failed.\n{query_details['QueryExecution']['Status']['StateChangeReason']}")
-            elif state == 'CANCELLED':
-                raise Exception(
-                    f"The summary stats query was cancelled.\n{query_details['QueryExecution']['Status']['StateChangeReason']}")
-        except Exception as e:
-            logging.error(f"An error occurred while fetching the query results for summary stats.\n{e}")
-            raise
-
-
-def report_summary_stats(row_data):
-    """ Generates some simple markdown text describing the status of all the files in the fileSlackerBot S3 bucket.
-    Uses the data structure from `get_stats_summary` """
-    data = row_data[1]['Data']
-    report_lines = list()
-    report_lines.append("*Summary of All Files*  ")
-    report_lines.append(f"\n{data[0]['VarCharValue']} files have been stored in AWS S3 from")
-    report_lines.append(f"{data[1]['VarCharValue']} different users across {data[2]['VarCharValue']}")
-    report_lines.append(f"slack channels since {data[8]['VarCharValue']}. There are")
-    report_lines.append(f"{data[3]['VarCharValue']} types of files with sizes ranging from")
-    report_lines.append(f"{data[4]['VarCharValue']} kB to {data[5]['VarCharValue']} kB with an")
-    report_lines.append(f"average size of {data[6]['VarCharValue']} kB.")
-    return " ".join(report_lines)
-
-
-def get_stats_by_filetype():
-    """ Executes an Athena query of stats per filetype of the files uploaded to the fileSlackerBot S3 bucket.
-    Returns a multiple row data structure. """
-    sql = '''SELECT filetype,
-   count(*) "# per filetype",
-   count(distinct(user)) "# of users", 
-   count(distinct(slack_orig_channel)) "# of slack channels",
-   round(avg(size)/1000,2) "avg size (kB)",
-   sum(case when nullif(user_text,'') is not null then 1 else 0 end) "# with text",
-   to_char(min(from_unixtime(created)), 'mm/dd/yyyy') "first create date",
-   to_char(max(from_unixtime(created)), 'mm/dd/yyyy') "last create date"
-FROM "file_slacker_db"."metadata"
-group by filetype
-order by 2 desc;'''
+
+def stats_partition_filter(window_days=None):
+    """ The WHERE clause restricting the stats queries to the `dt` partitions of the stats window, so Athena prunes
+    the older partitions instead of scanning them. Empty when reporting on all the files. """
+    window_days = ATHENA_STATS_WINDOW_DAYS if window_days is None else window_days
+    if not window_days:
+        return ''
+    since = (datetime.now(timezone.utc) - timedelta(days=window_days)).strftime('%Y-%m-%d')
+    return f"WHERE dt >= '{since}'"
+
+
+def run_athena_query(sql, description, use_cache=True):
+    """ Runs an Athena query and waits for its completion (see athenaQueries.py). Returns the result rows. """
     try:
-        query_execution = athena.start_query_execution(
-            QueryString=sql,
-            QueryExecutionContext={
-                'Database': 'file_slacker_db'
-            },
-            ResultConfiguration={
-                'OutputLocation': 's3://file-slacker-athena-query-result-bucket'
-            }
-        )
-        execution_id = query_execution['QueryExecutionId']
+        return get_athena_executor().run_query(sql, use_cache)
     except Exception as e:
-        logging.error(f"An error occurred whiled executing the stats by filetype sql.\n{e}")
+        logging.error(f"An error occurred while executing the {description} query.\n{e}")
         raise
-
-    for i in range(1, 5):
-        try:
-            time.sleep(i)
-            query_details = athena.get_query_execution(QueryExecutionId=execution_id)
-            state = query_details['QueryExecution']['Status']['State']
-            if state == 'SUCCEEDED':
-                query_results = athena.get_query_results(QueryExecutionId=execution_id)
-                return query_results['ResultSet']['Rows']
-            elif state == 'FAILED':
-                raise Exception(
-                    f"The stats by filetype query failed.\n{query_details['QueryExecution']['Status']['StateChangeReason']}")
-            elif state == 'CANCELLED':
-                raise Exception(
-                    f"The stats by filetype query was cancelled.\n{query_details['QueryExecution']['Status']['StateChangeReason']}")
-        except Exception as e:
-            logging.error(f"An error occurred while fetching the query results for stats by filetype.\n{e}")
-            raise
-
-
-def report_count_avg_size_by_filetype(row_data):
-    """ Generates a very simple table-like markdown report. This was made intentionally narrow to display better on
-    mobile devices.
-    Uses the data structure from `get_stats_by_filetype` """
-    report_lines = list()
-    report_lines.append("*Counts and Average Size in kB by Filetype*  \n")
-    report_lines.append("`Filetype  ` `Count     ` `Avg (kB)  `  \n")
-    for i in range(1, len(row_data)):
-        data = row_data[i]['Data']
-        report_lines.append(
-            f"`{data[0]['VarCharValue'].ljust(10)}` `{data[1]['VarCharValue'].ljust(10)}` `{data[4]['VarCharValue'].ljust(10)}`  \n")
-    return " ".join(report_lines)
-
-
-def report_user_channel_count_by_filetype(row_data):
-    """ Generates a very simple table-like markdown report. This was made intentionally narrow to display better on
-    mobile devices.
-    Uses the data structure from `get_stats_by_filetype` """
-    report_lines = list()
-    report_lines.append("*Count of Users having uploaded files and the number channels used by Filetype*  \n")
-    report_lines.append("`Filetype  ` `# Users   ` `# Channels`  \n")
-    for i in range(1, len(row_data)):
-        data = row_data[i]['Data']
-        report_lines.append(
-            f"`{data[0]['VarCharValue'].ljust(10)}` `{data[2]['VarCharValue'].ljust(10)}` `{data[3]['VarCharValue'].ljust(10)}`  \n")
-    return " ".join(report_lines)
-
-
-def report_earliest_latest_dates_by_filetype(row_data):
-    """ Generates a very simple table-like markdown report. This was made intentionally narrow to display better on
-    mobile devices.
-    Uses the data structure from `get_stats_by_filetype` """
-    report_lines = list()
-    report_lines.append("*First and Last Upload Dates by Filetype*  \n")
-    report_lines.append("`Filetype  ` `First     ` `Last      `  \n")
-    for i in range(1, len(row_data)):
-        data = row_data[i]['Data']
-        report_lines.append(
-            f"`{data[0]['VarCharValue'].ljust(10)}` `{data[6]['VarCharValue'].ljust(10)}` `{data[7]['VarCharValue'].ljust(10)}`  \n")
-    return " ".join(report_lines)
@@ -0,0 +1,190 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Ledger of the Slack events and files that fileSlacker has claimed or completed, used to ignore Slack retries.
+# set env var IDEMPOTENCY_BACKEND to `sqlite` or `dynamodb` (default `sqlite`)
+# set env var IDEMPOTENCY_DB_PATH for the `sqlite` backend (default /tmp/file-slacker-idempotency.db)
+# set env var IDEMPOTENCY_TABLE for the `dynamodb` backend. The table needs a string partition key named
+# `idempotency_key`, enable DynamoDB TTL on the `expires_at` attribute to have completed entries removed.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_IDEMPOTENCY_DB_PATH = '/tmp/file-slacker-idempotency.db'
+# a claim not completed within the lease (i.e. the Lambda died) can be claimed again
+CLAIM_LEASE_SECONDS = 900
+# how long a completed entry is remembered, Slack gives up retrying after a few minutes
+COMPLETED_TTL_SECONDS = 7 * 24 * 3600
+
+STATUS_CLAIMED = 'claimed'
+STATUS_COMPLETED = 'completed'
+
+
+class IdempotencyStore:
+    """ Atomic claim/complete/release semantics. `claim` returns an owner token when the caller now owns the key,
+    or None when the key is already claimed (and the lease has not expired) or completed (and not expired). The
+    token must be passed to `complete` or `release`, so a slow owner cannot complete a claim that was taken over.
+    Any key-value store supporting conditional writes can implement this. """
+
+    def claim(self, key, lease_seconds=CLAIM_LEASE_SECONDS):
+        raise NotImplementedError
+
+    def complete(self, key, token, ttl_seconds=COMPLETED_TTL_SECONDS):
+        raise NotImplementedError
+
+    def release(self, key, token):
+        raise NotImplementedError
+
+    def status(self, key):
+        raise NotImplementedError
+
+    def expire(self):
+        """ Removes expired entries. Stores with native expiry don't need to do anything. """
+        pass
+
+
+class SqliteIdempotencyStore(IdempotencyStore):
+    """ A local SQLite ledger. SQLite's locking makes the claim atomic across threads and processes sharing the
+    database file, which is enough for a single Lambda instance, local runs and tests. """
+
+    def __init__(self, path=DEFAULT_IDEMPOTENCY_DB_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS idempotency (
+            idempotency_key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            token TEXT NOT NULL,
+            expires_at REAL NOT NULL)''')
+
+    def claim(self, key, lease_seconds=CLAIM_LEASE_SECONDS):
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute('''INSERT INTO idempotency (idempotency_key, status, token, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (idempotency_key) DO UPDATE SET
+                    status = excluded.status, token = excluded.token, expires_at = excluded.expires_at
+                WHERE idempotency.expires_at < ?''',
+                                      (key, STATUS_CLAIMED, token, now + lease_seconds, now))
+        return token if cursor.rowcount == 1 else None
+
+    def complete(self, key, token, ttl_seconds=COMPLETED_TTL_SECONDS):
+        with self._lock:
+            cursor = self._db.execute('''UPDATE idempotency SET status = ?, expires_at = ?
+                WHERE idempotency_key = ? AND token = ?''',
+                                      (STATUS_COMPLETED, time.time() + ttl_seconds, key, token))
+        if cursor.rowcount != 1:
+            logger.warning(f"The claim on {key} was lost before it could be completed.")
+
+    def release(self, key, token):
+        with self._lock:
+            self._db.execute('DELETE FROM idempotency WHERE idempotency_key = ? AND token = ?', (key, token))
+
+    def status(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT status FROM idempotency WHERE idempotency_key = ? AND expires_at >= ?',
+                                   (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def expire(self):
+        with self._lock:
+            self._db.execute('DELETE FROM idempotency WHERE expires_at < ?', (time.time(),))
+
+
+class DynamoDbIdempotencyStore(IdempotencyStore):
+    """ A ledger in a DynamoDB table, shared by all the Lambda instances. Each operation is a single conditional
+    write. """
+
+    def __init__(self, table_name, dynamodb_client=None):
+        import boto3
+        self.table_name = table_name
+        self.dynamodb = dynamodb_client or boto3.client('dynamodb', 'us-east-2')
+
+    def claim(self, key, lease_seconds=CLAIM_LEASE_SECONDS):
+        token = uuid.uuid4().hex
+        now = int(time.time())
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table_name,
+                Item={
+                    'idempotency_key': {'S': key},
+                    'status': {'S': STATUS_CLAIMED},
+                    'token': {'S': token},
+                    'expires_at': {'N': str(now + lease_seconds)}
+                },
+                ConditionExpression='attribute_not_exists(idempotency_key) OR expires_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}})
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return None
+        return token
+
+    def complete(self, key, token, ttl_seconds=COMPLETED_TTL_SECONDS):
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={'idempotency_key': {'S': key}},
+                UpdateExpression='SET #status = :completed, expires_at = :expires_at',
+                ConditionExpression='#token = :token',
+                ExpressionAttributeNames={'#status': 'status', '#token': 'token'},
+                ExpressionAttributeValues={
+                    ':completed': {'S': STATUS_COMPLETED},
+                    ':expires_at': {'N': str(int(time.time()) + ttl_seconds)},
+                    ':token': {'S': token}
+                })
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            logger.warning(f"The claim on {key} was lost before it could be completed.")
+
+    def release(self, key, token):
+        try:
+            self.dynamodb.delete_item(
+                TableName=self.table_name,
+                Key={'idempotency_key': {'S': key}},
+                ConditionExpression='#token = :token',
+                ExpressionAttributeNames={'#token': 'token'},
+                ExpressionAttributeValues={':token': {'S': token}})
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def status(self, key):
+        response = self.dynamodb.get_item(TableName=self.table_name,
+                                          Key={'idempotency_key': {'S': key}},
+                                          ConsistentRead=True)
+        item = response.get('Item')
+        if item is None or int(item['expires_at']['N']) < time.time():
+            return None
+        return item['status']['S']
+
+
+_idempotency_store = None
+
+
+def get_idempotency_store():
+    """ Returns the idempotency store configured by the environment, created once per Lambda instance. """
+    global _idempotency_store
+    if _idempotency_store is None:
+        backend = os.environ.get('IDEMPOTENCY_BACKEND', 'sqlite').lower()
+        if backend == 'sqlite':
+            _idempotency_store = SqliteIdempotencyStore(
+                os.environ.get('IDEMPOTENCY_DB_PATH', DEFAULT_IDEMPOTENCY_DB_PATH))
+        elif backend == 'dynamodb':
+            _idempotency_store = DynamoDbIdempotencyStore(os.environ['IDEMPOTENCY_TABLE'])
+        else:
+            raise ValueError(f"Unknown IDEMPOTENCY_BACKEND: {backend}")
+    return _idempotency_store
+
+
+def set_idempotency_store(idempotency_store):
+    """ Overrides the configured idempotency store. """
+    global _idempotency_store
+    _idempotency_store = idempotency_store
+
+
+def event_key(slack_event_id):
+    return f"event:{slack_event_id}"
+
+
+def file_key(slack_file_id):
+    return f"file:{slack_file_id}"
@@ -0,0 +1,115 @@
+import logging
+from dataclasses import dataclass
+from io import BytesIO
+
+from lazyClients import lazy_import
+
+# Image pre-processing before the OpenAI image analysis: decode once, auto-orient, downsize and re-encode to a
+# compact JPEG or WebP, plus a thumbnail for the Slack reply. Needs `pillow`, HEIC/HEIF support needs `pillow-heif`.
+# Pillow is only imported with the first image, it isn't needed on most invocations.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+Image = None
+ImageOps = None
+
+# OpenAI scales "low" detail images to 512x512, anything larger is wasted
+LOW_DETAIL_MAX_EDGE = 512
+EXIF_ORIENTATION_TAG = 0x0112
+FORMAT_MIMETYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+class ImagePrepError(Exception):
+    """ The image could not be decoded, the caller should fall back to the original upload. """
+    pass
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mimetype: str
+    extension: str
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    detail: str
+    thumbnail: bytes = None
+
+
+def prepare_image(fileobj, max_edge=1536, image_format='JPEG', quality=80, thumbnail_edge=256,
+                  low_detail_max_edge=LOW_DETAIL_MAX_EDGE):
+    """ Decodes the image, applies its EXIF orientation and downsizes it to fit `max_edge` before re-encoding it.
+    JPEG sources are decoded straight at a reduced scale (`draft`) which is much faster than a full decode. The
+    OpenAI detail level is "low" when the result fits `low_detail_max_edge`, "high" otherwise. """
+    if not _load_pillow():
+        raise ImagePrepError("pillow is not installed")
+    try:
+        with Image.open(fileobj) as image:
+            original_width, original_height = image.size
+            # orientations 5 to 8 are rotated by 90 degrees, the displayed width and height are swapped
+            if image.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+                original_width, original_height = original_height, original_width
+            # only take the first frame of animations and multi-page images
+            image.seek(0)
+            image.draft('RGB', (max_edge, max_edge))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'L'):
+                image = _flatten(image)
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            data = _encode(image, image_format, quality)
+            thumbnail = None
+            if thumbnail_edge:
+                small = image.copy()
+                small.thumbnail((thumbnail_edge, thumbnail_edge), Image.Resampling.BILINEAR)
+                thumbnail = _encode(small, image_format, quality)
+            width, height = image.size
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImagePrepError(f"The image could not be decoded: {e}") from e
+    return PreparedImage(
+        data=data,
+        mimetype=FORMAT_MIMETYPES[image_format],
+        extension=FORMAT_EXTENSIONS[image_format],
+        width=width,
+        height=height,
+        original_width=original_width,
+        original_height=original_height,
+        detail='low' if max(width, height) <= low_detail_max_edge else 'high',
+        thumbnail=thumbnail)
+
+
+def _load_pillow():
+    """ Imports Pillow, and registers the HEIF opener when `pillow-heif` is installed. Returns False without Pillow. """
+    global Image, ImageOps
+    if Image is None:
+        try:
+            image_ops = lazy_import('PIL.ImageOps')
+        except ImportError:
+            return False
+        try:
+            lazy_import('pillow_heif').register_heif_opener()
+        except ImportError:
+            pass
+        ImageOps = image_ops
+        Image = lazy_import('PIL.Image')
+    return True
+
+
+def _flatten(image):
+    """ Converts palette, CMYK, 16 bit, ... images to RGB, transparent pixels become white. """
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _encode(image, image_format, quality):
+    buffer = BytesIO()
+    if image_format == 'JPEG':
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, image_format, quality=quality, method=4)
+    return buffer.getvalue()
@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+# Queue used between the fast-ack fileSlacker.lambda_handler and the fileSlacker.worker_handler.
+# set env var JOB_QUEUE_BACKEND to one of `memory`, `local` or `sqs` (default `local`)
+# set env var JOB_QUEUE_DIR for the `local` backend (default /tmp/file-slacker-jobs)
+# set env var JOB_QUEUE_URL for the `sqs` backend
+# the heavy files (see admission.py) get a queue of their own, drained by workers with their own concurrency, when
+# JOB_QUEUE_DIR_HEAVY (`local`) or JOB_QUEUE_URL_HEAVY (`sqs`) is set, otherwise they share the queue
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_JOB_QUEUE_DIR = '/tmp/file-slacker-jobs'
+
+
+@dataclass
+class QueuedJob:
+    """ A job taken off a queue. The receipt is backend specific and is used to acknowledge or release the job. """
+    receipt: str
+    job: dict
+
+
+def build_job(metadata_records, tier=None):
+    """ Builds the compact job record that is put on the queue by the acknowledging handler. Only the Slack
+    metadata of each attached file is needed by the worker to fetch, upload and analyze the files. """
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'enqueued': time.time(),
+        'files': metadata_records
+    }
+    if tier:
+        job['tier'] = tier
+    return job
+
+
+def build_command_job(command):
+    """ The job answering the metadata query of a mention without a file (see metadataQueries.py). """
+    return {
+        'job_id': uuid.uuid4().hex,
+        'enqueued': time.time(),
+        'command': command
+    }
+
+
+class JobQueue:
+    """ The queue abstraction used by fileSlacker. Jobs taken with `get` are invisible to other consumers until
+    they are acknowledged (`ack`, removes the job) or released (`release`, the job is retried). """
+
+    def put(self, job):
+        raise NotImplementedError
+
+    def get(self, max_jobs=1, wait_seconds=0):
+        raise NotImplementedError
+
+    def ack(self, queued_job):
+        raise NotImplementedError
+
+    def release(self, queued_job):
+        raise NotImplementedError
+
+
+class InProcessJobQueue(JobQueue):
+    """ A queue living in the memory of the current process. Useful for running the whole ingest pipeline, and load
+    testing it, within a single python process. """
+
+    def __init__(self):
+        self._pending = queue.Queue()
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        self._pending.put(job)
+        return job['job_id']
+
+    def get(self, max_jobs=1, wait_seconds=0):
+        jobs = list()
+        while len(jobs) < max_jobs:
+            try:
+                # only block for the first job, then take whatever else is immediately available
+                job = self._pending.get(block=wait_seconds > 0 and not jobs, timeout=wait_seconds or None)
+            except queue.Empty:
+                break
+            receipt = uuid.uuid4().hex
+            with self._lock:
+                self._in_flight[receipt] = job
+            jobs.append(QueuedJob(receipt, job))
+        return jobs
+
+    def ack(self, queued_job):
+        with self._lock:
+            self._in_flight.pop(queued_job.receipt, None)
+
+    def release(self, queued_job):
+        with self._lock:
+            job = self._in_flight.pop(queued_job.receipt, None)
+        if job is not None:
+            self._pending.put(job)
+
+    def __len__(self):
+        return self._pending.qsize()
+
+
+class LocalFileJobQueue(JobQueue):
+    """ A queue backed by a local directory, one JSON file per job. Jobs are claimed by an atomic rename from the
+    `pending` to the `in_flight` directory, so several worker processes can safely drain the same directory. """
+
+    def __init__(self, directory=DEFAULT_JOB_QUEUE_DIR, visibility_timeout=900):
+        self.pending_dir = os.path.join(directory, 'pending')
+        self.in_flight_dir = os.path.join(directory, 'in_flight')
+        self.visibility_timeout = visibility_timeout
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.in_flight_dir, exist_ok=True)
+
+    def put(self, job):
+        # time ordered file names give a FIFO-ish ordering when listing the directory
+        name = f"{time.time_ns():020d}-{job['job_id']}.json"
+        tmp_path = os.path.join(self.pending_dir, f".{name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp_path, os.path.join(self.pending_dir, name))
+        return job['job_id']
+
+    def get(self, max_jobs=1, wait_seconds=0):
+        deadline = time.monotonic() + wait_seconds
+        self.requeue_expired()
+        while True:
+            jobs = self._claim(max_jobs)
+            if jobs or time.monotonic() >= deadline:
+                return jobs
+            time.sleep(0.1)
+
+    def _claim(self, max_jobs):
+        jobs = list()
+        for name in sorted(os.listdir(self.pending_dir)):
+            if len(jobs) >= max_jobs:
+                break
+            if not name.endswith('.json'):
+                continue
+            in_flight_path = os.path.join(self.in_flight_dir, name)
+            try:
+                os.rename(os.path.join(self.pending_dir, name), in_flight_path)
+            except FileNotFoundError:
+                # another worker claimed this job first
+                continue
+            # the modification time marks when the job was claimed, used for the visibility timeout
+            os.utime(in_flight_path)
+            with open(in_flight_path) as f:
+                jobs.append(QueuedJob(name, json.load(f)))
+        return jobs
+
+    def ack(self, queued_job):
+        try:
+            os.remove(os.path.join(self.in_flight_dir, queued_job.receipt))
+        except FileNotFoundError:
+            logger.warning(f"Job {queued_job.receipt} was already acknowledged or requeued.")
+
+    def release(self, queued_job):
+        try:
+            os.rename(os.path.join(self.in_flight_dir, queued_job.receipt),
+                      os.path.join(self.pending_dir, queued_job.receipt))
+        except FileNotFoundError:
+            logger.warning(f"Job {queued_job.receipt} was already acknowledged or requeued.")
+
+    def requeue_expired(self):
+        """ Moves jobs claimed by a worker that died (or is too slow) back to pending. """
+        expired_before = time.time() - self.visibility_timeout
+        for name in os.listdir(self.in_flight_dir):
+            path = os.path.join(self.in_flight_dir, name)
+            try:
+                if os.path.getmtime(path) < expired_before:
+                    logger.warning(f"Requeueing expired job {name}")
+                    os.rename(path, os.path.join(self.pending_dir, name))
+            except FileNotFoundError:
+                continue
+
+    def __len__(self):
+        return len([n for n in os.listdir(self.pending_dir) if n.endswith('.json')])
+
+
+class SqsJobQueue(JobQueue):
+    """ A queue backed by AWS SQS. When the worker Lambda is triggered by SQS directly the records are passed to
+    `fileSlacker.worker_handler` and this class is only used to send jobs. """
+
+    def __init__(self, queue_url, sqs_client=None):
+        import boto3
+        self.queue_url = queue_url
+        self.sqs = sqs_client or boto3.client('sqs', 'us-east-2')
+
+    def put(self, job):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job))
+        return job['job_id']
+
+    def get(self, max_jobs=1, wait_seconds=0):
+        response = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                            MaxNumberOfMessages=min(max_jobs, 10),
+                                            WaitTimeSeconds=min(int(wait_seconds), 20))
+        return [QueuedJob(m['ReceiptHandle'], json.loads(m['Body'])) for m in response.get('Messages', [])]
+
+    def ack(self, queued_job):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=queued_job.receipt)
+
+    def release(self, queued_job):
+        self.sqs.change_message_visibility(QueueUrl=self.queue_url,
+                                           ReceiptHandle=queued_job.receipt,
+                                           VisibilityTimeout=0)
+
+
+_job_queue = None
+_tier_job_queues = dict()
+
+
+def get_job_queue(tier=None):
+    """ Returns the job queue configured by the environment, the queue of `tier` when it has one. The queue is
+    created once and reused across warm Lambda invocations. """
+    global _job_queue
+    if tier and tier in _tier_job_queues:
+        return _tier_job_queues[tier]
+    suffix = f"_{tier.upper()}" if tier else ''
+    if tier and (os.environ.get(f'JOB_QUEUE_URL{suffix}') or os.environ.get(f'JOB_QUEUE_DIR{suffix}')):
+        if os.environ.get(f'JOB_QUEUE_URL{suffix}'):
+            _tier_job_queues[tier] = SqsJobQueue(os.environ[f'JOB_QUEUE_URL{suffix}'])
+        else:
+            _tier_job_queues[tier] = LocalFileJobQueue(os.environ[f'JOB_QUEUE_DIR{suffix}'])
+        return _tier_job_queues[tier]
+    if _job_queue is None:
+        backend = os.environ.get('JOB_QUEUE_BACKEND', 'local').lower()
+        if backend == 'memory':
+            _job_queue = InProcessJobQueue()
+        elif backend == 'local':
+            _job_queue = LocalFileJobQueue(os.environ.get('JOB_QUEUE_DIR', DEFAULT_JOB_QUEUE_DIR))
+        elif backend == 'sqs':
+            _job_queue = SqsJobQueue(os.environ['JOB_QUEUE_URL'])
+        else:
+            raise ValueError(f"Unknown JOB_QUEUE_BACKEND: {backend}")
+    return _job_queue
+
+
+def set_job_queue(job_queue, tier=None):
+    """ Overrides the configured job queue (or the queue of `tier`), e.g. with an `InProcessJobQueue` when running the
+    pipeline locally. """
+    global _job_queue
+    if tier:
+        _tier_job_queues[tier] = job_queue
+    else:
+        _job_queue = job_queue
@@ -0,0 +1,153 @@
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from transport import HTTP_POOL_SIZE
+from transport import aws_config
+from transport import count_boto3_calls
+from transport import pooled_session
+
+# Lazily created, memoized clients for the AWS, OpenAI and Slack APIs. Importing boto3, openai, requests or slack_sdk
+# and building their clients takes most of a Lambda cold start, so it is only done on the code path that needs them,
+# and the clients are then reused across warm invocations. Set env var STARTUP_PROFILING_ENABLED to true to log the
+# import, client creation and first call timings of every dependency once per Lambda instance.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+REGION = 'us-east-2'
+STARTUP_PROFILING_ENABLED = os.environ.get('STARTUP_PROFILING_ENABLED', 'false').lower() == 'true'
+
+_clients = dict()
+_lock = threading.Lock()
+_profile = {'imports': dict(), 'clients': dict(), 'first_calls': dict()}
+_profile_logged = False
+_started = time.perf_counter()
+
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def lazy_import(module_name):
+    """ Imports a module on first use. The import time is recorded in the startup profile. """
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if STARTUP_PROFILING_ENABLED:
+        _profile['imports'].setdefault(module_name, _elapsed_ms(start))
+    return module
+
+
+def memoized_client(name, factory):
+    """ Returns the client `name`, created with `factory` on the first call. """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                start = time.perf_counter()
+                client = factory()
+                if STARTUP_PROFILING_ENABLED:
+                    _profile['clients'][name] = _elapsed_ms(start)
+                    _time_first_boto3_call(name, client)
+                _clients[name] = client
+    return client
+
+
+def set_client(name, client):
+    """ Replaces the client `name`, e.g. with a fake for an offline run. None resets it. """
+    with _lock:
+        if client is None:
+            _clients.pop(name, None)
+        else:
+            _clients[name] = client
+
+
+def aws_client(service):
+    """ A boto3 client with the shared connection pool and retry settings (see transport.py). """
+    return memoized_client(service, lambda: count_boto3_calls(service, lazy_import('boto3').client(
+        service, REGION, config=aws_config(lazy_import('botocore.config')))))
+
+
+def s3_client():
+    return aws_client('s3')
+
+
+def athena_client():
+    return aws_client('athena')
+
+
+def openai_client():
+    """ The OpenAI client keeps up to HTTP_POOL_SIZE connections alive. Its own retries are disabled, the calls go
+    through `transport.call_with_retries` like the Slack calls. """
+    def create():
+        openai, httpx = lazy_import('openai'), lazy_import('httpx')
+        limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+        return openai.OpenAI(max_retries=0, http_client=openai.DefaultHttpxClient(limits=limits))
+    return memoized_client('openai', create)
+
+
+def slack_client():
+    return memoized_client('slack', lambda: lazy_import('slack_sdk').WebClient(token=os.environ.get("SLACK_BOT_TOKEN")))
+
+
+def http_session():
+    """ The pooled `requests` Session used to download the Slack files, reusing its connections to files.slack.com
+    across files and warm invocations. """
+    return memoized_client('http', lambda: pooled_session(lazy_import('requests')))
+
+
+@contextmanager
+def first_call(name):
+    """ Times the enclosed call the first time it is made for `name`, e.g. the connection setup of a client. """
+    if not STARTUP_PROFILING_ENABLED or name in _profile['first_calls']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profile['first_calls'].setdefault(name, _elapsed_ms(start))
+
+
+def _time_first_boto3_call(name, client):
+    """ boto3 clients report their first API call through their event hooks, no need to wrap the call sites. """
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return
+    calls = dict()
+
+    def before_call(model, **kwargs):
+        calls.setdefault(model.name, time.perf_counter())
+
+    def after_call(model, **kwargs):
+        _profile['first_calls'].setdefault(f"{name}.{model.name}", _elapsed_ms(calls[model.name]))
+
+    events.register('before-call', before_call)
+    events.register('after-call', after_call)
+
+
+def startup_profile():
+    """ The timings recorded so far, in milliseconds. """
+    return {
+        'since_start_ms': _elapsed_ms(_started),
+        'imports': dict(_profile['imports']),
+        'clients': dict(_profile['clients']),
+        'first_calls': dict(_profile['first_calls'])
+    }
+
+
+def log_startup_profile(handler):
+    """ Logs the startup profile as a single JSON line, once per Lambda instance. """
+    global _profile_logged
+    if not STARTUP_PROFILING_ENABLED or _profile_logged:
+        return
+    _profile_logged = True
+    logger.info(json.dumps({'startup_profile': handler, **startup_profile()}))
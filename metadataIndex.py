@@ -0,0 +1,180 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from metadataLayout import read_records
+from metadataLayout import typed_metadata
+
+# Local index of the metadata records, a SQLite database kept in /tmp across warm invocations, with secondary indexes
+# on the user, channel, filetype and creation time. It answers the metadata queries of the Slack users (see
+# metadataQueries.py) in milliseconds instead of an Athena query. The index is synced incrementally from the `meta/`
+# partitions (see metadataLayout.py): only the objects it hasn't read yet are read, the partitions of the last
+# METADATA_INDEX_RELIST_DAYS days are listed again at most every METADATA_INDEX_SYNC_SECONDS and all of them every
+# METADATA_INDEX_FULL_SYNC_SECONDS (a file created days before it was shared lands in an older partition).
+# set env var METADATA_INDEX_DB_PATH for the database (default /tmp/file-slacker-metadata-index.db)
+# set env var METADATA_INDEX_DAYS to only index the partitions of the last N days (default 0, all of them), the
+# queries reaching further back are answered by Athena
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_METADATA_INDEX_DB_PATH = '/tmp/file-slacker-metadata-index.db'
+METADATA_INDEX_DAYS = int(os.environ.get('METADATA_INDEX_DAYS', '0'))
+METADATA_INDEX_SYNC_SECONDS = float(os.environ.get('METADATA_INDEX_SYNC_SECONDS', '60'))
+METADATA_INDEX_FULL_SYNC_SECONDS = float(os.environ.get('METADATA_INDEX_FULL_SYNC_SECONDS', '3600'))
+METADATA_INDEX_RELIST_DAYS = int(os.environ.get('METADATA_INDEX_RELIST_DAYS', '2'))
+# the metadata objects are read this many at a time
+SYNC_READ_CONCURRENCY = 16
+
+# the indexed fields of a record, the columns of the `files` table
+INDEX_FIELDS = ('id', 's3_key', 'name', 'user', 'slack_orig_channel', 'slack_orig_ts', 'filetype', 'mimetype', 'size',
+                'created', 'blob_duplicate')
+
+_DT_RE = re.compile(r'dt=(\d{4}-\d{2}-\d{2})/$')
+
+
+class MetadataIndex:
+    """ The index database. One row per file (by file id and S3 key, a file re-shared with the same key is indexed
+    once), the S3 objects already read and the days already listed. SQLite's locking makes it safe to share across
+    threads and processes. """
+
+    def __init__(self, path=DEFAULT_METADATA_INDEX_DB_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT NOT NULL,
+                s3_key TEXT NOT NULL,
+                name TEXT,
+                user TEXT,
+                slack_orig_channel TEXT,
+                slack_orig_ts TEXT,
+                filetype TEXT,
+                mimetype TEXT,
+                size INTEGER,
+                created INTEGER,
+                blob_duplicate INTEGER,
+                PRIMARY KEY (id, s3_key));
+            CREATE INDEX IF NOT EXISTS files_user ON files (user, created);
+            CREATE INDEX IF NOT EXISTS files_channel ON files (slack_orig_channel, created);
+            CREATE INDEX IF NOT EXISTS files_filetype ON files (filetype, created);
+            CREATE INDEX IF NOT EXISTS files_created ON files (created);
+            CREATE INDEX IF NOT EXISTS files_size ON files (size);
+            CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, etag TEXT);
+            CREATE TABLE IF NOT EXISTS days (dt TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value REAL);''')
+
+    def add(self, records, objects=()):
+        """ Indexes the metadata records (replacing the earlier version of a record), and the (key, ETag) of the S3
+        objects they were read from or written to, so the next sync doesn't read them. """
+        rows = list()
+        for record in records:
+            record = typed_metadata(dict(record))
+            rows.append(tuple(1 if record.get(f) is True else 0 if record.get(f) is False else record.get(f)
+                              for f in INDEX_FIELDS))
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany(f'''INSERT OR REPLACE INTO files ({', '.join(INDEX_FIELDS)})
+                VALUES ({', '.join('?' for _ in INDEX_FIELDS)})''', rows)
+            self._db.executemany('INSERT OR REPLACE INTO objects (key, etag) VALUES (?, ?)', objects)
+            self._db.execute('COMMIT')
+        return len(rows)
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def count(self):
+        return self.query('SELECT count(*) FROM files')[0][0]
+
+    def _get_state(self, name):
+        row = self.query('SELECT value FROM state WHERE name = ?', (name,))
+        return row[0][0] if row else None
+
+    def _set_state(self, name, value):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)', (name, value))
+
+    def covers(self, since):
+        """ Whether the index holds every record created from `since` (epoch seconds, None for all times). """
+        synced_since = self._get_state('synced_since')
+        return synced_since is not None and (synced_since == 0 or (since is not None and since >= synced_since))
+
+    def sync(self, s3, bucket, folder, days=None, force=False):
+        """ Reads the metadata objects of the indexed days it hasn't read yet. Returns the number of new records,
+        None when the index was synced less than METADATA_INDEX_SYNC_SECONDS ago. """
+        now = time.time()
+        last_sync = self._get_state('last_sync') or 0
+        if not force and now - last_sync < METADATA_INDEX_SYNC_SECONDS:
+            return None
+        days = METADATA_INDEX_DAYS if days is None else days
+        today = datetime.now(timezone.utc)
+        since_dt = (today - timedelta(days=days)).strftime('%Y-%m-%d') if days else ''
+        relist_dt = (today - timedelta(days=METADATA_INDEX_RELIST_DAYS)).strftime('%Y-%m-%d')
+        full = now - (self._get_state('last_full_sync') or 0) >= METADATA_INDEX_FULL_SYNC_SECONDS
+        listed = {row[0] for row in self.query('SELECT dt FROM days')}
+        dts = [dt for dt in self._list_days(s3, bucket, folder)
+               if dt >= since_dt and (full or dt >= relist_dt or dt not in listed)]
+
+        known = dict(self.query('SELECT key, etag FROM objects'))
+        new_objects = list()
+        paginator = s3.get_paginator('list_objects_v2')
+        for dt in dts:
+            for page in paginator.paginate(Bucket=bucket, Prefix=f"{folder}/dt={dt}/"):
+                new_objects.extend((o['Key'], o.get('ETag')) for o in page.get('Contents', [])
+                                   if o['Key'] not in known or known[o['Key']] != o.get('ETag'))
+        added = 0
+        if new_objects:
+            with ThreadPoolExecutor(max_workers=SYNC_READ_CONCURRENCY) as executor:
+                for records in executor.map(lambda obj: read_records(s3, bucket, obj[0]), new_objects):
+                    added += self.add(records)
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('INSERT OR REPLACE INTO objects (key, etag) VALUES (?, ?)', new_objects)
+            self._db.executemany('INSERT OR IGNORE INTO days (dt) VALUES (?)', [(dt,) for dt in dts])
+            self._db.execute('COMMIT')
+        self._set_state('last_sync', now)
+        if full:
+            self._set_state('last_full_sync', now)
+        synced_since = (today - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0).timestamp() \
+            if days else 0
+        self._set_state('synced_since', synced_since)
+        logger.info(f"Synced the metadata index: {len(dts)} days listed, {len(new_objects)} objects and {added} "
+                    f"records read{' (full)' if full else ''}")
+        return added
+
+    @staticmethod
+    def _list_days(s3, bucket, folder):
+        dts = list()
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{folder}/dt=", Delimiter='/'):
+            for prefix in page.get('CommonPrefixes', []):
+                match = _DT_RE.search(prefix['Prefix'])
+                if match:
+                    dts.append(match.group(1))
+        return dts
+
+
+_metadata_index = None
+_metadata_index_lock = threading.Lock()
+
+
+def get_metadata_index():
+    """ Returns the metadata index configured by the environment, created once per Lambda instance. """
+    global _metadata_index
+    with _metadata_index_lock:
+        if _metadata_index is None:
+            _metadata_index = MetadataIndex(os.environ.get('METADATA_INDEX_DB_PATH', DEFAULT_METADATA_INDEX_DB_PATH))
+        return _metadata_index
+
+
+def set_metadata_index(metadata_index):
+    """ Overrides the configured metadata index. """
+    global _metadata_index
+    _metadata_index = metadata_index
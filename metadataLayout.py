@@ -0,0 +1,264 @@
+import gzip
+import hashlib
+import json
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timezone
+
+# Layout of the metadata records in S3. Records are partitioned Hive-style by creation date and filetype:
+#     meta/dt=YYYY-MM-DD/filetype=<filetype>/<s3_key>-metadata.json
+# and a periodic compaction rolls the small JSON objects of a partition into a single gzip'd NDJSON object. See
+# athena/metadata_table.sql for the matching table with partition projection. The compaction of a partition and the
+# updates of its records (e.g. a deferred analysis completing) hold the partition's lease, an object under
+# `metadata-leases/` (outside of the table's location) created with a conditional write.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+METADATA_SUFFIX = '-metadata.json'
+COMPACTED_PREFIX = 'compacted-'
+COMPACTED_SUFFIX = '.json.gz'
+OTHER_FILETYPE = 'other'
+# the filetypes documented by Slack, the partition projection enumerates them (plus `other` for anything else)
+SLACK_FILETYPES = (
+    'auto', 'text', 'ai', 'apk', 'applescript', 'binary', 'bmp', 'boxnote', 'c', 'csharp', 'cpp', 'css', 'csv',
+    'clojure', 'coffeescript', 'cfm', 'd', 'dart', 'diff', 'doc', 'docx', 'dockerfile', 'dotx', 'email', 'eps',
+    'epub', 'erlang', 'fla', 'flv', 'fsharp', 'fortran', 'go', 'groovy', 'gdoc', 'gdraw', 'gpres', 'gsheet', 'gzip',
+    'html', 'haskell', 'haxe', 'heic', 'indd', 'java', 'javascript', 'jpg', 'json', 'keynote', 'kotlin', 'latex',
+    'lisp', 'lua', 'm4a', 'markdown', 'matlab', 'mhtml', 'mkv', 'mov', 'mp3', 'mp4', 'mpg', 'mumps', 'numbers',
+    'nzb', 'objc', 'ocaml', 'odg', 'odi', 'odp', 'ods', 'odt', 'ogg', 'ogv', 'pages', 'pascal', 'pdf', 'perl', 'php',
+    'pig', 'png', 'post', 'powershell', 'ppt', 'pptx', 'psd', 'puppet', 'python', 'qtz', 'r', 'rtf', 'ruby', 'rust',
+    'sql', 'sass', 'scala', 'scheme', 'sketch', 'shell', 'smalltalk', 'svg', 'swf', 'swift', 'tar', 'tiff', 'tsv',
+    'vb', 'vbscript', 'vcard', 'velocity', 'verilog', 'wav', 'webm', 'wmv', 'xls', 'xlsx', 'xlsb', 'xlsm', 'xltx',
+    'xml', 'yaml', 'zip')
+# attempts of a conditional rewrite of a record updated concurrently
+MAX_UPDATE_ATTEMPTS = 5
+LEASE_FOLDER = 'metadata-leases'
+# a lease left behind by a crashed holder is taken over once expired
+LEASE_SECONDS = 900
+LEASE_WAIT_SECONDS = 60
+LEASE_POLL_SECONDS = 0.5
+# fields stored as JSON numbers, older records have them as strings
+NUMERIC_FIELDS = ('created', 'timestamp', 'size', 'event_file_index', 'event_file_count', 'byte_count',
+                  'image_width', 'image_height', 'analyzed_image_bytes')
+
+_PARTITION_RE = re.compile(r'dt=(\d{4}-\d{2}-\d{2})/filetype=([^/]+)/')
+
+
+def metadata_partition(metadata):
+    """ Returns the (dt, filetype) partition values of a metadata record. """
+    dt = datetime.fromtimestamp(int(float(metadata['created'])), timezone.utc).strftime('%Y-%m-%d')
+    filetype = f"{metadata['filetype']}".lower()
+    return dt, filetype if filetype in SLACK_FILETYPES else OTHER_FILETYPE
+
+
+def partition_prefix(folder, dt, filetype):
+    return f"{folder}/dt={dt}/filetype={filetype}/"
+
+
+def metadata_s3_key(folder, metadata):
+    dt, filetype = metadata_partition(metadata)
+    return f"{partition_prefix(folder, dt, filetype)}{metadata['s3_key']}{METADATA_SUFFIX}"
+
+
+def is_metadata_key(key):
+    """ True for a single metadata record (partitioned or legacy flat), False for compacted objects. """
+    return key.endswith(METADATA_SUFFIX)
+
+
+def typed_metadata(metadata):
+    """ Converts the numeric fields of an older record stored as strings to numbers. """
+    for name in NUMERIC_FIELDS:
+        value = metadata.get(name)
+        if isinstance(value, str):
+            try:
+                metadata[name] = int(float(value))
+            except ValueError:
+                pass
+    return metadata
+
+
+def list_partitions(s3, bucket, folder):
+    """ Returns the (dt, filetype) partitions found under the metadata folder. """
+    partitions = list()
+    paginator = s3.get_paginator('list_objects_v2')
+    for dt_page in paginator.paginate(Bucket=bucket, Prefix=f"{folder}/dt=", Delimiter='/'):
+        for dt_prefix in dt_page.get('CommonPrefixes', []):
+            for page in paginator.paginate(Bucket=bucket, Prefix=dt_prefix['Prefix'], Delimiter='/'):
+                for prefix in page.get('CommonPrefixes', []):
+                    match = _PARTITION_RE.search(prefix['Prefix'])
+                    if match:
+                        partitions.append((match.group(1), match.group(2)))
+    return partitions
+
+
+def _list_keys(s3, bucket, prefix, delimiter=None):
+    keys = list()
+    paginator = s3.get_paginator('list_objects_v2')
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    for page in paginator.paginate(**kwargs):
+        keys.extend(o['Key'] for o in page.get('Contents', []))
+    return keys
+
+
+def read_records(s3, bucket, key):
+    """ The records of a metadata object: a single record, or every record of a compacted object. """
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    if key.endswith(COMPACTED_SUFFIX):
+        return [json.loads(line) for line in gzip.decompress(body).decode('utf-8').splitlines() if line.strip()]
+    return [json.loads(body.decode('utf-8'))]
+
+
+def _read_all(s3, bucket, keys):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return [r for records in executor.map(lambda k: read_records(s3, bucket, k), keys) for r in records]
+
+
+def write_compacted(s3, bucket, prefix, records):
+    """ Writes the records, deduplicated by file id and sorted, as one gzip'd NDJSON object. The name is derived
+    from the content (gzip'd without a timestamp) so a re-run after a crash overwrites instead of duplicating. """
+    unique = {record_id(r): typed_metadata(r) for r in records}
+    lines = [json.dumps(unique[k], separators=(',', ':')) for k in sorted(unique)]
+    body = gzip.compress("\n".join(lines).encode('utf-8'), mtime=0)
+    key = f"{prefix}{COMPACTED_PREFIX}{hashlib.sha256(body).hexdigest()[:16]}{COMPACTED_SUFFIX}"
+    s3.put_object(Body=body, Bucket=bucket, Key=key, ContentType='application/json', ContentEncoding='gzip')
+    return key, len(lines)
+
+
+def record_id(record):
+    """ The identity of a record, by which the compaction deduplicates them. """
+    return f"{record['id']}/{record.get('s3_key')}"
+
+
+class PartitionLeaseError(Exception):
+    """ The lease of a partition is held by someone else for longer than the wait. """
+
+
+def _take_lease(s3, bucket, key, seconds):
+    """ Creates the lease object, or takes over an expired one. Returns False when it is held. """
+    from botocore.exceptions import ClientError
+    body = json.dumps({'expires': time.time() + seconds})
+    try:
+        s3.put_object(Body=body, Bucket=bucket, Key=key, ContentType='application/json', IfNoneMatch='*')
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return False
+    if json.loads(response['Body'].read().decode('utf-8'))['expires'] > time.time():
+        return False
+    logger.warning(f"Taking over the expired lease {key}")
+    try:
+        s3.put_object(Body=body, Bucket=bucket, Key=key, ContentType='application/json', IfMatch=response['ETag'])
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+        return False
+
+
+@contextmanager
+def partition_lease(s3, bucket, prefix, seconds=LEASE_SECONDS, wait_seconds=LEASE_WAIT_SECONDS):
+    """ Holds the lease of the partition `prefix` for the block, so a compaction and the updates of its records
+    don't interleave (an update written between the reads and the deletes of a compaction would be lost, or be
+    compacted twice). Raises PartitionLeaseError after `wait_seconds` of someone else holding it. """
+    key = f"{LEASE_FOLDER}/{prefix}lease.json"
+    deadline = time.monotonic() + wait_seconds
+    while not _take_lease(s3, bucket, key, seconds):
+        if time.monotonic() > deadline:
+            raise PartitionLeaseError(f"The partition {prefix} is leased by someone else")
+        time.sleep(LEASE_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        s3.delete_object(Bucket=bucket, Key=key)
+
+
+def update_record(s3, bucket, key, identity, update):
+    """ Applies `update(record)` to the metadata record `identity` (see `record_id`) stored as the single record
+    object `key`, or once the compaction rolled it up, in a compacted object of its partition. The single record is
+    written back with a conditional write, a compacted object under the key derived from its new content (the old
+    one is deleted), both while holding the lease of the partition. Returns the updated record, None when it is
+    nowhere to be found. """
+    prefix = key.rsplit('/', 1)[0] + '/'
+    with partition_lease(s3, bucket, prefix):
+        return _update_record(s3, bucket, key, prefix, identity, update)
+
+
+def _update_record(s3, bucket, key, prefix, identity, update):
+    from botocore.exceptions import ClientError
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        try:
+            response = s3.get_object(Bucket=bucket, Key=key)
+        except s3.exceptions.NoSuchKey:
+            break
+        record = update(json.loads(response['Body'].read().decode('utf-8')))
+        try:
+            s3.put_object(Body=json.dumps(record), Bucket=bucket, Key=key, ContentType='application/json',
+                          IfMatch=response['ETag'])
+            return record
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+        logger.info(f"The metadata record {key} was updated concurrently, retrying ({attempt + 1})")
+        time.sleep(0.05 * (attempt + 1))
+    else:
+        raise Exception(f"Could not update the metadata record {key} after {MAX_UPDATE_ATTEMPTS} attempts")
+    for compacted_key in _list_keys(s3, bucket, prefix):
+        if is_metadata_key(compacted_key):
+            continue
+        records = read_records(s3, bucket, compacted_key)
+        matches = [i for i, r in enumerate(records) if record_id(r) == identity]
+        if not matches:
+            continue
+        records[matches[0]] = update(records[matches[0]])
+        new_key, _ = write_compacted(s3, bucket, prefix, records)
+        if new_key != compacted_key:
+            s3.delete_object(Bucket=bucket, Key=compacted_key)
+        return records[matches[0]]
+    logger.warning(f"The metadata record {identity} was found neither at {key} nor compacted")
+    return None
+
+
+def _delete_keys(s3, bucket, keys):
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True})
+
+
+def compact_partition(s3, bucket, folder, dt, filetype):
+    """ Rolls all the objects of a partition (single records and earlier compacted objects) into one compacted
+    object, then deletes the rolled up objects, while holding the lease of the partition. Returns the number of
+    records in the partition, or 0 when there was nothing to compact. """
+    prefix = partition_prefix(folder, dt, filetype)
+    with partition_lease(s3, bucket, prefix):
+        keys = _list_keys(s3, bucket, prefix)
+        if len(keys) < 2:
+            return 0
+        compacted_key, count = write_compacted(s3, bucket, prefix, _read_all(s3, bucket, keys))
+        _delete_keys(s3, bucket, [k for k in keys if k != compacted_key])
+    logger.info(f"Compacted {len(keys)} objects of {prefix} into {compacted_key} ({count} records)")
+    return count
+
+
+def migrate_legacy_metadata(s3, bucket, folder):
+    """ Moves the records written to the flat metadata folder, before the partitioned layout, into compacted
+    objects of their partitions. Returns the number of migrated records. """
+    keys = [k for k in _list_keys(s3, bucket, f"{folder}/", delimiter='/') if is_metadata_key(k)]
+    if not keys:
+        return 0
+    partitions = dict()
+    for record in _read_all(s3, bucket, keys):
+        partitions.setdefault(metadata_partition(record), list()).append(record)
+    for (dt, filetype), records in partitions.items():
+        write_compacted(s3, bucket, partition_prefix(folder, dt, filetype), records)
+    _delete_keys(s3, bucket, keys)
+    logger.info(f"Migrated {len(keys)} legacy metadata records into {len(partitions)} partitions")
+    return len(keys)
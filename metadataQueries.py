@@ -0,0 +1,472 @@
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from dataclasses import dataclass
+from dataclasses import replace
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from athenaQueries import AthenaQueryExecutor
+from lazyClients import athena_client
+from lazyClients import memoized_client
+from lazyClients import slack_client
+from metadataIndex import get_metadata_index
+from metadataLayout import SLACK_FILETYPES
+from replyRendering import context
+from replyRendering import section
+from replyRendering import truncate
+from tracing import span
+from transport import call_with_retries
+
+# Metadata queries asked by mentioning fileSlackerBot without a file, e.g.
+#     @fileSlackerBot largest 5 pdfs in #general last week
+#     @fileSlackerBot count files by user this month
+#     @fileSlackerBot my newest images
+# The command is parsed into a `MetadataQuery` and answered from the local metadata index (see metadataIndex.py), or
+# by Athena when the index can't answer it: a search of the AI analyses (`about "..."`) or a time range older than
+# the indexed days. `@fileSlackerBot help` lists the grammar.
+# A command answered before the Slack event is acknowledged (see `answers_inline`) waits at most
+# QUERY_INLINE_SYNC_SECONDS for the index sync, which goes on in the background when it takes longer (the first sync of
+# an instance), and the command is queued for the worker instead.
+# set env var METADATA_QUERIES_ENABLED to false to ignore the mentions without a file, as before
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+METADATA_QUERIES_ENABLED = os.environ.get('METADATA_QUERIES_ENABLED', 'true').lower() == 'true'
+QUERY_DEFAULT_LIMIT = int(os.environ.get('QUERY_DEFAULT_LIMIT', '10'))
+QUERY_MAX_LIMIT = int(os.environ.get('QUERY_MAX_LIMIT', '50'))
+# same Athena table and result location as fileStatsSlacker
+ATHENA_DATABASE = 'file_slacker_db'
+ATHENA_OUTPUT_LOCATION = 's3://file-slacker-athena-query-result-bucket'
+ATHENA_DEADLINE_SECONDS = int(os.environ.get('ATHENA_DEADLINE_SECONDS', '30'))
+QUERY_INLINE_SYNC_SECONDS = float(os.environ.get('QUERY_INLINE_SYNC_SECONDS', '1.5'))
+
+LIST = 'list'
+AGGREGATE = 'aggregate'
+HELP = 'help'
+
+# the first word of a command, any other mention without a file is ignored
+COMMAND_WORDS = {'list', 'show', 'find', 'count', 'how', 'total', 'largest', 'biggest', 'smallest', 'newest', 'latest',
+                 'recent', 'oldest', 'top', 'my', 'help'}
+ORDER_WORDS = {'largest': 'largest', 'biggest': 'largest', 'smallest': 'smallest', 'newest': 'newest',
+               'latest': 'newest', 'recent': 'newest', 'oldest': 'oldest'}
+GROUP_WORDS = {'filetype': 'filetype', 'filetypes': 'filetype', 'type': 'filetype', 'types': 'filetype',
+               'user': 'user', 'users': 'user', 'channel': 'channel', 'channels': 'channel', 'day': 'day',
+               'days': 'day'}
+MIMETYPE_WORDS = {'image': 'image/', 'images': 'image/', 'photo': 'image/', 'photos': 'image/',
+                  'picture': 'image/', 'pictures': 'image/', 'video': 'video/', 'videos': 'video/',
+                  'audio': 'audio/', 'text': 'text/'}
+FILETYPE_ALIASES = {'jpeg': 'jpg', 'spreadsheet': 'xlsx', 'spreadsheets': 'xlsx', 'excel': 'xlsx', 'word': 'docx'}
+UNITS_SECONDS = {'hour': 3600, 'hours': 3600, 'day': 86400, 'days': 86400, 'week': 7 * 86400, 'weeks': 7 * 86400,
+                 'month': 30 * 86400, 'months': 30 * 86400}
+
+HELP_TEXT = """*Ask me about the files shared with me* (mention me without a file):
+`list` / `show` files, or `count` them (`how many`, `total size`), optionally `by filetype|user|channel|day`
+filtered by filetype (`pdfs`, `csv`, `images`, `videos`), `in #channel` (or `here`), `by @user` (or `my`),
+`today`, `yesterday`, `this week`, `last week`, `this month`, `last 3 days`, `since 2024-01-31`, `before 2024-03-01`,
+`named "report"`, `about "invoices"` (searches the AI analyses, slower)
+sorted by `newest` (default), `oldest`, `largest` or `smallest`, `top 20` (at most 50)
+e.g. `@fileSlackerBot largest 5 pdfs in #general last week` or `@fileSlackerBot count files by user this month`"""
+
+# a channel mention, a user mention, a quoted string (straight or curly quotes) or a word
+_TOKEN_RE = re.compile(r'<#(C[A-Z0-9]+)(?:\|[^>]*)?>|<@([UW][A-Z0-9]+)(?:\|[^>]*)?>|"([^"]*)"|“([^”]*)”|'
+                       r'([^\s,;]+)')
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class QueryParseError(Exception):
+    """ The mention looks like a command but can't be understood, the message is shown to the user. """
+    pass
+
+
+@dataclass(frozen=True)
+class MetadataQuery:
+    """ A listing (`list`) or a count and total size (`aggregate`, optionally grouped) of the metadata records. The
+    times are epoch seconds. """
+    kind: str = LIST
+    group_by: str = None
+    filetypes: tuple = ()
+    mimetype_prefix: str = None
+    channel: str = None
+    user: str = None
+    since: int = None
+    until: int = None
+    name_contains: str = None
+    about: str = None
+    order: str = 'newest'
+    limit: int = QUERY_DEFAULT_LIMIT
+
+
+@dataclass
+class QueryResult:
+    """ The rows of a query, what answered it (`index` or `athena`) and how long it took. """
+    columns: tuple
+    rows: list
+    source: str
+    seconds: float
+
+
+def _tokens(text):
+    """ (kind, value) pairs: `channel`, `user`, `quoted` and lower case `word`. """
+    tokens = list()
+    for channel, user, quoted, curly, word in _TOKEN_RE.findall(text):
+        if channel:
+            tokens.append(('channel', channel))
+        elif user:
+            tokens.append(('user', user))
+        elif quoted or curly:
+            tokens.append(('quoted', quoted or curly))
+        elif word:
+            tokens.append(('word', word.lower().strip('.?!')))
+    return tokens
+
+
+def _filetype(word):
+    word = FILETYPE_ALIASES.get(word, word)
+    for candidate in (word, word[:-1] if word.endswith('s') else None, word[:-2] if word.endswith('es') else None):
+        if candidate and candidate in SLACK_FILETYPES and candidate not in ('text', 'auto', 'binary', 'post'):
+            return candidate
+    return None
+
+
+def _day_start(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _date(value):
+    if not _DATE_RE.match(value):
+        raise QueryParseError(f"`{value}` is not a date, use YYYY-MM-DD")
+    try:
+        return int(datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+    except ValueError:
+        raise QueryParseError(f"`{value}` is not a date, use YYYY-MM-DD")
+
+
+def parse_command(text, requester=None, channel=None, now=None):
+    """ Parses the text of a mention (with the bot mention first) into a MetadataQuery. Returns None when the text
+    isn't a command. `requester` and `channel` are the user and channel of the mention, for `my` and `here`. """
+    tokens = _tokens(text)
+    if tokens and tokens[0][0] == 'user':
+        # the mention of the bot
+        tokens = tokens[1:]
+    if not tokens or tokens[0][0] != 'word' or tokens[0][1] not in COMMAND_WORDS:
+        return None
+    if tokens[0][1] == 'help':
+        return MetadataQuery(kind=HELP)
+    now = datetime.now(timezone.utc) if now is None else now
+    fields = dict()
+    filetypes = list()
+    words = [value if kind == 'word' else None for kind, value in tokens]
+
+    def word(index):
+        return words[index] if index < len(words) else None
+
+    def value_after(index):
+        if index + 1 >= len(tokens):
+            raise QueryParseError(f"`{tokens[index][1]}` needs a value")
+        return tokens[index + 1][1]
+
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i]
+        if kind == 'channel':
+            fields['channel'] = value
+        elif kind == 'user':
+            fields['user'] = value
+        elif kind == 'quoted':
+            fields['name_contains'] = value
+        elif value in ('count', 'total', 'size') or (value == 'how' and word(i + 1) == 'many'):
+            fields['kind'] = AGGREGATE
+        elif value in ORDER_WORDS:
+            fields['order'] = ORDER_WORDS[value]
+        elif value.isdigit():
+            fields['limit'] = int(value)
+        elif value in ('by', 'per') and word(i + 1) in GROUP_WORDS:
+            fields['group_by'] = GROUP_WORDS[word(i + 1)]
+            fields['kind'] = AGGREGATE
+            i += 1
+        elif value in ('by', 'from') and word(i + 1) == 'me' or value in ('my', 'mine'):
+            fields['user'] = requester
+            i += 1 if value in ('by', 'from') else 0
+        elif value == 'here' or (value in ('in', 'from') and word(i + 1) == 'this' and word(i + 2) == 'channel'):
+            fields['channel'] = channel
+            i += 2 if value != 'here' else 0
+        elif value in ('named', 'called', 'matching'):
+            fields['name_contains'] = value_after(i)
+            i += 1
+        elif value == 'about':
+            fields['about'] = value_after(i)
+            i += 1
+        elif value == 'today':
+            fields['since'] = int(_day_start(now).timestamp())
+        elif value == 'yesterday':
+            fields['since'] = int((_day_start(now) - timedelta(days=1)).timestamp())
+            fields['until'] = int(_day_start(now).timestamp())
+        elif value == 'this' and word(i + 1) in ('week', 'month'):
+            start = _day_start(now) - timedelta(days=now.weekday()) if word(i + 1) == 'week' else \
+                _day_start(now).replace(day=1)
+            fields['since'] = int(start.timestamp())
+            i += 1
+        elif value in ('last', 'past') and word(i + 1) in UNITS_SECONDS:
+            fields['since'] = int(now.timestamp()) - UNITS_SECONDS[word(i + 1)]
+            i += 1
+        elif value in ('last', 'past') and (word(i + 1) or '').isdigit() and word(i + 2) in UNITS_SECONDS:
+            fields['since'] = int(now.timestamp()) - int(word(i + 1)) * UNITS_SECONDS[word(i + 2)]
+            i += 2
+        elif value == 'since':
+            fields['since'] = _date(value_after(i))
+            i += 1
+        elif value == 'before':
+            fields['until'] = _date(value_after(i))
+            i += 1
+        elif value in MIMETYPE_WORDS:
+            fields['mimetype_prefix'] = MIMETYPE_WORDS[value]
+        elif _filetype(value):
+            filetypes.append(_filetype(value))
+        i += 1
+    fields['filetypes'] = tuple(dict.fromkeys(filetypes))
+    query = MetadataQuery(**fields)
+    if not 1 <= query.limit <= QUERY_MAX_LIMIT:
+        query = replace(query, limit=min(max(query.limit, 1), QUERY_MAX_LIMIT))
+    return query
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _literal(value):
+    """ An Athena SQL literal, strings are quoted with their quotes doubled. """
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def to_sql(query, dialect='sqlite'):
+    """ The SQL of a query for the local index (`sqlite`, with `?` parameters) or Athena (`athena`, with literals).
+    Returns the SQL, its parameters and the column names of the result. """
+    where, params = list(), list()
+
+    def condition(sql, *values):
+        where.append(sql)
+        params.extend(values)
+
+    if query.filetypes:
+        condition(f"filetype IN ({', '.join('?' for _ in query.filetypes)})", *query.filetypes)
+    if query.mimetype_prefix:
+        condition("mimetype LIKE ? ESCAPE '\\'", _escape_like(query.mimetype_prefix) + '%')
+    if query.channel:
+        condition("slack_orig_channel = ?", query.channel)
+    if query.user:
+        condition("\"user\" = ?", query.user)
+    if query.since is not None:
+        condition("created >= ?", query.since)
+        if dialect == 'athena':
+            # the partition of the day before too, `created` is in UTC like the partitions but may be late
+            condition("dt >= ?", datetime.fromtimestamp(query.since - 86400, timezone.utc).strftime('%Y-%m-%d'))
+    if query.until is not None:
+        condition("created < ?", query.until)
+    if query.name_contains:
+        condition("lower(name) LIKE ? ESCAPE '\\'", f"%{_escape_like(query.name_contains.lower())}%")
+    if query.about:
+        condition("lower(ai_analysis) LIKE ? ESCAPE '\\'", f"%{_escape_like(query.about.lower())}%")
+    table = 'files' if dialect == 'sqlite' else f'"{ATHENA_DATABASE}"."metadata"'
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+
+    if query.kind == LIST:
+        order = {'newest': 'created DESC', 'oldest': 'created ASC', 'largest': 'size DESC',
+                 'smallest': 'size ASC'}[query.order]
+        columns = ('name', 'filetype', 'size', 'created', 'user', 'slack_orig_channel')
+        sql = (f"SELECT name, filetype, size, created, \"user\", slack_orig_channel FROM {table} {where_sql} "
+               f"ORDER BY {order} LIMIT {query.limit}")
+    elif query.group_by:
+        group = {'filetype': 'filetype', 'user': '"user"', 'channel': 'slack_orig_channel',
+                 'day': "date(created, 'unixepoch')" if dialect == 'sqlite' else
+                 "cast(date(from_unixtime(created)) AS varchar)"}[query.group_by]
+        columns = (query.group_by, 'files', 'bytes')
+        sql = (f"SELECT {group}, count(*), sum(size) FROM {table} {where_sql} GROUP BY {group} "
+               f"ORDER BY {'1 DESC' if query.group_by == 'day' else '2 DESC'} LIMIT {query.limit}")
+    else:
+        columns = ('files', 'bytes', 'users', 'channels')
+        sql = (f"SELECT count(*), coalesce(sum(size), 0), count(DISTINCT \"user\"), "
+               f"count(DISTINCT slack_orig_channel) FROM {table} {where_sql}")
+    if dialect == 'athena':
+        parts = sql.split('?')
+        sql = parts[0] + ''.join(_literal(value) + part for value, part in zip(params, parts[1:]))
+        params = []
+    return sql, params, columns
+
+
+def get_athena_executor():
+    """ The Athena query executor of the queries the index can't answer, kept across warm invocations. """
+    return memoized_client('query_athena_executor', lambda: AthenaQueryExecutor(
+        athena_client(), ATHENA_DATABASE, ATHENA_OUTPUT_LOCATION, deadline_seconds=ATHENA_DEADLINE_SECONDS))
+
+
+def _athena_value(cell, column):
+    value = cell.get('VarCharValue')
+    if value is not None and column in ('size', 'created', 'files', 'bytes', 'users', 'channels'):
+        return int(float(value))
+    return value
+
+
+_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='index-sync')
+_sync_future = None
+_sync_lock = threading.Lock()
+
+
+def sync_index(index, s3, bucket, folder, timeout=None):
+    """ Syncs the index in the background, one sync at a time, and waits for it `timeout` seconds at most (None for
+    as long as it takes). Returns whether the sync is done, raises its error. """
+    global _sync_future
+    with _sync_lock:
+        if _sync_future is None or _sync_future.done():
+            _sync_future = _sync_executor.submit(index.sync, s3, bucket, folder)
+        future = _sync_future
+    with span('index_sync', timeout=timeout) as sync_span:
+        try:
+            sync_span.set(records=future.result(timeout))
+        except TimeoutError:
+            sync_span.set(pending=True)
+            return False
+    return True
+
+
+def run_query(query, s3, bucket, folder):
+    """ Answers the query from the local index, synced first, or from Athena. """
+    start = time.perf_counter()
+    if query.about is None:
+        index = get_metadata_index()
+        try:
+            sync_index(index, s3, bucket, folder)
+            if index.covers(query.since):
+                sql, params, columns = to_sql(query, 'sqlite')
+                with span('index_query', kind=query.kind):
+                    rows = index.query(sql, params)
+                return QueryResult(columns, rows, 'index', time.perf_counter() - start)
+        except Exception as e:
+            logger.error(f"Could not query the metadata index, falling back to Athena: {e}")
+    sql, _, columns = to_sql(query, 'athena')
+    rows = get_athena_executor().run_query(sql)
+    # the first row holds the column names
+    rows = [tuple(_athena_value(cell, column) for cell, column in zip(row['Data'], columns)) for row in rows[1:]]
+    return QueryResult(columns, rows, 'athena', time.perf_counter() - start)
+
+
+def _size(size):
+    size = size or 0
+    for unit, factor in (('GB', 1000 ** 3), ('MB', 1000 ** 2), ('kB', 1000)):
+        if size >= factor:
+            return f"{size / factor:,.1f} {unit}"
+    return f"{size} B"
+
+
+def _day(created):
+    return datetime.fromtimestamp(int(created), timezone.utc).strftime('%Y-%m-%d') if created is not None else ''
+
+
+def describe(query):
+    """ What the query asked for, in words, for the reply. """
+    what = ', '.join(f"{t} files" for t in query.filetypes) or \
+        {'image/': 'images', 'video/': 'videos', 'audio/': 'audio files', 'text/': 'text files'}.get(
+            query.mimetype_prefix, 'files')
+    parts = [what]
+    if query.name_contains:
+        parts.append(f'named like "{query.name_contains}"')
+    if query.about:
+        parts.append(f'about "{query.about}"')
+    if query.channel:
+        parts.append(f"in <#{query.channel}>")
+    if query.user:
+        parts.append(f"shared by <@{query.user}>")
+    if query.since is not None:
+        parts.append(f"since {_day(query.since)}")
+    if query.until is not None:
+        parts.append(f"before {_day(query.until)}")
+    if query.kind == LIST:
+        return f"The {query.limit} {query.order} {' '.join(parts)}"
+    return f"The {' '.join(parts)}{f' by {query.group_by}' if query.group_by else ''}"
+
+
+def render_answer(query, result):
+    """ The blocks of the reply to a query: the rows as lines, and where the answer came from. """
+    if query.kind == LIST:
+        lines = [f"`{name}` {filetype}, {_size(size)}, {_day(created)}, <@{user}> in <#{channel}>"
+                 for name, filetype, size, created, user, channel in result.rows]
+    elif query.group_by:
+        def label(value):
+            return {'user': f"<@{value}>", 'channel': f"<#{value}>"}.get(query.group_by, f"`{value}`")
+        lines = [f"{label(value)}: {files} files, {_size(size)}" for value, files, size in result.rows]
+    else:
+        files, size, users, channels = result.rows[0] if result.rows else (0, 0, 0, 0)
+        lines = [f"{files} files, {_size(size)}, shared by {users} users in {channels} channels"]
+    body = "\n".join(lines) or "No files found."
+    source = 'the metadata index' if result.source == 'index' else 'Athena'
+    return [section(truncate(f"*{describe(query)}*  \n{body}")),
+            context(f"Answered from {source} in {result.seconds * 1000:,.0f} ms")]
+
+
+def post_answer(channel, thread_ts, blocks, text):
+    with span('query_reply'):
+        call_with_retries('slack.chat.postMessage', slack_client().chat_postMessage, channel=channel,
+                          thread_ts=thread_ts, text=text, blocks=blocks)
+
+
+def answers_inline(command, s3, bucket, folder):
+    """ Whether the command can be answered before the Slack event is acknowledged: a help or a parse error, or a
+    query of the local index synced within QUERY_INLINE_SYNC_SECONDS. The others (a search of the analyses or a range
+    the index doesn't cover, for Athena) take seconds. """
+    try:
+        query = parse_command(command['text'], command.get('user'), command['channel'])
+    except QueryParseError:
+        return True
+    if query is None or query.kind == HELP:
+        return True
+    if query.about is not None:
+        return False
+    index = get_metadata_index()
+    try:
+        return sync_index(index, s3, bucket, folder, QUERY_INLINE_SYNC_SECONDS) and index.covers(query.since)
+    except Exception as e:
+        logger.error(f"Could not sync the metadata index: {e}")
+        return False
+
+
+def answer_command(command, s3, bucket, folder):
+    """ Answers the command of a mention in its thread. `command` holds the `text`, `user`, `channel` and `ts` (and
+    `thread_ts`) of the Slack event. """
+    thread_ts = command.get('thread_ts') or command['ts']
+    try:
+        query = parse_command(command['text'], command.get('user'), command['channel'])
+    except QueryParseError as e:
+        post_answer(command['channel'], thread_ts, [section(f"I didn't understand that: {e}\n\n{HELP_TEXT}")],
+                    "I didn't understand that.")
+        return
+    if query is None:
+        return
+    if query.kind == HELP:
+        post_answer(command['channel'], thread_ts, [section(HELP_TEXT)], "What I can answer about the files.")
+        return
+    result = run_query(query, s3, bucket, folder)
+    logger.info(f"Answered {query} from {result.source} in {result.seconds * 1000:.1f} ms ({len(result.rows)} rows)")
+    post_answer(command['channel'], thread_ts, render_answer(query, result), describe(query))
+
+
+def command_from_event(slack_event):
+    """ The command of a Slack mention without a file, None when it isn't one. """
+    event = slack_event.get('event', {})
+    if not METADATA_QUERIES_ENABLED or 'files' in event or event.get('type') != 'app_mention':
+        return None
+    try:
+        if parse_command(event.get('text', ''), event.get('user'), event.get('channel')) is None:
+            return None
+    except QueryParseError:
+        # answered with the error
+        pass
+    return {'text': event.get('text', ''), 'user': event.get('user'), 'channel': event['channel'], 'ts': event['ts'],
+            'thread_ts': event.get('thread_ts'), 'slack_event_id': slack_event.get('event_id', event['ts'])}
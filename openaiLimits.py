@@ -0,0 +1,393 @@
+import contextvars
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from transport import backoff_delay
+from transport import call_with_retries
+from transport import is_throttle
+from transport import throttle_retry_after
+
+# Client-side budget of the OpenAI requests and tokens per minute, in front of every chat completion and assistant run
+# so a burst of analyses waits its turn instead of being throttled by OpenAI. The budget is kept in a token budget
+# store: `local` to the process (its threads, e.g. the workers of a backfill, see backfill.py), `sqlite` for the
+# processes of a machine or `dynamodb` for all the Lambda instances and workers sharing the same OpenAI quota.
+# Requests go through one of two lanes: `interactive` (the small files of a Slack message, the default) and `bulk`
+# (the heavy tier, see admission.py, and the backfills), which only uses the budget the interactive lane leaves. A 429
+# of OpenAI pauses the whole budget for its Retry-After and the request is queued again in its lane.
+# set env var OPENAI_REQUESTS_PER_MINUTE and OPENAI_TOKENS_PER_MINUTE (default 0, no limit)
+# set env var OPENAI_BUDGET_BACKEND to `local`, `sqlite` or `dynamodb` (default `local`)
+# set env var OPENAI_BUDGET_DB_PATH for the `sqlite` backend (default /tmp/file-slacker-openai-budget.db)
+# set env var OPENAI_BUDGET_TABLE for the `dynamodb` backend. The table needs a string partition key named
+# `budget_key`.
+# set env var OPENAI_INTERACTIVE_RESERVE_SECONDS (default 2) for the seconds' worth of the limits kept for the
+# interactive lane, and OPENAI_THROTTLE_MAX_WAIT_SECONDS (default 300) for how long a throttled request is queued
+# again before its error is raised
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+OPENAI_REQUESTS_PER_MINUTE = float(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', '0'))
+OPENAI_TOKENS_PER_MINUTE = float(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '0'))
+OPENAI_INTERACTIVE_RESERVE_SECONDS = float(os.environ.get('OPENAI_INTERACTIVE_RESERVE_SECONDS', '2'))
+OPENAI_THROTTLE_MAX_WAIT_SECONDS = float(os.environ.get('OPENAI_THROTTLE_MAX_WAIT_SECONDS', '300'))
+DEFAULT_OPENAI_BUDGET_DB_PATH = '/tmp/file-slacker-openai-budget.db'
+# the limits allow bursts of this many seconds' worth of requests and tokens
+BURST_SECONDS = 1
+# a bulk request waiting for the budget checks it again at least this often
+BULK_POLL_SECONDS = 0.25
+# attempts of a conditional write of a shared budget updated concurrently
+MAX_UPDATE_ATTEMPTS = 10
+# rough token counts: text, an image (detail low, or high/auto once downsized, see imagePrep.py) and an assistant run
+# with file_search, which retrieves at most FILE_SEARCH_MAX_TOKENS of the file (20 chunks of 800 tokens)
+CHARACTERS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_LOW_DETAIL_TOKENS = 85
+IMAGE_TOKENS = 765
+FILE_SEARCH_MAX_TOKENS = 16000
+ASSISTANT_RUN_OVERHEAD_TOKENS = 1500
+
+# the "Please try again in 1.5s" (or 120ms, 1m30s) of a rate limit error message
+TRY_AGAIN_PATTERN = re.compile(r'try again in ((?:\d+(?:\.\d+)?(?:ms|s|m|h))+)')
+TRY_AGAIN_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = (INTERACTIVE, BULK)
+
+_lane = contextvars.ContextVar('openai_lane', default=INTERACTIVE)
+
+
+@contextmanager
+def openai_lane(lane):
+    """ Runs the OpenAI requests of the block in `lane`. """
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def current_lane():
+    return _lane.get()
+
+
+def with_current_lane(fn):
+    """ Wraps `fn` to run in the lane of the calling thread, for the functions submitted to a thread pool. """
+    lane = current_lane()
+
+    def run(*args, **kwargs):
+        with openai_lane(lane):
+            return fn(*args, **kwargs)
+    return run
+
+
+def estimate_tokens(request):
+    """ An estimate of the tokens a chat completion request uses: its messages and at most `max_tokens` more. """
+    tokens = 0
+    for message in request.get('messages', []):
+        content = message.get('content')
+        parts = content if isinstance(content, list) else [{'type': 'text', 'text': content or ''}]
+        for part in parts:
+            if part.get('type') == 'image_url':
+                low = part['image_url'].get('detail') == 'low'
+                tokens += IMAGE_LOW_DETAIL_TOKENS if low else IMAGE_TOKENS
+            else:
+                tokens += len(str(part.get('text', ''))) // CHARACTERS_PER_TOKEN
+        tokens += MESSAGE_OVERHEAD_TOKENS
+    return tokens + (request.get('max_tokens') or 0)
+
+
+def estimate_run_tokens(size=None):
+    """ An estimate of the tokens an assistant run with file_search uses for a file of `size` bytes: the instructions
+    and answer, and what it retrieves of the file. """
+    retrieved = FILE_SEARCH_MAX_TOKENS if size is None else min(FILE_SEARCH_MAX_TOKENS, size // CHARACTERS_PER_TOKEN)
+    return ASSISTANT_RUN_OVERHEAD_TOKENS + retrieved
+
+
+def used_tokens(response):
+    """ The tokens an OpenAI response reports it used, None when it doesn't (e.g. a streamed completion). """
+    usage = getattr(response, 'usage', None)
+    return getattr(usage, 'total_tokens', None)
+
+
+def message_retry_after(message):
+    """ The delay a rate limit error message asks for, in seconds. None when it doesn't say. Assistant runs that hit
+    the limits fail with such a message (`run.last_error`) instead of a 429 with a Retry-After header. """
+    match = TRY_AGAIN_PATTERN.search(message or '')
+    if match is None:
+        return None
+    return sum(float(value) * TRY_AGAIN_UNITS[unit]
+               for value, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', match.group(1)))
+
+
+class TokenBudgetStore:
+    """ The levels of token buckets refilled at `rate` per second up to `capacity`. `update` refills the bucket
+    `key`, passes its level to `change(level)`, which returns the new level and a result, saves the new level and
+    returns the result, atomically. Any store with transactions or conditional writes can implement this. """
+
+    def update(self, key, rate, capacity, change):
+        raise NotImplementedError
+
+
+def _refilled(level, updated, now, rate, capacity):
+    return capacity if level is None else min(capacity, level + max(0.0, now - updated) * rate)
+
+
+class LocalTokenBudgetStore(TokenBudgetStore):
+    """ The buckets of the process, shared by its threads. """
+
+    def __init__(self):
+        self._levels = dict()
+        self._lock = threading.Lock()
+
+    def update(self, key, rate, capacity, change):
+        with self._lock:
+            now = time.time()
+            level, updated = self._levels.get(key, (None, now))
+            level, result = change(_refilled(level, updated, now, rate, capacity))
+            self._levels[key] = (level, now)
+            return result
+
+
+class SqliteTokenBudgetStore(TokenBudgetStore):
+    """ The buckets in a SQLite file, shared by the processes of a machine (e.g. local workers draining the job
+    queue, or a backfill running next to them). Every update is an immediate transaction. """
+
+    def __init__(self, path=DEFAULT_OPENAI_BUDGET_DB_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS budgets (
+            budget_key TEXT PRIMARY KEY,
+            level REAL NOT NULL,
+            updated_at REAL NOT NULL)''')
+
+    def update(self, key, rate, capacity, change):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute('SELECT level, updated_at FROM budgets WHERE budget_key = ?', (key,)).fetchone()
+                now = time.time()
+                level, result = change(_refilled(row[0] if row else None, row[1] if row else now, now, rate,
+                                                 capacity))
+                self._db.execute('''INSERT INTO budgets (budget_key, level, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (budget_key) DO UPDATE SET level = excluded.level, updated_at = excluded.updated_at''',
+                                 (key, level, now))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return result
+
+
+class DynamoDbTokenBudgetStore(TokenBudgetStore):
+    """ The buckets in a DynamoDB table, shared by all the Lambda instances. An update reads the bucket and writes it
+    back on the condition that nobody else did in between. """
+
+    def __init__(self, table_name, dynamodb_client=None):
+        import boto3
+        self.table_name = table_name
+        self.dynamodb = dynamodb_client or boto3.client('dynamodb', 'us-east-2')
+
+    def update(self, key, rate, capacity, change):
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            item = self.dynamodb.get_item(TableName=self.table_name, Key={'budget_key': {'S': key}},
+                                          ConsistentRead=True).get('Item')
+            now = time.time()
+            level = None if item is None else float(item['level']['N'])
+            updated = now if item is None else float(item['updated_at']['N'])
+            level, result = change(_refilled(level, updated, now, rate, capacity))
+            condition = {'ConditionExpression': 'attribute_not_exists(budget_key)'} if item is None else {
+                'ConditionExpression': 'updated_at = :updated_at',
+                'ExpressionAttributeValues': {':updated_at': item['updated_at']}}
+            try:
+                self.dynamodb.put_item(TableName=self.table_name, Item={
+                    'budget_key': {'S': key}, 'level': {'N': repr(level)}, 'updated_at': {'N': repr(now)}}, **condition)
+                return result
+            except self.dynamodb.exceptions.ConditionalCheckFailedException:
+                time.sleep(random.uniform(0, 0.01 * (attempt + 1)))
+        raise Exception(f"Could not update the OpenAI budget {key} after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+class OpenAIRateLimiter:
+    """ The budget of OpenAI requests and tokens per minute, a limit of 0 is no limit. A request takes its estimated
+    tokens up front, and the ones OpenAI reports it used beyond the estimate once it is done.
+    An interactive request takes them right away, possibly into debt, and waits until the debt is paid back. A bulk
+    request only takes them when that leaves OPENAI_INTERACTIVE_RESERVE_SECONDS' worth of the limits in the budget,
+    and not while an interactive request of the process is waiting: with a shared store the bulk lane of every worker
+    yields to the interactive lane of all of them, and the budget is still used up to the limits. """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, store=None,
+                 reserve_seconds=OPENAI_INTERACTIVE_RESERVE_SECONDS,
+                 max_throttle_seconds=OPENAI_THROTTLE_MAX_WAIT_SECONDS, name='openai'):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.store = store or LocalTokenBudgetStore()
+        self.reserve_seconds = reserve_seconds
+        self.max_throttle_seconds = max_throttle_seconds
+        self._requests_key = f"{name}:requests" if requests_per_minute else None
+        self._tokens_key = f"{name}:tokens" if tokens_per_minute else None
+        self._lock = threading.Lock()
+        self._interactive_waiting = 0
+        self.requests = 0
+        self.tokens = 0
+        self.waited_seconds = 0.0
+        self.throttled = 0
+        self.lane_requests = {lane: 0 for lane in LANES}
+        self.lane_waited_seconds = {lane: 0.0 for lane in LANES}
+
+    def _limits(self, key):
+        rate = (self.requests_per_minute if key == self._requests_key else self.tokens_per_minute) / 60
+        return rate, rate * (BURST_SECONDS + self.reserve_seconds), rate * self.reserve_seconds
+
+    def _budgets(self, tokens):
+        return [(key, amount) for key, amount in ((self._requests_key, 1), (self._tokens_key, tokens)) if key]
+
+    def _take(self, key, amount, floor=None):
+        """ Takes `amount` from a budget. Without a `floor`, into debt: returns the seconds until the debt is paid.
+        With one, only when the level stays above it (or the budget is full, for an amount larger than the bursts):
+        returns 0 when taken, else the seconds until it can be. """
+        rate, capacity, _ = self._limits(key)
+
+        def take(level):
+            if floor is None:
+                level -= amount
+                return level, max(0.0, -level / rate)
+            needed = floor + min(amount, capacity - floor)
+            if level >= needed:
+                return level - amount, 0.0
+            return level, (needed - level) / rate
+        return self.store.update(key, rate, capacity, take)
+
+    def _adjust(self, key, amount):
+        rate, capacity, _ = self._limits(key)
+        self.store.update(key, rate, capacity, lambda level: (min(capacity, level + amount), None))
+
+    def acquire(self, tokens, lane=None):
+        """ Waits until a request of about `tokens` tokens is within the limits, in its lane (by default the one of
+        the calling thread). Returns the tokens taken. """
+        lane = lane or current_lane()
+        start = time.monotonic()
+        if lane == BULK:
+            while True:
+                if self._interactive_waiting:
+                    time.sleep(BULK_POLL_SECONDS)
+                    continue
+                taken, wait = list(), 0.0
+                for key, amount in self._budgets(tokens):
+                    wait = self._take(key, amount, self._limits(key)[2])
+                    if wait > 0:
+                        break
+                    taken.append((key, amount))
+                if wait == 0:
+                    break
+                for key, amount in taken:
+                    self._adjust(key, amount)
+                time.sleep(min(wait, BULK_POLL_SECONDS))
+        else:
+            with self._lock:
+                self._interactive_waiting += 1
+            try:
+                wait = max([self._take(key, amount) for key, amount in self._budgets(tokens)], default=0.0)
+                if wait > 0:
+                    logger.debug(f"Waiting {wait:.2f}s for the OpenAI rate limits")
+                    time.sleep(wait)
+            finally:
+                with self._lock:
+                    self._interactive_waiting -= 1
+        waited = time.monotonic() - start
+        with self._lock:
+            self.requests += 1
+            self.tokens += tokens
+            self.waited_seconds += waited
+            self.lane_requests[lane] += 1
+            self.lane_waited_seconds[lane] += waited
+        return tokens
+
+    def settle(self, estimated, used):
+        """ Takes the tokens used beyond the estimate, the next requests wait for them. The ones taken but not used
+        aren't given back: OpenAI counts a request against its limits by its prompt and `max_tokens`, not its usage. """
+        if used is None or used <= estimated:
+            return
+        with self._lock:
+            self.tokens += used - estimated
+        if self._tokens_key:
+            self._adjust(self._tokens_key, estimated - used)
+
+    def pause(self, seconds):
+        """ Empties the budget for `seconds`, for every worker sharing it: OpenAI throttled a request. Without limits
+        only the caller waits. """
+        if not self._budgets(0):
+            time.sleep(seconds)
+        for key, _ in self._budgets(0):
+            rate, capacity, _ = self._limits(key)
+            self.store.update(key, rate, capacity, lambda level: (min(level, -seconds * rate), None))
+
+    def call(self, endpoint, fn, tokens, **kwargs):
+        """ Runs the OpenAI request `fn(**kwargs)` of about `tokens` tokens within the budget, the transient errors
+        retried by `call_with_retries`. A throttled request (429) pauses the budget for its Retry-After (or a
+        backoff) and is queued again in its lane, for up to `max_throttle_seconds`, after which its error is
+        raised. """
+        deadline = time.monotonic() + self.max_throttle_seconds
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                response = call_with_retries(endpoint, fn, retry_throttles=False, **kwargs)
+            except Exception as e:
+                if not is_throttle(e):
+                    raise
+                delay = backoff_delay(attempt, throttle_retry_after(e))
+                if time.monotonic() + delay > deadline:
+                    raise
+                with self._lock:
+                    self.throttled += 1
+                logger.warning(f"{endpoint} was throttled, queued again in {delay:.2f}s (attempt {attempt + 1})")
+                self.pause(delay)
+                attempt += 1
+                continue
+            self.settle(tokens, used_tokens(response))
+            return response
+
+
+_token_budget_store = None
+_openai_limiter = None
+_openai_limiter_lock = threading.Lock()
+
+
+def get_token_budget_store():
+    """ Returns the token budget store configured by the environment, created once per Lambda instance. """
+    global _token_budget_store
+    with _openai_limiter_lock:
+        if _token_budget_store is None:
+            backend = os.environ.get('OPENAI_BUDGET_BACKEND', 'local').lower()
+            if backend == 'local':
+                _token_budget_store = LocalTokenBudgetStore()
+            elif backend == 'sqlite':
+                _token_budget_store = SqliteTokenBudgetStore(
+                    os.environ.get('OPENAI_BUDGET_DB_PATH', DEFAULT_OPENAI_BUDGET_DB_PATH))
+            elif backend == 'dynamodb':
+                _token_budget_store = DynamoDbTokenBudgetStore(os.environ['OPENAI_BUDGET_TABLE'])
+            else:
+                raise ValueError(f"Unknown OPENAI_BUDGET_BACKEND: {backend}")
+        return _token_budget_store
+
+
+def get_openai_limiter():
+    """ Returns the OpenAI rate limiter configured by the environment, created once per Lambda instance. """
+    global _openai_limiter
+    store = get_token_budget_store() if OPENAI_REQUESTS_PER_MINUTE or OPENAI_TOKENS_PER_MINUTE else None
+    with _openai_limiter_lock:
+        if _openai_limiter is None:
+            _openai_limiter = OpenAIRateLimiter(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE, store)
+        return _openai_limiter
+
+
+def set_openai_limiter(openai_limiter):
+    """ Overrides the configured OpenAI rate limiter. """
+    global _openai_limiter
+    _openai_limiter = openai_limiter
@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+
+from lazyClients import slack_client
+from replyRendering import FileReport
+from replyRendering import compose_reply
+from replyRendering import section
+from tracing import span
+from transport import call_with_retries
+
+# Progressive replies, set env var PROGRESSIVE_REPLY_ENABLED to true. As soon as the first file of a Slack message is
+# in S3 fileSlacker posts a "received, analyzing" message in its thread, the AI analyses streamed from OpenAI are then
+# written into that message with `chat.update`, at most every PROGRESSIVE_UPDATE_INTERVAL_SECONDS and at most
+# PROGRESSIVE_MAX_UPDATES times. Its `ts` is stored in the metadata (or event manifest) so fileStatsSlacker updates
+# the same message with the full reply and the stats instead of posting a new one.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PROGRESSIVE_REPLY_ENABLED = os.environ.get('PROGRESSIVE_REPLY_ENABLED', 'false').lower() == 'true'
+PROGRESSIVE_UPDATE_INTERVAL_SECONDS = float(os.environ.get('PROGRESSIVE_UPDATE_INTERVAL_SECONDS', '2'))
+PROGRESSIVE_MAX_UPDATES = int(os.environ.get('PROGRESSIVE_MAX_UPDATES', '10'))
+
+STATUS_TEXT = {
+    'pending': ":hourglass: waiting for the upload",
+    'analyzing': ":mag: stored in AWS S3, analyzing",
+    'analyzed': ":white_check_mark: analyzed, the stats are on their way",
+    'failed': ":thumbsdown: could not be uploaded",
+}
+
+
+class ProgressiveReply:
+    """ The progress message of the files of one Slack message, shared by their concurrent ingests. The Slack calls
+    are made by the ingest threads themselves, no timer: a change within the update interval, or while another
+    thread's Slack call is in flight, is only shown by the next change after it (or by the final reply). The lock
+    only guards the state, the Slack calls are made outside of it so a slow or throttled one doesn't hold up the
+    other files' streams. """
+
+    def __init__(self, channel, thread_ts, files):
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.ts = None
+        self.updates = 0
+        # file id: name, status and analysis so far, in the order of the message
+        self._files = {file_id: {'name': name, 'status': 'pending', 'text': ''} for file_id, name in files}
+        self._last_update = 0.0
+        self._closed = False
+        # a Slack call is in flight, and a forced update is waiting for it
+        self._sending = False
+        self._force_pending = False
+        self._lock = threading.Condition()
+
+    def received(self, file_id):
+        """ The file is in S3, the first one posts the progress message. """
+        with self._lock:
+            self._files[file_id]['status'] = 'analyzing'
+            call = self._next_call(post=True)
+        self._send(call)
+
+    def analysis(self, file_id, text, done=False):
+        """ The analysis of the file so far, e.g. the text streamed by OpenAI. """
+        with self._lock:
+            self._files[file_id]['text'] = text
+            if done:
+                self._files[file_id]['status'] = 'analyzed'
+            call = self._next_call()
+        self._send(call)
+
+    def failed(self, file_id):
+        """ The file could not be ingested. Shown right away when all the files failed, there won't be a final
+        reply then. """
+        with self._lock:
+            self._files[file_id]['status'] = 'failed'
+            call = self._next_call(force=all(f['status'] == 'failed' for f in self._files.values()))
+        self._send(call)
+
+    def close(self):
+        """ No more updates, the final reply takes over the message. Must be called before the metadata (or event
+        manifest) triggering the final reply is uploaded, so no late update overwrites it: waits for the Slack call
+        in flight, if any (an update is a single attempt). """
+        with self._lock:
+            self._closed = True
+            while self._sending:
+                self._lock.wait()
+
+    def _blocks(self):
+        reports = [FileReport(f['name'], [section(f"`{f['name']}` {STATUS_TEXT[f['status']]}")], f['text'])
+                   for f in self._files.values()]
+        blocks, _ = compose_reply(reports)
+        return blocks
+
+    def _text(self):
+        done = sum(1 for f in self._files.values() if f['status'] in ('analyzed', 'failed'))
+        return f"Received {len(self._files)} file(s), {done} analyzed so far."
+
+    def _next_call(self, post=False, force=False):
+        """ The Slack call to make for the current state, with the text and blocks taken under the lock, None when
+        there is nothing to send now. Called with the lock held. """
+        if self._closed:
+            return None
+        if self._sending:
+            self._force_pending = self._force_pending or force
+            return None
+        if self.ts is None:
+            if not post:
+                return None
+            self._sending = True
+            return 'post', None, self._text(), self._blocks()
+        now = time.monotonic()
+        if self.updates >= PROGRESSIVE_MAX_UPDATES:
+            return None
+        if not force and now - self._last_update < PROGRESSIVE_UPDATE_INTERVAL_SECONDS:
+            return None
+        self._last_update = now
+        self.updates += 1
+        self._sending = True
+        return 'update', self.ts, self._text(), self._blocks()
+
+    def _send(self, call):
+        while call is not None:
+            kind, ts, text, blocks = call
+            posted = self._post(text, blocks) if kind == 'post' else self._update(ts, text, blocks)
+            with self._lock:
+                if kind == 'post':
+                    self.ts = posted
+                    self._last_update = time.monotonic()
+                    self._closed = self._closed or posted is None
+                self._sending = False
+                self._lock.notify_all()
+                force, self._force_pending = self._force_pending, False
+                call = self._next_call(force=True) if force else None
+
+    def _post(self, text, blocks):
+        try:
+            with span('progress_post'):
+                response = call_with_retries('slack.chat.postMessage', slack_client().chat_postMessage,
+                                             channel=self.channel, thread_ts=self.thread_ts, text=text, blocks=blocks)
+            return response['ts']
+        except Exception as e:
+            # the final reply is then posted as a new message
+            logger.warning(f"Could not post the progress message in the thread {self.thread_ts}: {e}")
+            return None
+
+    def _update(self, ts, text, blocks):
+        try:
+            with span('progress_update', update=self.updates):
+                # a single attempt, `close` waits for it and a throttled update is superseded by the next one anyway
+                call_with_retries('slack.chat.update', slack_client().chat_update, channel=self.channel, ts=ts,
+                                  text=text, blocks=blocks, max_attempts=1)
+        except Exception as e:
+            logger.warning(f"Could not update the progress message {ts}: {e}")
+
+
+def start_progressive_reply(slack_metadata_records):
+    """ The progress of the files of a Slack message, None when progressive replies are disabled. """
+    if not PROGRESSIVE_REPLY_ENABLED:
+        return None
+    first = slack_metadata_records[0]
+    return ProgressiveReply(first['slack_orig_channel'], first['slack_orig_ts'],
+                            [(md['id'], md['name']) for md in slack_metadata_records])
@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Reply coalescing, set env var REPLY_COALESCING_ENABLED to true. The replies of fileStatsSlacker to the uploads of the
+# same channel (or, with REPLY_COALESCING_SCOPE=thread, of the same thread) are buffered and posted as a single reply
+# listing every file, followed by the stats once. A group of replies is flushed REPLY_COALESCING_WINDOW_SECONDS after
+# its last reply was buffered, REPLY_COALESCING_MAX_DELAY_SECONDS after its first one at the latest, or as soon as
+# it holds REPLY_COALESCING_MAX_BATCH replies.
+# By default the replies are only coalesced within a batch of notifications: on Lambda the S3 notifications go through
+# an SQS queue whose batching window (MaximumBatchingWindowInSeconds) plays the part of the coalescing window, and each
+# group of the batch is posted at its end. Set env var REPLY_BUFFER_DB_PATH to buffer the replies across invocations
+# in a SQLite database shared by the processes of one machine (e.g. a local run). Invocations never wait for a group:
+# they flush the ones that are due, and `fileStatsSlacker.flush_replies_handler`, scheduled on the same machine,
+# flushes the others. Lambda instances don't share their /tmp, so the buffer doesn't coalesce across them.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+REPLY_COALESCING_ENABLED = os.environ.get('REPLY_COALESCING_ENABLED', 'false').lower() == 'true'
+REPLY_COALESCING_SCOPE = os.environ.get('REPLY_COALESCING_SCOPE', 'channel').lower()
+REPLY_COALESCING_WINDOW_SECONDS = float(os.environ.get('REPLY_COALESCING_WINDOW_SECONDS', '10'))
+REPLY_COALESCING_MAX_DELAY_SECONDS = float(os.environ.get('REPLY_COALESCING_MAX_DELAY_SECONDS', '30'))
+REPLY_COALESCING_MAX_BATCH = int(os.environ.get('REPLY_COALESCING_MAX_BATCH', '20'))
+
+REPLY_BUFFER_DB_PATH = os.environ.get('REPLY_BUFFER_DB_PATH', '')
+# a group claimed for a flush that didn't complete within the lease (i.e. the Lambda died) can be claimed again
+FLUSH_LEASE_SECONDS = 120
+# a reply that could not be posted this many times is dropped
+MAX_FLUSH_ATTEMPTS = 3
+
+
+def group_key(bucket, channel, thread_ts):
+    """ The replies coalesced together: per bucket and channel, and per thread with the `thread` scope. """
+    if REPLY_COALESCING_SCOPE == 'thread':
+        return f"{bucket}|{channel}|{thread_ts}"
+    return f"{bucket}|{channel}"
+
+
+class ReplyBuffer:
+    """ The buffered replies, one row per S3 object, grouped by `group_key`. Adding a reply is idempotent (a
+    re-delivered notification is buffered once), a flush claims the oldest replies of a group with a token and
+    completes (deletes) or releases them. SQLite's locking makes the claim atomic across threads and processes sharing
+    the database file. """
+
+    def __init__(self, path=':memory:'):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS replies (
+            object_id TEXT PRIMARY KEY,
+            group_key TEXT NOT NULL,
+            reply TEXT NOT NULL,
+            added_at REAL NOT NULL,
+            token TEXT,
+            claimed_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS replies_group ON replies (group_key, added_at)')
+
+    def add(self, key, object_id, reply):
+        """ Buffers the reply to an object, once however many times its notification is delivered. """
+        with self._lock:
+            self._db.execute('''INSERT INTO replies (object_id, group_key, reply, added_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (object_id) DO NOTHING''', (object_id, key, json.dumps(reply), time.time()))
+
+    def due_times(self, now=None):
+        """ The time every group with claimable replies is due to be flushed, by group key. """
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._db.execute('''SELECT group_key, min(added_at), max(added_at), count(*) FROM replies
+                WHERE token IS NULL OR claimed_until < ? GROUP BY group_key''', (now,)).fetchall()
+        return {key: now if count >= REPLY_COALESCING_MAX_BATCH else
+                min(first + REPLY_COALESCING_MAX_DELAY_SECONDS, last + REPLY_COALESCING_WINDOW_SECONDS)
+                for key, first, last, count in rows}
+
+    def claim(self, key, limit=None):
+        """ Claims the oldest claimable replies of a group, at most `limit` (default REPLY_COALESCING_MAX_BATCH).
+        Returns the claim token and the (object id, reply) pairs, no pairs when another flush got them first. """
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute('''UPDATE replies SET token = ?, claimed_until = ? WHERE object_id IN (
+                SELECT object_id FROM replies WHERE group_key = ? AND (token IS NULL OR claimed_until < ?)
+                ORDER BY added_at LIMIT ?)''',
+                             (token, now + FLUSH_LEASE_SECONDS, key, now, limit or REPLY_COALESCING_MAX_BATCH))
+            rows = self._db.execute('SELECT object_id, reply FROM replies WHERE token = ? ORDER BY added_at',
+                                    (token,)).fetchall()
+        return token, [(object_id, json.loads(reply)) for object_id, reply in rows]
+
+    def complete(self, token):
+        with self._lock:
+            self._db.execute('DELETE FROM replies WHERE token = ?', (token,))
+
+    def release(self, token):
+        """ Returns the claimed replies to the buffer for another flush, the ones that failed too often are
+        dropped. """
+        with self._lock:
+            self._db.execute('UPDATE replies SET token = NULL, claimed_until = NULL, attempts = attempts + 1 '
+                             'WHERE token = ?', (token,))
+            dropped = self._db.execute('DELETE FROM replies WHERE token IS NULL AND attempts >= ?',
+                                       (MAX_FLUSH_ATTEMPTS,)).rowcount
+        if dropped:
+            logger.error(f"Dropped {dropped} buffered replies after {MAX_FLUSH_ATTEMPTS} failed flushes")
+
+
+def coalesce_replies(buffer, flush, all_groups=False):
+    """ Flushes the groups of the buffer that are due (every group with `all_groups`, at the end of a batch) with
+    `flush(group_key, [(object_id, reply), ...])`, which returns whether the coalesced reply was posted. Never waits
+    for a group, the replies of a flush that failed are released for the next one. Returns the ids of the objects
+    whose replies could not be posted. """
+    unposted = list()
+    now = time.time()
+    for key, due in sorted(buffer.due_times(now).items(), key=lambda item: item[1]):
+        if due > now and not all_groups:
+            continue
+        while True:
+            token, replies = buffer.claim(key)
+            if not replies:
+                break
+            try:
+                posted = flush(key, replies)
+            except Exception as e:
+                logger.error(f"An error occurred while flushing the replies of {key}: {e}")
+                posted = False
+            (buffer.complete if posted else buffer.release)(token)
+            if not posted:
+                unposted.extend(object_id for object_id, _ in replies)
+                break
+    return unposted
+
+
+_reply_buffer = None
+_reply_buffer_lock = threading.Lock()
+
+
+def get_reply_buffer():
+    """ Returns the reply buffer shared across invocations, created once per process. None without
+    REPLY_BUFFER_DB_PATH, the replies are then coalesced within each batch. """
+    global _reply_buffer
+    with _reply_buffer_lock:
+        if _reply_buffer is None and REPLY_BUFFER_DB_PATH:
+            _reply_buffer = ReplyBuffer(REPLY_BUFFER_DB_PATH)
+        return _reply_buffer
+
+
+def set_reply_buffer(reply_buffer):
+    """ Overrides the configured reply buffer. """
+    global _reply_buffer
+    _reply_buffer = reply_buffer
@@ -0,0 +1,391 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import date
+from datetime import datetime
+from datetime import timezone
+
+# Renders the Slack reply blocks of fileStatsSlacker within Slack's limits: a section's text can't exceed 3000
+# characters and a message 50 blocks, beyond that `chat.postMessage` fails. The stats are turned once into typed rows
+# (from the stats snapshot or the Athena rows), the report fragments rendered from them are cached per stats version
+# and the tables only list the REPLY_TOP_FILETYPES most uploaded filetypes, the others are rolled up in one row. Long
+# AI analyses are split across sections, what doesn't fit in the message is posted as replies in the thread.
+SECTION_TEXT_LIMIT = 3000
+MESSAGE_BLOCK_LIMIT = 50
+# the size of the JSON blocks of a message, kept well under Slack's limits so the message stays readable
+REPLY_MAX_CHARS = int(os.environ.get('REPLY_MAX_CHARS', '12000'))
+REPLY_TOP_FILETYPES = int(os.environ.get('REPLY_TOP_FILETYPES', '15'))
+# the sections of a file's description shown in the reply itself, the rest goes to the thread
+REPLY_INLINE_DESCRIPTION_SECTIONS = int(os.environ.get('REPLY_INLINE_DESCRIPTION_SECTIONS', '2'))
+# at most REPLY_MAX_FOLLOW_UPS messages continue a reply in its thread, the rest of the descriptions is left out
+REPLY_MAX_FOLLOW_UPS = int(os.environ.get('REPLY_MAX_FOLLOW_UPS', '5'))
+FRAGMENT_CACHE_SIZE = int(os.environ.get('REPLY_FRAGMENT_CACHE_SIZE', '32'))
+OTHER_FILETYPES = 'other'
+
+_fragments = OrderedDict()
+_fragments_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class SummaryStats:
+    files: int
+    users: int
+    channels: int
+    filetypes: int
+    min_kb: float
+    max_kb: float
+    avg_kb: float
+    with_text: int
+    first_date: date = None
+    last_date: date = None
+    # the bytes uploaded and the bytes stored, less with content-addressed storage
+    logical_bytes: int = 0
+    physical_bytes: int = 0
+
+
+@dataclass(frozen=True)
+class FiletypeStats:
+    filetype: str
+    count: int
+    users: int
+    channels: int
+    avg_kb: float
+    with_text: int
+    first_date: date = None
+    last_date: date = None
+    # the distinct users and channels, only known from the snapshot, give the exact counts of a rollup
+    user_ids: tuple = field(default=None, compare=False, repr=False)
+    channel_ids: tuple = field(default=None, compare=False, repr=False)
+
+
+@dataclass(frozen=True)
+class ReportStats:
+    """ The stats of a reply, the filetypes sorted by decreasing count. """
+    summary: SummaryStats
+    filetypes: tuple
+
+
+@dataclass(frozen=True)
+class FileReport:
+    """ What a reply says about one file: its upload blocks and its AI description, split as needed. """
+    name: str
+    blocks: list
+    description: str = ''
+
+
+def _kb(size):
+    return round(size / 1000, 2)
+
+
+def _mb(size):
+    return round(size / 1000 ** 2, 2)
+
+
+def _timestamp_date(created):
+    return datetime.fromtimestamp(created, timezone.utc).date()
+
+
+def _athena_date(value):
+    """ A date formatted 'mm/dd/yyyy' by Athena's to_char, parsed without strptime which is slow for 10k's. """
+    return date(int(value[6:10]), int(value[0:2]), int(value[3:5])) if value else None
+
+
+def _number(value, convert=float):
+    return convert(float(value)) if value not in (None, '') else convert(0)
+
+
+def stats_from_snapshot(snapshot):
+    """ The typed stats of a snapshot, see statsSnapshot.py. """
+    filetypes = list()
+    for filetype, s in snapshot['filetypes'].items():
+        if not s['count']:
+            continue
+        filetypes.append(FiletypeStats(
+            filetype, s['count'], len(s['users']), len(s['channels']), _kb(s['size_sum'] / s['count']),
+            s['with_text'], _timestamp_date(s['created_min']), _timestamp_date(s['created_max']),
+            tuple(s['users']), tuple(s['channels'])))
+    filetypes.sort(key=lambda f: (-f.count, f.filetype))
+    counters = [s for s in snapshot['filetypes'].values() if s['count']]
+    count = sum(s['count'] for s in counters)
+    if not count:
+        return ReportStats(SummaryStats(0, 0, 0, 0, 0.0, 0.0, 0.0, 0), tuple())
+    summary = SummaryStats(
+        count,
+        len(set().union(*(f.user_ids for f in filetypes))),
+        len(set().union(*(f.channel_ids for f in filetypes))),
+        len(filetypes),
+        _kb(min(s['size_min'] for s in counters)),
+        _kb(max(s['size_max'] for s in counters)),
+        _kb(sum(s['size_sum'] for s in counters) / count),
+        sum(s['with_text'] for s in counters),
+        _timestamp_date(min(s['created_min'] for s in counters)),
+        _timestamp_date(max(s['created_max'] for s in counters)),
+        sum(s['size_sum'] for s in counters),
+        sum(s.get('physical_size_sum', s['size_sum']) for s in counters))
+    return ReportStats(summary, tuple(filetypes))
+
+
+def stats_from_athena_rows(summary_rows, filetype_rows):
+    """ The typed stats of the rows of the summary and by filetype Athena queries (see fileStatsSlacker.py), the
+    first row of both holds the column names. """
+    def values(row):
+        return [d.get('VarCharValue', '') for d in row['Data']]
+
+    filetypes = list()
+    for row in filetype_rows[1:]:
+        filetype, count, users, channels, avg_kb, with_text, first_date, last_date = values(row)
+        filetypes.append(FiletypeStats(filetype, _number(count, int), _number(users, int), _number(channels, int),
+                                       _number(avg_kb), _number(with_text, int), _athena_date(first_date),
+                                       _athena_date(last_date)))
+    filetypes.sort(key=lambda f: (-f.count, f.filetype))
+    (files, users, channels, filetype_count, min_kb, max_kb, avg_kb, with_text, first_date, last_date, logical_bytes,
+     physical_bytes) = values(summary_rows[1])
+    summary = SummaryStats(_number(files, int), _number(users, int), _number(channels, int),
+                           _number(filetype_count, int), _number(min_kb), _number(max_kb), _number(avg_kb),
+                           _number(with_text, int), _athena_date(first_date), _athena_date(last_date),
+                           _number(logical_bytes, int), _number(physical_bytes, int))
+    return ReportStats(summary, tuple(filetypes))
+
+
+def rows_version(*row_sets):
+    """ A version of Athena rows for the fragment cache: the digest of their content. """
+    return hashlib.sha1(json.dumps(row_sets, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def rollup(filetypes, top_n):
+    """ The `top_n` first filetypes and, when there are more, a row of the other filetypes. The users and channels
+    of the rollup are exact when the distinct ids are known, the largest count of a single filetype otherwise. """
+    if len(filetypes) <= top_n:
+        return list(filetypes)
+    others = filetypes[top_n:]
+    count = sum(f.count for f in others)
+    if all(f.user_ids is not None and f.channel_ids is not None for f in others):
+        users = len(set().union(*(f.user_ids for f in others)))
+        channels = len(set().union(*(f.channel_ids for f in others)))
+    else:
+        users = max(f.users for f in others)
+        channels = max(f.channels for f in others)
+    first_dates = [f.first_date for f in others if f.first_date]
+    last_dates = [f.last_date for f in others if f.last_date]
+    other = FiletypeStats(
+        f"{OTHER_FILETYPES} ({len(others)})", count, users, channels,
+        round(sum(f.avg_kb * f.count for f in others) / count, 2) if count else 0.0,
+        sum(f.with_text for f in others),
+        min(first_dates) if first_dates else None,
+        max(last_dates) if last_dates else None)
+    return list(filetypes[:top_n]) + [other]
+
+
+def _date_text(value):
+    return value.strftime('%m/%d/%Y') if value else ''
+
+
+def _cell(value):
+    text = _date_text(value) if isinstance(value, date) else str(value)
+    return f"`{text.ljust(10)}`"
+
+
+def report_summary(summary):
+    """ Generates some simple markdown text describing the status of all the files in the fileSlackerBot S3 bucket. """
+    return (f"*Summary of All Files*   \n{summary.files} files have been stored in AWS S3 from "
+            f"{summary.users} different users across {summary.channels} "
+            f"slack channels since {_date_text(summary.first_date)}. There are "
+            f"{summary.filetypes} types of files with sizes ranging from "
+            f"{summary.min_kb} kB to {summary.max_kb} kB with an "
+            f"average size of {summary.avg_kb} kB.{report_storage(summary)}")
+
+
+def report_storage(summary):
+    """ The savings of the content-addressed storage: the duplicate uploads are only stored once. """
+    if not summary.logical_bytes:
+        return ''
+    saved = 100 * (summary.logical_bytes - summary.physical_bytes) / summary.logical_bytes
+    return (f" They take {_mb(summary.physical_bytes)} MB in S3 for {_mb(summary.logical_bytes)} MB uploaded, "
+            f"{saved:.1f}% saved by storing duplicate files once.")
+
+
+# the by filetype tables: title, column headers and the columns of a row. They were made intentionally narrow to
+# display better on mobile devices.
+FILETYPE_TABLES = (
+    ("*Counts and Average Size in kB by Filetype*", ('Filetype', 'Count', 'Avg (kB)'),
+     lambda f: (f.filetype, f.count, f.avg_kb)),
+    ("*Count of Users having uploaded files and the number channels used by Filetype*",
+     ('Filetype', '# Users', '# Channels'),
+     lambda f: (f.filetype, f.users, f.channels)),
+    ("*First and Last Upload Dates by Filetype*", ('Filetype', 'First', 'Last'),
+     lambda f: (f.filetype, f.first_date or '', f.last_date or '')),
+)
+
+
+def report_table(title, headers, columns, rows):
+    lines = [f"{title}  ", " ".join(_cell(h) for h in headers) + "  "]
+    lines.extend(" ".join(_cell(v) for v in columns(row)) + "  " for row in rows)
+    return "\n".join(lines)
+
+
+def section(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def render_stats_blocks(stats, top_n=None):
+    """ The summary and the by filetype tables as section blocks. The tables list the `top_n` most uploaded filetypes
+    and roll up the others, fewer are listed when a table would still exceed the section limit (long filetypes). """
+    top_n = REPLY_TOP_FILETYPES if top_n is None else top_n
+    while True:
+        rows = rollup(stats.filetypes, top_n)
+        tables = [report_table(title, headers, columns, rows) for title, headers, columns in FILETYPE_TABLES]
+        if top_n <= 1 or all(len(t) <= SECTION_TEXT_LIMIT for t in tables):
+            break
+        top_n //= 2
+    return [section(truncate(text)) for text in [report_summary(stats.summary)] + tables]
+
+
+def context(text):
+    return {"type": "context", "elements": [{"type": "mrkdwn", "text": text}]}
+
+
+def cached_fragment(key, render):
+    """ The fragment cached for `key` (which includes the stats version), rendered with `render()` on a miss. The
+    cache is kept across warm invocations, a fragment is only rendered again once the stats change. """
+    with _fragments_lock:
+        if key in _fragments:
+            _fragments.move_to_end(key)
+            return _fragments[key]
+    fragment = render()
+    with _fragments_lock:
+        _fragments[key] = fragment
+        while len(_fragments) > FRAGMENT_CACHE_SIZE:
+            _fragments.popitem(last=False)
+    return fragment
+
+
+def truncate(text, limit=SECTION_TEXT_LIMIT):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def split_text(text, limit=SECTION_TEXT_LIMIT):
+    """ Splits `text` in chunks of at most `limit` characters, at a paragraph, line or word break when there is one
+    in the second half of the chunk. """
+    chunks = list()
+    while len(text) > limit:
+        cut = -1
+        for separator in ('\n\n', '\n', ' '):
+            cut = text.rfind(separator, limit // 2, limit)
+            if cut > 0:
+                break
+        cut = cut if cut > 0 else limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def block_size(block):
+    return len(json.dumps(block))
+
+
+def description_blocks(report, limit=SECTION_TEXT_LIMIT):
+    """ The description of a file as sections, the first one titled. """
+    title = "*Description*  \n"
+    chunks = split_text(report.description, limit - len(title)) or ['']
+    return [section(title + chunks[0])] + [section(chunk) for chunk in chunks[1:]]
+
+
+class _Message:
+    def __init__(self, reserved_blocks=0, reserved_chars=0):
+        self.blocks = list()
+        self.block_budget = MESSAGE_BLOCK_LIMIT - reserved_blocks
+        self.char_budget = REPLY_MAX_CHARS - reserved_chars
+
+    def fits(self, blocks):
+        return len(blocks) <= self.block_budget and sum(block_size(b) for b in blocks) <= self.char_budget
+
+    def add(self, blocks):
+        self.blocks.extend(blocks)
+        self.block_budget -= len(blocks)
+        self.char_budget -= sum(block_size(b) for b in blocks)
+
+
+def compose_reply(file_reports, trailing_blocks=()):
+    """ Lays the file reports out in the reply and its follow-ups in the thread. Returns the blocks of the reply and
+    a list of the blocks of every follow-up message, all within the per block and per message budgets.
+
+    The reply lists the upload blocks of every file and the first REPLY_INLINE_DESCRIPTION_SECTIONS sections of its
+    description, as long as the message budget allows after the `trailing_blocks` (the stats). The remaining
+    sections, and the files that don't fit at all, are continued in the thread, in up to REPLY_MAX_FOLLOW_UPS
+    messages. """
+    trailing_blocks = list(trailing_blocks)
+    reply = _Message(len(trailing_blocks), sum(block_size(b) for b in trailing_blocks))
+    continued = list()
+    for report in file_reports:
+        sections = description_blocks(report)
+        inline = sections[:REPLY_INLINE_DESCRIPTION_SECTIONS]
+        rest = sections[REPLY_INLINE_DESCRIPTION_SECTIONS:]
+        # keep room for the note pointing to the thread
+        note = context(f"_The description of `{report.name}` continues in the thread._")
+        while inline and not reply.fits(report.blocks + inline + [note]):
+            rest.insert(0, inline.pop())
+        if not reply.fits(report.blocks + inline + ([note] if rest else [])):
+            continued.append(report.blocks + sections)
+            continue
+        reply.add(report.blocks + inline + ([note] if rest else []))
+        if rest:
+            continued.append([section(f"*Description of `{report.name}` (continued)*")] + rest)
+    follow_ups = pack_messages(continued)
+    if len(follow_ups) > REPLY_MAX_FOLLOW_UPS:
+        follow_ups = follow_ups[:REPLY_MAX_FOLLOW_UPS]
+        note = context("_The descriptions are cut short here, the full analyses are in the metadata in S3._")
+        last = follow_ups[-1]
+        if len(last) >= MESSAGE_BLOCK_LIMIT or block_size(note) + sum(block_size(b) for b in last) > REPLY_MAX_CHARS:
+            last.pop()
+        last.append(note)
+    return reply.blocks + trailing_blocks, follow_ups
+
+
+def shrink_block(block, char_budget):
+    """ The block with its text truncated so that it fits in `char_budget` characters (as counted by `block_size`),
+    for a block too large for a message on its own. """
+    if block_size(block) <= char_budget:
+        return block
+    if block.get('type') == 'section':
+        text, make = block['text']['text'], section
+    elif block.get('type') == 'context':
+        text, make = block['elements'][0]['text'], context
+    else:
+        return block
+
+    def shrunk(length):
+        return make(truncate(text, length) if length > 1 else '')
+
+    # the longest text that fits, the escaped characters count more than one
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if block_size(shrunk(middle)) <= char_budget:
+            low = middle
+        else:
+            high = middle - 1
+    return shrunk(low)
+
+
+def pack_messages(block_groups):
+    """ Packs groups of blocks in as few messages as the budgets allow, a group is only split when it doesn't fit in
+    a message on its own, and a block that doesn't fit in one is truncated. """
+    messages = list()
+    message = _Message()
+    for group in block_groups:
+        for block in ([group] if _Message().fits(group) else [[b] for b in group]):
+            if message.blocks and not message.fits(block):
+                messages.append(message.blocks)
+                message = _Message()
+            if not message.fits(block):
+                block = [shrink_block(b, message.char_budget) for b in block]
+            message.add(block)
+    if message.blocks:
+        messages.append(message.blocks)
+    return messages
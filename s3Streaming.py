@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MB = 1024 * 1024
+# S3 requires every part but the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * MB
+DEFAULT_PART_SIZE = 8 * MB
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+
+@dataclass
+class StreamedObject:
+    """ The result of streaming an object to S3. `body` holds the bytes only when the whole object fit into a single
+    part, so small files can be analyzed without reading them back from S3. """
+    bucket: str
+    key: str
+    size: int
+    sha256: str
+    body: bytes = None
+
+
+def stream_to_s3(s3, chunks, bucket, key, content_type, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_UPLOAD_CONCURRENCY, small_object_key=None):
+    """ Streams an iterable of byte chunks to S3, computing the SHA-256 and byte count on the fly. Objects smaller
+    than a part are sent with a single PUT, larger ones with a multipart upload of up to `max_concurrency` parts in
+    flight. Peak memory is about (max_concurrency + 1) * part_size, whatever the size of the object.
+    Since the SHA-256 of an object smaller than a part is known before its PUT, `small_object_key(sha256)` can give
+    its key instead of `key`, or None to not store it at all (e.g. content already stored). """
+    part_size = max(part_size, MIN_PART_SIZE)
+    sha256 = hashlib.sha256()
+    size = 0
+    buffer = bytearray()
+    upload = None
+
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            sha256.update(chunk)
+            size += len(chunk)
+            buffer += chunk
+            while len(buffer) >= part_size:
+                if upload is None:
+                    upload = _MultipartUpload(s3, bucket, key, content_type, max_concurrency)
+                upload.submit(bytes(buffer[:part_size]))
+                del buffer[:part_size]
+
+        if upload is None:
+            body = bytes(buffer)
+            if small_object_key is not None:
+                key = small_object_key(sha256.hexdigest())
+            if key is not None:
+                s3.put_object(Body=body, Bucket=bucket, Key=key, ContentType=content_type)
+            return StreamedObject(bucket, key, size, sha256.hexdigest(), body)
+
+        if buffer:
+            upload.submit(bytes(buffer))
+        buffer = None
+        upload.complete()
+        return StreamedObject(bucket, key, size, sha256.hexdigest())
+    except BaseException:
+        if upload is not None:
+            upload.abort()
+        raise
+
+
+class _MultipartUpload:
+    """ A multipart upload with a bounded number of parts being uploaded concurrently. `submit` blocks while the
+    maximum number of parts are in flight, which is what keeps the memory bounded. """
+
+    def __init__(self, s3, bucket, key, content_type, max_concurrency):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='s3-part')
+        self.in_flight = threading.BoundedSemaphore(max_concurrency)
+        self.futures = list()
+        logger.debug(f"Started multipart upload {self.upload_id} for {key}")
+
+    def submit(self, data):
+        self.in_flight.acquire()
+        # fail fast instead of uploading the rest of the file after a part failed
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                self.in_flight.release()
+                raise future.exception()
+        part_number = len(self.futures) + 1
+        future = self.executor.submit(self._upload_part, part_number, data)
+        future.add_done_callback(lambda f: self.in_flight.release())
+        self.futures.append(future)
+
+    def _upload_part(self, part_number, data):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def complete(self):
+        parts = [future.result() for future in self.futures]
+        self.executor.shutdown()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': parts})
+        logger.debug(f"Completed multipart upload {self.upload_id} of {len(parts)} parts for {self.key}")
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.error(f"Could not abort the multipart upload {self.upload_id} for {self.key}: {e}")
@@ -0,0 +1,129 @@
+import json
+import logging
+import time
+
+# Incrementally maintained stats of all the files uploaded via fileSlackerBot. The snapshot is a single small JSON
+# object in S3, updated by fileStatsSlacker for every new metadata record and read with one GET for the reply, so
+# the reply doesn't need Athena. Athena only rebuilds it periodically (see `fileStatsSlacker.reconcile_handler`).
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SNAPSHOT_KEY = 'stats/snapshot.json'
+# S3 event notifications are delivered at least once, the recently applied metadata keys make updates idempotent
+MAX_APPLIED_KEYS = 2000
+MAX_UPDATE_ATTEMPTS = 10
+
+
+def empty_snapshot():
+    return {'version': 0, 'updated': None, 'filetypes': dict(), 'applied_keys': list()}
+
+
+def empty_filetype_stats():
+    return {
+        'count': 0,
+        'size_sum': 0,
+        # the bytes of the uploads which were not duplicates of a stored content (see contentStore.py)
+        'physical_size_sum': 0,
+        'size_min': None,
+        'size_max': None,
+        'created_min': None,
+        'created_max': None,
+        'with_text': 0,
+        'users': list(),
+        'channels': list()
+    }
+
+
+def apply_metadata(snapshot, metadata, metadata_key):
+    """ Adds one metadata record to the running counters of its filetype. Returns False when the record was
+    already applied. The distinct users and channels are exact sets, a workspace has few enough of them. """
+    if metadata_key in snapshot['applied_keys']:
+        return False
+    stats = snapshot['filetypes'].setdefault(metadata['filetype'], empty_filetype_stats())
+    size = int(float(metadata['size']))
+    created = int(float(metadata['created']))
+    stats['count'] += 1
+    stats.setdefault('physical_size_sum', stats['size_sum'])
+    stats['size_sum'] += size
+    if not metadata.get('blob_duplicate'):
+        stats['physical_size_sum'] += size
+    stats['size_min'] = size if stats['size_min'] is None else min(stats['size_min'], size)
+    stats['size_max'] = size if stats['size_max'] is None else max(stats['size_max'], size)
+    stats['created_min'] = created if stats['created_min'] is None else min(stats['created_min'], created)
+    stats['created_max'] = created if stats['created_max'] is None else max(stats['created_max'], created)
+    if metadata.get('user_text', '').strip():
+        stats['with_text'] += 1
+    if metadata['user'] not in stats['users']:
+        stats['users'].append(metadata['user'])
+    if metadata['slack_orig_channel'] not in stats['channels']:
+        stats['channels'].append(metadata['slack_orig_channel'])
+    snapshot['applied_keys'].append(metadata_key)
+    del snapshot['applied_keys'][:-MAX_APPLIED_KEYS]
+    return True
+
+
+def load_snapshot(s3, bucket):
+    """ Returns the snapshot and its ETag, or an empty snapshot and None when there is no snapshot yet. """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=SNAPSHOT_KEY)
+    except s3.exceptions.NoSuchKey:
+        return empty_snapshot(), None
+    return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+
+def save_snapshot(s3, bucket, snapshot, etag):
+    """ Saves the snapshot only if nobody else saved it since it was loaded (S3 conditional write). Returns False
+    when the write lost the race. """
+    from botocore.exceptions import ClientError
+    snapshot['version'] += 1
+    snapshot['updated'] = int(time.time())
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        s3.put_object(Body=json.dumps(snapshot, separators=(',', ':')), Bucket=bucket, Key=SNAPSHOT_KEY,
+                      ContentType='application/json', **condition)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+    return True
+
+
+def update_snapshot(s3, bucket, keyed_metadata_records):
+    """ Applies (metadata_key, metadata) pairs to the snapshot with optimistic concurrency: on a concurrent update
+    the snapshot is read again and the records re-applied. Returns the updated snapshot. """
+    for attempt in range(MAX_UPDATE_ATTEMPTS):
+        snapshot, etag = load_snapshot(s3, bucket)
+        changed = [apply_metadata(snapshot, metadata, key) for key, metadata in keyed_metadata_records]
+        if not any(changed):
+            return snapshot
+        if save_snapshot(s3, bucket, snapshot, etag):
+            return snapshot
+        logger.info(f"The stats snapshot was updated concurrently, retrying ({attempt + 1})")
+        time.sleep(0.05 * (attempt + 1))
+    raise Exception(f"Could not update the stats snapshot after {MAX_UPDATE_ATTEMPTS} attempts")
+
+
+def snapshot_from_reconciliation_rows(rows, previous_snapshot):
+    """ Builds a snapshot from the rows of the reconciliation Athena query, see
+    `fileStatsSlacker.get_reconciliation_stats`. The user and channel lists are comma separated. The version and
+    recently applied keys carry on from the previous snapshot. """
+    snapshot = empty_snapshot()
+    snapshot['version'] = previous_snapshot['version']
+    snapshot['applied_keys'] = list(previous_snapshot['applied_keys'])
+    for row in rows[1:]:
+        values = [d.get('VarCharValue', '') for d in row['Data']]
+        (filetype, count, size_sum, physical_size_sum, size_min, size_max, created_min, created_max, with_text, users,
+         channels) = values
+        snapshot['filetypes'][filetype] = {
+            'count': int(count),
+            'size_sum': int(float(size_sum)),
+            'physical_size_sum': int(float(physical_size_sum)),
+            'size_min': int(float(size_min)),
+            'size_max': int(float(size_max)),
+            'created_min': int(float(created_min)),
+            'created_max': int(float(created_max)),
+            'with_text': int(with_text),
+            'users': [u for u in users.split(',') if u],
+            'channels': [c for c in channels.split(',') if c]
+        }
+    return snapshot
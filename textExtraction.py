@@ -0,0 +1,354 @@
+import codecs
+import csv
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+from collections import Counter
+from dataclasses import dataclass
+from dataclasses import field
+
+# Local extraction of the content of text-like files (csv, tsv, json, plain text, source code, xlsx, ...) so they can
+# be summarized with a single chat completion instead of the Assistants file_search pipeline.
+# xlsx support needs `openpyxl`, without it xlsx files are left to the Assistants fallback.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# rough OpenAI token estimate for English text and code
+CHARS_PER_TOKEN = 4
+# JSON documents (not NDJSON) have to be parsed whole, larger ones are sampled as plain text
+MAX_JSON_BYTES = 32 * 1024 * 1024
+# xlsx files need a seekable file, they are spooled to /tmp past this size
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+
+_INT_RE = re.compile(r'[-+]?\d+')
+_FLOAT_RE = re.compile(r'[-+]?(\d+\.\d*|\.\d+|\d+)([eE][-+]?\d+)?')
+_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2})?)?.*|\d{1,2}/\d{1,2}/\d{2,4}')
+_BOOL_VALUES = {'true', 'false', 'yes', 'no'}
+
+
+class ExtractionError(Exception):
+    """ The file could not be extracted locally, the caller should fall back to another analysis. """
+    pass
+
+
+@dataclass
+class Extraction:
+    """ The result of a local extraction. `sample` fits the token budget. When the content doesn't fit, `chunks`
+    holds up to `max_chunks` budget-sized pieces spread over the whole content for a map-reduce summary. """
+    kind: str
+    stats: dict
+    sample: str
+    chunks: list = field(default_factory=list)
+    truncated: bool = False
+
+
+@dataclass
+class _Extractor:
+    name: str
+    mimetypes: tuple
+    extensions: tuple
+    extract: callable
+
+
+_extractors = list()
+
+
+def extractor(name, mimetypes=(), extensions=()):
+    """ Registers an extraction function for the given mimetypes (a trailing `/` matches a whole family, e.g.
+    `text/`) and filename extensions. The function is called with a binary file object and the character budget. """
+    def register(extract):
+        _extractors.insert(0, _Extractor(name, tuple(mimetypes), tuple(extensions), extract))
+        return extract
+    return register
+
+
+def find_extractor(mimetype, filename):
+    """ Finds the extractor for a file, the filename extension wins over the (often generic) Slack mimetype. Returns
+    None when the file can't be extracted locally. """
+    extension = os.path.splitext(filename or '')[1].lower()
+    for e in _extractors:
+        if extension and extension in e.extensions:
+            return e
+    for e in _extractors:
+        if mimetype in e.mimetypes:
+            return e
+    for e in _extractors:
+        if any(m.endswith('/') and mimetype.startswith(m) for m in e.mimetypes):
+            return e
+    return None
+
+
+def extract(fileobj, mimetype, filename, token_budget=6000, max_chunks=8):
+    """ Extracts the content and structural stats of a file, keeping the sample within `token_budget`. Raises
+    ExtractionError when there is no extractor for the file or the content can't be parsed. """
+    e = find_extractor(mimetype, filename)
+    if e is None:
+        raise ExtractionError(f"No extractor for {filename} ({mimetype})")
+    try:
+        extraction = e.extract(fileobj, token_budget * CHARS_PER_TOKEN, max_chunks)
+    except ExtractionError:
+        raise
+    except Exception as err:
+        raise ExtractionError(f"The {e.name} extractor failed on {filename}: {err}") from err
+    extraction.stats['extractor'] = e.name
+    return extraction
+
+
+def _text_lines(fileobj):
+    """ Decodes a binary stream line by line without reading it all, invalid UTF-8 is replaced. """
+    return codecs.getreader('utf-8')(fileobj, errors='replace')
+
+
+class _PrefixedReader:
+    """ A binary reader returning the bytes already read from a stream followed by the rest of the stream. """
+
+    def __init__(self, prefix, rest):
+        self.prefix = memoryview(prefix)
+        self.rest = rest
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = bytes(self.prefix) + self.rest.read()
+            self.prefix = self.prefix[len(self.prefix):]
+            return data
+        if self.prefix:
+            data = bytes(self.prefix[:size])
+            self.prefix = self.prefix[len(data):]
+            return data
+        return self.rest.read(size)
+
+
+def _value_type(value):
+    value = value.strip()
+    if value == '':
+        return None
+    if _INT_RE.fullmatch(value):
+        return 'int'
+    if _FLOAT_RE.fullmatch(value):
+        return 'float'
+    if value.lower() in _BOOL_VALUES:
+        return 'bool'
+    if _DATE_RE.fullmatch(value):
+        return 'date'
+    return 'text'
+
+
+def _column_type(counter):
+    """ The type of a column is the most specific type all its non-empty values have. """
+    types = set(counter)
+    if not types:
+        return 'empty'
+    if types == {'int'}:
+        return 'int'
+    if types <= {'int', 'float'}:
+        return 'float'
+    if len(types) == 1:
+        return types.pop()
+    return 'text'
+
+
+def _delimited(fileobj, char_budget, delimiter):
+    reader = csv.reader(_text_lines(fileobj), delimiter=delimiter)
+    header = next(reader, None)
+    if header is None:
+        raise ExtractionError("The file is empty")
+    type_counters = [Counter() for _ in header]
+    null_counts = [0] * len(header)
+    sample_lines = [delimiter.join(header)]
+    sample_chars = len(sample_lines[0])
+    rows = 0
+    ragged_rows = 0
+    for row in reader:
+        rows += 1
+        if len(row) != len(header):
+            ragged_rows += 1
+        for i, value in enumerate(row[:len(header)]):
+            value_type = _value_type(value)
+            if value_type is None:
+                null_counts[i] += 1
+            # once a column is text nothing will change its type, skip counting its values
+            elif 'text' not in type_counters[i] or len(type_counters[i]) > 1:
+                type_counters[i][value_type] += 1
+        if sample_chars < char_budget:
+            line = delimiter.join(row)
+            sample_chars += len(line) + 1
+            if sample_chars < char_budget:
+                sample_lines.append(line)
+    stats = {
+        'rows': rows,
+        'columns': len(header),
+        'column_types': {name: _column_type(c) for name, c in zip(header, type_counters)},
+        'empty_values': {name: n for name, n in zip(header, null_counts) if n},
+    }
+    if ragged_rows:
+        stats['rows_with_unexpected_column_count'] = ragged_rows
+    return Extraction('table', stats, "\n".join(sample_lines), truncated=len(sample_lines) - 1 < rows)
+
+
+@extractor('csv', mimetypes=('text/csv', 'application/csv'), extensions=('.csv',))
+def extract_csv(fileobj, char_budget, max_chunks):
+    return _delimited(fileobj, char_budget, ',')
+
+
+@extractor('tsv', mimetypes=('text/tab-separated-values',), extensions=('.tsv', '.tab'))
+def extract_tsv(fileobj, char_budget, max_chunks):
+    return _delimited(fileobj, char_budget, '\t')
+
+
+@extractor('ndjson', mimetypes=('application/x-ndjson', 'application/jsonl'), extensions=('.ndjson', '.jsonl'))
+def extract_ndjson(fileobj, char_budget, max_chunks):
+    records = 0
+    invalid = 0
+    keys = Counter()
+    sample_lines = list()
+    sample_chars = 0
+    for line in _text_lines(fileobj):
+        line = line.strip()
+        if not line:
+            continue
+        records += 1
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            invalid += 1
+            continue
+        if isinstance(record, dict):
+            keys.update(record.keys())
+        if sample_chars + len(line) < char_budget:
+            sample_chars += len(line) + 1
+            sample_lines.append(line)
+    stats = {'records': records, 'invalid_records': invalid, 'keys': dict(keys.most_common(50))}
+    return Extraction('json', stats, "\n".join(sample_lines), truncated=len(sample_lines) < records)
+
+
+def _json_shape(value, depth=0):
+    """ A short description of the structure of a JSON value. """
+    if isinstance(value, dict):
+        if depth >= 2:
+            return f'object({len(value)} keys)'
+        return {k: _json_shape(v, depth + 1) for k, v in list(value.items())[:30]}
+    if isinstance(value, list):
+        return [f'{len(value)} items', _json_shape(value[0], depth + 1)] if value else []
+    return type(value).__name__
+
+
+@extractor('json', mimetypes=('application/json',), extensions=('.json', '.geojson'))
+def extract_json(fileobj, char_budget, max_chunks):
+    content = fileobj.read(MAX_JSON_BYTES + 1)
+    if len(content) > MAX_JSON_BYTES:
+        logger.info(f"The JSON document is larger than {MAX_JSON_BYTES} bytes, extracting it as text")
+        return extract_text(_PrefixedReader(content, fileobj), char_budget, max_chunks)
+    document = json.loads(content.decode('utf-8', errors='replace'))
+    stats = {'top_level_type': type(document).__name__, 'shape': _json_shape(document)}
+    if isinstance(document, (list, dict)):
+        stats['top_level_length'] = len(document)
+    sample = json.dumps(document, indent=1, default=str)
+    return Extraction('json', stats, sample[:char_budget], truncated=len(sample) > char_budget)
+
+
+@extractor('text', mimetypes=('text/', 'application/xml', 'application/x-yaml', 'application/javascript',
+                              'application/x-sh', 'application/sql', 'application/toml'),
+           extensions=('.txt', '.md', '.rst', '.log', '.ini', '.cfg', '.conf', '.toml', '.yaml', '.yml', '.xml',
+                       '.html', '.htm', '.css', '.py', '.js', '.ts', '.tsx', '.jsx', '.java', '.kt', '.scala',
+                       '.go', '.rs', '.rb', '.php', '.c', '.h', '.cpp', '.hpp', '.cs', '.swift', '.sh', '.bash',
+                       '.sql', '.r', '.m', '.pl', '.lua', '.tf', '.dockerfile'))
+def extract_text(fileobj, char_budget, max_chunks):
+    """ Plain text and source code. The text is cut in budget-sized chunks on line boundaries and a reservoir of
+    `max_chunks` chunks (in document order, always starting with the first one) is kept, so memory is bounded whatever
+    the file size. """
+    lines = 0
+    words = 0
+    chars = 0
+    longest_line = 0
+    chunk_count = 0
+    reservoir = list()
+    current = list()
+    current_chars = 0
+    rng = random.Random(0)
+
+    def keep(chunk_index, text):
+        # the first chunk (title, imports, headings, ...) is always kept, the others are sampled
+        if len(reservoir) < max_chunks:
+            reservoir.append((chunk_index, text))
+        else:
+            slot = rng.randint(1, chunk_index)
+            if slot < max_chunks:
+                reservoir[slot] = (chunk_index, text)
+
+    for line in _text_lines(fileobj):
+        lines += 1
+        words += len(line.split())
+        chars += len(line)
+        longest_line = max(longest_line, len(line))
+        if current_chars + len(line) > char_budget and current:
+            keep(chunk_count, "".join(current))
+            chunk_count += 1
+            current = list()
+            current_chars = 0
+        current.append(line[:char_budget])
+        current_chars += min(len(line), char_budget)
+    if current:
+        keep(chunk_count, "".join(current))
+        chunk_count += 1
+    if chunk_count == 0:
+        raise ExtractionError("The file is empty")
+    reservoir.sort()
+    stats = {'lines': lines, 'words': words, 'characters': chars, 'longest_line': longest_line}
+    if chunk_count == 1:
+        return Extraction('text', stats, reservoir[0][1])
+    stats['chunks'] = chunk_count
+    return Extraction('text', stats, reservoir[0][1], chunks=[text for _, text in reservoir], truncated=True)
+
+
+@extractor('xlsx', mimetypes=('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',),
+           extensions=('.xlsx', '.xlsm'))
+def extract_xlsx(fileobj, char_budget, max_chunks):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ExtractionError("openpyxl is not installed")
+    # the zip directory is at the end of the file, so it has to be seekable
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES) as spool:
+        while chunk := fileobj.read(1024 * 1024):
+            spool.write(chunk)
+        spool.seek(0)
+        workbook = load_workbook(spool, read_only=True, data_only=True)
+        sheets = dict()
+        sample_parts = list()
+        truncated = False
+        sheet_budget = char_budget // max(1, len(workbook.sheetnames))
+        for sheet in workbook.worksheets:
+            rows = 0
+            type_counters = None
+            header = None
+            sample_lines = list()
+            sample_chars = 0
+            for row in sheet.iter_rows(values_only=True):
+                values = ['' if v is None else str(v) for v in row]
+                if header is None:
+                    header = values
+                    type_counters = [Counter() for _ in header]
+                    sample_lines.append(",".join(values))
+                    continue
+                rows += 1
+                for i, value in enumerate(row[:len(header)]):
+                    if value is not None:
+                        type_counters[i][type(value).__name__] += 1
+                line = ",".join(values)
+                if sample_chars + len(line) < sheet_budget:
+                    sample_chars += len(line) + 1
+                    sample_lines.append(line)
+            truncated = truncated or len(sample_lines) - 1 < rows
+            sheets[sheet.title] = {
+                'rows': rows,
+                'columns': len(header or []),
+                'column_types': {name: '/'.join(sorted(c)) or 'empty'
+                                 for name, c in zip(header or [], type_counters or [])}
+            }
+            sample_parts.append(f"# sheet {sheet.title}\n" + "\n".join(sample_lines))
+        workbook.close()
+    stats = {'sheets': sheets}
+    return Extraction('table', stats, "\n\n".join(sample_parts), truncated=truncated)
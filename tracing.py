@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+# Per-stage timing spans of the ingest (fileSlacker) and reply (fileStatsSlacker) pipelines. Every finished span is
+# written to stdout as a single JSON line carrying its duration and attributes (bytes, file size, mimetype, cache hit,
+# ...), or in the CloudWatch embedded metric format (EMF) so CloudWatch also extracts them as metrics. Set env var
+# TRACING_ENABLED to true to emit the spans and TRACING_FORMAT to `json` (default) or `emf`. When disabled `span`
+# returns a shared no-op object, the instrumented code pays for a function call and an attribute check.
+# `python benchmarks/spanStats.py <log files>` aggregates the spans into p50/p95/p99 per stage.
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'false').lower() == 'true'
+TRACING_FORMAT = os.environ.get('TRACING_FORMAT', 'json').lower()
+EMF_NAMESPACE = os.environ.get('TRACING_EMF_NAMESPACE', 'fileSlackerBot')
+# attributes reported as EMF metrics (with their unit), every other attribute is only a property of the log line
+EMF_METRICS = {'duration_ms': 'Milliseconds', 'bytes': 'Bytes', 'size': 'Bytes', 'retries': 'Count'}
+
+_trace = threading.local()
+_write_lock = threading.Lock()
+
+
+class _NoopSpan:
+    """ The span returned when tracing is disabled. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attributes):
+        return self
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """ Times the enclosed block, `set` adds attributes known only during the stage (e.g. the bytes transferred). """
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration_ms = round((time.perf_counter() - self.start) * 1000, 3)
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        _emit(self.stage, duration_ms, self.attributes)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+
+def span(stage, **attributes):
+    """ A span for the stage `stage`, used as a context manager. """
+    if not TRACING_ENABLED:
+        return _NOOP_SPAN
+    return Span(stage, attributes)
+
+
+def start_trace(handler, trace_id=None):
+    """ Starts the trace of a handler invocation, the spans of the invocation carry its handler name and trace id.
+    The trace is per thread, `current_trace`/`resume_trace` carry it over to the worker threads. """
+    _trace.context = {'handler': handler, 'trace_id': trace_id or uuid.uuid4().hex[:16]}
+    return _trace.context
+
+
+def current_trace():
+    return getattr(_trace, 'context', None)
+
+
+def resume_trace(context):
+    _trace.context = context
+
+
+def set_trace_id(trace_id):
+    """ Replaces the trace id once it is known, e.g. the Slack event id after parsing the event. """
+    context = current_trace()
+    if context is not None:
+        context['trace_id'] = trace_id
+
+
+def _emit(stage, duration_ms, attributes):
+    record = dict(current_trace() or {})
+    record.update(attributes)
+    record.update({'span': stage, 'duration_ms': duration_ms})
+    if TRACING_FORMAT == 'emf':
+        metrics = [{'Name': name, 'Unit': unit} for name, unit in EMF_METRICS.items()
+                   if isinstance(record.get(name), (int, float)) and not isinstance(record.get(name), bool)]
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': EMF_NAMESPACE, 'Dimensions': [['span']], 'Metrics': metrics}]
+        }
+    line = json.dumps(record, default=str, separators=(',', ':'))
+    with _write_lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+class lazy_json:
+    """ Defers `json.dumps` to when a log record is actually formatted, e.g.
+    `logger.debug("event: %s", lazy_json(event))` costs nothing when debug logging is off. """
+
+    def __init__(self, value, **kwargs):
+        self.value = value
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return json.dumps(self.value, default=str, **self.kwargs)
+
+
+def with_current_trace(fn):
+    """ Wraps `fn` to run in the trace of the calling thread, for the functions submitted to a thread pool. """
+    context = current_trace()
+
+    def run(*args, **kwargs):
+        resume_trace(context)
+        return fn(*args, **kwargs)
+    return run
@@ -0,0 +1,258 @@
+import email.utils
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from tracing import span
+
+# The retry/backoff policy shared by the calls to Slack, OpenAI and S3, and per-endpoint latency and retry counters.
+# Transient failures (429, 5xx, connection errors and timeouts) are retried with exponential backoff and full jitter,
+# a Retry-After header sent with a rate limit is honored. boto3 clients retry by themselves (adaptive mode, see
+# `aws_config`), their calls are only counted. Set env var ENDPOINT_STATS_LOGGING_ENABLED to false to not log the
+# counters after every invocation.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY_SECONDS = float(os.environ.get('RETRY_BASE_DELAY_SECONDS', '0.5'))
+RETRY_MAX_DELAY_SECONDS = float(os.environ.get('RETRY_MAX_DELAY_SECONDS', '20'))
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+# matched against the class hierarchy so requests, httpx and openai don't need to be imported here
+TRANSIENT_ERRORS = frozenset(('ConnectionError', 'TimeoutError', 'Timeout', 'ChunkedEncodingError',
+                              'APIConnectionError', 'APITimeoutError', 'TransportError'))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '16'))
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '32'))
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+ENDPOINT_STATS_LOGGING_ENABLED = os.environ.get('ENDPOINT_STATS_LOGGING_ENABLED', 'true').lower() == 'true'
+
+_stats = dict()
+_stats_lock = threading.Lock()
+
+
+class HttpStatusError(Exception):
+    """ An unsuccessful HTTP response, retried when its status is transient. """
+
+    def __init__(self, status_code, message, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def _status_and_headers(error):
+    """ The HTTP status and headers of an error raised by requests, slack_sdk, openai or this module. """
+    response = getattr(error, 'response', None)
+    status = getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+    headers = getattr(error, 'headers', None) or getattr(response, 'headers', None) or {}
+    return status, headers
+
+
+def is_transient(error):
+    status, _ = _status_and_headers(error)
+    if status is not None:
+        return status in RETRY_STATUSES
+    return any(c.__name__ in TRANSIENT_ERRORS for c in type(error).__mro__)
+
+
+def is_throttle(error):
+    """ Whether the error is a rate limit (429). """
+    status, _ = _status_and_headers(error)
+    return status == 429
+
+
+def throttle_retry_after(error):
+    """ The Retry-After delay of a rate limit error, in seconds. None without the header. """
+    _, headers = _status_and_headers(error)
+    return retry_after_seconds(headers)
+
+
+def retry_after_seconds(headers):
+    """ The delay asked for by a Retry-After header, in seconds or as an HTTP date. None without the header. """
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """ Full jitter exponential backoff, or the Retry-After delay when the server sent one. """
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY_SECONDS)
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+
+def call_with_retries(endpoint, fn, *args, max_attempts=None, retry_throttles=True, **kwargs):
+    """ Calls `fn(*args, **kwargs)`, retrying transient failures, rate limits only with `retry_throttles` (the OpenAI
+    rate limiter queues them again instead, see openaiLimits.py). The latency, retries and failures are counted for
+    `endpoint`. """
+    max_attempts = max_attempts or RETRY_MAX_ATTEMPTS
+    attempt = 0
+    with span(endpoint) as endpoint_span:
+        while True:
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+                record_call(endpoint, time.perf_counter() - start, retries=attempt)
+                endpoint_span.set(retries=attempt)
+                return result
+            except Exception as e:
+                if attempt + 1 >= max_attempts or not is_transient(e) or (not retry_throttles and is_throttle(e)):
+                    record_call(endpoint, time.perf_counter() - start, retries=attempt, failed=True)
+                    endpoint_span.set(retries=attempt)
+                    raise
+                _, headers = _status_and_headers(e)
+                delay = backoff_delay(attempt, retry_after_seconds(headers))
+                logger.warning(f"Retrying {endpoint} in {delay:.2f}s (attempt {attempt + 1} of {max_attempts}): {e}")
+                record_call(endpoint, time.perf_counter() - start, counted=False)
+                time.sleep(delay)
+                attempt += 1
+
+
+class TokenBucket:
+    """ Allows `rate` acquisitions per second on average, with bursts of up to `capacity`. """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """ Takes the tokens, possibly into debt, and returns how long to wait in seconds before using them. """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, tokens=1):
+        time.sleep(self.reserve(tokens))
+
+    def try_acquire(self, tokens=1):
+        """ Takes the tokens only when they are available right away, never waits. """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def refund(self, tokens=1):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+
+class KeyedRateLimiter:
+    """ A token bucket per key, e.g. per Slack channel. The buckets are kept across warm invocations, the least
+    recently created ones are dropped past `max_keys`. """
+
+    def __init__(self, rate, capacity, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    del self._buckets[next(iter(self._buckets))]
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            return bucket
+
+    def acquire(self, key, tokens=1):
+        self.bucket(key).acquire(tokens)
+
+    def try_acquire(self, key, tokens=1):
+        return self.bucket(key).try_acquire(tokens)
+
+    def refund(self, key, tokens=1):
+        self.bucket(key).refund(tokens)
+
+
+def record_call(endpoint, seconds, retries=0, failed=False, counted=True):
+    """ Adds a call to the counters of `endpoint`. An attempt that is retried only adds its latency. """
+    with _stats_lock:
+        stats = _stats.setdefault(endpoint, {'calls': 0, 'retries': 0, 'failures': 0, 'latency_ms': 0.0,
+                                             'max_latency_ms': 0.0})
+        stats['latency_ms'] += seconds * 1000
+        if counted:
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['failures'] += 1 if failed else 0
+            stats['max_latency_ms'] = max(stats['max_latency_ms'], seconds * 1000)
+
+
+def endpoint_stats(reset=False):
+    """ The counters per endpoint, the latency includes the retried attempts (but not the backoff sleeps). """
+    with _stats_lock:
+        stats = {endpoint: dict(s, latency_ms=round(s['latency_ms'], 2), max_latency_ms=round(s['max_latency_ms'], 2),
+                                avg_latency_ms=round(s['latency_ms'] / s['calls'], 2) if s['calls'] else 0.0)
+                 for endpoint, s in _stats.items()}
+        if reset:
+            _stats.clear()
+    return stats
+
+
+def log_endpoint_stats(handler):
+    """ Logs the counters of the invocation as a single JSON line and resets them. """
+    stats = endpoint_stats(reset=True)
+    if ENDPOINT_STATS_LOGGING_ENABLED and stats:
+        logger.info(json.dumps({'endpoint_stats': handler, 'endpoints': stats}))
+
+
+def aws_config(botocore_config):
+    """ The botocore `Config` of the boto3 clients: a connection pool sized for the concurrent file ingests and the
+    adaptive retry mode, which also rate limits the client on throttling errors. """
+    return botocore_config.Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        retries={'mode': 'adaptive', 'max_attempts': AWS_MAX_ATTEMPTS},
+        tcp_keepalive=True)
+
+
+def count_boto3_calls(service, client):
+    """ Counts the calls of a boto3 client with its event hooks, the retries are the ones botocore made. """
+    def before_call(model, context, **kwargs):
+        context['transport_call'] = (f"{service}.{model.name}", time.perf_counter())
+
+    def after_call(context, parsed=None, http_response=None, **kwargs):
+        if 'transport_call' in context:
+            endpoint, start = context.pop('transport_call')
+            retries = ((parsed or {}).get('ResponseMetadata') or {}).get('RetryAttempts', 0)
+            failed = http_response is not None and http_response.status_code >= 300
+            record_call(endpoint, time.perf_counter() - start, retries=retries, failed=failed)
+
+    def after_call_error(context, **kwargs):
+        if 'transport_call' in context:
+            endpoint, start = context.pop('transport_call')
+            record_call(endpoint, time.perf_counter() - start, failed=True)
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call_error)
+    return client
+
+
+def pooled_session(requests_module):
+    """ A requests Session keeping up to HTTP_POOL_SIZE connections alive per host. Retries are left to
+    `call_with_retries`. """
+    session = requests_module.Session()
+    adapter = requests_module.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session